@@ -18,6 +18,7 @@ cdef class RedisParser:
     cdef object _encoding
     cdef object _inbuffer
     cdef Task _current
+    cdef object _error
 
     def __cinit__(self, object perr, object rerr):
         self._protocolError = perr
@@ -33,11 +34,27 @@ cdef class RedisParser:
 
     # DECODER
     def get(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
         if self._current:
             return self._resume(self._current, False)
         else:
             return self._get(None)
 
+    def get_all(self):
+        cdef list messages = []
+        try:
+            message = self.get()
+            while message is not False:
+                messages.append(message)
+                message = self.get()
+        except Exception as exc:
+            if not messages:
+                raise
+            self._error = exc
+        return messages
+
     def feed(self, stream):
         self._inbuffer.extend(stream)
 
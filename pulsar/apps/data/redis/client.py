@@ -1,5 +1,7 @@
 from itertools import chain
+from collections import deque
 import datetime
+import asyncio
 
 import pulsar
 from pulsar.utils.pep import to_string
@@ -10,6 +12,12 @@ from .pubsub import RedisPubSub
 
 str_or_bytes = (bytes, str)
 
+try:
+    from builtins import StopAsyncIteration
+except ImportError:     # pragma    nocover
+    class StopAsyncIteration(Exception):
+        '''Python 3.4 has no asynchronous iteration protocol.'''
+
 INVERSE_COMMANDS_INFO = dict(((i.method_name, i.name)
                               for i in COMMANDS_INFO.values()))
 
@@ -71,7 +79,7 @@ def parse_info(response):
             sub_dict = {}
             for item in value.split(','):
                 k, v = item.rsplit('=', 1)
-                sub_dict[k] = get_value(v)
+                sub_dict[k.strip()] = get_value(v)
             return sub_dict
 
     for line in response.splitlines():
@@ -114,8 +122,8 @@ class Consumer(pulsar.ProtocolConsumer):
 
     RESPONSE_CALLBACKS = dict_merge(
         string_keys_to_dict(
-            'BGSAVE FLUSHALL FLUSHDB HMSET LSET LTRIM MSET RENAME RESTORE '
-            'SAVE SELECT SHUTDOWN SLAVEOF SET WATCH UNWATCH',
+            'BGSAVE FLUSHALL FLUSHDB HMSET LSET LTRIM MSET PFMERGE RENAME '
+            'RESTORE SAVE SELECT SHUTDOWN SLAVEOF SET WATCH UNWATCH',
             lambda r: r == b'OK'
         ),
         string_keys_to_dict('SORT', sort_return_tuples),
@@ -123,7 +131,8 @@ class Consumer(pulsar.ProtocolConsumer):
         string_keys_to_dict('SMEMBERS SDIFF SINTER SUNION', set),
         string_keys_to_dict('INCRBYFLOAT HINCRBYFLOAT ZINCRBY ZSCORE',
                             lambda v: float(v) if v is not None else v),
-        string_keys_to_dict('ZRANGE ZRANGEBYSCORE ZREVRANGE ZREVRANGEBYSCORE',
+        string_keys_to_dict('ZDIFF ZRANGE ZRANGEBYSCORE ZREVRANGE '
+                            'ZREVRANGEBYSCORE',
                             values_to_zset),
         string_keys_to_dict('EXISTS EXPIRE EXPIREAT PEXPIRE PEXPIREAT '
                             'PERSIST RENAMENX',
@@ -170,9 +179,9 @@ class Consumer(pulsar.ProtocolConsumer):
                     self.finished(response)
             else:   # pipeline
                 commands, raise_on_error, responses = request
-                while response is not False:
+                if response is not False:
                     responses.append(response)
-                    response = parser.get()
+                    responses.extend(parser.get_all())
                 if len(responses) == len(commands):
                     error = None
                     result = responses[-1]
@@ -193,6 +202,68 @@ class Consumer(pulsar.ProtocolConsumer):
             self.finished(exc=exc)
 
 
+class ScanIterator:
+    '''Asynchronous iterator over the elements returned by the ``SCAN``,
+    ``HSCAN``, ``SSCAN`` and ``ZSCAN`` commands.
+
+    Elements are keys or set members, ``(field, value)`` pairs for hashes
+    and ``(member, score)`` pairs for sorted sets. With python 3.5::
+
+        async for key in client.scan_iter(match='user:*'):
+            ...
+
+    With python 3.4 call the :meth:`next` coroutine until it returns
+    ``None``.
+    '''
+    def __init__(self, client, command, key=None, match=None, count=None,
+                 type=None):
+        self.client = client
+        self.command = command
+        self.args = args = []
+        if key is not None:
+            args.append(key)
+        if match is not None:
+            args.extend(('MATCH', match))
+        if count is not None:
+            args.extend(('COUNT', count))
+        if type is not None:
+            args.extend(('TYPE', type))
+        self._cursor = None
+        self._elements = deque()
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        element = yield from self.next()
+        if element is None:
+            raise StopAsyncIteration
+        return element
+
+    @asyncio.coroutine
+    def next(self):
+        '''The next element or ``None`` once the iteration is complete.'''
+        elements = self._elements
+        while not elements:
+            if self._cursor == 0:
+                return
+            args = list(self.args)
+            args.insert(1 if self.command != 'scan' else 0, self._cursor or 0)
+            cursor, result = yield from self.client.execute(self.command,
+                                                            *args)
+            self._cursor = int(cursor)
+            if self.command == 'hscan':
+                it = iter(result)
+                elements.extend(zip(it, it))
+            elif self.command == 'zscan':
+                it = iter(result)
+                elements.extend(((m, float(s)) for m, s in zip(it, it)))
+            else:
+                elements.extend(result)
+        return elements.popleft()
+
+
 class RedisClient(object):
     '''Client for :class:`.RedisStore`.
 
@@ -221,6 +292,12 @@ class RedisClient(object):
 
     # special commands
 
+    # KEYS
+    def scan_iter(self, match=None, count=None, type=None):
+        '''Asynchronous iterator over keys, see :class:`.ScanIterator`.'''
+        return ScanIterator(self, 'scan', match=match, count=count,
+                            type=type)
+
     # STRINGS
     def decrby(self, key, ammount=None):
         if ammount is None:
@@ -279,6 +356,11 @@ class RedisClient(object):
         [args.extend(pair) for pair in mapping_iterator(iterable)]
         return self.execute('hmset', key, *args)
 
+    def hscan_iter(self, key, match=None, count=None):
+        '''Asynchronous iterator over ``(field, value)`` pairs of the hash
+        at ``key``.'''
+        return ScanIterator(self, 'hscan', key, match, count)
+
     # LISTS
     def blpop(self, keys, timeout=0):
         if timeout is None:
@@ -305,6 +387,11 @@ class RedisClient(object):
             timeout = 0
         return self.execute_command('BRPOPLPUSH', src, dst, timeout)
 
+    # SETS
+    def sscan_iter(self, key, match=None, count=None):
+        '''Asynchronous iterator over members of the set at ``key``.'''
+        return ScanIterator(self, 'sscan', key, match, count)
+
     # SORTED SETS
     def zadd(self, name, *args, **kwargs):
         """
@@ -335,6 +422,16 @@ class RedisClient(object):
             pieces.append(pair[0])
         return self.execute_command('ZADD', name, *pieces)
 
+    def zdiff(self, keys, withscores=False):
+        if withscores:
+            return self.execute_command('ZDIFF', len(keys), *keys,
+                                        b'WITHSCORES', withscores=True)
+        else:
+            return self.execute_command('ZDIFF', len(keys), *keys)
+
+    def zdiffstore(self, des, keys):
+        return self.execute_command('ZDIFFSTORE', des, len(keys), *keys)
+
     def zinterstore(self, des, keys, weights=None, aggregate=None):
         numkeys = len(keys)
         pieces = list(keys)
@@ -364,6 +461,20 @@ class RedisClient(object):
         else:
             return self.execute_command('ZRANGE', key, start, stop)
 
+    def zrangestore(self, des, key, start, stop, byscore=False, rev=False,
+                    offset=None, count=None):
+        pieces = []
+        if byscore:
+            pieces.append(b'BYSCORE')
+        if rev:
+            pieces.append(b'REV')
+        if offset is not None:
+            pieces.append(b'LIMIT')
+            pieces.append(offset)
+            pieces.append(count)
+        return self.execute_command('ZRANGESTORE', des, key, start, stop,
+                                    *pieces)
+
     def zrangebyscore(self, key, min, max, withscores=False, offset=None,
                       count=None):
         pieces = []
@@ -395,6 +506,11 @@ class RedisClient(object):
         return self.execute_command('ZREVRANGEBYSCORE', key, min, max, *pieces,
                                     withscores=withscores)
 
+    def zscan_iter(self, key, match=None, count=None):
+        '''Asynchronous iterator over ``(member, score)`` pairs of the sorted
+        set at ``key``.'''
+        return ScanIterator(self, 'zscan', key, match, count)
+
     def eval(self, script, keys=None, args=None):
         return self._eval('eval', script, keys, args)
 
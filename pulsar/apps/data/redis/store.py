@@ -1,14 +1,22 @@
 from functools import partial
 
-from pulsar import Connection, Pool, get_actor
+from pulsar import Connection, Pool, get_actor, asyncio
 from pulsar.utils.pep import to_string
 from pulsar.apps.data import RemoteStore
-from pulsar.apps.ds import redis_parser
+from pulsar.apps.ds import (redis_parser, RedisError, MovedError,
+                            COMMANDS_INFO)
+from pulsar.apps.ds.cluster import SLOTS, key_slot, command_keys
 
 from .client import RedisClient, Pipeline, Consumer, ResponseError
 from .pubsub import RedisPubSub
 
 
+# Multi-key commands split into one command for each shard, with the number
+# of arguments for each key
+SPLIT_COMMANDS = {'mget': 1, 'mset': 2, 'del': 1}
+MAX_REDIRECTIONS = 5
+
+
 class RedisStoreConnection(Connection):
 
     def __init__(self, *args, **kw):
@@ -34,12 +42,19 @@ class RedisStoreConnection(Connection):
 
 class RedisStore(RemoteStore):
     '''Redis :class:`.Store` implementation.
+
+    When the ``cluster`` parameter is true, for example with the
+    ``pulsar://127.0.0.1:6410?cluster=1`` url, the store routes commands to
+    the shard owning the slot of their keys. Each shard has its own
+    connection pool. Multi-key ``MGET``, ``MSET`` and ``DEL`` commands and
+    pipelines are split into one request for each shard, pipelines are
+    therefore transactional within each shard only.
     '''
     protocol_factory = partial(RedisStoreConnection, Consumer)
     supported_queries = frozenset(('filter', 'exclude'))
 
     def _init(self, namespace=None, parser_class=None, pool_size=50,
-              decode_responses=False, **kwargs):
+              decode_responses=False, cluster=False, **kwargs):
         self._decode_responses = decode_responses
         if not parser_class:
             actor = get_actor()
@@ -49,6 +64,12 @@ class RedisStore(RemoteStore):
         if namespace:
             self._urlparams['namespace'] = namespace
         self._pool = Pool(self.connect, pool_size=pool_size, loop=self._loop)
+        self._cluster = str(cluster).lower() in ('1', 'true', 'yes')
+        if self._cluster:
+            self._urlparams['cluster'] = 1
+        # address of the shard owning each hash slot and pool of each shard
+        self._slots = None
+        self._shard_pools = {}
         if self._database is None:
             self._database = 0
         self._database = int(self._database)
@@ -83,26 +104,34 @@ class RedisStore(RemoteStore):
         return self.client().ping()
 
     def execute(self, *args, **options):
+        if self._cluster:
+            result = yield from self._execute_cluster(args, options)
+            return result
         connection = yield from self._pool.connect()
         with connection:
             result = yield from connection.execute(*args, **options)
             return result
 
     def execute_pipeline(self, commands, raise_on_error=True):
+        if self._cluster:
+            result = yield from self._execute_pipeline_cluster(
+                commands, raise_on_error)
+            return result
         conn = yield from self._pool.connect()
         with conn:
             result = yield from conn.execute_pipeline(commands, raise_on_error)
             return result
 
-    def connect(self, protocol_factory=None):
+    def connect(self, protocol_factory=None, address=None):
         protocol_factory = protocol_factory or self.create_protocol
-        if isinstance(self._host, tuple):
-            host, port = self._host
+        address = address or self._host
+        if isinstance(address, tuple):
+            host, port = address
             transport, connection = yield from self._loop.create_connection(
                 protocol_factory, host, port)
         else:
             raise NotImplementedError('Could not connect to %s' %
-                                      str(self._host))
+                                      str(address))
         if self._password:
             yield from connection.execute('AUTH', self._password)
         if self._database:
@@ -110,10 +139,14 @@ class RedisStore(RemoteStore):
         return connection
 
     def flush(self):
+        if self._cluster:
+            return self._execute_shards('flushdb')
         return self.execute('flushdb')
 
     def close(self):
         '''Close all open connections.'''
+        for pool in self._shard_pools.values():
+            pool.close()
         return self._pool.close()
 
     def has_query(self, query_type):
@@ -124,6 +157,122 @@ class RedisStore(RemoteStore):
         postfix = ':'.join((to_string(p) for p in args if p is not None))
         return '%s:%s' % (key, postfix) if postfix else key
 
+    #    CLUSTER
+    def _execute_cluster(self, args, options):
+        info = COMMANDS_INFO.get(to_string(args[0]).lower())
+        keys = command_keys(info, args) if info else ()
+        step = SPLIT_COMMANDS.get(info.name) if info else None
+        if step and len(keys) > 1:
+            slots = yield from self._cluster_slots()
+            if len(set((slots[key_slot(key)] for key in keys))) > 1:
+                result = yield from self._execute_split(args, options, step)
+                return result
+        for redirection in range(MAX_REDIRECTIONS):
+            if keys:
+                slots = yield from self._cluster_slots()
+                address = slots[key_slot(keys[0])]
+            else:
+                address = self._host
+            connection = yield from self._shard_pool(address).connect()
+            try:
+                with connection:
+                    result = yield from connection.execute(*args, **options)
+                    return result
+            except MovedError:
+                # the shards changed, reload the slots
+                self._slots = None
+        raise RedisError('Too many cluster redirections')
+
+    def _execute_split(self, args, options, step):
+        slots = yield from self._cluster_slots()
+        shards = {}
+        for index in range(1, len(args), step):
+            address = slots[key_slot(args[index])]
+            if address not in shards:
+                shards[address] = ([], [args[0]])
+            positions, request = shards[address]
+            positions.append(index)
+            request.extend(args[index:index+step])
+        results = yield from asyncio.gather(*[
+            self._execute_cluster(request, options)
+            for _, request in shards.values()], loop=self._loop)
+        command = to_string(args[0]).lower()
+        if command == 'mget':
+            response = [None]*(len(args) - 1)
+            for (positions, _), values in zip(shards.values(), results):
+                for index, value in zip(positions, values):
+                    response[index-1] = value
+            return response
+        elif command == 'del':
+            return sum(results)
+        else:
+            return all(results)
+
+    def _execute_pipeline_cluster(self, commands, raise_on_error):
+        slots = yield from self._cluster_slots()
+        multi, commit = commands[0], commands[-1]
+        commands = commands[1:-1]
+        shards = {}
+        for index, command in enumerate(commands):
+            args = command[0]
+            info = COMMANDS_INFO.get(to_string(args[0]).lower())
+            keys = command_keys(info, args) if info else ()
+            address = slots[key_slot(keys[0])] if keys else self._host
+            if address not in shards:
+                shards[address] = ([], [multi])
+            positions, pipeline = shards[address]
+            positions.append(index)
+            pipeline.append(command)
+        results = yield from asyncio.gather(*[
+            self._execute_pipeline_shard(address, pipeline + [commit],
+                                         raise_on_error)
+            for address, (_, pipeline) in shards.items()], loop=self._loop)
+        response = [None]*len(commands)
+        for (positions, _), values in zip(shards.values(), results):
+            for index, value in zip(positions, values):
+                response[index] = value
+        return response
+
+    def _execute_pipeline_shard(self, address, commands, raise_on_error):
+        conn = yield from self._shard_pool(address).connect()
+        with conn:
+            result = yield from conn.execute_pipeline(commands, raise_on_error)
+            return result
+
+    def _execute_shards(self, *args):
+        slots = yield from self._cluster_slots()
+        results = []
+        for address in sorted(set(slots)):
+            connection = yield from self._shard_pool(address).connect()
+            with connection:
+                result = yield from connection.execute(*args)
+                results.append(result)
+        return results
+
+    def _cluster_slots(self):
+        if self._slots is None:
+            connection = yield from self._pool.connect()
+            with connection:
+                shards = yield from connection.execute('cluster', 'slots')
+            slots = [self._host]*SLOTS
+            for shard in shards:
+                first, last, (host, port) = shard[0], shard[1], shard[2][:2]
+                address = (to_string(host), int(port))
+                slots[first:last+1] = [address]*(last - first + 1)
+            self._slots = slots
+        return self._slots
+
+    def _shard_pool(self, address):
+        if address == self._host:
+            return self._pool
+        pool = self._shard_pools.get(address)
+        if pool is None:
+            pool = Pool(partial(self.connect, address=address),
+                        pool_size=self._pool.pool_size,
+                        loop=self._loop)
+            self._shard_pools[address] = pool
+        return pool
+
     def meta(self, meta):
         '''Extract model metadata for lua script stdnet/lib/lua/odm.lua'''
         #  indices = dict(((idx.attname, idx.unique) for idx in meta.indices))
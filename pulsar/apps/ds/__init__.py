@@ -2,11 +2,12 @@ from .server import PulsarDS, DEFAULT_PULSAR_STORE_ADDRESS, pulsards_url
 from .client import COMMANDS_INFO, redis_to_py_pattern
 from .parser import (PyRedisParser, RedisParser, redis_parser,
                      RedisError, ResponseError,
-                     InvalidResponse, NoScriptError, CommandError)
+                     InvalidResponse, NoScriptError, MovedError,
+                     CommandError)
 
 
 __all__ = ['PulsarDS', 'DEFAULT_PULSAR_STORE_ADDRESS', 'pulsards_url',
            'COMMANDS_INFO', 'redis_to_py_pattern',
            'PyRedisParser', 'RedisParser', 'redis_parser',
            'RedisError', 'ResponseError',
-           'InvalidResponse', 'NoScriptError', 'CommandError']
+           'InvalidResponse', 'NoScriptError', 'MovedError', 'CommandError']
@@ -0,0 +1,297 @@
+'''Append only file persistence for pulsar-ds.
+
+When enabled, every write command executed by the :class:`.Storage` is
+appended to a file in the same format used by the redis protocol. The
+file is replayed at startup and can be compacted in the background with
+the ``BGREWRITEAOF`` command.
+'''
+import os
+import time
+import pickle
+from itertools import islice
+from multiprocessing import Process
+
+from pulsar.utils.structures import Zset, Deque, Quicklist
+
+from .pyparser import Parser
+from .listpack import ListpackHash, ListpackList, ListpackSet, ListpackZset
+from .hyperloglog import HyperLogLog
+from .stream import Stream
+from .utils import string_bytes
+
+
+FSYNC_POLICIES = ('always', 'everysec', 'no')
+# Number of elements in each command written by the rewrite process
+REWRITE_BATCH = 64
+
+
+class AppendOnlyFile:
+    '''Log write commands into an append only file.
+
+    Commands fed during an event loop iteration are written to the file
+    in one go at the end of the iteration. The ``fsync`` policy controls
+    when the file is synced to disk:
+
+    * ``always``: the file is written and synced once at the end of each
+      iteration, before the :class:`.Storage` writes the replies of the
+      commands to clients
+    * ``everysec``: the file is synced once per second in a thread of the
+      event loop executor, so that the loop never waits for the disk
+    * ``no``: syncing is left to the operating system
+
+    :param filename: the file to append commands to
+    :param loop: the event loop of the storage
+    :param parser: a redis parser used to encode commands
+    :param fsync: one of the :data:`FSYNC_POLICIES`
+    '''
+    def __init__(self, filename, loop, parser, fsync='everysec',
+                 logger=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy "%s"' % fsync)
+        self.filename = filename
+        self.fsync = fsync
+        self.logger = logger
+        self._loop = loop
+        self._parser = parser
+        self._buffer = []
+        self._database = None
+        self._flush_handle = None
+        self._fsync_waiter = None
+        self._last_fsync = loop.time()
+        self._rewriter = None
+        self._rewrite_buffer = None
+        self._rewrite_database = None
+        self._last_rewrite = None
+        self._file = open(filename, 'ab')
+
+    @property
+    def size(self):
+        '''Size in bytes of the append only file.'''
+        return self._file.tell() + sum((len(b) for b in self._buffer))
+
+    @property
+    def rewriting(self):
+        '''``True`` when a background rewrite is in progress.'''
+        return self._rewriter is not None
+
+    def info(self):
+        return {'aof_enabled': 1,
+                'aof_fsync': self.fsync,
+                'aof_current_size': self.size,
+                'aof_rewrite_in_progress': int(self.rewriting),
+                'aof_last_rewrite_time': self._last_rewrite or -1}
+
+    def feed(self, database, request):
+        '''Append ``request`` executed on ``database`` to the file.'''
+        chunk = self._parser.pack_command(request)
+        if database != self._database:
+            self._database = database
+            self._buffer.append(self._select(database))
+        self._buffer.append(chunk)
+        if self._rewrite_buffer is not None:
+            if database != self._rewrite_database:
+                self._rewrite_database = database
+                self._rewrite_buffer.append(self._select(database))
+            self._rewrite_buffer.append(chunk)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self.flush)
+
+    def flush(self):
+        '''Write buffered commands into the file.'''
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._buffer:
+            data = b''.join(self._buffer)
+            self._buffer = []
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync == 'always':
+                os.fsync(self._file.fileno())
+
+    def cron(self):
+        '''Periodic task invoked by the :class:`.Storage` cron.
+
+        Sync the file when the policy is ``everysec`` and complete a
+        background rewrite once its process has exited.
+        '''
+        now = self._loop.time()
+        if (self.fsync == 'everysec' and self._fsync_waiter is None and
+                now - self._last_fsync >= 1):
+            self.flush()
+            self._last_fsync = now
+            self._fsync_waiter = self._loop.run_in_executor(
+                None, os.fsync, self._file.fileno())
+            self._fsync_waiter.add_done_callback(self._fsync_done)
+        rewriter = self._rewriter
+        if (rewriter and not rewriter.is_alive() and
+                self._fsync_waiter is None):
+            self._rewrite_done()
+
+    def rewrite(self, dbs):
+        '''Rewrite the file in a background process.
+
+        :param dbs: an iterable over ``(number, data, expires)`` triplets
+            where ``data`` is the dictionary of keys of a database and
+            ``expires`` a mapping of keys to loop time deadlines.
+        :return: ``False`` if a rewrite was already in progress.
+
+        New commands are accumulated in memory and appended to the
+        rewritten file once the process completes. The event loop is
+        blocked only to append these commands and to swap the files.
+        '''
+        if self.rewriting:
+            return False
+        self.flush()
+        self._rewrite_buffer = []
+        self._rewrite_database = None
+        offset = time.time() - self._loop.time()
+        self._rewriter = Process(target=rewrite_aof,
+                                 args=(self._temp_filename(), dbs, offset))
+        self._rewriter.start()
+        return True
+
+    def restart(self, dbs):
+        '''Truncate the file and rewrite it from ``dbs``.
+
+        Called when the data of the storage is replaced, by the full
+        synchronization of a replica with its master. Buffered commands
+        and a rewrite in progress, which log the replaced data, are
+        discarded.
+        '''
+        rewriter, self._rewriter = self._rewriter, None
+        if rewriter is not None:
+            rewriter.terminate()
+            rewriter.join()
+            temp = self._temp_filename()
+            if os.path.isfile(temp):
+                os.remove(temp)
+        self._buffer = []
+        self._database = None
+        self._file.truncate(0)
+        self._file.seek(0)
+        self.rewrite(dbs)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    #    INTERNALS
+    def _select(self, database):
+        return self._parser.pack_command(('select', database))
+
+    def _temp_filename(self):
+        path, name = os.path.split(self.filename)
+        return os.path.join(path, 'temp-rewriteaof-%s' % name)
+
+    def _fsync_done(self, waiter):
+        self._fsync_waiter = None
+        exc = waiter.exception()
+        if exc and self.logger:
+            self.logger.error('Could not sync append only file: %s', exc)
+
+    def _rewrite_done(self):
+        rewriter, self._rewriter = self._rewriter, None
+        buffer, self._rewrite_buffer = self._rewrite_buffer, None
+        temp = self._temp_filename()
+        if rewriter.exitcode:
+            if self.logger:
+                self.logger.error('Background append only file rewrite '
+                                  'failed with exit code %s',
+                                  rewriter.exitcode)
+            if os.path.isfile(temp):
+                os.remove(temp)
+            return
+        self.flush()
+        with open(temp, 'ab') as file:
+            file.write(b''.join(buffer))
+            file.flush()
+            os.fsync(file.fileno())
+        self._file.close()
+        os.replace(temp, self.filename)
+        self._file = open(self.filename, 'ab')
+        self._database = self._rewrite_database if buffer else None
+        self._last_rewrite = int(time.time())
+        if self.logger:
+            self.logger.info('Background append only file rewrite '
+                             'completed')
+
+
+def read_commands(filename, parser, chunk_size=65536):
+    '''Generator of commands stored in the append only file ``filename``.
+
+    A truncated command at the end of the file, left by a crash during a
+    write, is ignored.
+    '''
+    with open(filename, 'rb') as file:
+        chunk = file.read(chunk_size)
+        while chunk:
+            parser.feed(chunk)
+            request = parser.get()
+            while request is not False:
+                yield request
+                request = parser.get()
+            chunk = file.read(chunk_size)
+
+
+def rewrite_aof(filename, dbs, offset):
+    '''Write the shortest sequence of commands rebuilding ``dbs``.
+
+    Executed in a child process by :meth:`AppendOnlyFile.rewrite`.
+    ``offset`` converts loop time deadlines into unix timestamps.
+    '''
+    parser = Parser(None, None)
+    pack = parser.pack_command
+    with open(filename, 'wb') as file:
+        for num, data, expires in dbs:
+            if not data:
+                continue
+            file.write(pack(('select', num)))
+            for key, value in data.items():
+                for request in rebuild_commands(key, value):
+                    file.write(pack(request))
+                deadline = expires.get(key)
+                if deadline is not None:
+                    timestamp = int(1000*(deadline + offset))
+                    file.write(pack(('pexpireat', key, timestamp)))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def rebuild_commands(key, value):
+    '''Generator of commands which rebuild ``value`` at ``key``.'''
+    if isinstance(value, (bytes, bytearray, int, HyperLogLog)):
+        yield ('set', key, string_bytes(value))
+    elif isinstance(value, (set, ListpackSet)):
+        for members in _batches(value):
+            yield ('sadd', key) + members
+    elif isinstance(value, (Zset, ListpackZset)):
+        for items in _batches(value.items()):
+            yield ('zadd', key) + tuple(_flat(items))
+    elif isinstance(value, (Quicklist, Deque, ListpackList)):
+        for items in _batches(value):
+            yield ('rpush', key) + items
+    elif isinstance(value, (dict, ListpackHash)):
+        for items in _batches(value.items()):
+            yield ('hmset', key) + tuple(_flat(items))
+    elif isinstance(value, Stream):
+        # restored in one piece, consumer groups and their pending entries
+        # have no command to rebuild them
+        yield ('restore', key, 0, pickle.dumps(value))
+    else:
+        raise TypeError('Cannot rewrite value of type %s' %
+                        type(value).__name__)
+
+
+def _batches(iterable):
+    it = iter(iterable)
+    batch = tuple(islice(it, REWRITE_BATCH))
+    while batch:
+        yield batch
+        batch = tuple(islice(it, REWRITE_BATCH))
+
+
+def _flat(pairs):
+    for a, b in pairs:
+        yield a
+        yield b
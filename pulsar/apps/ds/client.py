@@ -1,4 +1,5 @@
 import time
+from time import perf_counter
 from functools import partial
 
 import pulsar
@@ -42,6 +43,14 @@ class command:
 
 
 class ClientMixin(object):
+    # Write commands are refused when the store is a replica
+    readonly = True
+    # Commands on keys of other shards are redirected
+    redirect = True
+    # Keys are evicted before write commands when memory is over the limit
+    evict = True
+    # The host:port of the connection, empty for clients without one
+    address = ''
 
     def __init__(self, store):
         self.store = store
@@ -72,10 +81,11 @@ class ClientMixin(object):
                 return self.reply_error('Blocked client cannot request')
             if self.transaction is not None and command not in 'exec':
                 self.transaction.append((handle, request))
-                return self._transport.write(self.store.QUEUED)
+                return self.reply_queued()
         self._execute_command(handle, request)
 
     def _execute_command(self, handle, request):
+        duration = None
         try:
             if request:
                 command = request[0]
@@ -86,7 +96,28 @@ class ClientMixin(object):
                     if command != 'auth':
                         return self.reply_error(
                             'Authentication required', 'NOAUTH')
-                handle(self, request, len(request) - 1)
+                if (handle._info.write and self.store._master_link and
+                        self.readonly):
+                    return self.reply_error("You can't write against a "
+                                            "read only replica.", 'READONLY')
+                if (self.store._cluster and self.redirect and
+                        not self.store._cluster.check(self, handle._info,
+                                                      request)):
+                    return
+                if (handle._info.write and self.store._evictor and
+                        self.evict and
+                        not self.store._evictor.allow(command)):
+                    return self.reply_error(self.store.OOM, 'OOM')
+                dirty = self.store._dirty
+                start = perf_counter()
+                try:
+                    handle(self, request, len(request) - 1)
+                finally:
+                    duration = perf_counter() - start
+                # only write commands which changed the data are propagated
+                if (self.store._propagation and handle._info.write and
+                        self.store._dirty != dirty):
+                    self.store._propagate(self, request)
             else:
                 command = ''
                 return self.reply_error("no command")
@@ -98,6 +129,10 @@ class ClientMixin(object):
             self.reply_error('Server Error')
         finally:
             self.last_command = command
+        if duration is not None:
+            # failed commands are recorded too
+            self.store._command_executed(self, handle._info, request,
+                                         duration)
 
     def reply_ok(self):
         raise NotImplementedError
@@ -105,6 +140,9 @@ class ClientMixin(object):
     def reply_status(self, status):
         raise NotImplementedError
 
+    def reply_queued(self):
+        raise NotImplementedError
+
     def reply_error(self, value, prefix=None):
         raise NotImplementedError
 
@@ -130,6 +168,33 @@ class ClientMixin(object):
         raise NotImplementedError
 
 
+class ReplayClient(ClientMixin):
+    '''A client executing commands without replying.
+
+    Used to replay the append only file at startup and the commands
+    streamed by the master of a replica.
+    '''
+    readonly = False
+    redirect = False
+    evict = False
+    channels = ()
+    patterns = ()
+    watched_keys = None
+
+    def __init__(self, store):
+        super().__init__(store)
+        self._loop = store._loop
+        self.password = store._password
+
+    def _noreply(self, *args):
+        pass
+
+    reply_ok = reply_status = reply_queued = reply_error = _noreply
+    reply_wrongtype = _noreply
+    reply_int = reply_one = reply_zero = _noreply
+    reply_bulk = reply_multi_bulk = reply_multi_bulk_len = _noreply
+
+
 class PulsarStoreClient(pulsar.Protocol, ClientMixin):
     '''Used both by client and server'''
 
@@ -143,6 +208,11 @@ class PulsarStoreClient(pulsar.Protocol, ClientMixin):
         self.patterns = set()
         self.watched_keys = None
         self.password = b''
+        # messages coalesced into one write per loop iteration
+        self._output = []
+        self._output_size = 0
+        self._soft_limit_time = None
+        self.dropped_messages = 0
         self.bind_event('connection_lost',
                         partial(self.store._remove_connection, self))
 
@@ -153,6 +223,9 @@ class PulsarStoreClient(pulsar.Protocol, ClientMixin):
     def reply_status(self, value):
         self._write(('+%s\r\n' % value).encode('utf-8'))
 
+    def reply_queued(self):
+        self._send(self.store.QUEUED)
+
     def reply_int(self, value):
         self._write((':%d\r\n' % value).encode('utf-8'))
 
@@ -183,6 +256,51 @@ class PulsarStoreClient(pulsar.Protocol, ClientMixin):
     def reply_multi_bulk_len(self, value):
         self._write(self.store._parser.multi_bulk_len(value))
 
+    @property
+    def address(self):
+        '''The ``host:port`` of the peer, empty when the transport does not
+        know it, once the connection is lost.'''
+        transport = self._transport
+        peername = transport.get_extra_info('peername') if transport else None
+        if isinstance(peername, tuple):
+            return '%s:%s' % peername[:2]
+        return ''
+
+    # Output buffer
+    @property
+    def output_class(self):
+        '''The class of output buffer limits which apply to this client.
+        '''
+        if self.flag & self.store.REPLICA:
+            return 'replica'
+        elif self.flag & self.store.MONITOR:
+            return 'monitor'
+        elif self.channels or self.patterns:
+            return 'pubsub'
+        else:
+            return 'normal'
+
+    def output_memory(self):
+        '''Bytes waiting to be written to this client.'''
+        return self._output_size + self._transport.get_write_buffer_size()
+
+    def write_message(self, message):
+        '''Queue a pub/sub or monitor ``message`` for this client.
+
+        Messages queued during a loop iteration are written at once at the
+        next iteration. Return ``False`` when the message is dropped because
+        the client is disconnecting.
+        '''
+        if self._transport._closing:
+            self.dropped_messages += 1
+            self.store._dropped_messages += 1
+            return False
+        if not self._output:
+            self.store._buffer_output(self)
+        self._output.append(message)
+        self._output_size += len(message)
+        return self._check_output_limits()
+
     # Protocol Implementaton
     def data_received(self, data):
         self.parser.feed(data)
@@ -197,12 +315,67 @@ class PulsarStoreClient(pulsar.Protocol, ClientMixin):
     def _write(self, response):
         if self.transaction is not None:
             self.transaction.append(response)
+        else:
+            self._send(response)
+
+    def _send(self, response):
+        if self._output or self.store._hold_replies:
+            # keep replies in order with queued messages, or hold them
+            # until the append only file is synced
+            if not self._output:
+                self.store._buffer_output(self)
+            self._output.append(response)
+            self._output_size += len(response)
         elif not self._transport._closing:
             self._transport.write(response)
+            if self.store._output_limited:
+                self._check_output_limits()
+
+    def _flush_output(self):
+        output = self._output
+        if output:
+            self._output = []
+            self._output_size = 0
+            if not self._transport._closing:
+                self._transport.write(b''.join(output))
+                self._check_output_limits()
+
+    def _check_output_limits(self):
+        hard, soft, seconds = self.store._output_limits[self.output_class]
+        if hard or soft:
+            memory = self.output_memory()
+            if hard and memory > hard:
+                return self._output_overflow(memory)
+            elif soft and memory > soft:
+                now = self._loop.time()
+                if self._soft_limit_time is None:
+                    self._soft_limit_time = now
+                elif now - self._soft_limit_time > seconds:
+                    return self._output_overflow(memory)
+            else:
+                self._soft_limit_time = None
+        return True
+
+    def _output_overflow(self, memory):
+        store = self.store
+        dropped = len(self._output)
+        self._output = []
+        self._output_size = 0
+        self.dropped_messages += dropped
+        store._dropped_messages += dropped
+        store._output_buffer_disconnections += 1
+        store.logger.warning('Closing %s client %s, output buffer of %d bytes '
+                             'over the limit', self.output_class,
+                             self.address, memory)
+        self._transport.abort()
+        return False
 
 
 class Blocked:
     '''Handle blocked keys for a client
+
+    ``dest`` is the destination list of ``BRPOPLPUSH`` or the pending read
+    of ``XREAD`` and ``XREADGROUP``.
     '''
     def __init__(self, client, command, keys, timeout, dest=None):
         self.command = command
@@ -231,16 +404,15 @@ class Blocked:
             client.blocked = None
             store._bpop_blocked_clients -= 1
             #
-            # make sure to remove the client from the set of blocked
-            # clients in the database associated with key
-            if key is None:
-                bkeys = client.db._blocking_keys
-                for key in self.keys:
-                    clients = bkeys.get(key)
-                    if clients:
-                        clients.discard(client)
-                        if not clients:
-                            bkeys.pop(key)
+            # make sure to remove the client from the sets of blocked
+            # clients of all its keys, not only the key serving it
+            bkeys = client.db._blocking_keys
+            for bkey in self.keys:
+                clients = bkeys.get(bkey)
+                if clients:
+                    clients.discard(client)
+                    if not clients:
+                        bkeys.pop(bkey)
             #
             # send the response
             if value is None:
@@ -0,0 +1,182 @@
+'''Hash slot sharding for pulsar-ds.
+
+When the :ref:`key_value_cluster <setting-key_value_cluster>` setting is
+on, each worker of a :class:`.PulsarDS` application listens on its own port
+and owns a contiguous range of the :data:`SLOTS` hash slots. The slot of a
+key is the CRC16 of the key, or of its hash tag, modulo :data:`SLOTS`, as in
+redis cluster. A worker replies with a ``MOVED`` error to commands on keys
+it does not own and with a ``CROSSSLOT`` error to commands on keys owned by
+more than one shard. Unlike redis cluster, keys of a multi-key command only
+need to be in the same shard, not in the same slot, since slots never move
+between shards.
+
+Each shard persists its keys into its own snapshot and append only files,
+named by :func:`shard_filename`.
+'''
+import os
+from binascii import crc_hqx
+
+from pulsar.utils.pep import to_string
+
+
+SLOTS = 16384
+CROSSSLOT = "Keys in request don't hash to the same shard"
+# Groups of commands whose first argument is a key
+KEY_GROUPS = frozenset(('Keys', 'Strings', 'Hashes', 'Lists', 'Sets',
+                        'Sorted Sets', 'HyperLogLog', 'Streams'))
+# Commands without keys in the key groups
+KEYLESS_COMMANDS = frozenset(('keys', 'randomkey', 'scan', 'migrate'))
+# (first, last, step) positions of keys in requests of commands with more
+# than one key or keys not in first position. Negative positions count
+# from the end of the request.
+KEY_POSITIONS = {'del': (1, -1, 1),
+                 'unlink': (1, -1, 1),
+                 'exists': (1, -1, 1),
+                 'mget': (1, -1, 1),
+                 'mset': (1, -1, 2),
+                 'msetnx': (1, -1, 2),
+                 'rename': (1, 2, 1),
+                 'renamenx': (1, 2, 1),
+                 'rpoplpush': (1, 2, 1),
+                 'brpoplpush': (1, 2, 1),
+                 'smove': (1, 2, 1),
+                 'zrangestore': (1, 2, 1),
+                 'sdiff': (1, -1, 1),
+                 'sdiffstore': (1, -1, 1),
+                 'sinter': (1, -1, 1),
+                 'sinterstore': (1, -1, 1),
+                 'sunion': (1, -1, 1),
+                 'sunionstore': (1, -1, 1),
+                 'blpop': (1, -2, 1),
+                 'brpop': (1, -2, 1),
+                 'bitop': (2, -1, 1),
+                 'pfcount': (1, -1, 1),
+                 'pfmerge': (1, -1, 1),
+                 'object': (2, 2, 1),
+                 'xgroup': (2, 2, 1),
+                 'watch': (1, -1, 1)}
+# Commands with the position of the first key and of the number of keys,
+# followed by the keys. Keys between the two positions are keys too.
+NUMKEYS_COMMANDS = {'zunionstore': (1, 2),
+                    'zinterstore': (1, 2),
+                    'zdiffstore': (1, 2),
+                    'zdiff': (1, 1),
+                    'sintercard': (1, 1),
+                    'eval': (2, 2),
+                    'evalsha': (2, 2)}
+# Commands with keys in the first half of the arguments which follow the
+# STREAMS option
+STREAMS_COMMANDS = frozenset(('xread', 'xreadgroup'))
+
+
+def key_slot(key):
+    '''The hash slot of ``key``.
+
+    When ``key`` contains a non empty hash tag, a substring between the
+    first ``{`` and the following ``}``, only the hash tag is hashed so
+    that related keys can be stored in the same slot.
+    '''
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    start = key.find(b'{')
+    if start >= 0:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start+1:end]
+    return crc_hqx(key, 0) % SLOTS
+
+
+def command_keys(info, request):
+    '''The keys in ``request``, a list starting with the command name.
+
+    :param info: the :class:`.command` information of the command
+    '''
+    name = info.name
+    if name in KEY_POSITIONS:
+        first, last, step = KEY_POSITIONS[name]
+        if last < 0:
+            last += len(request)
+        return request[first:last+1:step]
+    elif name in NUMKEYS_COMMANDS:
+        first, position = NUMKEYS_COMMANDS[name]
+        keys = list(request[first:position])
+        try:
+            numkeys = int(request[position])
+        except (IndexError, ValueError):
+            return keys
+        return keys + list(request[position+1:position+1+numkeys])
+    elif name in STREAMS_COMMANDS:
+        # arguments are strings, rather than bytes, on the client side
+        for n, arg in enumerate(request):
+            if to_string(arg, errors='ignore').lower() == 'streams':
+                args = request[n+1:]
+                return args[:len(args)//2]
+        return ()
+    elif info.group in KEY_GROUPS and name not in KEYLESS_COMMANDS:
+        return request[1:2]
+    else:
+        return ()
+
+
+def shard_filename(filename, shard):
+    '''The ``filename`` of a ``shard``, with the shard index before the
+    extension.'''
+    root, ext = os.path.splitext(filename)
+    return '%s.%d%s' % (root, shard, ext)
+
+
+def slot_ranges(shards):
+    '''Split the hash slots into ``shards`` contiguous ranges.
+
+    :return: a list of ``(first, last)`` slots
+    '''
+    return [(n*SLOTS//shards, (n + 1)*SLOTS//shards - 1)
+            for n in range(shards)]
+
+
+class Cluster:
+    '''The hash slots of the shards of a :class:`.PulsarDS` application.
+
+    :param addresses: the ``(host, port)`` addresses of shards
+    :param shard: the index of the shard served by the :class:`.Storage`
+    '''
+    def __init__(self, addresses, shard):
+        self.addresses = list(addresses)
+        self.shard = shard
+        self.slots = slot_ranges(len(self.addresses))
+        self.first, self.last = self.slots[shard]
+
+    def info(self):
+        return {'cluster_enabled': 1,
+                'cluster_state': 'ok',
+                'cluster_slots_assigned': SLOTS,
+                'cluster_known_nodes': len(self.addresses),
+                'cluster_size': len(self.addresses),
+                'cluster_my_slots': '%d-%d' % (self.first, self.last)}
+
+    def owner(self, slot):
+        '''The address of the shard owning ``slot``.'''
+        for address, (first, last) in zip(self.addresses, self.slots):
+            if first <= slot <= last:
+                return address
+
+    def check(self, client, info, request):
+        '''Check the keys of ``request`` are served by this shard.
+
+        Reply with an error to ``client`` and return ``False`` when they
+        are not.
+        '''
+        keys = command_keys(info, request)
+        if keys:
+            slot = key_slot(keys[0])
+            mine = self.first <= slot <= self.last
+            for key in keys[1:]:
+                if (self.first <= key_slot(key) <= self.last) != mine:
+                    client.reply_error(CROSSSLOT, 'CROSSSLOT')
+                    return False
+            if not mine:
+                host, port = self.owner(slot)
+                client.reply_error('%d %s:%d' % (slot, to_string(host), port),
+                                   'MOVED')
+                return False
+        return True
@@ -0,0 +1,239 @@
+'''Memory limit and eviction of keys for pulsar-ds.
+
+When the :ref:`key_value_maxmemory <setting-key_value_maxmemory>` setting is
+not 0, each :class:`.Db` estimates the memory used by its keys and the
+:class:`Evictor` of the :class:`.Storage` evicts keys before write commands
+while the estimate is over the limit.
+
+As in redis, keys are not kept in an eviction order. Random keys of each
+database are sampled and the best candidates are kept in a small pool
+from which keys are evicted. The metadata of a key is a single integer
+stored in the ``_meta`` dictionary of its database: the estimated size
+of the key and its value in the high bits and, in the low
+:data:`ACCESS_BITS`, either the time of the last access, for the ``lru``
+policies, or a logarithmic access counter with the time of its last
+decrement, for the ``lfu`` policies.
+'''
+from sys import getsizeof
+from bisect import insort
+from itertools import islice
+from random import random
+
+from pulsar.utils.structures import Quicklist
+
+from .listpack import Listpack
+from .hyperloglog import HyperLogLog
+from .stream import Stream
+
+
+MAXMEMORY_POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu',
+                      'volatile-lru', 'volatile-ttl')
+ACCESS_BITS = 32
+ACCESS_MASK = (1 << ACCESS_BITS) - 1
+# Seconds between two ticks of the clock of the lru policies
+LRU_RESOLUTION = 0.01
+# Initial value, probability factor and decay period, in minutes, of the
+# access counter of the lfu policies
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1
+# Number of eviction candidates kept between samplings
+POOL_SIZE = 16
+# Dictionary entries, scan index and metadata of a key
+KEY_OVERHEAD = 128
+# Elements of a container sampled to estimate its size
+SIZE_SAMPLES = 8
+# Float score, score member pair and block slot of a zset member
+ZSET_MEMBER_OVERHEAD = 96
+# Slot of a list element in its quicklist chunk
+LIST_ELEMENT_OVERHEAD = 8
+# Slot of an element in the buckets of the scan index of its container
+SCAN_INDEX_OVERHEAD = 16
+# Write commands which never need more memory and are executed when the
+# memory is over the limit
+FREEING_COMMANDS = frozenset(('del', 'unlink', 'flushdb', 'flushall',
+                              'expire', 'pexpire', 'expireat', 'pexpireat',
+                              'persist',
+                              'lpop', 'rpop', 'blpop', 'brpop', 'lrem',
+                              'ltrim', 'spop', 'srem', 'hdel', 'zrem',
+                              'zremrangebyrank', 'zremrangebyscore'))
+OOM = "command not allowed when used memory > 'maxmemory'."
+
+
+def object_memory(key, value):
+    '''Approximate number of bytes used by ``key`` and its ``value``.
+
+    The size of the elements of a container is estimated from a sample
+    of its first :data:`SIZE_SAMPLES` elements.
+    '''
+    size = KEY_OVERHEAD + getsizeof(key) + getsizeof(value)
+    if isinstance(value, (bytes, bytearray, int)):
+        return size
+    elif isinstance(value, HyperLogLog):
+        registers = value._registers
+        if registers is None:
+            return size + getsizeof(value._index) + getsizeof(value._values)
+        return size + getsizeof(registers)
+    length = len(value)
+    if not length:
+        return size
+    if isinstance(value, Listpack):
+        # the elements of a listpack are in one or two flat lists
+        for name in value.__slots__[:-1]:
+            elements = getattr(value, name)
+            size += getsizeof(elements) + sum(map(getsizeof, elements))
+        return size
+    elif isinstance(value, dict):
+        sample = [getsizeof(k) + getsizeof(v) for k, v in
+                  islice(value.items(), SIZE_SAMPLES)]
+    elif hasattr(value, '_dict'):
+        members = value._dict
+        size += getsizeof(members)
+        sample = [getsizeof(m) + ZSET_MEMBER_OVERHEAD for m in
+                  islice(members, SIZE_SAMPLES)]
+    elif isinstance(value, Quicklist):
+        size += getsizeof(value._chunks) + getsizeof(value._starts)
+        sample = [getsizeof(v) + LIST_ELEMENT_OVERHEAD for v in
+                  islice(value, SIZE_SAMPLES)]
+    elif isinstance(value, Stream):
+        sample = [getsizeof(id) + getsizeof(fields) +
+                  sum(map(getsizeof, fields)) for id, fields in
+                  islice(value.range(), SIZE_SAMPLES)]
+    else:
+        sample = [getsizeof(v) for v in islice(value, SIZE_SAMPLES)]
+    if hasattr(value, 'scan_index'):
+        size += length*SCAN_INDEX_OVERHEAD
+    return size + length*sum(sample)//len(sample)
+
+
+class Evictor:
+    '''Keep the memory of a :class:`.Storage` below ``maxmemory``.
+
+    :param maxmemory: the memory limit in bytes
+    :param policy: one of the :data:`MAXMEMORY_POLICIES`
+    :param samples: the number of keys sampled in each database when
+        looking for keys to evict
+    '''
+    def __init__(self, store, maxmemory, policy, samples=5):
+        assert policy in MAXMEMORY_POLICIES
+        self.store = store
+        self.maxmemory = maxmemory
+        self.policy = policy
+        self.samples = max(samples, 1)
+        self.used_memory = 0
+        self.evicted_keys = 0
+        self.volatile = policy.startswith('volatile')
+        self._loop = store._loop
+        self._pool = []
+        if policy.endswith('lfu'):
+            self.access = self._lfu_access
+            self.touch = self._lfu_touch
+            self._score = self._lfu_score
+        elif policy.endswith('lru'):
+            self.access = self.touch = self._lru_access
+            self._score = self._lru_score
+        else:
+            self.access = self.touch = self._no_access
+            self._score = self._ttl_score
+
+    def info(self):
+        return {'used_memory': self.used_memory,
+                'maxmemory': self.maxmemory,
+                'maxmemory_policy': self.policy,
+                'maxmemory_samples': self.samples}
+
+    def allow(self, command):
+        '''Free memory before the write ``command``.
+
+        Return ``False`` when the memory is over the limit after the
+        eviction, and ``command`` could use more memory.
+        '''
+        if self.used_memory > self.maxmemory:
+            return self.free() or command in FREEING_COMMANDS
+        return True
+
+    def free(self):
+        '''Evict keys until the memory is below the limit.
+
+        Return ``False`` when no key could be evicted.
+        '''
+        if self.policy == 'noeviction':
+            return False
+        while self.used_memory > self.maxmemory:
+            if not self._evict_one():
+                return False
+        return True
+
+    #    INTERNALS
+    def _evict_one(self):
+        self._populate()
+        pool = self._pool
+        databases = self.store.databases
+        while pool:
+            _, num, key = pool.pop()
+            db = databases[num]
+            if key in db._data and (not self.volatile or key in db._expires):
+                db._evict(key)
+                self.evicted_keys += 1
+                return True
+        return False
+
+    def _populate(self):
+        pool = self._pool
+        samples = self.samples
+        volatile = self.volatile
+        for db in self.store.databases.values():
+            if volatile:
+                if not db._expires:
+                    continue
+                keys = db._index.sample(samples, db._expires.__contains__)
+                if not keys:
+                    # volatile keys are too sparse to be found by sampling
+                    keys = list(islice(db._expires, samples))
+            elif db._data:
+                keys = db._index.sample(samples)
+            else:
+                continue
+            for key in keys:
+                entry = (self._score(db, key), db._num, key)
+                if entry not in pool:
+                    insort(pool, entry)
+            if len(pool) > POOL_SIZE:
+                del pool[:len(pool) - POOL_SIZE]
+
+    def _no_access(self, access=None):
+        return 0
+
+    def _lru_access(self, access=None):
+        return int(self._loop.time() / LRU_RESOLUTION) & ACCESS_MASK
+
+    def _lru_score(self, db, key):
+        # idle time, the clock wraps around every 497 days
+        access = db._meta[key] & ACCESS_MASK
+        return (self._lru_access() - access) & ACCESS_MASK
+
+    def _lfu_minutes(self):
+        return int(self._loop.time() / 60) & 0xFFFF
+
+    def _lfu_access(self):
+        return self._lfu_minutes() << 8 | LFU_INIT_VAL
+
+    def _lfu_counter(self, access):
+        # the counter decremented once for each elapsed decay period
+        counter = access & 0xFF
+        elapsed = (self._lfu_minutes() - (access >> 8)) & 0xFFFF
+        return max(counter - elapsed // LFU_DECAY_TIME, 0)
+
+    def _lfu_touch(self, access):
+        counter = self._lfu_counter(access)
+        if counter < 255:
+            base = max(counter - LFU_INIT_VAL, 0)
+            if random() < 1.0/(base*LFU_LOG_FACTOR + 1):
+                counter += 1
+        return self._lfu_minutes() << 8 | counter
+
+    def _lfu_score(self, db, key):
+        return 255 - self._lfu_counter(db._meta[key] & ACCESS_MASK)
+
+    def _ttl_score(self, db, key):
+        return -db._expires[key]
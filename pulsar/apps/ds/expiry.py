@@ -0,0 +1,86 @@
+'''Expiry index for volatile keys.
+
+Volatile keys are not scheduled in the event loop. Each :class:`.Db`
+owns a :class:`TimerWheel` which maps keys to their deadline and groups
+them into time slots so that keys can be reclaimed in bulk by the
+active expiry cycle of the :class:`.Storage` cron, while reads perform
+lazy expiry by comparing the deadline with the loop time.
+'''
+from math import floor
+
+
+class TimerWheel(dict):
+    '''A dictionary of ``key``, ``deadline`` pairs indexed by time slot.
+
+    Deadlines are expressed in event loop time. Keys are grouped into
+    slots of ``resolution`` seconds stored in a sparse dictionary, so that
+    adding, moving or removing a deadline is ``O(1)`` and never leaves
+    a cancelled handle behind. Slots are walked in order by
+    :meth:`pop_expired`.
+
+    Lookups (``key in wheel``, :meth:`get`) are plain dictionary
+    operations; use :meth:`add` and :meth:`remove` to modify the wheel.
+    '''
+    def __init__(self, now, resolution=0.1):
+        super().__init__()
+        self._resolution = resolution
+        self._slots = {}
+        self._tick = self._slot(now)
+
+    def add(self, key, deadline):
+        '''Set the ``deadline`` of ``key``, replacing any previous one.'''
+        self.remove(key)
+        dict.__setitem__(self, key, deadline)
+        # a key is never placed in a slot which has been walked already
+        tick = max(self._slot(deadline), self._tick)
+        slot = self._slots.get(tick)
+        if slot is None:
+            self._slots[tick] = slot = set()
+        slot.add(key)
+
+    def remove(self, key):
+        '''Remove ``key`` from the wheel and return its deadline.
+
+        Return ``None`` when ``key`` is not in the wheel.
+        '''
+        deadline = self.pop(key, None)
+        if deadline is not None:
+            tick = max(self._slot(deadline), self._tick)
+            slot = self._slots.get(tick)
+            if slot is not None:
+                slot.discard(key)
+                if not slot:
+                    self._slots.pop(tick)
+        return deadline
+
+    def clear(self):
+        super().clear()
+        self._slots.clear()
+
+    def pop_expired(self, now):
+        '''Generator of keys with a deadline in a slot older than ``now``.
+
+        Keys are removed from the wheel before being yielded, so the
+        consumer can stop the iteration at any time (for example when its
+        time budget is exhausted) and resume it later.
+        '''
+        slots = self._slots
+        last = self._slot(now)
+        if not slots:
+            self._tick = max(self._tick, last)
+            return
+        while self._tick < last:
+            slot = slots.get(self._tick)
+            if slot is not None:
+                while slot:
+                    key = slot.pop()
+                    dict.__delitem__(self, key)
+                    yield key
+                slots.pop(self._tick, None)
+                if not slots:
+                    self._tick = last
+                    break
+            self._tick += 1
+
+    def _slot(self, deadline):
+        return int(floor(deadline / self._resolution))
@@ -0,0 +1,239 @@
+'''HyperLogLog cardinality estimation for pulsar-ds.
+
+A :class:`HyperLogLog` approximates the number of distinct elements added
+to it with a standard error of 0.81%, in at most 16KB. Each element is
+hashed into 64 bits: the low :data:`P` bits select one of :data:`REGISTERS`
+registers, which keeps the longest run of trailing zeros, plus one, seen
+in the remaining bits.
+
+New counters use a ``sparse`` encoding which only stores the registers
+which are not zero, a sorted array of their indexes and the array of their
+values, 3 bytes for each register. The :class:`.Storage` converts them to
+the ``dense`` encoding, one byte for each register, once they are over
+:ref:`key_value_hll_sparse_max_bytes
+<setting-key_value_hll_sparse_max_bytes>`. A byte rather than the 6 bits
+of redis is used for each register so that the histogram of the registers
+is counted by ``bytearray.count``.
+
+The cardinality is estimated from the histogram of the registers with the
+improved estimator of Otmar Ertl, as redis does, and cached until the
+registers change.
+'''
+from array import array
+from bisect import bisect_left
+from hashlib import md5
+from math import log, sqrt
+
+
+P = 14
+REGISTERS = 1 << P
+Q = 64 - P
+ALPHA_INF = 0.5/log(2)
+MAGIC = b'HYLL'
+DENSE = 0
+SPARSE = 1
+# bytes of a register in the sparse encoding, index and value
+SPARSE_REGISTER_SIZE = 3
+
+
+def hash_element(element):
+    '''Deterministic 64 bits hash of the bytes ``element``.'''
+    return int.from_bytes(md5(element).digest()[:8], 'little')
+
+
+def register_of(element):
+    '''The register index and value of ``element``.'''
+    h = hash_element(element)
+    # a sentinel bit bounds the value to Q + 1
+    bits = (h >> P) | (1 << Q)
+    return h & (REGISTERS - 1), (bits & -bits).bit_length()
+
+
+def _sigma(x):
+    if x == 1:
+        return float('inf')
+    y = 1
+    z = x
+    while True:
+        x *= x
+        previous = z
+        z += x*y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x):
+    if x == 0 or x == 1:
+        return 0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x)**2*y
+        if z == previous:
+            return z/3
+
+
+def estimate(histogram):
+    '''Cardinality from the ``histogram`` of the register values.'''
+    m = REGISTERS
+    z = m*_tau((m - histogram[Q + 1])/m)
+    for k in range(Q, 0, -1):
+        z = 0.5*(z + histogram[k])
+    z += m*_sigma(histogram[0]/m)
+    return int(round(ALPHA_INF*m*m/z))
+
+
+class HyperLogLog:
+    '''A HyperLogLog counter.
+
+    ``_registers`` is the bytearray of the dense encoding, ``None`` for
+    the sparse encoding which keeps registers in ``_index`` and
+    ``_values``.
+    '''
+    __slots__ = ('_registers', '_index', '_values', '_cardinality')
+
+    def __init__(self):
+        self._registers = None
+        self._index = array('H')
+        self._values = bytearray()
+        self._cardinality = 0
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, self.encoding)
+
+    def __reduce__(self):
+        return self.from_bytes, (self.to_bytes(),)
+
+    @property
+    def encoding(self):
+        return 'sparse' if self._registers is None else 'dense'
+
+    def sparse_size(self):
+        '''Number of bytes of the sparse encoding, 0 when dense.'''
+        return SPARSE_REGISTER_SIZE*len(self._index)
+
+    def add(self, element):
+        '''Add ``element``, return ``True`` when a register changed.'''
+        index, value = register_of(element)
+        return self._set(index, value)
+
+    def update(self, elements):
+        '''Add ``elements``, return ``True`` when a register changed.'''
+        changed = False
+        for element in elements:
+            if self.add(element):
+                changed = True
+        return changed
+
+    def count(self):
+        '''The estimated number of distinct elements, cached.'''
+        if self._cardinality is None:
+            self._cardinality = estimate(self.histogram())
+        return self._cardinality
+
+    def histogram(self):
+        '''Number of registers for each value from 0 to ``Q + 1``.'''
+        registers = self._registers
+        if registers is None:
+            values = self._values
+            histogram = [values.count(k) for k in range(Q + 2)]
+            histogram[0] = REGISTERS - len(values)
+        else:
+            histogram = [registers.count(k) for k in range(Q + 2)]
+        return histogram
+
+    def merge(self, *others):
+        '''Keep the maximum of the registers of this and ``others``.
+
+        Return ``True`` when a register changed.
+        '''
+        changed = False
+        dense = [other._registers for other in others
+                 if other._registers is not None]
+        if dense:
+            self.to_dense()
+            registers = self._registers
+            merged = bytearray(map(max, registers, *dense))
+            if merged != registers:
+                self._registers = merged
+                self._cardinality = None
+                changed = True
+        for other in others:
+            if other._registers is None:
+                for index, value in zip(other._index, other._values):
+                    if self._set(index, value):
+                        changed = True
+        return changed
+
+    def to_dense(self):
+        '''Convert to the dense encoding.'''
+        if self._registers is None:
+            registers = bytearray(REGISTERS)
+            for index, value in zip(self._index, self._values):
+                registers[index] = value
+            self._registers = registers
+            self._index = array('H')
+            self._values = bytearray()
+
+    def copy(self):
+        return self.from_bytes(self.to_bytes())
+
+    def to_bytes(self):
+        '''Serialize into bytes, as stored in snapshots and dumps.'''
+        if self._registers is None:
+            index = self._index
+            entries = b''.join(i.to_bytes(2, 'big') + bytes((v,)) for i, v
+                               in zip(index, self._values))
+            return MAGIC + bytes((SPARSE,)) + entries
+        return MAGIC + bytes((DENSE,)) + self._registers
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''The :class:`HyperLogLog` serialized in ``data``.
+
+        Raise ``ValueError`` when ``data`` is not a valid serialization.
+        '''
+        header = len(MAGIC) + 1
+        if data[:len(MAGIC)] != MAGIC or len(data) < header:
+            raise ValueError('Not a HyperLogLog')
+        hll = cls()
+        encoding = data[len(MAGIC)]
+        if encoding == DENSE and len(data) == header + REGISTERS:
+            hll._registers = bytearray(data[header:])
+        elif encoding == SPARSE and not (len(data) - header) % 3:
+            for n in range(header, len(data), 3):
+                index = int.from_bytes(data[n:n + 2], 'big')
+                if index >= REGISTERS:
+                    raise ValueError('Not a HyperLogLog')
+                if data[n + 2]:
+                    hll._set(index, data[n + 2])
+        else:
+            raise ValueError('Not a HyperLogLog')
+        if max(hll._registers or hll._values or b'\x00') > Q + 1:
+            raise ValueError('Not a HyperLogLog')
+        hll._cardinality = None
+        return hll
+
+    #    INTERNALS
+    def _set(self, index, value):
+        registers = self._registers
+        if registers is None:
+            keys = self._index
+            pos = bisect_left(keys, index)
+            if pos < len(keys) and keys[pos] == index:
+                if value <= self._values[pos]:
+                    return False
+                self._values[pos] = value
+            else:
+                keys.insert(pos, index)
+                self._values.insert(pos, value)
+        elif value > registers[index]:
+            registers[index] = value
+        else:
+            return False
+        self._cardinality = None
+        return True
@@ -0,0 +1,126 @@
+'''Lazy freeing of large values for pulsar-ds.
+
+Deallocating a container releases all its elements in a single call: a
+set or a hash of tens of millions of elements stops the event loop, and
+every client, for seconds. ``UNLINK`` and ``FLUSHDB ASYNC`` detach values
+from the keyspace at once and pass them to the :class:`LazyFree` of the
+:class:`.Storage`, which removes their elements in chunks of
+:data:`FREE_CHUNK` elements, one chunk for each iteration of the loop.
+
+Values with less than :data:`FREE_THRESHOLD` elements are cheaper to
+free than to schedule and are released immediately.
+'''
+from collections import deque
+
+from pulsar.utils.structures import Dict, Zset, Deque, Quicklist
+
+from .eviction import object_memory
+from .scan import IndexedDict, IndexedSet, IndexedZset
+from .expiry import TimerWheel
+from .stream import Stream
+
+
+# Values with less elements are freed at once
+FREE_THRESHOLD = 64
+# Elements released by each loop iteration
+FREE_CHUNK = 1024
+# Containers freed a chunk of elements at a time
+LAZY_TYPES = frozenset((dict, Dict, TimerWheel, set, list, Deque, deque,
+                        Quicklist, Zset, Stream, IndexedDict, IndexedSet,
+                        IndexedZset))
+
+
+def free_elements(value, count):
+    '''Release up to ``count`` elements of ``value``.
+
+    Return the elements released, the values of a dictionary are returned
+    so that large ones are freed lazily too.
+    '''
+    if isinstance(value, dict):
+        popitem = value.popitem
+        return [popitem()[1] for _ in range(min(count, len(value)))]
+    elif isinstance(value, Zset):
+        value.remove_range(0, count)
+    elif isinstance(value, Quicklist):
+        value.trim(count, len(value))
+    elif isinstance(value, Stream):
+        chunks = value._chunks
+        while chunks and count > 0:
+            ids, _ = chunks.pop()
+            value._firsts.pop()
+            value._length -= len(ids)
+            count -= len(ids)
+    else:
+        pop = value.pop
+        for _ in range(min(count, len(value))):
+            pop()
+    return ()
+
+
+class LazyFree:
+    '''Values waiting to be freed by the loop.
+
+    Each pending value is kept with its estimated size and its initial
+    number of elements, so that the memory still to be freed is estimated
+    from the elements left.
+    '''
+    def __init__(self, loop):
+        self._loop = loop
+        self._pending = deque()
+        self._scheduled = False
+        self.freed_objects = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def free(self, value, size=None):
+        '''Free ``value`` in the background when it is a large container.
+
+        :param size: the estimated size of ``value`` in bytes, estimated
+            by :func:`.object_memory` when not given
+        :return: ``True`` when ``value`` is freed lazily
+        '''
+        if value.__class__ not in LAZY_TYPES:
+            return False
+        length = len(value)
+        if length < FREE_THRESHOLD:
+            return False
+        if size is None:
+            size = object_memory(b'', value)
+        self._pending.append((value, size, length))
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._free_chunk)
+        return True
+
+    def pending_objects(self):
+        '''Number of elements waiting to be freed.'''
+        return sum((len(value) for value, _, _ in self._pending))
+
+    def pending_memory(self):
+        '''Estimated number of bytes waiting to be freed.'''
+        return sum((size*len(value)//length for value, size, length
+                    in self._pending))
+
+    def info(self):
+        return {'lazyfree_pending_objects': self.pending_objects(),
+                'lazyfree_pending_memory': self.pending_memory(),
+                'lazyfreed_objects': self.freed_objects}
+
+    def _free_chunk(self):
+        pending = self._pending
+        count = FREE_CHUNK
+        while pending and count > 0:
+            value = pending[0][0]
+            before = len(value)
+            for element in free_elements(value, count):
+                self.free(element)
+            released = before - len(value)
+            count -= released
+            self.freed_objects += released
+            if not value:
+                pending.popleft()
+        if pending:
+            self._loop.call_soon(self._free_chunk)
+        else:
+            self._scheduled = False
@@ -0,0 +1,457 @@
+'''Compact encodings of small hashes, lists, sets and sorted sets.
+
+A new container is created with a ``listpack`` encoding which keeps its
+elements in flat python lists, a few hundred bytes rather than the
+kilobytes of a dictionary, a deque or a skiplist. Lookups are linear
+scans of the lists, which are faster than hashing for a small number of
+elements.
+
+The :class:`.Storage` converts a listpack into the full type of its
+container, with :meth:`Listpack.convert`, once it holds more than
+:ref:`key_value_listpack_max_entries
+<setting-key_value_listpack_max_entries>` elements or an element longer
+than :ref:`key_value_listpack_max_value
+<setting-key_value_listpack_max_value>` bytes. Listpacks track the
+length of their longest element, so that the check is ``O(1)``, and
+they are never converted back.
+'''
+from bisect import bisect_left, bisect_right
+from random import randrange
+
+from pulsar.utils.structures import Quicklist, Zset
+
+from .scan import IndexedDict, IndexedSet, IndexedZset
+
+
+def element_size(element):
+    '''Length of a bytes ``element``, 0 for numbers.'''
+    try:
+        return len(element)
+    except TypeError:
+        return 0
+
+
+class Listpack:
+    '''Base class of compact containers.
+
+    Subclasses keep the length of their longest element in ``_size``.
+    '''
+    __slots__ = ()
+    full_type = None
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self))
+
+    def fits(self, max_entries, max_value):
+        '''Whether this listpack is within the limits of its encoding.'''
+        return len(self) <= max_entries and self._size <= max_value
+
+    def convert(self):
+        '''A new container of :attr:`full_type` with the same elements.'''
+        raise NotImplementedError
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class ListpackHash(Listpack):
+    '''A small hash, fields and values alternate in a flat list.'''
+    __slots__ = ('_data', '_size')
+    full_type = IndexedDict
+
+    def __init__(self, pairs=None):
+        self._data = []
+        self._size = 0
+        if pairs:
+            self.update(pairs)
+
+    def __len__(self):
+        return len(self._data) // 2
+
+    def __iter__(self):
+        return iter(self._data[::2])
+
+    def __contains__(self, field):
+        return self._index(field) >= 0
+
+    def __getitem__(self, field):
+        index = self._index(field)
+        if index < 0:
+            raise KeyError(field)
+        return self._data[index + 1]
+
+    def __setitem__(self, field, value):
+        index = self._index(field)
+        if index < 0:
+            self._data.extend((field, value))
+            self._size = max(self._size, len(field))
+        else:
+            self._data[index + 1] = value
+        self._size = max(self._size, element_size(value))
+
+    def get(self, field, default=None):
+        index = self._index(field)
+        return default if index < 0 else self._data[index + 1]
+
+    def pop(self, field, default=None):
+        index = self._index(field)
+        if index < 0:
+            return default
+        value = self._data[index + 1]
+        del self._data[index:index + 2]
+        return value
+
+    def update(self, pairs):
+        for field, value in pairs:
+            self[field] = value
+
+    def mget(self, fields):
+        return [self.get(f) for f in fields]
+
+    def keys(self):
+        return self._data[::2]
+
+    def values(self):
+        return self._data[1::2]
+
+    def items(self):
+        data = self._data
+        return zip(data[::2], data[1::2])
+
+    def flat(self):
+        return list(self._data)
+
+    def convert(self):
+        return IndexedDict(self.items())
+
+    def _index(self, field):
+        # position of field in the list, a match at an odd position is a
+        # value equal to the field
+        data = self._data
+        index = -1
+        try:
+            while True:
+                index = data.index(field, index + 1)
+                if not index % 2:
+                    return index
+        except ValueError:
+            return -1
+
+
+class ListpackList(Listpack):
+    '''A small list.'''
+    __slots__ = ('_items', '_size')
+    full_type = Quicklist
+
+    def __init__(self, items=None):
+        self._items = []
+        self._size = 0
+        if items:
+            self.extend(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __setitem__(self, index, value):
+        self._items[index] = value
+        self._size = max(self._size, element_size(value))
+
+    def append(self, value):
+        self._items.append(value)
+        self._size = max(self._size, element_size(value))
+
+    def appendleft(self, value):
+        self._items.insert(0, value)
+        self._size = max(self._size, element_size(value))
+
+    def extend(self, values):
+        values = list(values)
+        self._items.extend(values)
+        self._size = max(self._size, max(map(element_size, values),
+                                         default=0))
+
+    def extendleft(self, values):
+        # as deque.extendleft, the values are added in reverse order
+        values = list(values)
+        values.reverse()
+        self._items[:0] = values
+        self._size = max(self._size, max(map(element_size, values),
+                                         default=0))
+
+    def pop(self):
+        return self._items.pop()
+
+    def popleft(self):
+        return self._items.pop(0)
+
+    def insert_before(self, pivot, value):
+        self._insert(pivot, value, 0)
+
+    def insert_after(self, pivot, value):
+        self._insert(pivot, value, 1)
+
+    def remove(self, elem, count=1):
+        items = self._items
+        if count:
+            if count < 0:
+                items.reverse()
+            removed = 0
+            for _ in range(abs(count)):
+                try:
+                    items.remove(elem)
+                except ValueError:
+                    break
+                removed += 1
+            if count < 0:
+                items.reverse()
+        else:
+            removed = len(items)
+            items[:] = [v for v in items if v != elem]
+            removed -= len(items)
+        return removed
+
+    def trim(self, start, end):
+        self._items = self._items[start:end]
+
+    def range(self, start=0, end=None):
+        return self._items[start:end]
+
+    def convert(self):
+        return Quicklist(self._items)
+
+    def _insert(self, pivot, value, offset):
+        try:
+            index = self._items.index(pivot)
+        except ValueError:
+            pass
+        else:
+            self._items.insert(index + offset, value)
+            self._size = max(self._size, element_size(value))
+
+
+class ListpackSet(Listpack):
+    '''A small set, members are kept in insertion order.'''
+    __slots__ = ('_members', '_size')
+    full_type = IndexedSet
+
+    def __init__(self, members=None):
+        self._members = []
+        self._size = 0
+        if members:
+            self.update(members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __contains__(self, member):
+        return member in self._members
+
+    def add(self, member):
+        if member not in self._members:
+            self._members.append(member)
+            self._size = max(self._size, len(member))
+
+    def update(self, members):
+        add = self.add
+        for member in members:
+            add(member)
+
+    def remove(self, member):
+        try:
+            self._members.remove(member)
+        except ValueError:
+            raise KeyError(member)
+
+    def discard(self, member):
+        if member in self._members:
+            self._members.remove(member)
+
+    def difference_update(self, members):
+        discard = self.discard
+        for member in members:
+            discard(member)
+
+    def pop(self):
+        '''Remove and return a random member.'''
+        members = self._members
+        if not members:
+            raise KeyError('pop from an empty set')
+        index = randrange(len(members))
+        members[index], members[-1] = members[-1], members[index]
+        return members.pop()
+
+    def union(self, *others):
+        return set(self._members).union(*others)
+
+    def intersection(self, *others):
+        return set(self._members).intersection(*others)
+
+    def difference(self, *others):
+        return set(self._members).difference(*others)
+
+    def convert(self):
+        return IndexedSet(self._members)
+
+
+class ListpackZset(Listpack):
+    '''A small sorted set.
+
+    Scores and members are kept in two parallel lists ordered by score
+    and, for equal scores, by member.
+    '''
+    __slots__ = ('_scores', '_members', '_size')
+    full_type = IndexedZset
+
+    def __init__(self, data=None):
+        self._scores = []
+        self._members = []
+        self._size = 0
+        if data:
+            self.update(data)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __eq__(self, other):
+        if isinstance(other, (Zset, ListpackZset)):
+            return dict(zip(self, self._scores)) == dict(
+                ((m, s) for s, m in other.items()))
+        return False
+
+    def items(self):
+        '''Iterable over ordered score, member pairs.'''
+        return zip(self._scores, self._members)
+
+    def flat(self):
+        result = []
+        for pair in zip(self._scores, self._members):
+            result.extend(pair)
+        return tuple(result)
+
+    def score(self, member, default=None):
+        try:
+            return self._scores[self._members.index(member)]
+        except ValueError:
+            return default
+
+    def rank(self, member):
+        try:
+            return self._members.index(member)
+        except ValueError:
+            return None
+
+    def add(self, score, member):
+        if score != score:
+            raise ValueError('Cannot insert score {0}'.format(score))
+        scores = self._scores
+        members = self._members
+        try:
+            index = members.index(member)
+        except ValueError:
+            result = 1
+            self._size = max(self._size, len(member))
+        else:
+            if scores[index] == score:
+                return 0
+            scores.pop(index)
+            members.pop(index)
+            result = 0
+        index = bisect_left(scores, score)
+        end = len(scores)
+        while (index < end and scores[index] == score and
+                members[index] < member):
+            index += 1
+        scores.insert(index, score)
+        members.insert(index, member)
+        return result
+
+    def update(self, score_members):
+        add = self.add
+        for score, member in score_members:
+            add(score, member)
+
+    def remove(self, member):
+        '''Remove ``member`` and return its score, ``None`` if not found.'''
+        try:
+            index = self._members.index(member)
+        except ValueError:
+            return None
+        self._members.pop(index)
+        return self._scores.pop(index)
+
+    def remove_items(self, members):
+        removed = 0
+        for member in members:
+            if self.remove(member) is not None:
+                removed += 1
+        return removed
+
+    def count(self, minval, maxval, include_min=True, include_max=True):
+        start, end = self._score_range(minval, maxval, include_min,
+                                       include_max)
+        return max(end - start, 0)
+
+    def range(self, start, end, scores=False):
+        if scores:
+            return zip(self._scores[start:end], self._members[start:end])
+        return iter(self._members[start:end])
+
+    def range_by_score(self, minval, maxval, include_min=True,
+                       include_max=True, start=0, num=None, scores=False):
+        first, last = self._score_range(minval, maxval, include_min,
+                                        include_max)
+        if num is not None:
+            last = min(last, first + start + num)
+        first += max(start, 0)
+        if first >= last:
+            return iter(())
+        return self.range(first, last, scores)
+
+    def remove_range(self, start, end):
+        '''Remove a range by rank.'''
+        size = len(self._members)
+        del self._scores[start:end]
+        del self._members[start:end]
+        return size - len(self._members)
+
+    def remove_range_by_score(self, minval, maxval, include_min=True,
+                              include_max=True):
+        start, end = self._score_range(minval, maxval, include_min,
+                                       include_max)
+        if start >= end:
+            return 0
+        return self.remove_range(start, end)
+
+    def convert(self):
+        return IndexedZset(zip(self._scores, self._members))
+
+    def _score_range(self, minval, maxval, include_min, include_max):
+        scores = self._scores
+        if include_min:
+            start = bisect_left(scores, minval)
+        else:
+            start = bisect_right(scores, minval)
+        if include_max:
+            end = bisect_right(scores, maxval)
+        else:
+            end = bisect_left(scores, maxval)
+        return start, end
+
+
+LISTPACK_TYPES = (ListpackHash, ListpackList, ListpackSet, ListpackZset)
@@ -27,9 +27,15 @@ class NoScriptError(ResponseError):
     pass
 
 
+class MovedError(ResponseError):
+    '''The key is served by another shard of a cluster'''
+    pass
+
+
 EXCEPTION_CLASSES = {
     'ERR': ResponseError,
     'NOSCRIPT': NoScriptError,
+    'MOVED': MovedError,
 }
 
 
@@ -0,0 +1,98 @@
+'''Dispatch index of pattern subscriptions.
+
+Patterns are stored in a trie keyed on their literal prefix, the bytes
+preceding the first glob special character. Publishing on a channel walks
+the trie along the channel name and only matches the regular expressions
+of the patterns found on the way, while the patterns matching recently
+published channels are cached until a pattern is added or removed.
+'''
+# Glob special characters: ``*``, ``?``, ``[`` and ``\``
+GLOB_CHARS = frozenset(b'*?[\\')
+# Maximum number of channels in the cache of matching patterns
+CACHE_SIZE = 10000
+
+
+def literal_prefix(pattern):
+    '''The bytes of ``pattern`` preceding its first glob special character.
+    '''
+    for n, c in enumerate(pattern):
+        if c in GLOB_CHARS:
+            return pattern[:n]
+    return pattern
+
+
+class PatternIndex:
+    '''Index of pattern subscriptions.
+
+    Values are objects with a compiled regular expression in their ``re``
+    attribute, such as the ``pubsub_patterns`` of the :class:`.Storage`.
+    A trie node is a two elements list, the dictionary of children nodes
+    and the dictionary of patterns whose literal prefix ends at the node.
+    '''
+    def __init__(self, cache_size=CACHE_SIZE):
+        self._root = [{}, {}]
+        self._cache = {}
+        self._cache_size = cache_size
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, pattern, value):
+        '''Add ``value`` for ``pattern`` and invalidate the cache.'''
+        node = self._root
+        for c in literal_prefix(pattern):
+            child = node[0].get(c)
+            if child is None:
+                node[0][c] = child = [{}, {}]
+            node = child
+        if pattern not in node[1]:
+            self._size += 1
+        node[1][pattern] = value
+        self._cache.clear()
+
+    def remove(self, pattern):
+        '''Remove ``pattern`` and invalidate the cache.'''
+        node = self._root
+        path = []
+        for c in literal_prefix(pattern):
+            child = node[0].get(c)
+            if child is None:
+                return
+            path.append((node, c))
+            node = child
+        if node[1].pop(pattern, None) is not None:
+            self._size -= 1
+            self._cache.clear()
+            # prune empty nodes
+            while path and not node[0] and not node[1]:
+                node, c = path.pop()
+                node[0].pop(c)
+
+    def clear(self):
+        self.__init__(self._cache_size)
+
+    def match(self, channel):
+        '''Tuple of values whose pattern matches ``channel``.'''
+        matched = self._cache.get(channel)
+        if matched is None:
+            matched = []
+            if self._size:
+                ch = channel.decode('utf-8')
+                node = self._root
+                for value in node[1].values():
+                    if value.re.match(ch):
+                        matched.append(value)
+                for c in channel:
+                    node = node[0].get(c)
+                    if node is None:
+                        break
+                    for value in node[1].values():
+                        if value.re.match(ch):
+                            matched.append(value)
+            matched = tuple(matched)
+            cache = self._cache
+            if len(cache) >= self._cache_size:
+                cache.clear()
+            cache[channel] = matched
+        return matched
@@ -1,4 +1,14 @@
 '''A parser for redis messages
+
+The :class:`Parser` reads messages from a single ``bytearray`` at a read
+offset, rather than slicing the parsed bytes off the buffer after each
+line or bulk string, which copied the rest of a pipelined batch for each
+element of each message. Parsed bytes are dropped from the buffer once for
+each :meth:`Parser.feed`.
+
+A bulk string is parsed only when all its bytes are in the buffer, the
+elements of an incomplete array are kept in a stack of partial arrays so
+that they are not parsed again when more data is fed.
 '''
 from itertools import starmap
 
@@ -9,57 +19,8 @@ REPLAY_TYPE = frozenset((b'$',   # REDIS_REPLY_STRING,
                          b':',   # REDIS_REPLY_INTEGER,
                          b'+',   # REDIS_REPLY_STATUS,
                          b'-'))  # REDIS_REPLY_ERROR
-
-
-class String(object):
-    __slots__ = ('_length', 'next')
-
-    def __init__(self, length, next):
-        self._length = length
-        self.next = next
-
-    def decode(self, parser, result):
-        parser._current = None
-        length = self._length
-        if length >= 0:
-            b = parser._inbuffer
-            if len(b) >= length+2:
-                parser._inbuffer, chunk = b[length+2:], bytes(b[:length])
-                if parser.encoding:
-                    return chunk.decode(parser.encoding)
-                else:
-                    return chunk
-            else:
-                parser._current = self
-                return False
-
-
-class ArrayTask(object):
-    __slots__ = ('_length', '_response', 'next')
-
-    def __init__(self, length, next):
-        self._length = length
-        self._response = []
-        self.next = next
-
-    def decode(self, parser, result):
-        parser._current = None
-        length = self._length
-        if length >= 0:
-            response = self._response
-            if result is not False:
-                response.append(result)
-            while len(response) < length:
-                result = parser._get(self)
-                if result is False:
-                    break
-                response.append(result)
-            if len(response) == length:
-                parser._current = None
-                return response
-            elif not parser._current:
-                parser._current = self
-            return False
+# first bytes of lines as integers
+STRING, ARRAY, INTEGER, STATUS, ERROR = b'$*:+-'
 
 
 class Parser(object):
@@ -69,8 +30,10 @@ class Parser(object):
     def __init__(self, protocolError, responseError):
         self.protocolError = protocolError
         self.responseError = responseError
-        self._current = None
         self._inbuffer = bytearray()
+        self._offset = 0
+        self._arrays = []
+        self._error = None
 
     def on_connect(self, connection):
         if connection.decode_responses:
@@ -81,14 +44,96 @@ class Parser(object):
 
     def feed(self, buffer):
         '''Feed new data into the buffer'''
-        self._inbuffer.extend(buffer)
+        b = self._inbuffer
+        if self._offset:
+            del b[:self._offset]
+            self._offset = 0
+        b.extend(buffer)
 
     def get(self):
-        '''Called by the protocol consumer'''
-        if self._current:
-            return self._resume(self._current, False)
-        else:
-            return self._get(None)
+        '''Called by the protocol consumer.
+
+        Return the next complete message or ``False``.
+        '''
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        b = self._inbuffer
+        size = len(b)
+        offset = self._offset
+        arrays = self._arrays
+        while offset < size:
+            eol = b.find(b'\r\n', offset)
+            if eol < 0:
+                break
+            rtype = b[offset]
+            if rtype == STRING:
+                length = int(b[offset+1:eol])
+                if length < 0:
+                    value = None
+                    offset = eol + 2
+                else:
+                    end = eol + 2 + length
+                    if end + 2 > size:
+                        # wait for the whole string
+                        break
+                    value = bytes(b[eol+2:end])
+                    if self.encoding:
+                        value = value.decode(self.encoding)
+                    offset = end + 2
+            elif rtype == ARRAY:
+                length = int(b[offset+1:eol])
+                offset = eol + 2
+                if length > 0:
+                    arrays.append((length, []))
+                    continue
+                value = [] if length == 0 else None
+            elif rtype == INTEGER:
+                value = int(b[offset+1:eol])
+                offset = eol + 2
+            elif rtype == STATUS:
+                value = bytes(b[offset+1:eol])
+                offset = eol + 2
+            elif rtype == ERROR:
+                value = self.responseError(b[offset+1:eol].decode('utf-8'))
+                offset = eol + 2
+            else:
+                # Clear the buffer and raise
+                self._inbuffer = bytearray()
+                self._offset = 0
+                arrays.clear()
+                raise self.protocolError('Protocol Error')
+            while arrays:
+                length, array = arrays[-1]
+                array.append(value)
+                if len(array) < length:
+                    break
+                arrays.pop()
+                value = array
+            else:
+                self._offset = offset
+                return value
+        self._offset = offset
+        return False
+
+    def get_all(self):
+        '''List of the complete messages in the buffer.
+
+        Parsing stops at a malformed message: the messages before it are
+        returned and the error is raised by the next call.
+        '''
+        messages = []
+        get = self.get
+        try:
+            message = get()
+            while message is not False:
+                messages.append(message)
+                message = get()
+        except Exception as exc:
+            if not messages:
+                raise
+            self._error = exc
+        return messages
 
     def bulk(self, value):
         if value is None:
@@ -166,38 +211,6 @@ class Parser(object):
                 break
             yield v
 
-    def _get(self, next):
-        b = self._inbuffer
-        length = b.find(b'\r\n')
-        if length >= 0:
-            self._inbuffer, response = b[length+2:], bytes(b[:length])
-            rtype, response = response[:1], response[1:]
-            if rtype == b'-':
-                return self.responseError(response.decode('utf-8'))
-            elif rtype == b':':
-                return int(response)
-            elif rtype == b'+':
-                return response
-            elif rtype == b'$':
-                task = String(int(response), next)
-                return task.decode(self, False)
-            elif rtype == b'*':
-                task = ArrayTask(int(response), next)
-                return task.decode(self, False)
-            else:
-                # Clear the buffer and raise
-                self._inbuffer = bytearray()
-                raise self.protocolError('Protocol Error')
-        else:
-            return False
-
     def buffer(self):
         '''Current buffer'''
-        return bytes(self._inbuffer)
-
-    def _resume(self, task, result):
-        result = task.decode(self, result)
-        if result is not False and task.next:
-            return self._resume(task.next, result)
-        else:
-            return result
+        return bytes(self._inbuffer[self._offset:])
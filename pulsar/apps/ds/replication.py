@@ -0,0 +1,473 @@
+'''Master-replica replication for pulsar-ds.
+
+A replica connects to its master with the :class:`MasterLink` protocol and
+sends ``PSYNC <replid> <offset>``. When the master can resume the stream
+from its :class:`ReplicationBacklog` it replies ``+CONTINUE`` followed by
+the missing commands. Otherwise it replies ``+FULLRESYNC <replid> <offset>``
+and streams a snapshot, written by a forked process, as a bulk string
+followed by the write commands executed since the fork.
+
+Once in sync, write commands propagated by the :class:`.Storage` are
+streamed to replicas and appended to the backlog. Replicas acknowledge the
+processed offset once per second with ``REPLCONF ACK <offset>``.
+'''
+import os
+import time
+import binascii
+import tempfile
+import asyncio
+from collections import deque
+from multiprocessing import Process
+
+from pulsar import async
+
+from .client import ReplayClient
+from .snapshot import save_snapshot
+
+
+BACKLOG_SIZE = 1 << 20
+# Size of snapshot chunks written to replicas and the transport buffer
+# size which pauses the transfer
+TRANSFER_CHUNK = 1 << 16
+TRANSFER_HIGH_WATER = 1 << 20
+TRANSFER_PAUSE = 0.01
+RECONNECT_DELAY = 1
+
+
+def new_replid():
+    return binascii.hexlify(os.urandom(20)).decode('utf-8')
+
+
+def command_size(request):
+    '''Number of bytes of ``request`` encoded by the redis protocol.'''
+    size = len(str(len(request))) + 3
+    for value in request:
+        n = len(value)
+        size += len(str(n)) + n + 5
+    return size
+
+
+class ReplicationBacklog:
+    '''The last ``size`` bytes of the replication stream.
+
+    :attr:`offset` is the replication offset, the number of bytes streamed
+    since the backlog was created.
+    '''
+    def __init__(self, size=BACKLOG_SIZE):
+        self.size = size
+        self.offset = 0
+        self._chunks = deque()
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def first_byte_offset(self):
+        return self.offset - self._length + 1
+
+    def append(self, data):
+        chunks = self._chunks
+        chunks.append(data)
+        self._length += len(data)
+        self.offset += len(data)
+        while self._length - len(chunks[0]) >= self.size:
+            self._length -= len(chunks.popleft())
+
+    def read(self, offset):
+        '''Bytes streamed after ``offset``.
+
+        Return ``None`` when they are no longer in the backlog.
+        '''
+        missing = self.offset - offset
+        if missing < 0 or missing > self._length:
+            return None
+        elif not missing:
+            return b''
+        return b''.join(self._chunks)[self._length - missing:]
+
+
+class Replica:
+    '''State of a replica connected to a :class:`ReplicationMaster`.'''
+    def __init__(self, client, buffer=None):
+        self.client = client
+        self.online = False
+        # commands executed while waiting for the snapshot
+        self.buffer = list(buffer or ())
+        self.buffer_size = sum((len(b) for b in self.buffer))
+        self.file = None
+        self.ack_offset = 0
+        self.ack_time = None
+
+
+class ReplicationMaster:
+    '''Stream write commands of a :class:`.Storage` to its replicas.
+
+    Added to the propagation targets of the storage when the first replica
+    connects.
+    '''
+    def __init__(self, store, backlog_size=BACKLOG_SIZE):
+        self.store = store
+        self.replid = new_replid()
+        self.backlog = ReplicationBacklog(backlog_size)
+        self.replicas = {}
+        self._loop = store._loop
+        self._database = None
+        self._writer = None
+        self._snapshot = None
+        self._sync_full = 0
+        self._sync_partial_ok = 0
+        self._sync_partial_err = 0
+
+    @property
+    def offset(self):
+        return self.backlog.offset
+
+    def info(self):
+        backlog = self.backlog
+        online = [r for r in self.replicas.values() if r.online]
+        info = {'connected_slaves': len(online),
+                'master_replid': self.replid,
+                'master_repl_offset': backlog.offset,
+                'repl_backlog_active': 1,
+                'repl_backlog_size': backlog.size,
+                'repl_backlog_first_byte_offset': backlog.first_byte_offset,
+                'repl_backlog_histlen': len(backlog),
+                'sync_full': self._sync_full,
+                'sync_partial_ok': self._sync_partial_ok,
+                'sync_partial_err': self._sync_partial_err}
+        now = self._loop.time()
+        for n, replica in enumerate(online):
+            address = replica.client._transport.get_extra_info('peername')
+            lag = int(now - replica.ack_time) if replica.ack_time else -1
+            info['slave%d' % n] = {'ip': address[0] if address else '',
+                                   'port': address[1] if address else 0,
+                                   'state': 'online',
+                                   'offset': replica.ack_offset,
+                                   'lag': lag}
+        return info
+
+    def feed(self, database, request):
+        parser = self.store._parser
+        chunk = parser.pack_command(request)
+        if database != self._database:
+            self._database = database
+            chunk = parser.pack_command(('select', database)) + chunk
+        self.backlog.append(chunk)
+        for replica in tuple(self.replicas.values()):
+            if replica.online:
+                replica.client.write_message(chunk)
+            else:
+                replica.buffer.append(chunk)
+                replica.buffer_size += len(chunk)
+                hard = self.store._output_limits['replica'][0]
+                if hard and replica.buffer_size > hard:
+                    self.store.logger.warning(
+                        'Closing replica waiting for synchronization, '
+                        'output buffer over the limit')
+                    self._close(replica)
+
+    def sync(self, client, replid=None, offset=-1):
+        '''Synchronize the replica connected to ``client``.
+
+        :param replid: the replication id of the last master of the replica
+            or ``None`` for the ``SYNC`` command
+        :param offset: the first byte of the stream the replica needs
+        '''
+        client.flag |= self.store.REPLICA
+        self.remove(client)
+        if replid == self.replid:
+            data = self.backlog.read(offset - 1)
+            if data is not None:
+                self._sync_partial_ok += 1
+                client._transport.write(b'+CONTINUE\r\n' + data)
+                replica = Replica(client)
+                replica.online = True
+                self.replicas[client] = replica
+                return
+        if replid is not None and replid != '?':
+            self._sync_partial_err += 1
+        self._sync_full += 1
+        self._full_sync(client, replid is not None)
+
+    def ack(self, client, offset):
+        replica = self.replicas.get(client)
+        if replica:
+            replica.ack_offset = offset
+            replica.ack_time = self._loop.time()
+
+    def remove(self, client):
+        replica = self.replicas.pop(client, None)
+        if replica and replica.file:
+            replica.file.close()
+
+    def cron(self):
+        '''Start streaming the snapshot once its process has exited.'''
+        writer = self._writer
+        if writer and not writer.is_alive():
+            self._writer = None
+            waiting = [r for r in self.replicas.values() if not r.online]
+            if writer.exitcode:
+                self.store.logger.error('Replication snapshot failed')
+                for replica in waiting:
+                    self._close(replica)
+            else:
+                for replica in waiting:
+                    self._send_snapshot(replica)
+        self._remove_snapshot()
+
+    def close(self):
+        for replica in tuple(self.replicas.values()):
+            self._close(replica)
+        self._remove_snapshot()
+
+    def reset(self):
+        '''Start a new replication history.
+
+        Called when the data of a replica with replicas of its own is
+        replaced by a full synchronization with its master.
+        '''
+        self.close()
+        self.replid = new_replid()
+        self.backlog = ReplicationBacklog(self.backlog.size)
+        self._database = None
+
+    #    INTERNALS
+    def _full_sync(self, client, psync):
+        store = self.store
+        waiting = [r for r in self.replicas.values() if not r.online]
+        if waiting:
+            # share the snapshot of replicas waiting for synchronization
+            replica = Replica(client, waiting[0].buffer)
+            offset = self._snapshot_offset
+        else:
+            replica = Replica(client)
+            offset = self.offset
+            self._snapshot_offset = offset
+            self._snapshot = tempfile.mktemp(prefix='pulsards-sync-')
+            args = (store.cfg, self._snapshot, store._dbs(),
+                    time.time() - self._loop.time())
+            # the forked process shares the data copy-on-write
+            self._writer = Process(target=save_snapshot, args=args)
+            self._writer.start()
+            # commands after the snapshot select their database
+            self._database = None
+        self.replicas[client] = replica
+        if psync:
+            client._transport.write(('+FULLRESYNC %s %d\r\n' %
+                                     (self.replid, offset)).encode('utf-8'))
+        if not self._writer:
+            self._send_snapshot(replica)
+
+    def _send_snapshot(self, replica):
+        transport = replica.client._transport
+        if transport._closing or replica.client not in self.replicas:
+            return self.remove(replica.client)
+        if replica.file is None:
+            replica.file = open(self._snapshot, 'rb')
+            size = os.fstat(replica.file.fileno()).st_size
+            transport.write(('$%d\r\n' % size).encode('utf-8'))
+        while transport.get_write_buffer_size() < TRANSFER_HIGH_WATER:
+            data = replica.file.read(TRANSFER_CHUNK)
+            if not data:
+                replica.file.close()
+                replica.file = None
+                replica.online = True
+                transport.write(b''.join(replica.buffer))
+                replica.buffer = None
+                return self._remove_snapshot()
+            transport.write(data)
+        self._loop.call_later(TRANSFER_PAUSE, self._send_snapshot, replica)
+
+    def _remove_snapshot(self):
+        if self._snapshot and not self._writer:
+            if all((r.online for r in self.replicas.values())):
+                if os.path.isfile(self._snapshot):
+                    os.remove(self._snapshot)
+                self._snapshot = None
+
+    def _close(self, replica):
+        self.remove(replica.client)
+        replica.client._transport.close()
+
+
+class MasterLink(asyncio.Protocol):
+    '''The connection of a replica :class:`.Storage` to its master.
+
+    Reconnects after :data:`RECONNECT_DELAY` seconds when the connection
+    is lost and resumes the replication stream from the last processed
+    offset when the master backlog allows it.
+    '''
+    def __init__(self, store, host, port):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.replid = '?'
+        self.offset = -1
+        self.status = 'connect'
+        self.client = ReplayClient(store)
+        self._loop = store._loop
+        self._transport = None
+        self._buffer = bytearray()
+        self._parser = None
+        self._state = None
+        self._snapshot = None
+        self._remaining = 0
+        self._last_io = None
+        self._closed = False
+
+    def __repr__(self):
+        return 'master %s:%s' % (self.host, self.port)
+
+    def info(self):
+        last_io = self._last_io
+        return {'master_host': self.host,
+                'master_port': self.port,
+                'master_link_status': ('up' if self.status == 'connected'
+                                       else 'down'),
+                'master_last_io_seconds_ago': (
+                    int(self._loop.time() - last_io) if last_io else -1),
+                'master_sync_in_progress': int(self.status == 'sync'),
+                'slave_repl_offset': max(self.offset, 0),
+                'slave_read_only': 1}
+
+    def connect(self):
+        if not self._closed:
+            self.status = 'connect'
+            async(self._connect(), loop=self._loop)
+
+    def close(self):
+        self._closed = True
+        if self._transport:
+            self._transport.close()
+
+    def cron(self):
+        '''Acknowledge the processed offset to the master.'''
+        if self.status == 'connected':
+            self._write(('replconf', 'ack', self.offset))
+
+    # Protocol implementation
+    def connection_made(self, transport):
+        self._transport = transport
+        self._buffer = bytearray()
+        self._state = self._read_status
+        self._last_io = self._loop.time()
+        self.status = 'handshake'
+        self._write(('psync', self.replid, self.offset + 1))
+
+    def connection_lost(self, exc):
+        self._transport = None
+        self._close_snapshot()
+        if not self._closed:
+            self.store.logger.warning('Lost connection with %s', self)
+            self._loop.call_later(RECONNECT_DELAY, self.connect)
+
+    def data_received(self, data):
+        self._last_io = self._loop.time()
+        self._buffer.extend(data)
+        while self._buffer and self._state():
+            pass
+
+    #    INTERNALS
+    @asyncio.coroutine
+    def _connect(self):
+        try:
+            yield from self._loop.create_connection(lambda: self, self.host,
+                                                    self.port)
+        except Exception as exc:
+            self.store.logger.warning('Could not connect to %s: %s',
+                                      self, exc)
+            self._loop.call_later(RECONNECT_DELAY, self.connect)
+
+    def _write(self, request):
+        if self._transport:
+            self._transport.write(self.store._parser.pack_command(request))
+
+    def _readline(self):
+        buffer = self._buffer
+        # masters may send new lines to keep the connection alive
+        while buffer[:1] == b'\n':
+            del buffer[0]
+        index = buffer.find(b'\r\n')
+        if index >= 0:
+            line = bytes(buffer[:index])
+            del buffer[:index+2]
+            return line.decode('utf-8')
+
+    def _read_status(self):
+        line = self._readline()
+        if line is None:
+            return False
+        elif line.startswith('+FULLRESYNC'):
+            _, self.replid, offset = line.split()
+            self.offset = int(offset)
+            self.status = 'sync'
+            self._state = self._read_snapshot_length
+        elif line.startswith('+CONTINUE'):
+            self.store.logger.info('Partial resynchronization with %s', self)
+            self._stream()
+        else:
+            self.store.logger.error('Unexpected reply from %s: %s',
+                                    self, line)
+            self._transport.close()
+            return False
+        return True
+
+    def _read_snapshot_length(self):
+        line = self._readline()
+        if line is None:
+            return False
+        self._remaining = int(line[1:])
+        fd, self._snapshot = tempfile.mkstemp(prefix='pulsards-replica-')
+        self._snapshot_file = os.fdopen(fd, 'wb')
+        self._state = self._read_snapshot
+        return True
+
+    def _read_snapshot(self):
+        buffer = self._buffer
+        size = min(self._remaining, len(buffer))
+        self._snapshot_file.write(buffer[:size])
+        del buffer[:size]
+        self._remaining -= size
+        if self._remaining:
+            return False
+        self._snapshot_file.close()
+        self._snapshot_file = None
+        self.store.logger.info('Full resynchronization with %s', self)
+        store = self.store
+        for db in store.databases.values():
+            db.flush()
+        store._load_snapshot(self._snapshot)
+        if store._aof:
+            # the append only file logs the replaced data
+            store._aof.restart(store._dbs())
+        if store._replication:
+            store._replication.reset()
+        os.remove(self._snapshot)
+        self._snapshot = None
+        self.client.database = 0
+        self._stream()
+        return True
+
+    def _stream(self):
+        self.status = 'connected'
+        self._parser = self.store._server._parser_class()
+        self._state = self._read_commands
+
+    def _read_commands(self):
+        parser = self._parser
+        parser.feed(bytes(self._buffer))
+        self._buffer = bytearray()
+        client = self.client
+        request = parser.get()
+        while request is not False:
+            self.offset += command_size(request)
+            client.execute(request)
+            request = parser.get()
+        return False
+
+    def _close_snapshot(self):
+        if self._snapshot:
+            self._snapshot_file.close()
+            os.remove(self._snapshot)
+            self._snapshot = None
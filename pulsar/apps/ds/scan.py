@@ -0,0 +1,402 @@
+'''Cursor iteration for the SCAN family of commands.
+
+Elements are grouped into a power of two number of buckets by the low bits
+of their hash. A cursor is a bucket number with its bits reversed and it is
+incremented from the most significant bit, as in redis, so that every
+element present during a whole iteration is returned even when the number
+of buckets grows or shrinks between calls.
+
+Keys are indexed by their :class:`.Db` and the elements of hashes, sets and
+sorted sets of full type by the container itself, as :class:`IndexedDict`,
+:class:`IndexedSet` and :class:`IndexedZset` update their index with their
+elements. Cursors are therefore stateless for both. Listpacks are small
+and scanned in one call.
+'''
+from random import randrange
+
+from pulsar.utils.structures import Dict, Zset
+
+MAX64 = (1 << 64) - 1
+# Average number of elements per bucket which triggers a resize
+LOAD = 8
+MIN_BUCKETS = 4
+# Number of empty buckets visited for each requested element
+EMPTY_VISITS = 10
+
+_REVERSED_BYTES = bytes((int('{:08b}'.format(b)[::-1], 2)
+                         for b in range(256)))
+
+
+def reverse_bits(value):
+    '''Reverse the bits of the 64 bits unsigned integer ``value``.'''
+    return int.from_bytes(
+        value.to_bytes(8, 'big').translate(_REVERSED_BYTES), 'little')
+
+
+def next_cursor(cursor, mask):
+    '''The cursor following ``cursor`` in a table with ``mask``.
+
+    Return 0 when the iteration is complete.
+    '''
+    cursor = reverse_bits(cursor | (~mask & MAX64))
+    return reverse_bits((cursor + 1) & MAX64)
+
+
+class ScanIndex:
+    '''Buckets of elements supporting cursor based iteration.
+
+    The number of buckets doubles, or halves, one bucket at a time: each
+    :meth:`add` and :meth:`remove` splits, or merges, one bucket while a
+    resize is in progress, so that the index never stalls the event loop.
+    During a resize the buckets below ``_split`` use the larger mask.
+    '''
+    def __init__(self, elements=None):
+        self._size = 0
+        self._mask = MIN_BUCKETS - 1
+        self._split = 0
+        self._growing = False
+        if elements is not None:
+            size = MIN_BUCKETS
+            while size * LOAD < len(elements):
+                size *= 2
+            self._mask = size - 1
+        self._buckets = [None] * (self._mask + 1)
+        if elements is not None:
+            add = self._add
+            for element in elements:
+                add(element)
+            self._size = len(elements)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, element):
+        '''Add a new ``element``, which must not be in the index.'''
+        self._add(element)
+        self._size += 1
+        self._resize()
+
+    def update(self, elements):
+        '''Add new ``elements``, which must not be in the index.
+
+        When they outnumber the elements in the index, the buckets are
+        rebuilt at once rather than split one at a time.
+        '''
+        if len(elements) > self._size:
+            elements = [e for bucket in self._buckets if bucket
+                        for e in bucket] + list(elements)
+            self.__init__(elements)
+        else:
+            add = self.add
+            for element in elements:
+                add(element)
+
+    def remove(self, element):
+        '''Remove ``element``, which must be in the index.'''
+        bucket = self._bucket(hash(element))
+        elements = self._buckets[bucket]
+        elements.remove(element)
+        if not elements:
+            self._buckets[bucket] = None
+        self._size -= 1
+        self._resize()
+
+    def clear(self):
+        self.__init__()
+
+    def scan(self, cursor, count):
+        '''Return the next cursor and a list of elements.
+
+        Buckets are visited until at least ``count`` elements have been
+        collected or ``EMPTY_VISITS`` times ``count`` empty buckets have
+        been visited.
+        '''
+        buckets = self._buckets
+        mask = self._mask
+        result = []
+        empty = EMPTY_VISITS*count
+        while True:
+            if self._split:
+                # visit both halves of a bucket of the smaller table
+                mask = self._mask >> 1
+                bucket = cursor & mask
+                lower = buckets[bucket]
+                upper = buckets[bucket + mask + 1]
+                found = lower or upper
+                if lower:
+                    result.extend(lower)
+                if upper:
+                    result.extend(upper)
+            else:
+                found = buckets[cursor & mask]
+                if found:
+                    result.extend(found)
+            cursor = next_cursor(cursor, mask)
+            if not cursor or len(result) >= count:
+                break
+            if not found:
+                empty -= 1
+                if not empty:
+                    break
+        return cursor, result
+
+    def sample(self, count, accept=None):
+        '''Return up to ``count`` random elements.
+
+        Consecutive buckets are visited from a random one until ``count``
+        elements, for which ``accept`` returns true when given, have been
+        collected or ``EMPTY_VISITS`` times ``count`` buckets have been
+        visited.
+        '''
+        buckets = self._buckets
+        size = len(buckets)
+        bucket = randrange(size)
+        result = []
+        for _ in range(min(EMPTY_VISITS*count, size)):
+            elements = buckets[bucket]
+            if elements:
+                if accept:
+                    elements = [e for e in elements if accept(e)]
+                result.extend(elements)
+                if len(result) >= count:
+                    break
+            bucket = (bucket + 1) % size
+        return result[:count]
+
+    #    INTERNALS
+    def _bucket(self, h):
+        mask = self._mask
+        if self._split:
+            small = mask >> 1
+            if h & small >= self._split:
+                return h & small
+        return h & mask
+
+    def _add(self, element):
+        bucket = self._bucket(hash(element))
+        elements = self._buckets[bucket]
+        if elements is None:
+            self._buckets[bucket] = [element]
+        else:
+            elements.append(element)
+
+    def _resize(self):
+        if self._split:
+            if self._growing:
+                self._split_bucket()
+            else:
+                self._merge_bucket()
+        elif self._size > LOAD*(self._mask + 1):
+            # double the buckets, all of them use the smaller mask
+            self._buckets.extend([None] * (self._mask + 1))
+            self._mask = 2*self._mask + 1
+            self._growing = True
+            self._split_bucket()
+        elif (self._mask >= MIN_BUCKETS and
+                self._size < LOAD*(self._mask + 1) // 4):
+            # halve the buckets, all of them use the larger mask
+            self._split = (self._mask + 1) // 2
+            self._growing = False
+            self._merge_bucket()
+
+    def _split_bucket(self):
+        mask = self._mask
+        half = (mask + 1) // 2
+        bucket = self._split
+        elements = self._buckets[bucket]
+        if elements:
+            upper = [e for e in elements if hash(e) & mask != bucket]
+            if upper:
+                self._buckets[bucket + half] = upper
+                lower = [e for e in elements if hash(e) & mask == bucket]
+                self._buckets[bucket] = lower or None
+        self._split = bucket + 1
+        if self._split == half:
+            self._split = 0
+
+    def _merge_bucket(self):
+        half = (self._mask + 1) // 2
+        self._split = bucket = self._split - 1
+        upper = self._buckets[bucket + half]
+        if upper:
+            self._buckets[bucket + half] = None
+            lower = self._buckets[bucket]
+            if lower:
+                lower.extend(upper)
+            else:
+                self._buckets[bucket] = upper
+        if not bucket:
+            del self._buckets[half:]
+            self._mask = half - 1
+
+
+
+class IndexedDict(Dict):
+    '''A hash with a :class:`ScanIndex` of its fields.'''
+    __slots__ = ('scan_index',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scan_index = ScanIndex(self)
+
+    def __reduce__(self):
+        return Dict, (dict(self),)
+
+    def __setitem__(self, field, value):
+        if field not in self:
+            self.scan_index.add(field)
+        dict.__setitem__(self, field, value)
+
+    def __delitem__(self, field):
+        dict.__delitem__(self, field)
+        self.scan_index.remove(field)
+
+    def pop(self, field, *default):
+        if field in self:
+            self.scan_index.remove(field)
+        return dict.pop(self, field, *default)
+
+    def popitem(self):
+        field, value = dict.popitem(self)
+        self.scan_index.remove(field)
+        return field, value
+
+    def setdefault(self, field, default=None):
+        if field not in self:
+            self[field] = default
+        return self[field]
+
+    def update(self, *args, **kwargs):
+        pairs = dict(*args, **kwargs)
+        fields = pairs.keys() - self.keys()
+        dict.update(self, pairs)
+        self.scan_index.update(fields)
+
+    def clear(self):
+        dict.clear(self)
+        self.scan_index.clear()
+
+
+class IndexedSet(set):
+    '''A set with a :class:`ScanIndex` of its members.
+
+    Operations returning a new set, such as :meth:`union`, return a plain
+    ``set``.
+    '''
+    __slots__ = ('scan_index',)
+
+    def __init__(self, members=()):
+        super().__init__(members)
+        self.scan_index = ScanIndex(self)
+
+    def __reduce__(self):
+        return set, (list(self),)
+
+    def add(self, member):
+        if member not in self:
+            set.add(self, member)
+            self.scan_index.add(member)
+
+    def remove(self, member):
+        set.remove(self, member)
+        self.scan_index.remove(member)
+
+    def discard(self, member):
+        if member in self:
+            self.remove(member)
+
+    def pop(self):
+        member = set.pop(self)
+        self.scan_index.remove(member)
+        return member
+
+    def clear(self):
+        set.clear(self)
+        self.scan_index.clear()
+
+    def update(self, *others):
+        for other in others:
+            members = set(other).difference(self)
+            set.update(self, members)
+            self.scan_index.update(members)
+
+    def difference_update(self, *others):
+        discard = self.discard
+        for other in others:
+            for member in other:
+                discard(member)
+
+    def intersection_update(self, *others):
+        remove = self.remove
+        for member in set.difference(self, set.intersection(self, *others)):
+            remove(member)
+
+    def symmetric_difference_update(self, other):
+        for member in set(other):
+            if member in self:
+                self.remove(member)
+            else:
+                self.add(member)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+
+class IndexedZset(Zset):
+    '''A sorted set with a :class:`ScanIndex` of its members.'''
+    def __init__(self, data=None):
+        self.scan_index = ScanIndex()
+        super().__init__(data)
+
+    def __reduce__(self):
+        return Zset, (), self.__getstate__()
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.scan_index = ScanIndex(state)
+
+    def add(self, score, member):
+        added = super().add(score, member)
+        if added:
+            self.scan_index.add(member)
+        return added
+
+    def remove(self, member):
+        score = super().remove(member)
+        if score is not None:
+            self.scan_index.remove(member)
+        return score
+
+    def remove_range(self, start, end):
+        return self._sl.remove_range(start, end, callback=self._removed)
+
+    def remove_range_by_score(self, minval, maxval,
+                              include_min=True, include_max=True):
+        return self._sl.remove_range_by_score(
+            minval, maxval, include_min=include_min, include_max=include_max,
+            callback=self._removed)
+
+    def clear(self):
+        super().clear()
+        self.scan_index.clear()
+
+    def _removed(self, score, member):
+        self._dict.pop(member)
+        self.scan_index.remove(member)
+
+    def _set_scores(self, scores):
+        super()._set_scores(scores)
+        self.scan_index = ScanIndex(scores)
@@ -0,0 +1,279 @@
+'''Lua scripting for pulsar-ds.
+
+Scripts are compiled, via the optional lupa_ binding, into Lua functions of
+the ``KEYS`` and ``ARGV`` tables and cached by the SHA1 digest of their
+body. ``redis.call`` and ``redis.pcall`` execute commands with the
+:class:`.Storage` methods through a :class:`ScriptClient` which converts
+replies into Lua values.
+
+Write commands executed by a script are propagated to the append only file
+and replicas, within MULTI and EXEC, rather than the script itself.
+
+Scripts are sandboxed: the runtime has no python builtins, the attributes
+of python objects are not accessible from Lua and only plain functions,
+wrapping the :class:`LuaScripting` methods, are passed to Lua.
+
+.. _lupa: https://pypi.python.org/pypi/lupa
+'''
+from hashlib import sha1
+
+try:
+    import lupa
+except ImportError:     # pragma    nocover
+    lupa = None
+
+from pulsar.utils.pep import to_string
+
+from .client import ClientMixin, COMMANDS_INFO
+from .parser import CommandError
+
+
+WRONGTYPE = (b'WRONGTYPE Operation against a key holding the wrong kind '
+             b'of value')
+# Remove access to the file system and the python interpreter, define the
+# redis table and return helpers for building tables
+PRELUDE = b'''
+local redis_call, redis_pcall, sha1hex = ...
+io = nil
+os = nil
+package = nil
+require = nil
+dofile = nil
+loadfile = nil
+debug = nil
+python = nil
+unpack = unpack or table.unpack
+local function status_reply (s) return {ok=s} end
+local function error_reply (s) return {err=s} end
+redis = {call=redis_call, pcall=redis_pcall, sha1hex=sha1hex,
+         status_reply=status_reply, error_reply=error_reply}
+return status_reply, error_reply, function (...) return {...} end
+'''
+
+
+class ScriptError(Exception):
+    '''Raised by ``redis.call`` when a command replies with an error.'''
+
+
+def sha1hex(body):
+    return sha1(body).hexdigest().encode('utf-8')
+
+
+def no_attributes(obj, name, is_setting):
+    '''The ``attribute_filter`` of the Lua runtime, which denies access to
+    any attribute of a python object.'''
+    raise AttributeError('Script attempted to access a python attribute')
+
+
+class ScriptClient(ClientMixin):
+    '''The client executing commands from scripts.
+
+    Replies are stored, converted into Lua values, in :attr:`result`.
+    '''
+    redirect = False
+    channels = ()
+    patterns = ()
+    watched_keys = None
+
+    def __init__(self, store, lua):
+        super().__init__(store)
+        self._loop = store._loop
+        self.password = store._password
+        self.lua = lua
+        self.result = None
+        self.error = None
+        self._multi = []
+
+    def reply_ok(self):
+        self._reply(self.lua.status(b'OK'))
+
+    def reply_status(self, value):
+        self._reply(self.lua.status(value.encode('utf-8')))
+
+    def reply_error(self, value, prefix=None):
+        self.error = ('%s %s' % (prefix or 'ERR', value)).encode('utf-8')
+        self._reply(self.lua.error(self.error))
+
+    def reply_wrongtype(self):
+        self.error = WRONGTYPE
+        self._reply(self.lua.error(WRONGTYPE))
+
+    def reply_int(self, value):
+        self._reply(int(value))
+
+    def reply_one(self):
+        self._reply(1)
+
+    def reply_zero(self):
+        self._reply(0)
+
+    def reply_bulk(self, value=None):
+        self._reply(self._value(value))
+
+    def reply_multi_bulk(self, value=None):
+        self._reply(self._value(value))
+
+    def reply_multi_bulk_len(self, value):
+        if value:
+            self._multi.append((value, []))
+        else:
+            self._reply(self.lua.array())
+
+    #    INTERNALS
+    def _reply(self, value):
+        while self._multi:
+            length, values = self._multi[-1]
+            values.append(value)
+            if len(values) < length:
+                return
+            self._multi.pop()
+            value = self.lua.array(*values)
+        self.result = value
+
+    def _value(self, value):
+        if value is None:
+            return False
+        elif isinstance(value, bytes):
+            return value
+        elif isinstance(value, (bytearray, memoryview)):
+            return bytes(value)
+        elif isinstance(value, str):
+            return value.encode('utf-8')
+        elif isinstance(value, (int, float)):
+            return str(value).encode('utf-8')
+        else:
+            return self.lua.array(*[self._value(v) for v in value])
+
+
+class LuaScripting:
+    '''Compile, cache and run the scripts of a :class:`.Storage`.'''
+    def __init__(self, store):
+        self.store = store
+        self.scripts = {}
+        self._runtime = runtime = lupa.LuaRuntime(
+            encoding=None, register_eval=False, register_builtins=False,
+            attribute_filter=no_attributes)
+        execute = self._execute
+
+        def call(*args):
+            client = execute(args)
+            if client.error is not None:
+                raise ScriptError(to_string(client.error))
+            return client.result
+
+        def pcall(*args):
+            return execute(args).result
+
+        def lua_sha1hex(body):
+            return sha1hex(body)
+
+        self.status, self.error, self.array = runtime.execute(
+            PRELUDE, call, pcall, lua_sha1hex)
+        self.client = ScriptClient(store, self)
+
+    def load(self, body):
+        '''Compile ``body`` and return the SHA1 of the script.'''
+        sha = sha1hex(body)
+        if sha not in self.scripts:
+            try:
+                self.scripts[sha] = self._runtime.execute(
+                    b'return function (KEYS, ARGV)\n' + body + b'\nend')
+            except lupa.LuaError as exc:
+                raise CommandError('Error compiling script (new function): '
+                                   '%s' % exc)
+        return sha
+
+    def flush(self):
+        self.scripts.clear()
+
+    def run(self, client, sha, args):
+        '''Run the script with ``sha`` and reply to ``client``.
+
+        :param args: the number of keys followed by keys and arguments
+        '''
+        try:
+            numkeys = int(args[0])
+        except ValueError:
+            raise CommandError('value is not an integer or out of range')
+        if numkeys < 0:
+            raise CommandError("Number of keys can't be negative")
+        elif numkeys > len(args) - 1:
+            raise CommandError("Number of keys can't be greater than number "
+                               "of args")
+        array = self.array
+        keys = array(*args[1:numkeys+1])
+        argv = array(*args[numkeys+1:])
+        self.client.database = client.database
+        multi = self.store._start_multi()
+        try:
+            result = self.scripts[sha](keys, argv)
+        except (lupa.LuaError, ScriptError) as exc:
+            raise CommandError('Error running script (call to f_%s): %s' %
+                               (sha.decode('utf-8'), exc))
+        finally:
+            if multi:
+                self.store._end_multi(self.client.database)
+        self.reply(client, result)
+
+    def reply(self, client, value):
+        '''Reply to ``client`` with the Lua ``value``.'''
+        if value is None or value is False:
+            client.reply_bulk(None)
+        elif value is True:
+            client.reply_one()
+        elif isinstance(value, (int, float)):
+            client.reply_int(int(value))
+        elif isinstance(value, bytes):
+            client.reply_bulk(value)
+        elif lupa.lua_type(value) == 'table':
+            error = value[b'err']
+            if error is not None:
+                prefix, _, error = to_string(error).partition(' ')
+                if error:
+                    client.reply_error(error, prefix)
+                else:
+                    client.reply_error(prefix)
+                return
+            status = value[b'ok']
+            if status is not None:
+                return client.reply_status(to_string(status))
+            values = []
+            while True:
+                element = value[len(values) + 1]
+                if element is None:
+                    break
+                values.append(element)
+            client.reply_multi_bulk_len(len(values))
+            for element in values:
+                self.reply(client, element)
+        else:
+            client.reply_bulk(None)
+
+    #    INTERNALS
+    def _execute(self, args):
+        if not args:
+            raise ScriptError('Please specify at least one argument for '
+                              'redis.call()')
+        request = []
+        for arg in args:
+            if isinstance(arg, float) and arg.is_integer():
+                arg = int(arg)
+            if isinstance(arg, (int, float)):
+                arg = str(arg).encode('utf-8')
+            elif not isinstance(arg, bytes):
+                raise ScriptError('Lua redis() command arguments must be '
+                                  'strings or integers')
+            request.append(arg)
+        request[0] = command = to_string(request[0]).lower()
+        info = COMMANDS_INFO.get(command)
+        if not info:
+            raise ScriptError('Unknown Redis command called from Lua script')
+        elif not info.script:
+            raise ScriptError('This Redis command is not allowed from '
+                              'scripts')
+        client = self.client
+        client.result = client.error = None
+        client._multi = []
+        client._execute_command(getattr(self.store, info.method_name),
+                                request)
+        return client
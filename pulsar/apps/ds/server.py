@@ -46,19 +46,43 @@ import time
 import math
 import pickle
 from random import choice
-from itertools import islice, chain
+from itertools import islice
 from functools import partial, reduce
 from collections import namedtuple
-from itertools import zip_longest
 
 import pulsar
+from pulsar import asyncio, ImproperlyConfigured
+from pulsar.async.mailbox import create_aid
 from pulsar.apps.socket import SocketServer
+from pulsar.utils.internet import parse_address
 from pulsar.utils.config import Global
-from pulsar.utils.structures import Dict, Zset, Deque
-
-from .parser import redis_parser
-from .utils import sort_command, count_bytes, and_op, or_op, xor_op, save_data
-from .client import (command, PulsarStoreClient, Blocked,
+from pulsar.utils.structures import Dict, Zset, Deque, Quicklist
+
+from .parser import redis_parser, CommandError
+from .expiry import TimerWheel
+from .eviction import (Evictor, MAXMEMORY_POLICIES, ACCESS_BITS, ACCESS_MASK,
+                       OOM, object_memory)
+from .scan import (ScanIndex, IndexedDict, IndexedSet, IndexedZset,
+                   MAX64)
+from .listpack import (ListpackHash, ListpackList, ListpackSet, ListpackZset,
+                       LISTPACK_TYPES)
+from .pubsub import PatternIndex
+from .scripting import LuaScripting, lupa
+from .aof import AppendOnlyFile, FSYNC_POLICIES, read_commands
+from .snapshot import save_snapshot, load_snapshot
+from .replication import ReplicationMaster, MasterLink
+from .cluster import Cluster, key_slot, shard_filename
+from .slowlog import CommandStats, SlowLog
+from .lazyfree import LazyFree
+from .hyperloglog import HyperLogLog, MAGIC as HLL_MAGIC
+from .stream import (Stream, ConsumerGroup, StreamIdError, parse_id,
+                     format_id, SEQ_BITS, SEQ_MASK, MAX_ID)
+from .utils import (sort_command, count_bytes, bit_operation, bit_position,
+                    bitfield_type, bitfield_overflow, get_bits, set_bits,
+                    encode_string, string_bytes, parse_number, add_numbers,
+                    number_string, set_operation,
+                    intersection_count, BITOPS, BITFIELD_OVERFLOWS)
+from .client import (command, PulsarStoreClient, ReplayClient, Blocked,
                      COMMANDS_INFO, check_input, redis_to_py_pattern)
 
 
@@ -110,6 +134,24 @@ def validate_list_of_pairs(val):
     return new_val
 
 
+OUTPUT_BUFFER_CLASSES = ('normal', 'pubsub', 'monitor', 'replica')
+
+
+def validate_output_buffer_limits(val):
+    new_val = []
+    if val:
+        if not isinstance(val, (list, tuple)):
+            raise TypeError("Not a list: %s" % val)
+        for elem in val:
+            if not isinstance(elem, (list, tuple)) or not len(elem) == 4:
+                raise TypeError("Not a list of four elements: %s" % elem)
+            if elem[0] not in OUTPUT_BUFFER_CLASSES:
+                raise TypeError("Unknown client class: %s" % elem[0])
+            new_val.append((elem[0], int(elem[1]), int(elem[2]),
+                            int(elem[3])))
+    return new_val
+
+
 # #############################################################################
 # #    CONFIGURATION PARAMETERS
 class KeyValueDatabases(PulsarDsSetting):
@@ -150,7 +192,236 @@ class KeyValueFileName(PulsarDsSetting):
     name = "key_value_filename"
     flags = ["--key-value-filename"]
     default = 'pulsards.rdb'
-    desc = '''The filename where to dump the DB.'''
+    desc = '''\
+        The filename where to dump the DB.
+
+        In cluster mode each shard dumps its keys into this filename with
+        the shard index before the extension, ``pulsards.0.rdb`` for the
+        first shard.
+    '''
+
+
+class KeyValueAppendOnly(PulsarDsSetting):
+    name = "key_value_appendonly"
+    flags = ["--key-value-appendonly"]
+    action = "store_true"
+    default = False
+    validator = pulsar.validate_bool
+    desc = '''\
+        Log every write command into the append only file.
+
+        When enabled, the append only file rather than the snapshot file
+        is used to load the data at startup.
+    '''
+
+
+class KeyValueAppendFileName(PulsarDsSetting):
+    name = "key_value_appendfilename"
+    flags = ["--key-value-appendfilename"]
+    default = 'pulsards.aof'
+    desc = '''\
+        The name of the append only file.
+
+        In cluster mode the shard index is added before the extension, as
+        for the :ref:`key_value_filename <setting-key_value_filename>`.
+    '''
+
+
+class KeyValueAppendFsync(PulsarDsSetting):
+    name = "key_value_appendfsync"
+    flags = ["--key-value-appendfsync"]
+    choices = FSYNC_POLICIES
+    default = 'everysec'
+    desc = '''\
+        When the append only file is synced to disk.
+
+        ``always`` after every write command, ``everysec`` once per second
+        in a background thread, ``no`` when the operating system decides.
+    '''
+
+
+class KeyValueClientOutputBufferLimit(PulsarDsSetting):
+    name = "key_value_client_output_buffer_limit"
+    default = [('normal', 0, 0, 0),
+               ('pubsub', 33554432, 8388608, 60),
+               ('monitor', 33554432, 8388608, 60),
+               ('replica', 268435456, 67108864, 60)]
+    validator = validate_output_buffer_limits
+    desc = '''\
+        List of output buffer limits for each class of clients.
+
+        Each element is a client class, ``normal``, ``pubsub``,
+        ``monitor`` or ``replica``, followed by a hard limit, a soft limit
+        and a number of seconds. A client is disconnected as soon as the
+        bytes waiting to be written to it exceed the hard limit, or when
+        they exceed the soft limit for more than the given number of
+        seconds.
+        A limit of 0 disables it.
+    '''
+
+
+class KeyValueSlaveOf(PulsarDsSetting):
+    name = "key_value_slaveof"
+    flags = ["--key-value-slaveof"]
+    default = ''
+    desc = '''\
+        The ``host:port`` address of a master to replicate.
+
+        A replica loads the data of its master and then executes the write
+        commands streamed by it. Write commands from clients are refused.
+    '''
+
+
+class KeyValueReplBacklogSize(PulsarDsSetting):
+    name = "key_value_repl_backlog_size"
+    flags = ["--key-value-repl-backlog-size"]
+    type = int
+    default = 1048576
+    desc = '''\
+        Size in bytes of the backlog of write commands streamed to replicas.
+
+        A replica reconnecting after a disconnection resumes the stream
+        when the commands it missed are in the backlog, otherwise it
+        loads again all the data of its master.
+    '''
+
+
+class KeyValueMaxMemory(PulsarDsSetting):
+    name = "key_value_maxmemory"
+    flags = ["--key-value-maxmemory"]
+    type = int
+    default = 0
+    desc = '''\
+        Approximate memory limit in bytes of the keys and values.
+
+        When the limit is reached keys are evicted, before write commands,
+        according to the ``key_value_maxmemory_policy``. 0 for no limit.
+    '''
+
+
+class KeyValueMaxMemoryPolicy(PulsarDsSetting):
+    name = "key_value_maxmemory_policy"
+    flags = ["--key-value-maxmemory-policy"]
+    choices = MAXMEMORY_POLICIES
+    default = 'noeviction'
+    desc = '''\
+        How keys are evicted when the memory limit is reached.
+
+        ``allkeys-lru`` and ``allkeys-lfu`` evict the least recently or
+        least frequently used keys, ``volatile-lru`` the least recently
+        used keys with an expiry and ``volatile-ttl`` the keys with the
+        nearest expiry. With ``noeviction`` write commands which could use
+        more memory are refused.
+    '''
+
+
+class KeyValueMaxMemorySamples(PulsarDsSetting):
+    name = "key_value_maxmemory_samples"
+    flags = ["--key-value-maxmemory-samples"]
+    type = int
+    default = 5
+    desc = '''\
+        Number of keys of each database sampled to choose the keys to evict.
+
+        Larger samples evict keys closer to the policy at a higher cost.
+    '''
+
+
+class KeyValueListpackMaxEntries(PulsarDsSetting):
+    name = "key_value_listpack_max_entries"
+    flags = ["--key-value-listpack-max-entries"]
+    type = int
+    default = 128
+    desc = '''\
+        Maximum number of elements of hashes, lists, sets and sorted sets
+        stored with the compact ``listpack`` encoding.
+
+        Larger containers are converted into their full encoding.
+    '''
+
+
+class KeyValueListpackMaxValue(PulsarDsSetting):
+    name = "key_value_listpack_max_value"
+    flags = ["--key-value-listpack-max-value"]
+    type = int
+    default = 64
+    desc = '''\
+        Maximum length in bytes of the elements of containers stored with
+        the compact ``listpack`` encoding.
+
+        Containers with a longer element are converted into their full
+        encoding.
+    '''
+
+
+class KeyValueHllSparseMaxBytes(PulsarDsSetting):
+    name = "key_value_hll_sparse_max_bytes"
+    flags = ["--key-value-hll-sparse-max-bytes"]
+    type = int
+    default = 3000
+    desc = '''\
+        Maximum size in bytes of HyperLogLog counters stored with the
+        ``sparse`` encoding.
+
+        Larger counters are converted into the ``dense`` encoding, 16KB.
+    '''
+
+
+class KeyValueNotifyKeyspaceEvents(PulsarDsSetting):
+    name = "key_value_notify_keyspace_events"
+    flags = ["--key-value-notify-keyspace-events"]
+    default = ''
+    desc = '''\
+        Classes of keyspace events published to pub/sub channels.
+
+        A string of the characters ``K`` for ``__keyspace@<db>__:<key>``
+        channels, ``E`` for ``__keyevent@<db>__:<event>`` channels and the
+        event classes ``g`` generic, ``$`` string, ``l`` list, ``s`` set,
+        ``h`` hash, ``z`` sorted set, ``t`` stream, ``x`` expired and ``e``
+        evicted, ``A`` for all of them. Empty disables notifications, it can
+        be changed by ``CONFIG SET notify-keyspace-events``.
+    '''
+
+
+class KeyValueCluster(PulsarDsSetting):
+    name = "key_value_cluster"
+    flags = ["--key-value-cluster"]
+    action = "store_true"
+    default = False
+    validator = pulsar.validate_bool
+    desc = '''\
+        Shard the keys across workers.
+
+        Each worker listens on its own port, consecutive ports when the
+        ``bind`` port is not 0, and owns a range of the 16384 hash slots.
+        Clients find the slots served by each worker with the
+        ``CLUSTER SLOTS`` command.
+    '''
+
+
+class KeyValueSlowlogLogSlowerThan(PulsarDsSetting):
+    name = "key_value_slowlog_log_slower_than"
+    flags = ["--key-value-slowlog-log-slower-than"]
+    type = int
+    default = 10000
+    desc = '''\
+        Commands taking at least this number of microseconds are logged
+        in the slow log.
+
+        0 logs every command and a negative value disables the slow log.
+    '''
+
+
+class KeyValueSlowlogMaxLen(PulsarDsSetting):
+    name = "key_value_slowlog_max_len"
+    flags = ["--key-value-slowlog-max-len"]
+    type = int
+    default = 128
+    desc = '''\
+        Maximum number of commands kept in the slow log.
+
+        When the slow log is full the oldest command is discarded.
+    '''
 
 
 class TcpServer(pulsar.TcpServer):
@@ -159,6 +430,12 @@ class TcpServer(pulsar.TcpServer):
         super().__init__(*args, **kwargs)
         self.cfg = cfg
         self._parser_class = redis_parser(cfg.redis_py_parser)
+        self._cluster = None
+        if cfg.key_value_cluster:
+            # the shard of this server is the one listening on its port
+            port = kwargs['sockets'][0].getsockname()[1]
+            ports = [address[1] for address in cfg.addresses]
+            self._cluster = Cluster(cfg.addresses, ports.index(port))
         self._key_value_store = Storage(self, cfg)
 
     def info(self):
@@ -183,14 +460,51 @@ class PulsarDS(SocketServer):
 
     def monitor_start(self, monitor):
         cfg = self.cfg
+        if cfg.key_value_cluster:
+            return self._start_shards(monitor)
         workers = min(1, cfg.workers)
         cfg.set('workers', workers)
         return super().monitor_start(monitor)
 
+    def actorparams(self, monitor, params):
+        super().actorparams(monitor, params)
+        if self.cfg.key_value_cluster:
+            # a new worker serves the shard of a worker no longer alive
+            owners = monitor.shard_workers
+            alive = monitor.managed_actors
+            shard = next((n for n in range(len(monitor.shard_sockets))
+                          if owners.get(n) not in alive), 0)
+            owners[shard] = aid = create_aid()
+            params.update({'aid': aid,
+                           'sockets': monitor.shard_sockets[shard]})
+
+    def _start_shards(self, monitor):
+        # Listen on one port for each worker
+        cfg = self.cfg
+        loop = monitor._loop
+        yield from super().monitor_start(monitor)
+        shards = [monitor.sockets]
+        host, port = parse_address(cfg.address)
+        for n in range(1, cfg.workers):
+            try:
+                server = yield from loop.create_server(
+                    asyncio.Protocol, host, port + n if port else 0)
+            except OSError as e:
+                raise ImproperlyConfigured(e)
+            for sock in server.sockets:
+                loop.remove_reader(sock.fileno())
+            shards.append(server.sockets)
+        monitor.shard_sockets = shards
+        monitor.shard_workers = {}
+        cfg.addresses = [sockets[0].getsockname() for sockets in shards]
+
 
 # #############################################################################
 # #    DATA STORE
 pubsub_patterns = namedtuple('pubsub_patterns', 're clients')
+# A blocked XREAD, or XREADGROUP when group is not None, and the IDs after
+# which entries are read for each key
+stream_read = namedtuple('stream_read', 'group consumer count noack ids')
 
 
 class Storage(object):
@@ -200,7 +514,23 @@ class Storage(object):
         self.cfg = cfg
         self._password = cfg.key_value_password.encode('utf-8')
         self._filename = cfg.key_value_filename
+        self._aof_filename = cfg.key_value_appendfilename
         self._writer = None
+        self._aof = None
+        # Append only file and replicas receiving write commands
+        self._propagation = []
+        # Writes of a transaction or script are propagated within MULTI
+        # and EXEC: None outside them, True once MULTI is propagated
+        self._propagating_multi = None
+        # Replies are written once the append only file is synced
+        self._hold_replies = False
+        self._replication = None
+        self._master_link = None
+        self._cluster = server._cluster
+        if self._cluster:
+            shard = self._cluster.shard
+            self._filename = shard_filename(self._filename, shard)
+            self._aof_filename = shard_filename(self._aof_filename, shard)
         self._server = server
         self._loop = server._loop
         self._parser = server._parser_class()
@@ -209,13 +539,38 @@ class Storage(object):
         self._expired_keys = 0
         self._dirty = 0
         self._bpop_blocked_clients = 0
+        # Seconds between cron runs and time each run can spend
+        # reclaiming expired keys
+        self._cron_interval = 0.1
+        self._expire_cycle_budget = 0.025
         self._last_save = int(time.time())
         self._channels = {}
         self._patterns = {}
-        # The set of clients which are watching keys
-        self._watching = set()
+        # Patterns indexed by their literal prefix for publish
+        self._pattern_index = PatternIndex()
         # The set of clients which issued the monitor command
         self._monitors = set()
+        # Clients with messages to write at the next loop iteration
+        self._pending_output = set()
+        self._output_limits = dict(((c, (0, 0, 0))
+                                    for c in OUTPUT_BUFFER_CLASSES))
+        for limits in cfg.key_value_client_output_buffer_limit:
+            self._output_limits[limits[0]] = limits[1:]
+        self._output_limited = any((hard or soft for hard, soft, _ in
+                                    self._output_limits.values()))
+        self._output_buffer_disconnections = 0
+        self._dropped_messages = 0
+        self._evictor = None
+        # large values removed by UNLINK and FLUSHDB ASYNC
+        self._lazyfree = LazyFree(self._loop)
+        if cfg.key_value_maxmemory:
+            self._evictor = Evictor(self, cfg.key_value_maxmemory,
+                                    cfg.key_value_maxmemory_policy,
+                                    cfg.key_value_maxmemory_samples)
+        # Calls and latencies by command name and the slow log
+        self._command_stats = {}
+        self._slowlog = SlowLog(cfg.key_value_slowlog_log_slower_than,
+                                cfg.key_value_slowlog_max_len)
         self.logger = server.logger
         #
         self.NOTIFY_KEYSPACE = (1 << 0)
@@ -228,22 +583,43 @@ class Storage(object):
         self.NOTIFY_ZSET = (1 << 7)
         self.NOTIFY_EXPIRED = (1 << 8)
         self.NOTIFY_EVICTED = (1 << 9)
+        self.NOTIFY_STREAM = (1 << 10)
         self.NOTIFY_ALL = (self.NOTIFY_GENERIC | self.NOTIFY_STRING |
                            self.NOTIFY_LIST | self.NOTIFY_SET |
                            self.NOTIFY_HASH | self.NOTIFY_ZSET |
-                           self.NOTIFY_EXPIRED | self.NOTIFY_EVICTED)
+                           self.NOTIFY_EXPIRED | self.NOTIFY_EVICTED |
+                           self.NOTIFY_STREAM)
+        self._notify_classes = (('g', self.NOTIFY_GENERIC),
+                                ('$', self.NOTIFY_STRING),
+                                ('l', self.NOTIFY_LIST),
+                                ('s', self.NOTIFY_SET),
+                                ('h', self.NOTIFY_HASH),
+                                ('z', self.NOTIFY_ZSET),
+                                ('x', self.NOTIFY_EXPIRED),
+                                ('e', self.NOTIFY_EVICTED),
+                                ('t', self.NOTIFY_STREAM),
+                                ('K', self.NOTIFY_KEYSPACE),
+                                ('E', self.NOTIFY_KEYEVENT))
+        # the classes of keyspace events to publish, 0 when they are not
+        # published to keyspace nor keyevent channels
+        self._notify_flags = 0
+        self._notify_events = 0
+        self._set_notify_flags(cfg.key_value_notify_keyspace_events)
 
         self.MONITOR = (1 << 2)
         self.MULTI = (1 << 3)
         self.BLOCKED = (1 << 4)
         self.DIRTY_CAS = (1 << 5)
+        self.REPLICA = (1 << 6)
         #
         self._event_handlers = {self.NOTIFY_GENERIC: self._generic_event,
+                                self.NOTIFY_EVICTED: self._generic_event,
                                 self.NOTIFY_STRING: self._string_event,
                                 self.NOTIFY_SET: self._set_event,
                                 self.NOTIFY_HASH: self._hash_event,
                                 self.NOTIFY_LIST: self._list_event,
-                                self.NOTIFY_ZSET: self._zset_event}
+                                self.NOTIFY_ZSET: self._zset_event,
+                                self.NOTIFY_STREAM: self._stream_event}
         self._set_options = (b'ex', b'px', b'nx', b'xx')
         self.OK = b'+OK\r\n'
         self.QUEUED = b'+QUEUED\r\n'
@@ -255,36 +631,137 @@ class Storage(object):
         self.PUBSUB_ONLY = ('only (P)SUBSCRIBE / (P)UNSUBSCRIBE / QUIT '
                             'allowed in this context')
         self.INVALID_SCORE = 'Invalid score value'
+        self.NOT_INTEGER = 'value is not an integer or out of range'
+        self.OVERFLOW = 'increment or decrement would overflow'
+        self.NOT_FINITE = 'increment would produce NaN or Infinity'
+        self.INVALID_HLL = 'Key is not a valid HyperLogLog string value.'
+        self.INVALID_STREAM_ID = ('Invalid stream ID specified as stream '
+                                  'command argument')
+        self.XGROUP_NO_KEY = ('The XGROUP subcommand requires the key to '
+                              'exist. Note that for CREATE you may want to '
+                              'use the MKSTREAM option to create an empty '
+                              'stream automatically.')
         self.NOT_SUPPORTED = 'Command not yet supported'
         self.OUT_OF_BOUND = 'Out of bound'
         self.SYNTAX_ERROR = 'Syntax error'
+        self.INVALID_CURSOR = 'invalid cursor'
+        self.NOSCRIPT = 'No matching script. Please use EVAL.'
+        self.OOM = OOM
+        # Containers up to this size are scanned in one call
+        self.SCAN_SMALL = 128
         self.SUBSCRIBE_COMMANDS = ('psubscribe', 'punsubscribe', 'subscribe',
                                    'unsubscribe', 'quit')
+        # Commands propagating their effects rather than the request
+        self.EXPLICIT_PROPAGATION = frozenset(('blpop', 'brpop',
+                                               'brpoplpush', 'spop',
+                                               'xadd', 'xreadgroup'))
+        self.EXPIRE_COMMANDS = frozenset(('expire', 'pexpire',
+                                          'expireat', 'pexpireat'))
+        self.VOLATILE_COMMANDS = frozenset(('set', 'setex', 'psetex',
+                                            'restore'))
         self.encoder = pickle
-        self.hash_type = Dict
-        self.list_type = Deque
-        self.zset_type = Zset
-        self.data_types = (bytearray, set, self.hash_type,
-                           self.list_type, self.zset_type)
+        # New containers are listpacks converted into the full types
+        # when they grow over the limits. Hashes, sets and sorted sets of
+        # full type index their elements for the scan commands
+        self.hash_type = ListpackHash
+        self.list_type = ListpackList
+        self.set_type = ListpackSet
+        self.zset_type = ListpackZset
+        self.hash_types = (ListpackHash, Dict)
+        # Deque lists are restored from the dumps of earlier versions
+        self.list_types = (ListpackList, Quicklist, Deque)
+        self.set_types = (ListpackSet, set)
+        self.zset_types = (ListpackZset, Zset)
+        self.listpack_max_entries = cfg.key_value_listpack_max_entries
+        self.listpack_max_value = cfg.key_value_listpack_max_value
+        self.hll_sparse_max_bytes = cfg.key_value_hll_sparse_max_bytes
+        # strings are immutable bytes, or ints for integers, until they
+        # are modified in place as a bytearray. HyperLogLog counters are
+        # strings too, serialized when read as strings
+        self.string_types = (bytes, int, bytearray, HyperLogLog)
+        self.data_types = (self.string_types + self.set_types +
+                           self.hash_types + self.list_types +
+                           self.zset_types + (Stream,))
         self.zset_aggregate = {b'min': min,
                                b'max': max,
                                b'sum': sum}
-        self._type_event_map = {bytearray: self.NOTIFY_STRING,
-                                self.hash_type: self.NOTIFY_HASH,
-                                self.list_type: self.NOTIFY_LIST,
+        self._type_event_map = {bytes: self.NOTIFY_STRING,
+                                int: self.NOTIFY_STRING,
+                                bytearray: self.NOTIFY_STRING,
+                                HyperLogLog: self.NOTIFY_STRING,
+                                ListpackHash: self.NOTIFY_HASH,
+                                Dict: self.NOTIFY_HASH,
+                                IndexedDict: self.NOTIFY_HASH,
+                                ListpackList: self.NOTIFY_LIST,
+                                Quicklist: self.NOTIFY_LIST,
+                                Deque: self.NOTIFY_LIST,
+                                ListpackSet: self.NOTIFY_SET,
                                 set: self.NOTIFY_SET,
-                                self.zset_type: self.NOTIFY_ZSET}
-        self._type_name_map = {bytearray: 'string',
-                               self.hash_type: 'hash',
-                               self.list_type: 'list',
+                                IndexedSet: self.NOTIFY_SET,
+                                ListpackZset: self.NOTIFY_ZSET,
+                                Zset: self.NOTIFY_ZSET,
+                                IndexedZset: self.NOTIFY_ZSET,
+                                Stream: self.NOTIFY_STREAM}
+        self._type_name_map = {bytes: 'string',
+                               int: 'string',
+                               bytearray: 'string',
+                               HyperLogLog: 'string',
+                               ListpackHash: 'hash',
+                               Dict: 'hash',
+                               IndexedDict: 'hash',
+                               ListpackList: 'list',
+                               Quicklist: 'list',
+                               Deque: 'list',
+                               ListpackSet: 'set',
                                set: 'set',
-                               self.zset_type: 'zset'}
+                               IndexedSet: 'set',
+                               ListpackZset: 'zset',
+                               Zset: 'zset',
+                               IndexedZset: 'zset',
+                               Stream: 'stream'}
+        self._listpacks = {Dict: ListpackHash,
+                           IndexedDict: ListpackHash,
+                           Quicklist: ListpackList,
+                           Deque: ListpackList,
+                           set: ListpackSet,
+                           IndexedSet: ListpackSet,
+                           Zset: ListpackZset,
+                           IndexedZset: ListpackZset}
+        self._indexed_types = {Dict: IndexedDict,
+                               set: IndexedSet,
+                               Zset: IndexedZset}
+        self._encoding_map = {bytes: 'embstr',
+                              int: 'int',
+                              bytearray: 'raw',
+                              HyperLogLog: 'raw',
+                              ListpackHash: 'listpack',
+                              Dict: 'hashtable',
+                              IndexedDict: 'hashtable',
+                              ListpackList: 'listpack',
+                              Quicklist: 'quicklist',
+                              Deque: 'linkedlist',
+                              ListpackSet: 'listpack',
+                              set: 'hashtable',
+                              IndexedSet: 'hashtable',
+                              ListpackZset: 'listpack',
+                              Zset: 'skiplist',
+                              IndexedZset: 'skiplist',
+                              Stream: 'stream'}
         self.databases = dict(((num, Db(num, self))
                                for num in range(cfg.key_value_databases)))
         # Initialise lua
-        self.lua = None
+        self.lua = LuaScripting(self) if lupa else None
         self.version = '2.4.10'
         self._loaddb()
+        if cfg.key_value_appendonly:
+            self._aof = AppendOnlyFile(self._aof_filename,
+                                       self._loop, self._parser,
+                                       cfg.key_value_appendfsync,
+                                       self.logger)
+            self._propagation.append(self._aof)
+            self._hold_replies = self._aof.fsync == 'always'
+        if cfg.key_value_slaveof:
+            self._replicate(cfg.key_value_slaveof)
         self._cron()
 
     # #########################################################################
@@ -296,6 +773,13 @@ class Storage(object):
         result = reduce(lambda x, y: x + rem(y), request[1:], 0)
         client.reply_int(result)
 
+    @command('Keys', True)
+    def unlink(self, client, request, N):
+        check_input(request, not N)
+        unlink = client.db.unlink
+        result = reduce(lambda x, y: x + unlink(y), request[1:], 0)
+        client.reply_int(result)
+
     @command('Keys')
     def dump(self, client, request, N):
         check_input(request, N != 1)
@@ -325,6 +809,8 @@ class Storage(object):
                 if timeout < 0:
                     return client.reply_error(self.INVALID_TIMEOUT)
                 if client.db.expire(request[1], m*timeout):
+                    self._signal(self.NOTIFY_GENERIC, client.db, 'expire',
+                                 request[1], 1)
                     return client.reply_one()
             client.reply_zero()
 
@@ -341,6 +827,8 @@ class Storage(object):
                     return client.reply_error(self.INVALID_TIMEOUT)
                 timeout = M*timeout - time.time()
                 if client.db.expire(request[1], timeout):
+                    self._signal(self.NOTIFY_GENERIC, client.db, 'expire',
+                                 request[1], 1)
                     return client.reply_one()
             client.reply_zero()
 
@@ -375,21 +863,33 @@ class Storage(object):
         value = db.get(key)
         if db2.exists(key) or value is None:
             return client.reply_zero()
-        assert value
         db.pop(key)
         self._signal(self.NOTIFY_GENERIC, db, 'del', key, 1)
-        db2._data[key] = value
+        db2.set(key, value)
         self._signal(self._type_event_map[type(value)], db2, 'set', key, 1)
         client.reply_one()
 
-    @command('Keys', supported=False)
+    @command('Keys', subcommands=['encoding'])
     def object(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, not N)
+        subcommand = request[1].decode('utf-8').lower()
+        if subcommand == 'encoding':
+            check_input(request, N != 2)
+            value = client.db.get(request[2])
+            if value is None:
+                client.reply_bulk()
+            else:
+                encoding = self._encoding_map[type(value)]
+                client.reply_bulk(encoding.encode('utf-8'))
+        else:
+            client.reply_error("unknown command 'object %s'" % subcommand)
 
     @command('Keys', True)
     def persist(self, client, request, N):
         check_input(request, N != 1)
         if client.db.persist(request[1]):
+            self._signal(self.NOTIFY_GENERIC, client.db, 'persist',
+                         request[1], 1)
             client.reply_one()
         else:
             client.reply_zero()
@@ -427,7 +927,6 @@ class Storage(object):
         elif key1 == key2:
             client.reply_error('Cannot rename key')
         else:
-            assert value
             if ex:
                 if db.exists(key2):
                     return client.reply_zero()
@@ -439,7 +938,7 @@ class Storage(object):
             db.pop(key1)
             event = self._type_event_map[type(value)]
             dirty = 1 if event == self.NOTIFY_STRING else len(value)
-            db._data[key2] = value
+            db.set(key2, value)
             self._signal(event, db, request[0], key2, dirty)
             client.reply_one() if result else client.reply_ok()
 
@@ -464,27 +963,27 @@ class Storage(object):
             return client.reply_error(self.INVALID_TIMEOUT)
         if db.pop(key) is not None:
             self._signal(self.NOTIFY_GENERIC, db, 'del', key)
-        db._data[key] = value
+        db.set(key, self._compact(value))
         if ttl > 0:
             db.expire(key, ttl)
+        event = self._type_event_map.get(type(value), self.NOTIFY_GENERIC)
+        self._signal(event, db, 'restore', key, 1)
         client.reply_ok()
 
     @command('Keys', True)
     def sort(self, client, request, N):
-        check_input(request, not N)
-        value = client.db.get(request[1])
-        if value is None:
-            value = self.list_type()
-        elif not isinstance(value, (set, self.list_type, self.zset_type)):
-            return client.reply_wrongtype()
-        sort_command(self, client, request, value)
+        self._sort(client, request, N)
 
-    @command('Keys', True)
+    @command('Keys')
+    def sort_ro(self, client, request, N):
+        self._sort(client, request, N, True)
+
+    @command('Keys')
     def ttl(self, client, request, N):
         check_input(request, N != 1)
         client.reply_int(client.db.ttl(request[1]))
 
-    @command('Keys', True)
+    @command('Keys')
     def type(self, client, request, N):
         check_input(request, N != 1)
         value = client.db.get(request[1])
@@ -494,9 +993,20 @@ class Storage(object):
             result = self._type_name_map[type(value)]
         client.reply_status(result)
 
-    @command('Keys', supported=False)
+    @command('Keys')
     def scan(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, not N)
+        cursor, count, match, type_name = self._scan_options(request, 2, True)
+        db = client.db
+        cursor, keys = db._index.scan(cursor, count)
+        keys = [key for key in keys if db.exists(key)]
+        if type_name:
+            type_map = self._type_name_map
+            keys = [key for key in keys
+                    if type_map[type(db._data[key])] == type_name]
+        if match:
+            keys = self._scan_match(match, keys)
+        client.reply_multi_bulk((str(cursor).encode('utf-8'), keys))
 
     # #########################################################################
     # #    STRING COMMANDS
@@ -507,15 +1017,17 @@ class Storage(object):
         db = client.db
         value = db.get(key)
         if value is None:
-            value = bytearray(request[2])
-            db._data[key] = value
-        elif not isinstance(value, bytearray):
+            value = encode_string(request[2])
+            db.set(key, value)
+            length = len(request[2])
+        elif not isinstance(value, self.string_types):
             return client.reply_wrongtype()
         else:
-            assert value
+            value = self._mutable_string(db, key, value)
             value.extend(request[2])
+            length = len(value)
         self._signal(self.NOTIFY_STRING, db, request[0], key, 1)
-        client.reply_int(len(value))
+        client.reply_int(length)
 
     @command('Strings')
     def bitcount(self, client, request, N):
@@ -525,10 +1037,10 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_int(0)
-        elif not isinstance(value, bytearray):
+        elif not isinstance(value, self.string_types):
             return client.reply_wrongtype()
         else:
-            assert value
+            value = string_bytes(value)
             if N > 1:
                 start = request[2]
                 end = request[3] if N == 3 else -1
@@ -541,49 +1053,157 @@ class Storage(object):
         check_input(request, N < 3)
         db = client.db
         op = request[1].lower()
-        if op == b'and':
-            reduce_op = and_op
-        elif op == b'or':
-            reduce_op = or_op
-        elif op == b'xor':
-            reduce_op = xor_op
-        elif op == b'not':
-            reduce_op = None
+        if op == b'not':
             check_input(request, N != 3)
-        else:
+        elif op not in BITOPS:
             return client.reply_error('bad command')
-        empty = bytearray()
-        keys = []
+        strings = []
         for key in request[3:]:
             value = db.get(key)
             if value is None:
-                keys.append(empty)
-            elif isinstance(value, bytearray):
-                keys.append(value)
+                strings.append(b'')
+            elif isinstance(value, self.string_types):
+                strings.append(string_bytes(value))
             else:
                 return client.reply_wrongtype()
-        result = bytearray()
-        if reduce_op is None:
-            for value in keys[0]:
-                result.append(~value & 255)
-        else:
-            for values in zip_longest(*keys, **{'fillvalue': 0}):
-                result.append(reduce(reduce_op, values))
+        result = bit_operation(op, strings)
         if result:
             dest = request[2]
-            if db.pop(dest):
+            if db.pop(dest) is not None:
                 self._signal(self.NOTIFY_GENERIC, db, 'del', dest)
-            db._data[dest] = result
+            db.set(dest, result)
             self._signal(self.NOTIFY_STRING, db, 'set', dest, 1)
             client.reply_int(len(result))
         else:
             client.reply_zero()
 
+    @command('Strings', True)
+    def bitfield(self, client, request, N):
+        check_input(request, not N)
+        key = request[1]
+        overflow = b'wrap'
+        operations = []
+        write = False
+        it = 2
+        try:
+            while it <= N:
+                name = request[it].lower()
+                if name == b'overflow':
+                    overflow = request[it + 1].lower()
+                    if overflow not in BITFIELD_OVERFLOWS:
+                        return client.reply_error(
+                            'Invalid OVERFLOW type specified')
+                    it += 2
+                    continue
+                elif name not in (b'get', b'set', b'incrby'):
+                    return client.reply_error(self.SYNTAX_ERROR)
+                try:
+                    signed, bits = bitfield_type(request[it + 1])
+                except ValueError:
+                    return client.reply_error(
+                        'Invalid bitfield type. Use something like i16 u8. '
+                        'Note that u64 is not supported but i64 is.')
+                try:
+                    offset = request[it + 2]
+                    if offset[:1] == b'#':
+                        offset = bits*int(offset[1:])
+                    else:
+                        offset = int(offset)
+                    if offset < 0 or offset + bits > STRING_LIMIT:
+                        raise ValueError
+                except ValueError:
+                    return client.reply_error(
+                        'bit offset is not an integer or out of range')
+                if name == b'get':
+                    operations.append((name, signed, bits, offset, 0,
+                                       overflow))
+                    it += 3
+                else:
+                    try:
+                        value = int(request[it + 3])
+                    except ValueError:
+                        return client.reply_error(self.NOT_INTEGER)
+                    operations.append((name, signed, bits, offset, value,
+                                       overflow))
+                    write = True
+                    it += 4
+        except IndexError:
+            return client.reply_error(self.SYNTAX_ERROR)
+        db = client.db
+        string = db.get(key)
+        if string is not None and not isinstance(string, self.string_types):
+            return client.reply_wrongtype()
+        if write:
+            if string is None:
+                string = bytearray()
+                db.set(key, string)
+            else:
+                string = self._mutable_string(db, key, string)
+        elif string is None:
+            string = b''
+        else:
+            string = string_bytes(string)
+        results = []
+        for name, signed, bits, offset, value, overflow in operations:
+            current = get_bits(string, offset, signed, bits)
+            if name == b'get':
+                results.append(current)
+                continue
+            elif name == b'incrby':
+                value += current
+            result = bitfield_overflow(value, signed, bits, overflow)
+            if result is None:
+                results.append(None)
+            else:
+                set_bits(string, offset, bits, result)
+                results.append(current if name == b'set' else result)
+        if write:
+            self._signal(self.NOTIFY_STRING, db, 'setbit', key, 1)
+        client.reply_multi_bulk_len(len(results))
+        for result in results:
+            if result is None:
+                client.reply_bulk()
+            else:
+                client.reply_int(result)
+
+    @command('Strings')
+    def bitpos(self, client, request, N):
+        check_input(request, N < 2 or N > 4)
+        try:
+            bit = int(request[2])
+            if bit not in (0, 1):
+                raise ValueError
+        except ValueError:
+            return client.reply_error('The bit argument must be 1 or 0.')
+        try:
+            start = int(request[3]) if N > 2 else 0
+            end = int(request[4]) if N > 3 else -1
+        except ValueError:
+            return client.reply_error(self.NOT_INTEGER)
+        value = client.db.get(request[1])
+        if value is None:
+            return client.reply_int(-1 if bit else 0)
+        elif not isinstance(value, self.string_types):
+            return client.reply_wrongtype()
+        string = string_bytes(value)
+        size = len(string)
+        if start < 0:
+            start = max(size + start, 0)
+        if end < 0:
+            end = max(size + end, 0)
+        end = min(end, size - 1)
+        if start > end:
+            client.reply_int(-1)
+        else:
+            client.reply_int(bit_position(string, bit, start,
+                                          end + 1 if N > 3 else None))
+
     @command('Strings', True)
     def decr(self, client, request, N):
         check_input(request, N != 1)
         r = self._incrby(client, request[0], request[1], b'-1', int)
-        client.reply_int(r)
+        if r is not None:
+            client.reply_int(r)
 
     @command('Strings', True)
     def decrby(self, client, request, N):
@@ -593,7 +1213,8 @@ class Storage(object):
         except Exception:
             val = request[2]
         r = self._incrby(client, request[0], request[1], val, int)
-        client.reply_int(r)
+        if r is not None:
+            client.reply_int(r)
 
     @command('Strings')
     def get(self, client, request, N):
@@ -601,9 +1222,8 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_bulk()
-        elif isinstance(value, bytearray):
-            assert value
-            client.reply_bulk(bytes(value))
+        elif isinstance(value, self.string_types):
+            client.reply_bulk(string_bytes(value))
         else:
             client.reply_wrongtype()
 
@@ -620,10 +1240,10 @@ class Storage(object):
         string = client.db.get(request[1])
         if string is None:
             client.reply_zero()
-        elif not isinstance(string, bytearray):
+        elif not isinstance(string, self.string_types):
             client.reply_wrongtype()
         else:
-            assert string
+            string = string_bytes(string)
             byte = bitoffset >> 3
             if len(string) > byte:
                 bit = 7 - (bitoffset & 7)
@@ -644,9 +1264,10 @@ class Storage(object):
         string = client.db.get(request[1])
         if string is None:
             client.reply_bulk(b'')
-        elif not isinstance(string, bytearray):
+        elif not isinstance(string, self.string_types):
             client.reply_wrongtype()
         else:
+            string = string_bytes(string)
             if start < 0:
                 start = len(string) + start
             if end < 0:
@@ -662,14 +1283,14 @@ class Storage(object):
         db = client.db
         value = db.get(key)
         if value is None:
-            db._data[key] = bytearray(request[2])
+            db.set(key, encode_string(request[2]))
             self._signal(self.NOTIFY_STRING, db, 'set', key, 1)
             client.reply_bulk()
-        elif isinstance(value, bytearray):
+        elif isinstance(value, self.string_types):
             db.pop(key)
-            db._data[key] = bytearray(request[2])
+            db.set(key, encode_string(request[2]))
             self._signal(self.NOTIFY_STRING, db, 'set', key, 1)
-            client.reply_bulk(bytes(value))
+            client.reply_bulk(string_bytes(value))
         else:
             client.reply_wrongtype()
 
@@ -677,19 +1298,22 @@ class Storage(object):
     def incr(self, client, request, N):
         check_input(request, N != 1)
         r = self._incrby(client, request[0], request[1], b'1', int)
-        client.reply_int(r)
+        if r is not None:
+            client.reply_int(r)
 
     @command('Strings', True)
     def incrby(self, client, request, N):
         check_input(request, N != 2)
         r = self._incrby(client, request[0], request[1], request[2], int)
-        client.reply_int(r)
+        if r is not None:
+            client.reply_int(r)
 
     @command('Strings', True)
     def incrbyfloat(self, client, request, N):
         check_input(request, N != 2)
         r = self._incrby(client, request[0], request[1], request[2], float)
-        client.reply_bulk(str(r).encode('utf-8'))
+        if r is not None:
+            client.reply_bulk(r)
 
     @command('Strings')
     def mget(self, client, request, N):
@@ -700,8 +1324,8 @@ class Storage(object):
             value = get(key)
             if value is None:
                 values.append(value)
-            elif isinstance(value, bytearray):
-                values.append(bytes(value))
+            elif isinstance(value, self.string_types):
+                values.append(string_bytes(value))
             else:
                 return client.reply_wrongtype()
         client.reply_multi_bulk(values)
@@ -713,7 +1337,7 @@ class Storage(object):
         db = client.db
         for key, value in zip(request[1::2], request[2::2]):
             db.pop(key)
-            db._data[key] = bytearray(value)
+            db.set(key, encode_string(value))
             self._signal(self.NOTIFY_STRING, db, 'set', key, 1)
         client.reply_ok()
 
@@ -732,7 +1356,7 @@ class Storage(object):
             client.reply_zero()
         else:
             for key, value in zip(keys, request[2::2]):
-                db._data[key] = bytearray(value)
+                db.set(key, encode_string(value))
                 self._signal(self.NOTIFY_STRING, db, 'set', key, 1)
             client.reply_one()
 
@@ -793,11 +1417,11 @@ class Storage(object):
         string = db.get(key)
         if string is None:
             string = bytearray()
-            db._data[key] = string
-        elif not isinstance(string, bytearray):
+            db.set(key, string)
+        elif not isinstance(string, self.string_types):
             return client.reply_wrongtype()
         else:
-            assert string
+            string = self._mutable_string(db, key, string)
 
         # grow value to the right if necessary
         byte = bitoffset >> 3
@@ -849,9 +1473,11 @@ class Storage(object):
         string = db.get(key)
         if string is None:
             string = bytearray(b'')
-            db._data[key] = string
-        elif not isinstance(string, bytearray):
+            db.set(key, string)
+        elif not isinstance(string, self.string_types):
             return client.reply_wrongtype()
+        else:
+            string = self._mutable_string(db, key, string)
         N = len(string)
         if N < T:
             string.extend((T - N)*b'\x00')
@@ -865,8 +1491,8 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif isinstance(value, bytearray):
-            client.reply_int(len(value))
+        elif isinstance(value, self.string_types):
+            client.reply_int(len(string_bytes(value)))
         else:
             return client.reply_wrongtype()
 
@@ -880,7 +1506,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             rem = 0
             for field in request[2:]:
                 rem += 0 if value.pop(field, None) is None else 1
@@ -897,7 +1523,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             client.reply_int(int(request[2] in value))
         else:
             client.reply_wrongtype()
@@ -908,7 +1534,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_bulk()
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             client.reply_bulk(value.get(request[2]))
         else:
             client.reply_wrongtype()
@@ -919,7 +1545,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_multi_bulk(())
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             client.reply_multi_bulk(value.flat())
         else:
             client.reply_wrongtype()
@@ -934,7 +1560,7 @@ class Storage(object):
     def hincrbyfloat(self, client, request, N):
         result = self._hincrby(client, request, N, float)
         if result is not None:
-            client.reply_bulk(str(result).encode('utf-8'))
+            client.reply_bulk(result)
 
     @command('Hashes')
     def hkeys(self, client, request, N):
@@ -942,7 +1568,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_multi_bulk(())
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             client.reply_multi_bulk(value)
         else:
             client.reply_wrongtype()
@@ -953,7 +1579,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             client.reply_int(len(value))
         else:
             client.reply_wrongtype()
@@ -964,7 +1590,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_multi_bulk(())
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             result = value.mget(request[2:])
             client.reply_multi_bulk(result)
         else:
@@ -979,9 +1605,10 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             value = self.hash_type()
-            db._data[key] = value
-        elif not isinstance(value, self.hash_type):
+            db.set(key, value)
+        elif not isinstance(value, self.hash_types):
             return client.reply_wrongtype()
+        value = self._grow(db, key, value, D)
         it = iter(request[2:])
         value.update(zip(it, it))
         self._signal(self.NOTIFY_HASH, db, request[0], key, D)
@@ -995,8 +1622,8 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             value = self.hash_type()
-            db._data[key] = value
-        elif not isinstance(value, self.hash_type):
+            db.set(key, value)
+        elif not isinstance(value, self.hash_types):
             return client.reply_wrongtype()
         avail = (field in value)
         value[field] = request[3]
@@ -1011,8 +1638,8 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             value = self.hash_type()
-            db._data[key] = value
-        elif not isinstance(value, self.hash_type):
+            db.set(key, value)
+        elif not isinstance(value, self.hash_types):
             return client.reply_wrongtype()
         if field in value:
             client.reply_zero()
@@ -1027,14 +1654,25 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_multi_bulk(())
-        elif isinstance(value, self.hash_type):
+        elif isinstance(value, self.hash_types):
             client.reply_multi_bulk(tuple(value.values()))
         else:
             client.reply_wrongtype()
 
-    @command('Hashes', supported=False)
+    @command('Hashes')
     def hscan(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N < 2)
+        key = request[1]
+        db = client.db
+        value = db.get(key)
+        if value is not None and not isinstance(value, self.hash_types):
+            return client.reply_wrongtype()
+        cursor, fields = self._scan_container(value, request)
+        result = []
+        for field in fields:
+            if field in value:
+                result.extend((field, value[field]))
+        client.reply_multi_bulk((cursor, result))
 
     # #########################################################################
     # #    LIST COMMANDS
@@ -1071,7 +1709,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_bulk()
-        elif isinstance(value, self.list_type):
+        elif isinstance(value, self.list_types):
             assert value
             index = int(request[2])
             if index >= 0 and index < len(value):
@@ -1091,7 +1729,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.list_type):
+        elif not isinstance(value, self.list_types):
             client.reply_wrongtype()
         else:
             assert value
@@ -1116,7 +1754,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif isinstance(value, self.list_type):
+        elif isinstance(value, self.list_types):
             assert value
             client.reply_int(len(value))
         else:
@@ -1130,7 +1768,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_bulk()
-        elif not isinstance(value, self.list_type):
+        elif not isinstance(value, self.list_types):
             client.reply_wrongtype()
         else:
             assert value
@@ -1155,11 +1793,12 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             value = self.list_type()
-            db._data[key] = value
-        elif not isinstance(value, self.list_type):
+            db.set(key, value)
+        elif not isinstance(value, self.list_types):
             return client.reply_wrongtype()
         else:
             assert value
+        value = self._grow(db, key, value, N - 1)
         if request[0] == 'lpush':
             value.extendleft(request[2:])
         else:
@@ -1179,7 +1818,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.list_type):
+        elif not isinstance(value, self.list_types):
             client.reply_wrongtype()
         else:
             assert value
@@ -1194,7 +1833,7 @@ class Storage(object):
     def rpushx(self, client, request, N):
         return self.lpushx(client, request, N)
 
-    @command('Lists', True)
+    @command('Lists')
     def lrange(self, client, request, N):
         check_input(request, N != 3)
         db = client.db
@@ -1206,11 +1845,11 @@ class Storage(object):
             return client.reply_error('invalid range')
         if value is None:
             client.reply_multi_bulk(())
-        elif not isinstance(value, self.list_type):
+        elif not isinstance(value, self.list_types):
             client.reply_wrongtype()
         else:
             assert value
-            client.reply_multi_bulk(tuple(islice(value, start, end)))
+            client.reply_multi_bulk(value.range(max(start, 0), end))
 
     @command('Lists', True)
     def lrem(self, client, request, N):
@@ -1222,7 +1861,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.list_type):
+        elif not isinstance(value, self.list_types):
             client.reply_wrongtype()
         else:
             assert value
@@ -1245,7 +1884,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_error(self.OUT_OF_BOUND)
-        elif not isinstance(value, self.list_type):
+        elif not isinstance(value, self.list_types):
             client.reply_wrongtype()
         else:
             assert value
@@ -1272,13 +1911,14 @@ class Storage(object):
             return client.reply_error('invalid range')
         if value is None:
             client.reply_ok()
-        elif not isinstance(value, self.list_type):
+        elif not isinstance(value, self.list_types):
             client.reply_wrongtype()
         else:
             assert value
+            size = len(value)
             value.trim(start, end)
             self._signal(self.NOTIFY_LIST, db, request[0], key,
-                         start-len(value))
+                         size - len(value))
             client.reply_ok()
             if db.pop(key, value) is not None:
                 self._signal(self.NOTIFY_GENERIC, db, 'del', key)
@@ -1292,14 +1932,14 @@ class Storage(object):
         dest = db.get(key2)
         if orig is None:
             client.reply_bulk()
-        elif not isinstance(orig, self.list_type):
+        elif not isinstance(orig, self.list_types):
             client.reply_wrongtype()
         else:
             assert orig
             if dest is None:
                 dest = self.list_type()
-                db._data[key2] = dest
-            elif not isinstance(dest, self.list_type):
+                db.set(key2, dest)
+            elif not isinstance(dest, self.list_types):
                 return client.reply_wrongtype()
             else:
                 assert dest
@@ -1320,10 +1960,11 @@ class Storage(object):
         db = client.db
         value = db.get(key)
         if value is None:
-            value = set()
-            db._data[key] = value
-        elif not isinstance(value, set):
+            value = self.set_type()
+            db.set(key, value)
+        elif not isinstance(value, self.set_types):
             return client.reply_wrongtype()
+        value = self._grow(db, key, value, N - 1)
         n = len(value)
         value.update(request[2:])
         n = len(value) - n
@@ -1336,7 +1977,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, set):
+        elif not isinstance(value, self.set_types):
             client.reply_wrongtype()
         else:
             client.reply_int(len(value))
@@ -1349,17 +1990,46 @@ class Storage(object):
     @command('Sets', True)
     def sdiffstore(self, client, request, N):
         check_input(request, N < 2)
-        self._setoper(client, 'difference', request[2:], request[1])
+        self._setoper(client, 'difference', request[2:], request[1],
+                      request[0])
 
     @command('Sets')
     def sinter(self, client, request, N):
         check_input(request, N < 1)
         self._setoper(client, 'intersection', request[1:])
 
+    @command('Sets')
+    def sintercard(self, client, request, N):
+        check_input(request, N < 2)
+        try:
+            numkeys = int(request[1])
+            if numkeys <= 0:
+                raise ValueError
+        except ValueError:
+            return client.reply_error('numkeys should be greater than 0')
+        keys = request[2:2+numkeys]
+        options = request[2+numkeys:]
+        limit = 0
+        if len(keys) != numkeys or options and (
+                len(options) != 2 or options[0].lower() != b'limit'):
+            return client.reply_error(self.SYNTAX_ERROR)
+        if options:
+            try:
+                limit = int(options[1])
+                if limit < 0:
+                    raise ValueError
+            except ValueError:
+                return client.reply_error("LIMIT can't be negative")
+        sets = self._sets(client.db, keys)
+        if sets is None:
+            return client.reply_wrongtype()
+        client.reply_int(intersection_count(sets, limit))
+
     @command('Sets', True)
     def sinterstore(self, client, request, N):
         check_input(request, N < 2)
-        self._setoper(client, 'intersection', request[2:], request[1])
+        self._setoper(client, 'intersection', request[2:], request[1],
+                      request[0])
 
     @command('Sets')
     def sismember(self, client, request, N):
@@ -1367,18 +2037,30 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, set):
+        elif not isinstance(value, self.set_types):
             client.reply_wrongtype()
         else:
             client.reply_int(int(request[2] in value))
 
+    @command('Sets')
+    def smismember(self, client, request, N):
+        check_input(request, N < 2)
+        value = client.db.get(request[1])
+        if value is None:
+            value = ()
+        elif not isinstance(value, self.set_types):
+            return client.reply_wrongtype()
+        client.reply_multi_bulk_len(N - 1)
+        for member in request[2:]:
+            client.reply_int(int(member in value))
+
     @command('Sets')
     def smembers(self, client, request, N):
         check_input(request, N != 1)
         value = client.db.get(request[1])
         if value is None:
             client.reply_multi_bulk(())
-        elif not isinstance(value, set):
+        elif not isinstance(value, self.set_types):
             client.reply_wrongtype()
         else:
             client.reply_multi_bulk(value)
@@ -1393,16 +2075,16 @@ class Storage(object):
         dest = db.get(key2)
         if orig is None:
             client.reply_zero()
-        elif not isinstance(orig, set):
+        elif not isinstance(orig, self.set_types):
             client.reply_wrongtype()
         else:
             member = request[3]
             if member in orig:
                 # we my be able to move
                 if dest is None:
-                    dest = set()
-                    db._data[request[2]] = dest
-                elif not isinstance(dest, set):
+                    dest = self.set_type()
+                    db.set(request[2], dest)
+                elif not isinstance(dest, self.set_types):
                     return client.reply_wrongtype()
                 orig.remove(member)
                 dest.add(member)
@@ -1422,20 +2104,22 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_bulk()
-        elif not isinstance(value, set):
+        elif not isinstance(value, self.set_types):
             client.reply_wrongtype()
         else:
             result = value.pop()
             self._signal(self.NOTIFY_SET, db, request[0], key, 1)
             if db.pop(key, value) is not None:
                 self._signal(self.NOTIFY_GENERIC, db, 'del', key)
+            if self._propagation:
+                self._feed(db._num, ('srem', key, result))
             client.reply_bulk(result)
 
     @command('Sets')
     def srandmember(self, client, request, N):
         check_input(request, N < 1 or N > 2)
         value = client.db.get(request[1])
-        if value is not None and not isinstance(value, set):
+        if value is not None and not isinstance(value, self.set_types):
             return client.reply_wrongtype()
         if N == 2:
             try:
@@ -1483,7 +2167,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, set):
+        elif not isinstance(value, self.set_types):
             client.reply_wrongtype()
         else:
             start = len(value)
@@ -1502,11 +2186,20 @@ class Storage(object):
     @command('Sets', True)
     def sunionstore(self, client, request, N):
         check_input(request, N < 2)
-        self._setoper(client, 'union', request[2:], request[1])
+        self._setoper(client, 'union', request[2:], request[1],
+                      request[0])
 
-    @command('Sets', supported=False)
+    @command('Sets')
     def sscan(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N < 2)
+        key = request[1]
+        db = client.db
+        value = db.get(key)
+        if value is not None and not isinstance(value, self.set_types):
+            return client.reply_wrongtype()
+        cursor, members = self._scan_container(value, request)
+        members = [member for member in members if member in value]
+        client.reply_multi_bulk((cursor, members))
 
     # #########################################################################
     # #    SORTED SETS COMMANDS
@@ -1519,13 +2212,15 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             value = self.zset_type()
-            db._data[key] = value
-        elif not isinstance(value, self.zset_type):
+            db.set(key, value)
+        elif not isinstance(value, self.zset_types):
             return client.reply_wrongtype()
+        value = self._grow(db, key, value, D)
         start = len(value)
         value.update(zip(map(float, request[2::2]), request[3::2]))
         result = len(value) - start
-        self._signal(self.NOTIFY_ZSET, db, request[0], key, result)
+        # members added or updated
+        self._signal(self.NOTIFY_ZSET, db, request[0], key, D)
         client.reply_int(result)
 
     @command('Sorted Sets')
@@ -1534,7 +2229,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             client.reply_int(len(value))
@@ -1545,7 +2240,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             min_value, max_value = request[2], request[3]
@@ -1565,6 +2260,15 @@ class Storage(object):
                 client.reply_int(value.count(mmin, mmax,
                                              include_min, include_max))
 
+    @command('Sorted Sets')
+    def zdiff(self, client, request, N):
+        self._zdiff(client, request, N)
+
+    @command('Sorted Sets', True)
+    def zdiffstore(self, client, request, N):
+        check_input(request, N < 3)
+        self._zdiff(client, request, N, request[1])
+
     @command('Sorted Sets', True)
     def zincrby(self, client, request, N):
         check_input(request, N != 3)
@@ -1572,8 +2276,9 @@ class Storage(object):
         db = client.db
         value = db.get(key)
         if value is None:
-            db._data[key] = value = self.zset_type()
-        elif not isinstance(value, self.zset_type):
+            value = self.zset_type()
+            db.set(key, value)
+        elif not isinstance(value, self.zset_types):
             return client.reply_wrongtype()
         try:
             increment = float(request[2])
@@ -1596,7 +2301,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_multi_bulk(())
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             try:
@@ -1621,7 +2326,7 @@ class Storage(object):
         value = client.db.get(request[1])
         if value is None:
             client.reply_multi_bulk(())
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             try:
@@ -1660,13 +2365,29 @@ class Storage(object):
                                                    include_max=include_max))
             client.reply_multi_bulk(result)
 
+    @command('Sorted Sets', True)
+    def zrangestore(self, client, request, N):
+        check_input(request, N < 4)
+        db = client.db
+        dest = request[1]
+        value = db.get(request[2])
+        if value is not None and not isinstance(value, self.zset_types):
+            return client.reply_wrongtype()
+        try:
+            pairs = self._zrange_pairs(value, request[3:])
+        except Exception:
+            return client.reply_error(self.SYNTAX_ERROR)
+        result = Zset(pairs)
+        self._zstore(db, request[0], dest, result)
+        client.reply_int(len(result))
+
     @command('Sorted Sets')
     def zrank(self, client, request, N):
         check_input(request, N != 2)
         value = client.db.get(request[1])
         if value is None:
             client.reply_bulk()
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             rank = value.rank(request[2])
@@ -1683,7 +2404,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             removed = value.remove_items(request[2:])
@@ -1701,7 +2422,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             try:
@@ -1723,7 +2444,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_zero()
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             try:
@@ -1755,7 +2476,7 @@ class Storage(object):
         value = db.get(key)
         if value is None:
             client.reply_bulk(None)
-        elif not isinstance(value, self.zset_type):
+        elif not isinstance(value, self.zset_types):
             client.reply_wrongtype()
         else:
             score = value.score(request[2], None)
@@ -1767,34 +2488,388 @@ class Storage(object):
     def zunionstore(self, client, request, N):
         self._zsetoper(client, request, N)
 
-    @command('Sorted Sets', supported=False)
+    @command('Sorted Sets')
     def zscan(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N < 2)
+        key = request[1]
+        db = client.db
+        value = db.get(key)
+        if value is not None and not isinstance(value, self.zset_types):
+            return client.reply_wrongtype()
+        cursor, members = self._scan_container(value, request)
+        result = []
+        for member in members:
+            score = value.score(member)
+            if score is not None:
+                result.extend((member, score))
+        client.reply_multi_bulk((cursor, result))
 
     # #########################################################################
-    # #    PUBSUB COMMANDS
-    @command('Pub/Sub', script=0)
-    def psubscribe(self, client, request, N):
+    # #    HYPERLOGLOG COMMANDS
+    @command('HyperLogLog', True)
+    def pfadd(self, client, request, N):
         check_input(request, not N)
-        for pattern in request[1:]:
-            p = self._patterns.get(pattern)
-            if not p:
-                pre = redis_to_py_pattern(pattern.decode('utf-8'))
-                p = pubsub_patterns(re.compile(pre), set())
-                self._patterns[pattern] = p
-            p.clients.add(client)
-            client.patterns.add(pattern)
-            count = reduce(lambda x, y: x + int(client in y.clients),
-                           self._patterns.values())
-            client.reply_multi_bulk((b'psubscribe', pattern, count))
+        key = request[1]
+        counters = self._hyperloglogs(client, (key,))
+        if counters is None:
+            return
+        db = client.db
+        hll = counters[0]
+        changed = hll is None
+        if changed:
+            hll = HyperLogLog()
+            db.set(key, hll)
+        if hll.update(request[2:]) or changed:
+            self._signal(self.NOTIFY_STRING, db, 'pfadd', key, 1)
+            client.reply_one()
+        else:
+            client.reply_zero()
 
-    @command('Pub/Sub')
-    def pubsub(self, client, request, N):
+    @command('HyperLogLog')
+    def pfcount(self, client, request, N):
         check_input(request, not N)
-        subcommand = request[1].decode('utf-8').lower()
-        if subcommand == 'channels':
-            check_input(request, N > 2)
-            if N == 2:
+        counters = self._hyperloglogs(client, request[1:])
+        if counters is None:
+            return
+        counters = [hll for hll in counters if hll is not None]
+        if not counters:
+            client.reply_zero()
+        elif len(counters) == 1:
+            client.reply_int(counters[0].count())
+        else:
+            merged = HyperLogLog()
+            merged.merge(*counters)
+            client.reply_int(merged.count())
+
+    @command('HyperLogLog', True)
+    def pfmerge(self, client, request, N):
+        check_input(request, not N)
+        key = request[1]
+        counters = self._hyperloglogs(client, request[1:])
+        if counters is None:
+            return
+        db = client.db
+        hll = counters[0]
+        if hll is None:
+            hll = HyperLogLog()
+            db.set(key, hll)
+        hll.merge(*[other for other in counters[1:] if other is not None])
+        self._signal(self.NOTIFY_STRING, db, 'pfmerge', key, 1)
+        client.reply_ok()
+
+    # #########################################################################
+    # #    STREAM COMMANDS
+    @command('Streams', True)
+    def xack(self, client, request, N):
+        check_input(request, N < 3)
+        key = request[1]
+        db = client.db
+        value = db.get(key)
+        if value is not None and not isinstance(value, Stream):
+            return client.reply_wrongtype()
+        ids = [self._stream_id(id) for id in request[3:]]
+        group = value.groups.get(request[2]) if value is not None else None
+        acked = 0
+        if group is not None:
+            for id in ids:
+                acked += group.ack(id)
+        if acked:
+            self._signal(self.NOTIFY_STREAM, db, 'xack', key, acked)
+        client.reply_int(acked)
+
+    @command('Streams', True)
+    def xadd(self, client, request, N):
+        check_input(request, N < 4)
+        key = request[1]
+        db = client.db
+        value = db.get(key)
+        if value is not None and not isinstance(value, Stream):
+            return client.reply_wrongtype()
+        nomkstream = False
+        maxlen = None
+        approximate = False
+        n = 2
+        while n < N:
+            option = request[n].lower()
+            if option == b'nomkstream':
+                nomkstream = True
+                n += 1
+            elif option == b'maxlen' and n + 2 < N:
+                n += 1
+                if request[n] in (b'=', b'~'):
+                    approximate = request[n] == b'~'
+                    n += 1
+                maxlen = self._int(request[n])
+                if maxlen < 0:
+                    return client.reply_error(
+                        'The MAXLEN argument must be >= 0.')
+                n += 1
+            else:
+                break
+        fields = tuple(request[n + 1:])
+        check_input(request, not fields or len(fields) % 2)
+        if value is None and nomkstream:
+            return client.reply_bulk()
+        stream = Stream() if value is None else value
+        id = request[n]
+        if id == b'*':
+            now = int(1000*time.time())
+            id = stream.next_id(max(now, stream.last_id >> SEQ_BITS))
+        elif id[-2:] == b'-*':
+            id = stream.next_id(self._stream_id(id[:-2]) >> SEQ_BITS)
+        else:
+            id = self._stream_id(id)
+            if not id:
+                return client.reply_error('The ID specified in XADD must be '
+                                          'greater than 0-0')
+            id = stream.next_id(id >> SEQ_BITS, id & SEQ_MASK)
+        if id is None:
+            return client.reply_error('The ID specified in XADD is equal or '
+                                      'smaller than the target stream top '
+                                      'item')
+        if value is None:
+            db.set(key, stream)
+        stream.add(id, fields)
+        trimmed = stream.trim(maxlen, approximate) if maxlen is not None else 0
+        self._signal(self.NOTIFY_STREAM, db, 'xadd', key, 1)
+        id = format_id(id)
+        if self._propagation:
+            # replicas add the same ID and keep the same entries
+            if trimmed:
+                self._feed(db._num, ('xadd', key, 'maxlen', '=',
+                                     len(stream), id) + fields)
+            else:
+                self._feed(db._num, ('xadd', key, id) + fields)
+        client.reply_bulk(id)
+
+    @command('Streams', True, subcommands=['create', 'createconsumer',
+                                           'delconsumer', 'destroy', 'setid'])
+    def xgroup(self, client, request, N):
+        check_input(request, N < 3)
+        subcommand = request[1].decode('utf-8').lower()
+        key = request[2]
+        db = client.db
+        value = db.get(key)
+        if value is not None and not isinstance(value, Stream):
+            return client.reply_wrongtype()
+        elif subcommand == 'create':
+            check_input(request, N != 4 and N != 5)
+            if N == 5 and request[5].lower() != b'mkstream':
+                return client.reply_error(self.SYNTAX_ERROR)
+            if value is None:
+                if N == 4:
+                    return client.reply_error(self.XGROUP_NO_KEY)
+                value = Stream()
+                db.set(key, value)
+            elif request[3] in value.groups:
+                return client.reply_error(
+                    'Consumer Group name already exists', 'BUSYGROUP')
+            value.groups[request[3]] = ConsumerGroup(
+                self._stream_group_id(value, request[4]))
+            self._signal(self.NOTIFY_STREAM, db, 'xgroup', key, 1)
+            return client.reply_ok()
+        elif subcommand not in ('createconsumer', 'delconsumer', 'destroy',
+                                'setid'):
+            return client.reply_error("unknown command 'xgroup %s'" %
+                                      subcommand)
+        check_input(request, N != (3 if subcommand == 'destroy' else 4))
+        if value is None:
+            return client.reply_error(self.XGROUP_NO_KEY)
+        elif subcommand == 'destroy':
+            if value.groups.pop(request[3], None) is None:
+                return client.reply_zero()
+            self._signal(self.NOTIFY_STREAM, db, 'xgroup', key, 1)
+            return client.reply_one()
+        group = value.groups.get(request[3])
+        if group is None:
+            return client.reply_error(
+                "No such consumer group '%s' for key name '%s'" %
+                (request[3].decode('utf-8'), key.decode('utf-8')), 'NOGROUP')
+        elif subcommand == 'setid':
+            group.last_id = self._stream_group_id(value, request[4])
+            client.reply_ok()
+        elif subcommand == 'createconsumer':
+            if request[4] in group.consumers:
+                return client.reply_zero()
+            group.consumer(request[4], int(1000*time.time()))
+            client.reply_one()
+        else:
+            client.reply_int(group.delete_consumer(request[4]))
+        self._signal(self.NOTIFY_STREAM, db, 'xgroup', key, 1)
+
+    @command('Streams')
+    def xlen(self, client, request, N):
+        check_input(request, N != 1)
+        value = client.db.get(request[1])
+        if value is None:
+            client.reply_zero()
+        elif not isinstance(value, Stream):
+            client.reply_wrongtype()
+        else:
+            client.reply_int(len(value))
+
+    @command('Streams')
+    def xpending(self, client, request, N):
+        check_input(request, N < 2)
+        value = client.db.get(request[1])
+        if value is not None and not isinstance(value, Stream):
+            return client.reply_wrongtype()
+        group = value.groups.get(request[2]) if value is not None else None
+        if group is None:
+            return client.reply_error(
+                "No such key '%s' or consumer group '%s'" %
+                (request[1].decode('utf-8'), request[2].decode('utf-8')),
+                'NOGROUP')
+        elif N == 2:
+            ids = group.pending_ids
+            client.reply_multi_bulk_len(4)
+            client.reply_int(len(ids))
+            if ids:
+                client.reply_bulk(format_id(ids[0]))
+                client.reply_bulk(format_id(ids[-1]))
+                client.reply_multi_bulk(sorted(
+                    (name, str(len(consumer.pending)).encode('ascii'))
+                    for name, consumer in group.consumers.items()
+                    if consumer.pending))
+            else:
+                client.reply_bulk()
+                client.reply_bulk()
+                client.reply_multi_bulk()
+            return
+        n = 3
+        min_idle = 0
+        if request[3].lower() == b'idle':
+            min_idle = self._int(request[4])
+            n = 5
+        if N - n not in (2, 3):
+            return client.reply_error(self.SYNTAX_ERROR)
+        start = self._stream_bound(request[n], 0)
+        end = self._stream_bound(request[n + 1], SEQ_MASK)
+        count = self._int(request[n + 2])
+        consumer = None
+        if N - n == 3:
+            consumer = group.consumers.get(request[n + 3])
+            if consumer is None:
+                return client.reply_multi_bulk(())
+        now = int(1000*time.time())
+        pending = []
+        for id in group.pending_range(start, end, consumer):
+            if len(pending) >= count:
+                break
+            name, delivery_time, deliveries = group.pending[id]
+            if now - delivery_time >= min_idle:
+                pending.append((id, name, now - delivery_time, deliveries))
+        client.reply_multi_bulk_len(len(pending))
+        for id, name, idle, deliveries in pending:
+            client.reply_multi_bulk_len(4)
+            client.reply_bulk(format_id(id))
+            client.reply_bulk(name)
+            client.reply_int(idle)
+            client.reply_int(deliveries)
+
+    @command('Streams')
+    def xrange(self, client, request, N, reverse=False):
+        check_input(request, N != 3 and N != 5)
+        value = client.db.get(request[1])
+        if value is not None and not isinstance(value, Stream):
+            return client.reply_wrongtype()
+        first, last = (request[3], request[2]) if reverse else request[2:4]
+        start = self._stream_bound(first, 0)
+        end = self._stream_bound(last, SEQ_MASK)
+        count = None
+        if N == 5:
+            if request[4].lower() != b'count':
+                return client.reply_error(self.SYNTAX_ERROR)
+            count = max(self._int(request[5]), 0)
+        if value is None or start > end:
+            return client.reply_multi_bulk(())
+        if reverse:
+            entries = value.revrange(end, start)
+        else:
+            entries = value.range(start, end)
+        client.reply_multi_bulk([(format_id(id), fields) for id, fields
+                                 in islice(entries, count)])
+
+    @command('Streams', script=0)
+    def xread(self, client, request, N):
+        check_input(request, N < 3)
+        count, timeout, _, keys, ids = self._stream_read_options(request, 1)
+        db = client.db
+        reads = []
+        for key, id in zip(keys, ids):
+            value = db.get(key)
+            if value is not None and not isinstance(value, Stream):
+                return client.reply_wrongtype()
+            elif id == b'$':
+                id = value.last_id if value is not None else 0
+            else:
+                id = self._stream_id(id)
+            reads.append((key, id))
+        result = self._xread(db, reads, count)
+        if result or timeout is None:
+            client.reply_multi_bulk(result or None)
+        else:
+            read = stream_read(None, None, count, False, dict(reads))
+            client.blocked = Blocked(client, request[0], keys,
+                                     0.001*timeout, read)
+
+    @command('Streams', True, script=0)
+    def xreadgroup(self, client, request, N):
+        check_input(request, N < 6)
+        if request[1].lower() != b'group':
+            return client.reply_error(self.SYNTAX_ERROR)
+        group, consumer = request[2:4]
+        count, timeout, noack, keys, ids = self._stream_read_options(
+            request, 4, True)
+        db = client.db
+        reads = []
+        for key, id in zip(keys, ids):
+            value = db.get(key)
+            if value is not None and not isinstance(value, Stream):
+                return client.reply_wrongtype()
+            elif value is None or group not in value.groups:
+                return client.reply_error(
+                    "No such key '%s' or consumer group '%s' in XREADGROUP "
+                    "with GROUP option" % (key.decode('utf-8'),
+                                           group.decode('utf-8')),
+                    'NOGROUP')
+            reads.append((key, None if id == b'>' else self._stream_id(id)))
+        read = stream_read(group, consumer, count, noack, None)
+        result = self._xreadgroup(db, reads, read)
+        if result or timeout is None:
+            client.reply_multi_bulk(result or None)
+        else:
+            client.blocked = Blocked(client, request[0], keys,
+                                     0.001*timeout, read)
+
+    @command('Streams')
+    def xrevrange(self, client, request, N):
+        self.xrange(client, request, N, True)
+
+    # #########################################################################
+    # #    PUBSUB COMMANDS
+    @command('Pub/Sub', script=0)
+    def psubscribe(self, client, request, N):
+        check_input(request, not N)
+        for pattern in request[1:]:
+            p = self._patterns.get(pattern)
+            if not p:
+                pre = redis_to_py_pattern(pattern.decode('utf-8'))
+                p = pubsub_patterns(re.compile(pre), set())
+                self._patterns[pattern] = p
+                self._pattern_index.add(pattern, p)
+            p.clients.add(client)
+            client.patterns.add(pattern)
+            client.reply_multi_bulk((b'psubscribe', pattern,
+                                     len(client.patterns)))
+
+    @command('Pub/Sub')
+    def pubsub(self, client, request, N):
+        check_input(request, not N)
+        subcommand = request[1].decode('utf-8').lower()
+        if subcommand == 'channels':
+            check_input(request, N > 2)
+            if N == 2:
                 pre = re.compile(redis_to_py_pattern(
                     request[2].decode('utf-8')))
                 channels = []
@@ -1812,8 +2887,7 @@ class Storage(object):
             client.reply_multi_bulk(count)
         elif subcommand == 'numpat':
             check_input(request, N > 1)
-            count = reduce(lambda x, y: x + len(y.clients),
-                           self._patterns.values())
+            count = sum((len(p.clients) for p in self._patterns.values()))
             client.reply_int(count)
         else:
             client.reply_error("Unknown command 'pubsub %s'" % subcommand)
@@ -1821,15 +2895,7 @@ class Storage(object):
     @command('Pub/Sub')
     def publish(self, client, request, N):
         check_input(request, N != 2)
-        channel, message = request[1:]
-        ch = channel.decode('utf-8')
-        msg = self._parser.multi_bulk((b'message', channel, message))
-        count = self._publish_clients(msg, self._channels.get(channel, ()))
-        for pattern in self._patterns.values():
-            g = pattern.re.match(ch)
-            if g:
-                count += self._publish_clients(msg, pattern.clients)
-        client.reply_int(count)
+        client.reply_int(self._publish(*request[1:]))
 
     @command('Pub/Sub', script=0)
     def punsubscribe(self, client, request, N):
@@ -1842,6 +2908,7 @@ class Storage(object):
                     p.clients.remove(client)
                     if not p.clients:
                         self._patterns.pop(pattern)
+                        self._pattern_index.remove(pattern)
                     client.reply_multi_bulk((b'punsubscribe', pattern))
 
     @command('Pub/Sub', script=0)
@@ -1892,8 +2959,11 @@ class Storage(object):
             else:
                 self._close_transaction(client)
                 client.reply_multi_bulk_len(len(requests))
+                multi = self._start_multi()
                 for handle, request in requests:
                     client._execute_command(handle, request)
+                if multi:
+                    self._end_multi(client.database)
 
     @command('Transactions', script=0)
     def multi(self, client, request, N):
@@ -1913,8 +2983,14 @@ class Storage(object):
             wkeys = client.watched_keys
             if not wkeys:
                 client.watched_keys = wkeys = set()
-                self._watching.add(client)
-            wkeys.update(request[1:])
+            db = client.db
+            watchers = db._watchers
+            for key in request[1:]:
+                clients = watchers.get(key)
+                if clients is None:
+                    watchers[key] = clients = set()
+                clients.add(client)
+                wkeys.add((db, key))
             client.reply_ok()
 
     @command('Transactions', script=0)
@@ -1927,17 +3003,46 @@ class Storage(object):
 
     # #########################################################################
     # #    SCRIPTING
-    @command('Scripting', supported=False)
+    @command('Scripting', script=0)
     def eval(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N < 2)
+        lua = self._scripting()
+        lua.run(client, lua.load(request[1]), request[2:])
 
-    @command('Scripting', supported=False)
+    @command('Scripting', script=0)
     def evalsha(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N < 2)
+        lua = self._scripting()
+        sha = request[1].lower()
+        if sha in lua.scripts:
+            lua.run(client, sha, request[2:])
+        else:
+            client.reply_error(self.NOSCRIPT, 'NOSCRIPT')
 
-    @command('Scripting', supported=False)
+    @command('Scripting', script=0,
+             subcommands=['exists', 'flush', 'kill', 'load'])
     def script(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, not N)
+        lua = self._scripting()
+        subcommand = request[1].decode('utf-8').lower()
+        if subcommand == 'exists':
+            check_input(request, N < 2)
+            client.reply_multi_bulk_len(N - 1)
+            for sha in request[2:]:
+                client.reply_int(int(sha.lower() in lua.scripts))
+        elif subcommand == 'flush':
+            check_input(request, N != 1)
+            lua.flush()
+            client.reply_ok()
+        elif subcommand == 'kill':
+            check_input(request, N != 1)
+            client.reply_error('No scripts in execution right now.',
+                               'NOTBUSY')
+        elif subcommand == 'load':
+            check_input(request, N != 2)
+            client.reply_bulk(lua.load(request[2]))
+        else:
+            client.reply_error("unknown command 'script %s'" % subcommand)
 
     # #########################################################################
     # #    CONNECTION COMMANDS
@@ -1983,9 +3088,17 @@ class Storage(object):
 
     # #########################################################################
     # #    SERVER COMMANDS
-    @command('Server', supported=False)
+    @command('Server')
     def bgrewriteaof(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N)
+        if self._aof is None:
+            client.reply_error('Append only file is disabled')
+        elif self._aof.rewrite(self._dbs()):
+            client.reply_status('Background append only file rewriting '
+                                'started')
+        else:
+            client.reply_error('Background append only file rewriting '
+                               'already in progress')
 
     @command('Server')
     def bgsave(self, client, request, N):
@@ -2001,9 +3114,55 @@ class Storage(object):
             check_input(request, N != 1)
             value = '\n'.join(self._client_list(client))
             client.reply_bulk(value.encode('utf-8'))
+        elif subcommand == 'kill':
+            check_input(request, N < 2)
+            if N == 2:
+                # the old form kills the client at an address
+                if self._client_kill(client, addr=request[2], skipme=b'no'):
+                    client.reply_ok()
+                else:
+                    client.reply_error('No such client')
+            else:
+                check_input(request, N % 2 == 0)
+                filters = {}
+                for name, value in zip(request[2::2], request[3::2]):
+                    name = name.decode('utf-8').lower()
+                    if name not in ('addr', 'type', 'skipme'):
+                        raise CommandError(self.SYNTAX_ERROR)
+                    filters[name] = value
+                client.reply_int(self._client_kill(client, **filters))
         else:
             client.reply_error("unknown command 'client %s'" % subcommand)
 
+    @command('Server', script=0, subcommands=['info', 'keyslot', 'slots'])
+    def cluster(self, client, request, N):
+        check_input(request, not N)
+        cluster = self._cluster
+        if cluster is None:
+            raise CommandError('This instance has cluster support disabled')
+        subcommand = request[1].decode('utf-8').lower()
+        if subcommand == 'slots':
+            check_input(request, N != 1)
+            client.reply_multi_bulk_len(len(cluster.addresses))
+            for (host, port), (first, last) in zip(cluster.addresses,
+                                                   cluster.slots):
+                client.reply_multi_bulk_len(3)
+                client.reply_int(first)
+                client.reply_int(last)
+                client.reply_multi_bulk_len(2)
+                client.reply_bulk(host.encode('utf-8'))
+                client.reply_int(port)
+        elif subcommand == 'keyslot':
+            check_input(request, N != 2)
+            client.reply_int(key_slot(request[2]))
+        elif subcommand == 'info':
+            check_input(request, N != 1)
+            info = ''.join(('%s:%s\r\n' % item
+                            for item in cluster.info().items()))
+            client.reply_bulk(info.encode('utf-8'))
+        else:
+            client.reply_error("unknown command 'cluster %s'" % subcommand)
+
     @command('Server')
     def config(self, client, request, N):
         check_input(request, not N)
@@ -2012,15 +3171,20 @@ class Storage(object):
             if N != 2:
                 client.reply_error("'config get' no argument")
             else:
-                value = self._get_config(request[2].decode('utf-8'))
-                client.reply_bulk(value)
+                name = request[2].decode('utf-8').lower()
+                value = self._get_config(name)
+                if value is None:
+                    client.reply_multi_bulk(())
+                else:
+                    client.reply_multi_bulk((name, value))
         elif subcommand == 'rewrite':
             client.reply_ok()
         elif subcommand == 'set':
             try:
                 if N != 3:
                     raise ValueError("'config set' no argument")
-                self._set_config(request[2].decode('utf-8'))
+                self._set_config(request[2].decode('utf-8').lower(),
+                                 request[3].decode('utf-8'))
             except Exception as e:
                 client.reply_error(str(e))
             else:
@@ -2029,6 +3193,7 @@ class Storage(object):
             self._hit_keys = 0
             self._missed_keys = 0
             self._expired_keys = 0
+            self._command_stats.clear()
             server = client._producer
             server._received = 0
             server._requests_processed = 0
@@ -2047,15 +3212,15 @@ class Storage(object):
 
     @command('Server', True)
     def flushdb(self, client, request, N):
-        check_input(request, N)
-        client.db.flush()
+        lazy = self._flush_mode(request, N)
+        client.db.flush(lazy)
         client.reply_ok()
 
     @command('Server', True)
     def flushall(self, client, request, N):
-        check_input(request, N)
+        lazy = self._flush_mode(request, N)
         for db in self.databases.values():
-            db.flush()
+            db.flush(lazy)
         client.reply_ok()
 
     @command('Server')
@@ -2086,17 +3251,88 @@ class Storage(object):
     def shutdown(self, client, request, N):
         client.reply_error(self.NOT_SUPPORTED)
 
-    @command('Server', supported=False)
+    @command('Server', script=0)
+    def psync(self, client, request, N):
+        check_input(request, N != 2)
+        try:
+            offset = int(request[2])
+        except ValueError:
+            raise CommandError('value is not an integer or out of range')
+        self._replication_master().sync(client, request[1].decode('utf-8'),
+                                        offset)
+
+    @command('Server', script=0)
+    def replconf(self, client, request, N):
+        check_input(request, not N or N % 2)
+        option = request[1].lower()
+        if option == b'ack':
+            # acknowledgements are not replied
+            if self._replication:
+                try:
+                    offset = int(request[2])
+                except ValueError:
+                    return
+                self._replication.ack(client, offset)
+        elif option in (b'listening-port', b'capa', b'ip-address'):
+            client.reply_ok()
+        else:
+            client.reply_error('Unrecognized REPLCONF option: %s' %
+                               request[1].decode('utf-8'))
+
+    @command('Server', script=0)
     def slaveof(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N != 2)
+        host, port = request[1].decode('utf-8'), request[2].decode('utf-8')
+        if host.lower() == 'no' and port.lower() == 'one':
+            if self._master_link:
+                self._master_link.close()
+                self._master_link = None
+                self.logger.info('Replica promoted to master')
+        else:
+            try:
+                int(port)
+            except ValueError:
+                raise CommandError('Invalid master port')
+            self._replicate('%s:%s' % (host, port))
+        client.reply_ok()
 
-    @command('Server', supported=False)
+    @command('Server', subcommands=['get', 'len', 'reset'])
     def slowlog(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, not N)
+        subcommand = request[1].decode('utf-8').lower()
+        if subcommand == 'get':
+            check_input(request, N > 2)
+            count = 10
+            if N == 2:
+                try:
+                    count = int(request[2])
+                except ValueError:
+                    raise CommandError('value is not an integer or out '
+                                       'of range')
+            entries = self._slowlog.get(count)
+            client.reply_multi_bulk_len(len(entries))
+            for id, timestamp, usec, args, address in entries:
+                client.reply_multi_bulk_len(6)
+                client.reply_int(id)
+                client.reply_int(timestamp)
+                client.reply_int(usec)
+                client.reply_multi_bulk(args)
+                client.reply_bulk(address.encode('utf-8'))
+                client.reply_bulk(b'')
+        elif subcommand == 'len':
+            check_input(request, N != 1)
+            client.reply_int(len(self._slowlog))
+        elif subcommand == 'reset':
+            check_input(request, N != 1)
+            self._slowlog.reset()
+            client.reply_ok()
+        else:
+            client.reply_error("unknown command 'slowlog %s'" % subcommand)
 
-    @command('Server', supported=False)
+    @command('Server', script=0)
     def sync(self, client, request, N):
-        client.reply_error(self.NOT_SUPPORTED)
+        check_input(request, N)
+        self._replication_master().sync(client)
 
     @command('Server')
     def time(self, client, request, N):
@@ -2109,6 +3345,10 @@ class Storage(object):
     # #########################################################################
     # #    INTERNALS
     def _cron(self):
+        until = self._loop.time() + self._expire_cycle_budget
+        for db in self.databases.values():
+            if db._expires:
+                db.active_expire(until)
         dirty = self._dirty
         if dirty:
             now = time.time()
@@ -2117,7 +3357,16 @@ class Storage(object):
                 if gap >= interval and dirty >= changes:
                     self._save()
                     break
-        self._loop.call_later(1, self._cron)
+        if self._aof:
+            self._aof.cron()
+        if self._replication:
+            self._replication.cron()
+        if self._master_link:
+            now = self._loop.time()
+            if now - self._last_ack >= 1:
+                self._last_ack = now
+                self._master_link.cron()
+        self._loop.call_later(self._cron_interval, self._cron)
 
     def _set(self, client, key, value, seconds=0, milliseconds=0,
              nx=False, xx=False):
@@ -2136,41 +3385,177 @@ class Storage(object):
         if not skip:
             if exists:
                 db.pop(key)
+            db.set(key, encode_string(value))
             if timeout > 0:
-                db._expires[key] = (self._loop.call_later(
-                    timeout, db._do_expire, key), bytearray(value))
+                db._expires.add(key, self._loop.time() + timeout)
                 self._signal(self.NOTIFY_STRING, db, 'expire', key)
-            else:
-                db._data[key] = bytearray(value)
             self._signal(self.NOTIFY_STRING, db, 'set', key, 1)
             return True
 
     def _incrby(self, client, name, key, value, type):
+        # the stored result, an int or the bytes of a float
         try:
-            tv = type(value)
-        except Exception:
+            tv = parse_number(value, type)
+        except ValueError:
             return client.reply_error('invalid increment')
         db = client.db
         cur = db.get(key)
-        if cur is None:
-            db._data[key] = bytearray(value)
-        elif isinstance(cur, bytearray):
+        if cur is not None:
+            if not isinstance(cur, self.string_types):
+                return client.reply_wrongtype()
             try:
-                tv += type(cur)
-            except Exception:
+                cur = parse_number(string_bytes(cur), type)
+            except ValueError:
                 return client.reply_error('invalid increment')
-            db._data[key] = bytearray(str(tv).encode('utf-8'))
-        else:
-            return client.reply_wrongtype()
+            try:
+                tv = add_numbers(cur, tv)
+            except OverflowError:
+                return client.reply_error(
+                    self.OVERFLOW if type is int else self.NOT_FINITE)
+        result = number_string(tv)
+        db.set(key, result if type is int else encode_string(result))
         self._signal(self.NOTIFY_STRING, db, name, key, 1)
-        return tv
+        return result
+
+    def _hyperloglogs(self, client, keys):
+        '''The :class:`.HyperLogLog` counters at ``keys``, ``None`` for
+        missing keys.
+
+        Strings are parsed into counters, stored in place. Reply with an
+        error and return ``None`` when a key holds another value.
+        '''
+        db = client.db
+        counters = []
+        for key in keys:
+            value = db.get(key)
+            if value is not None and value.__class__ is not HyperLogLog:
+                if not isinstance(value, self.string_types):
+                    return client.reply_wrongtype()
+                try:
+                    value = HyperLogLog.from_bytes(string_bytes(value))
+                except ValueError:
+                    return client.reply_error(self.INVALID_HLL, 'WRONGTYPE')
+                db.set(key, value)
+            counters.append(value)
+        return counters
+
+    def _int(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise CommandError(self.NOT_INTEGER)
+
+    def _stream_id(self, value, seq=0):
+        try:
+            return parse_id(value, seq)
+        except StreamIdError:
+            raise CommandError(self.INVALID_STREAM_ID)
+
+    def _stream_bound(self, value, seq):
+        # a range bound, - and + or an ID excluded when prefixed by (
+        if value == b'-':
+            return 0
+        elif value == b'+':
+            return MAX_ID
+        elif value[:1] == b'(':
+            id = self._stream_id(value[1:], seq)
+            return id + 1 if seq == 0 else id - 1
+        return self._stream_id(value, seq)
+
+    def _stream_group_id(self, stream, value):
+        return stream.last_id if value == b'$' else self._stream_id(value)
+
+    def _stream_read_options(self, request, n, group=False):
+        # COUNT, BLOCK and NOACK options before the keys and IDs which
+        # follow STREAMS
+        count = None
+        timeout = None
+        noack = False
+        N = len(request)
+        while n < N:
+            option = request[n].lower()
+            if option == b'streams':
+                break
+            elif option == b'count' and n + 1 < N:
+                count = max(self._int(request[n + 1]), 0) or None
+                n += 2
+            elif option == b'block' and n + 1 < N:
+                timeout = self._int(request[n + 1])
+                if timeout < 0:
+                    raise CommandError('timeout is negative')
+                n += 2
+            elif option == b'noack' and group:
+                noack = True
+                n += 1
+            else:
+                raise CommandError(self.SYNTAX_ERROR)
+        args = request[n + 1:]
+        if not args or len(args) % 2:
+            raise CommandError("Unbalanced '%s' list of streams: for each "
+                               "stream key an ID or '$' must be specified."
+                               % request[0])
+        return count, timeout, noack, args[:len(args)//2], args[len(args)//2:]
+
+    def _xread(self, db, reads, count):
+        # entries after the ID of each key
+        result = []
+        for key, id in reads:
+            value = db.get(key)
+            if value is not None and value.last_id > id:
+                result.append((key, [(format_id(id), fields) for id, fields
+                                     in islice(value.range(id + 1), count)]))
+        return result
+
+    def _xreadgroup(self, db, reads, read):
+        # new entries delivered to the consumer when the ID is None, its
+        # pending entries after the ID otherwise
+        now = int(1000*time.time())
+        count = read.count
+        result = []
+        for key, id in reads:
+            stream = db.get(key)
+            group = stream.groups[read.group]
+            consumer = group.consumer(read.consumer, now)
+            if id is None:
+                entries = list(islice(stream.range(group.last_id + 1), count))
+                if not entries:
+                    continue
+                group.last_id = entries[-1][0]
+                if not read.noack:
+                    for id, _ in entries:
+                        group.deliver(read.consumer, id, now)
+                request = b'>'
+            else:
+                request = format_id(id)
+                entries = [(id, stream.get(id)) for id in islice(
+                    group.pending_range(id + 1, MAX_ID, consumer), count)]
+                for id, _ in entries:
+                    group.redeliver(id, now)
+            result.append((key, [(format_id(id), fields)
+                                 for id, fields in entries]))
+            if not entries:
+                continue
+            self._signal(self.NOTIFY_STREAM, db, 'xreadgroup', key, 1)
+            if self._propagation:
+                options = ('noack',) if read.noack else ()
+                self._feed(db._num, ('xreadgroup', 'group', read.group,
+                                     read.consumer, 'count', len(entries)) +
+                           options + ('streams', key, request))
+        return result
+
+    def _mutable_string(self, db, key, value):
+        # promote an immutable string to a bytearray modified in place
+        if value.__class__ is not bytearray:
+            value = bytearray(string_bytes(value))
+            db.set(key, value)
+        return value
 
     def _bpop(self, client, request, keys, dest=None):
-        list_type = self.list_type
+        list_types = self.list_types
         db = client.db
         for key in keys:
             value = db.get(key)
-            if isinstance(value, list_type):
+            if isinstance(value, list_types):
                 self._block_callback(client, request[0], key, value, dest)
                 return True
             elif value is not None:
@@ -2180,13 +3565,19 @@ class Storage(object):
 
     def _block_callback(self, client, command, key, value, dest):
         db = client.db
+        if command == 'xread':
+            return client.reply_multi_bulk(
+                self._xread(db, ((key, dest.ids[key]),), dest.count))
+        elif command == 'xreadgroup':
+            return client.reply_multi_bulk(
+                self._xreadgroup(db, ((key, None),), dest))
         if command[:2] == 'br':
             if dest is not None:
                 dval = db.get(dest)
                 if dval is None:
                     dval = self.list_type()
-                    db._data[dest] = dval
-                elif not isinstance(dval, self.list_type):
+                    db.set(dest, dval)
+                elif not isinstance(dval, self.list_types):
                     return client.reply_wrongtype()
             elem = value.pop()
             self._signal(self.NOTIFY_LIST, db, 'rpop', key, 1)
@@ -2199,6 +3590,13 @@ class Storage(object):
         if not value:
             db.pop(key)
             self._signal(self.NOTIFY_GENERIC, db, 'del', key, 1)
+        if self._propagation:
+            if dest is not None:
+                self._feed(db._num, ('rpoplpush', key, dest))
+            elif command == 'brpop':
+                self._feed(db._num, ('rpop', key))
+            else:
+                self._feed(db._num, ('lpop', key))
         if dest is None:
             client.reply_multi_bulk((key, elem))
         else:
@@ -2218,9 +3616,40 @@ class Storage(object):
 
     def _close_transaction(self, client):
         client.transaction = None
-        client.watched_keys = None
         client.flag &= ~self.DIRTY_CAS
-        self._watching.discard(client)
+        self._unwatch(client)
+
+    def _replication_master(self):
+        if self._replication is None:
+            self._replication = ReplicationMaster(
+                self, self.cfg.key_value_repl_backlog_size)
+            self._propagation.append(self._replication)
+        return self._replication
+
+    def _replicate(self, address):
+        if self._master_link:
+            self._master_link.close()
+        host, _, port = address.rpartition(':')
+        self.logger.info('Replicating master %s', address)
+        self._last_ack = self._loop.time()
+        self._master_link = MasterLink(self, host or '127.0.0.1', int(port))
+        self._master_link.connect()
+
+    def _scripting(self):
+        if self.lua is None:
+            raise CommandError('Scripting requires the lupa package')
+        return self.lua
+
+    def _unwatch(self, client):
+        wkeys = client.watched_keys
+        if wkeys:
+            for db, key in wkeys:
+                clients = db._watchers.get(key)
+                if clients:
+                    clients.discard(client)
+                    if not clients:
+                        db._watchers.pop(key)
+        client.watched_keys = None
 
     def _flat_info(self):
         info = self._server.info()
@@ -2239,11 +3668,61 @@ class Storage(object):
                         value = e(value)
                     yield '%s:%s' % (key, value)
 
+    def _sort(self, client, request, N, readonly=False):
+        check_input(request, not N)
+        value = client.db.get(request[1])
+        if value is None:
+            value = self.list_type()
+        elif not isinstance(value, self.set_types + self.list_types +
+                                  self.zset_types):
+            return client.reply_wrongtype()
+        sort_command(self, client, request, value, readonly)
+
+    def _flush_mode(self, request, N):
+        # True for the ASYNC option of the flush commands
+        check_input(request, N > 1)
+        if N:
+            mode = request[1].lower()
+            if mode not in (b'async', b'sync'):
+                raise CommandError(self.SYNTAX_ERROR)
+            return mode == b'async'
+        return False
+
     def _get_config(self, name):
-        return b''
+        if name == 'notify-keyspace-events':
+            return self._get_notify_flags()
 
     def _set_config(self, name, value):
-        pass
+        if name == 'notify-keyspace-events':
+            self._set_notify_flags(value)
+        else:
+            raise ValueError('Unsupported CONFIG parameter: %s' % name)
+
+    def _get_notify_flags(self):
+        flags = self._notify_flags
+        classes = []
+        if flags & self.NOTIFY_ALL == self.NOTIFY_ALL:
+            flags &= ~self.NOTIFY_ALL
+            classes.append('A')
+        classes.extend((c for c, flag in self._notify_classes if flags & flag))
+        return ''.join(classes)
+
+    def _set_notify_flags(self, classes):
+        flags = 0
+        notify_classes = dict(self._notify_classes)
+        for c in classes:
+            if c == 'A':
+                flags |= self.NOTIFY_ALL
+            elif c in notify_classes:
+                flags |= notify_classes[c]
+            else:
+                raise ValueError('Invalid event class character. '
+                                 "Use 'g$lshzxetA' and 'KE'.")
+        self._notify_flags = flags
+        if flags & (self.NOTIFY_KEYSPACE | self.NOTIFY_KEYEVENT):
+            self._notify_events = flags & self.NOTIFY_ALL
+        else:
+            self._notify_events = 0
 
     def _encode_info_value(self, value):
         return str(value).replace('=',
@@ -2254,74 +3733,76 @@ class Storage(object):
         check_input(request, N != 3)
         key, field = request[1], request[2]
         try:
-            increment = type(request[3])
-        except Exception:
+            increment = parse_number(request[3], type)
+        except ValueError:
             return client.reply_error(
                 'value is not an %s or out of range' % type.__name__)
         db = client.db
         hash = db.get(key)
         if hash is None:
             hash = self.hash_type()
-            db._data[key] = hash
-        elif not isinstance(hash, self.hash_type):
+            db.set(key, hash)
+        elif not isinstance(hash, self.hash_types):
             return client.reply_wrongtype()
         if field in hash:
             try:
-                value = type(hash[field])
-            except Exception:
+                value = parse_number(hash[field], type)
+            except ValueError:
                 return client.reply_error(
                     'hash value is not an %s' % type.__name__)
-            increment += value
-        hash[field] = increment
+            try:
+                increment = add_numbers(value, increment)
+            except OverflowError:
+                return client.reply_error(
+                    self.OVERFLOW if type is int else self.NOT_FINITE)
+        hash[field] = result = number_string(increment)
         self._signal(self.NOTIFY_HASH, db, request[0], key, 1)
-        return increment
+        return result
 
-    def _setoper(self, client, oper, keys, dest=None):
+    def _setoper(self, client, oper, keys, dest=None, cmnd=None):
         db = client.db
-        result = None
-        for key in keys:
-            value = db.get(key)
-            if value is None:
-                value = set()
-            elif not isinstance(value, set):
-                return client.reply_wrongtype()
-            if result is None:
-                result = value
-            else:
-                result = getattr(result, oper)(value)
+        sets = self._sets(db, keys)
+        if sets is None:
+            return client.reply_wrongtype()
+        result = set_operation(oper, sets)
         if dest is not None:
-            db.pop(dest)
+            if db.pop(dest) is not None:
+                self._signal(self.NOTIFY_GENERIC, db, 'del', dest, 1)
             if result:
-                db._data[dest] = result
+                if any((result is value for value in sets)):
+                    result = set(result)
+                db.set(dest, self._compact(result))
+                self._signal(self.NOTIFY_SET, db, cmnd, dest, len(result))
                 client.reply_int(len(result))
             else:
                 client.reply_zero()
         else:
             client.reply_multi_bulk(result)
 
+    def _sets(self, db, keys):
+        # the sets at keys, None when a key holds another type
+        sets = []
+        for key in keys:
+            value = db.get(key)
+            if value is None:
+                value = self.set_type()
+            elif not isinstance(value, self.set_types):
+                return None
+            sets.append(value)
+        return sets
+
     def _zsetoper(self, client, request, N):
         check_input(request, N < 3)
         db = client.db
         cmnd = request[0]
         try:
             des = request[1]
-            try:
-                numkeys = int(request[2])
-            except Exception:
-                numkeys = 0
-            if numkeys <= 0:
-                raise ValueError('at least 1 input key is needed for '
-                                 'ZUNIONSTORE/ZINTERSTORE')
-            sets = []
-            for key in request[3:3+numkeys]:
-                value = db.get(key)
-                if value is None:
-                    value = self.zset_type()
-                elif not isinstance(value, self.zset_type):
-                    return client.reply_wrongtype()
-                sets.append(value)
+            numkeys = self._numkeys(cmnd, request[2])
+            sets = self._zsets(db, request[3:3+numkeys])
+            if sets is None:
+                return client.reply_wrongtype()
             if len(sets) != numkeys:
-                raise ValueError('numkeys does not match number of sets')
+                raise ValueError(self.SYNTAX_ERROR)
             op = set((b'weights', b'aggregate'))
             request = request[3+numkeys:]
             weights = None
@@ -2334,27 +3815,194 @@ class Storage(object):
                         weights = [float(v) for v in request[1:1+numkeys]]
                         request = request[1+numkeys:]
                     elif len(request) > 1:
-                        aggregate = self.zset_aggregate.get(request[1])
+                        aggregate = self.zset_aggregate.get(
+                            request[1].lower())
                         request = request[2:]
+                    else:
+                        raise ValueError(self.SYNTAX_ERROR)
                 else:
                     raise ValueError(self.SYNTAX_ERROR)
             if not aggregate:
-                raise ValueError(self.SYNTAX_ERRO)
+                raise ValueError(self.SYNTAX_ERROR)
             if weights is None:
                 weights = [1]*numkeys
             elif len(weights) != numkeys:
                 raise ValueError(self.SYNTAX_ERROR)
         except Exception as e:
             return client.reply_error(str(e))
-        if cmnd == b'zunionstore':
-            result = self.zset_type.union(sets, weights, aggregate)
+        if cmnd == 'zunionstore':
+            result = Zset.union(sets, weights, aggregate)
+        else:
+            result = Zset.inter(sets, weights, aggregate)
+        self._zstore(db, cmnd, des, result)
+        client.reply_int(len(result))
+
+    def _zdiff(self, client, request, N, dest=None):
+        # ZDIFF when dest is None, ZDIFFSTORE otherwise
+        first = 1 if dest is None else 2
+        check_input(request, N < first)
+        db = client.db
+        try:
+            numkeys = self._numkeys(request[0], request[first])
+            keys = request[first+1:first+1+numkeys]
+            options = [v.lower() for v in request[first+1+numkeys:]]
+            if len(keys) != numkeys or (
+                    options and (dest is not None or
+                                 options != [b'withscores'])):
+                raise ValueError(self.SYNTAX_ERROR)
+        except Exception as e:
+            return client.reply_error(str(e))
+        sets = self._zsets(db, keys)
+        if sets is None:
+            return client.reply_wrongtype()
+        result = Zset.diff(sets)
+        if dest is not None:
+            self._zstore(db, request[0], dest, result)
+            client.reply_int(len(result))
+        elif options:
+            reply = []
+            for score, member in result.items():
+                reply.extend((member, score))
+            client.reply_multi_bulk(reply)
         else:
-            result = self.zset_type.inter(sets, weights, aggregate)
+            client.reply_multi_bulk(list(result))
+
+    def _zrange_pairs(self, value, request):
+        # score, member pairs of value selected by the ZRANGESTORE
+        # arguments, by rank or BYSCORE, REV and LIMIT
+        start, end = request[:2]
+        options = [v.lower() for v in request[2:]]
+        byscore = rev = limit = False
+        offset, count = 0, -1
+        while options:
+            name = options.pop(0)
+            if name == b'byscore':
+                byscore = True
+            elif name == b'rev':
+                rev = True
+            elif name == b'limit' and len(options) > 1:
+                offset, count = int(options[0]), int(options[1])
+                options = options[2:]
+                limit = True
+            else:
+                raise ValueError(name)
+        if limit and not byscore:
+            raise ValueError('limit')
+        if byscore:
+            if rev:
+                start, end = end, start
+            minval, include_min, maxval, include_max = self._score_values(
+                start, end)
+            if not value or offset < 0:
+                return ()
+            if rev:
+                pairs = list(value.range_by_score(
+                    minval, maxval, include_min, include_max, scores=True))
+                pairs.reverse()
+                end = None if count < 0 else offset + count
+                return pairs[offset:end]
+            return list(value.range_by_score(
+                minval, maxval, include_min, include_max, start=offset,
+                num=None if count < 0 else count, scores=True))
+        start, end = self._range_values(value, start, end)
+        if not value:
+            return ()
+        size = len(value)
+        if rev:
+            start, end = size - end, size - start
+        start, end = max(start, 0), min(end, size)
+        if start >= end:
+            return ()
+        pairs = list(value.range(start, end, scores=True))
+        if rev:
+            pairs.reverse()
+        return pairs
+
+    def _numkeys(self, cmnd, value):
+        try:
+            numkeys = int(value)
+        except Exception:
+            numkeys = 0
+        if numkeys <= 0:
+            raise ValueError('at least 1 input key is needed for %s' %
+                             cmnd.upper())
+        return numkeys
+
+    def _zsets(self, db, keys):
+        # the sorted sets at keys, None when a key holds another type
+        sets = []
+        for key in keys:
+            value = db.get(key)
+            if value is None:
+                value = self.zset_type()
+            elif not isinstance(value, self.zset_types):
+                return None
+            sets.append(value)
+        return sets
+
+    def _zstore(self, db, cmnd, des, result):
+        # store the sorted set result at des, removed when empty
         if db.pop(des) is not None:
             self._signal(self.NOTIFY_GENERIC, db, 'del', des, 1)
-        db._data[des] = result
-        self._signal(self.NOTIFY_ZSET, db, cmnd, des, len(result))
-        client.reply_int(len(result))
+        if result:
+            db.set(des, self._compact(result))
+            self._signal(self.NOTIFY_ZSET, db, cmnd, des, len(result))
+
+    def _scan_options(self, request, start, type_option=False):
+        try:
+            cursor = int(request[start - 1])
+            if not 0 <= cursor <= MAX64:
+                raise ValueError
+        except ValueError:
+            raise CommandError(self.INVALID_CURSOR)
+        count = 10
+        match = None
+        type_name = None
+        options = request[start:]
+        if len(options) % 2:
+            raise CommandError(self.SYNTAX_ERROR)
+        for name, value in zip(options[::2], options[1::2]):
+            name = name.lower()
+            if name == b'count':
+                try:
+                    count = int(value)
+                    if count < 1:
+                        raise ValueError
+                except ValueError:
+                    raise CommandError(self.SYNTAX_ERROR)
+            elif name == b'match':
+                if value != b'*':
+                    match = re.compile(redis_to_py_pattern(
+                        value.decode('utf-8', 'ignore')))
+            elif name == b'type' and type_option:
+                type_name = value.decode('utf-8', 'ignore').lower()
+            else:
+                raise CommandError(self.SYNTAX_ERROR)
+        return cursor, count, match, type_name
+
+    def _scan_match(self, match, elements):
+        match = match.match
+        return [e for e in elements if match(e.decode('utf-8', 'ignore'))]
+
+    def _scan_container(self, value, request):
+        '''Scan the elements of ``value``.
+
+        Large containers are scanned via the :class:`.ScanIndex` of their
+        elements, small ones and listpacks in one call.
+        '''
+        cursor, count, match, _ = self._scan_options(request, 3)
+        index = getattr(value, 'scan_index', None)
+        if value is None:
+            elements = ()
+            cursor = 0
+        elif index is None or len(value) <= self.SCAN_SMALL:
+            elements = list(value)
+            cursor = 0
+        else:
+            cursor, elements = index.scan(cursor, count)
+        if match:
+            elements = self._scan_match(match, elements)
+        return str(cursor).encode('utf-8'), elements
 
     def _score_values(self, min_value, max_value):
         include_min = include_max = True
@@ -2374,27 +4022,153 @@ class Storage(object):
                  'keys_changed': self._dirty,
                  'pubsub_channels': len(self._channels),
                  'pubsub_patterns': len(self._patterns),
-                 'blocked_clients': self._bpop_blocked_clients}
+                 'blocked_clients': self._bpop_blocked_clients,
+                 'client_biggest_output_buffer': max(
+                     (c.output_memory() for c in
+                      self._server._concurrent_connections), default=0),
+                 'client_output_buffer_disconnections':
+                     self._output_buffer_disconnections,
+                 'dropped_messages': self._dropped_messages,
+                 'evicted_keys': (self._evictor.evicted_keys
+                                  if self._evictor else 0)}
+        writer = self._writer
         persistance = {'rdb_changes_since_last_save': self._dirty,
+                       'rdb_bgsave_in_progress': int(bool(
+                           writer and writer.is_alive())),
                        'rdb_last_save_time': self._last_save}
+        if self._aof:
+            persistance.update(self._aof.info())
+        else:
+            persistance['aof_enabled'] = 0
+        replication = {'role': 'slave' if self._master_link else 'master'}
+        if self._master_link:
+            replication.update(self._master_link.info())
+        if self._replication:
+            replication.update(self._replication.info())
+        else:
+            replication['connected_slaves'] = 0
+        if self._cluster:
+            cluster = self._cluster.info()
+        else:
+            cluster = {'cluster_enabled': 0}
+        if self._evictor:
+            memory = self._evictor.info()
+        else:
+            memory = {'maxmemory': 0}
+        memory.update(self._lazyfree.info())
         for db in self.databases.values():
             if len(db):
                 keyspace[str(db)] = db.info()
+        commandstats = dict((('cmdstat_%s' % name, stats.info())
+                             for name, stats in
+                             sorted(self._command_stats.items())))
         return {'keyspace': keyspace,
                 'stats': stats,
-                'persistance': persistance}
+                'persistance': persistance,
+                'replication': replication,
+                'cluster': cluster,
+                'memory': memory,
+                'commandstats': commandstats}
+
+    def _command_executed(self, client, info, request, duration):
+        # Update the statistics of a command which took duration seconds
+        usec = int(duration*1000000)
+        stats = self._command_stats.get(info.name)
+        if stats is None:
+            stats = self._command_stats[info.name] = CommandStats()
+        stats.add(usec)
+        threshold = self._slowlog.threshold
+        if threshold is not None and usec >= threshold:
+            self._slowlog.add(request, usec, client.address)
+
+    def _grow(self, db, key, value, entries):
+        '''The container at ``key`` ready for up to ``entries`` more.
+
+        A listpack is converted into its full type before, rather than
+        after, a write which may take it over the listpack limits, since
+        its insertions are linear in its size.
+        '''
+        if (value.__class__ in LISTPACK_TYPES and
+                len(value) + entries > self.listpack_max_entries):
+            value = db._data[key] = value.convert()
+        return value
+
+    def _compact(self, value):
+        '''The encoding of a new ``value`` within the listpack limits.
+
+        Small containers of a full type are converted into listpacks,
+        listpacks over the limits into their full type, other hashes, sets
+        and sorted sets into their indexed type and strings into
+        their immutable encoding, serialized HyperLogLog counters included.
+        '''
+        if type(value) in (bytes, bytearray):
+            if value[:len(HLL_MAGIC)] == HLL_MAGIC:
+                try:
+                    value = HyperLogLog.from_bytes(value)
+                except ValueError:
+                    pass
+                else:
+                    if value.sparse_size() > self.hll_sparse_max_bytes:
+                        value.to_dense()
+                    return value
+            return encode_string(bytes(value))
+        elif type(value) in LISTPACK_TYPES:
+            if not value.fits(self.listpack_max_entries,
+                              self.listpack_max_value):
+                return value.convert()
+        elif type(value) in self._listpacks:
+            if len(value) <= self.listpack_max_entries:
+                listpack = self._listpacks[type(value)](
+                    value.items() if isinstance(value, (dict, Zset))
+                    else value)
+                if listpack.fits(self.listpack_max_entries,
+                                 self.listpack_max_value):
+                    return listpack
+            if type(value) in self._indexed_types:
+                value = self._indexed_types[type(value)](
+                    value.items() if isinstance(value, Zset) else value)
+        return value
 
     def _client_list(self, client):
         for client in client._producer._concurrent_connections:
             yield ' '.join(self._client_info(client))
 
+    def _client_kill(self, client, addr=None, type=None, skipme=b'yes'):
+        '''Close the connections matching the filters of CLIENT KILL and
+        return their number.'''
+        if type is not None:
+            type = type.decode('utf-8').lower()
+            if type == 'slave':
+                type = 'replica'
+            elif type not in ('normal', 'replica', 'pubsub', 'monitor'):
+                raise CommandError("Unknown client type '%s'" % type)
+        skipme = skipme.lower()
+        if skipme not in (b'yes', b'no'):
+            raise CommandError(self.SYNTAX_ERROR)
+        if addr is not None:
+            addr = addr.decode('utf-8')
+        killed = 0
+        for other in tuple(client._producer._concurrent_connections):
+            if other is client and skipme == b'yes':
+                continue
+            if type is not None and other.output_class != type:
+                continue
+            if addr is not None and other.address != addr:
+                continue
+            other._transport.close()
+            killed += 1
+        return killed
+
     def _client_info(self, client):
-        yield 'addr=%s:%s' % client._transport.get_extra_info('addr')
+        yield 'addr=%s' % client.address
         yield 'fd=%s' % client._transport._sock_fd
         yield 'age=%s' % int(time.time() - client.started)
         yield 'db=%s' % client.database
         yield 'sub=%s' % len(client.channels)
         yield 'psub=%s' % len(client.patterns)
+        yield 'obl=%s' % len(client._output)
+        yield 'omem=%s' % client.output_memory()
+        yield 'drop=%s' % client.dropped_messages
         yield 'cmd=%s' % client.last_command
 
     def _save(self, async=True):
@@ -2403,93 +4177,245 @@ class Storage(object):
             self.logger.warning('Cannot save, background saving in progress')
         else:
             from multiprocessing import Process
-            data = self._dbs()
+            args = (self.cfg, self._filename, self._dbs(),
+                    time.time() - self._loop.time())
             self._dirty = 0
             self._last_save = int(time.time())
             if async:
+                # the forked process shares the data copy-on-write
                 self.logger.debug('Saving database in background process')
-                self._writer = Process(target=save_data,
-                                       args=(self.cfg, self._filename, data))
+                self._writer = Process(target=save_snapshot, args=args)
                 self._writer.start()
             else:
                 self.logger.debug('Saving database')
-                save_data(self.cfg, self._filename, data)
+                save_snapshot(*args)
 
     def _dbs(self):
-        data = [(db._num, db._data) for db in self.databases.values()
-                if len(db._data)]
-        return (1, data)
+        return [(db._num, db._data, db._expires)
+                for db in self.databases.values() if len(db._data)]
 
     def _loaddb(self):
         filename = self._filename
+        if self.cfg.key_value_appendonly:
+            if os.path.isfile(self._aof_filename):
+                return self._load_aof(self._aof_filename)
         if os.path.isfile(filename):
-            self.logger.info('loading data from "%s"', filename)
-            with open(filename, 'rb') as file:
-                data = pickle.load(file)
-            version, dbs = data
-            for num, data in dbs:
-                db = self.databases.get(num)
-                if db is not None:
-                    db._data = data
+            self._load_snapshot(filename)
+
+    def _load_snapshot(self, filename):
+        self.logger.info('loading data from "%s"', filename)
+        now = time.time()
+        offset = self._loop.time() - now
+        for num, key, value, expiretime in load_snapshot(filename):
+            db = self.databases.get(num)
+            if db is None:
+                continue
+            if expiretime is not None:
+                expiretime = 0.001*expiretime
+                if expiretime <= now:
+                    continue
+                db._expires.add(key, expiretime + offset)
+            db.set(key, self._compact(value))
+
+    def _load_aof(self, filename):
+        self.logger.info('loading data from "%s"', filename)
+        client = ReplayClient(self)
+        for request in read_commands(filename, self._server._parser_class()):
+            client.execute(request)
+
+    def _propagate(self, client, request):
+        '''Propagate a write ``request`` executed by ``client``.
+
+        Relative expiries are converted into absolute ``pexpireat``
+        commands so that replaying them yields the same deadline.
+        '''
+        command = request[0]
+        if command in self.EXPLICIT_PROPAGATION:
+            return
+        db = client.db
+        if command in self.EXPIRE_COMMANDS:
+            deadline = db._expires.get(request[1])
+            if deadline is not None:
+                return self._feed(db._num,
+                                  self._pexpireat(request[1], deadline))
+        self._feed(db._num, request)
+        if command in self.VOLATILE_COMMANDS:
+            deadline = db._expires.get(request[1])
+            if deadline is not None:
+                self._feed(db._num, self._pexpireat(request[1], deadline))
+
+    def _start_multi(self):
+        '''Propagate the writes which follow within MULTI and EXEC, so that
+        they are replayed atomically.
+
+        Return ``False`` when writes are already propagated within MULTI.
+        '''
+        if self._propagating_multi is None:
+            self._propagating_multi = False
+            return True
+        return False
+
+    def _end_multi(self, database):
+        if self._propagating_multi:
+            self._feed(database, ('exec',))
+        self._propagating_multi = None
+
+    def _feed(self, database, request):
+        if self._propagating_multi is False:
+            # MULTI is propagated with the first write only
+            self._propagating_multi = True
+            self._feed(database, ('multi',))
+        for target in self._propagation:
+            target.feed(database, request)
+
+    def _pexpireat(self, key, deadline):
+        timestamp = deadline - self._loop.time() + time.time()
+        return ('pexpireat', key, int(1000*timestamp))
 
     def _signal(self, type, db, command, key=None, dirty=0):
         self._dirty += dirty
+        value = db._data.get(key)
+        if (value.__class__ in LISTPACK_TYPES and
+                not value.fits(self.listpack_max_entries,
+                               self.listpack_max_value)):
+            db._data[key] = value.convert()
+        elif (value.__class__ is HyperLogLog and
+                value.sparse_size() > self.hll_sparse_max_bytes):
+            value.to_dense()
+        if db._meta is not None and key is not None:
+            db.resize(key)
         self._event_handlers[type](db, key, COMMANDS_INFO[command])
+        if type & self._notify_events and key is not None:
+            self._notify(type, db, command, key)
+
+    def _notify(self, type, db, event, key):
+        '''Publish ``event`` on ``key`` to the keyspace and keyevent
+        channels of ``db``.
+        '''
+        if type == self.NOTIFY_EVICTED:
+            # evicted keys are signalled as deleted
+            event = 'evicted'
+        event = event.encode('utf-8')
+        num = str(db._num).encode('ascii')
+        if self._notify_flags & self.NOTIFY_KEYSPACE:
+            self._publish(b'__keyspace@' + num + b'__:' + key, event)
+        if self._notify_flags & self.NOTIFY_KEYEVENT:
+            self._publish(b'__keyevent@' + num + b'__:' + event, key)
+
+    def _publish(self, channel, message):
+        '''Publish ``message`` to ``channel``, return the number of clients
+        which received it.
+        '''
+        msg = self._parser.multi_bulk((b'message', channel, message))
+        count = self._publish_clients(msg, self._channels.get(channel, ()))
+        for pattern in self._pattern_index.match(channel):
+            count += self._publish_clients(msg, pattern.clients)
+        return count
 
     def _publish_clients(self, msg, clients):
         remove = set()
         count = 0
         for client in clients:
             try:
-                client._transport.write(msg)
-                count += 1
+                if client.write_message(msg):
+                    count += 1
             except Exception:
                 remove.add(client)
         if remove:
             clients.difference_update(remove)
         return count
 
+    def _buffer_output(self, client):
+        if not self._pending_output:
+            self._loop.call_soon(self._flush_output)
+        self._pending_output.add(client)
+
+    def _flush_output(self):
+        if self._hold_replies:
+            # sync commands to disk before replying
+            self._aof.flush()
+        clients = self._pending_output
+        self._pending_output = set()
+        for client in clients:
+            client._flush_output()
+
     # EVENT HANDLERS
-    def _modified_key(self, key):
-        for client in self._watching:
-            if key is None or key in client.watched_keys:
-                client.flag |= self.DIRTY_CAS
+    def _modified_key(self, db, key):
+        # Invalidate transactions of clients watching key, or all keys in db
+        # when key is None. Dirty clients stop watching.
+        if db._watchers:
+            if key is None:
+                for clients in db._watchers.values():
+                    for client in clients:
+                        client.flag |= self.DIRTY_CAS
+                db._watchers.clear()
+            else:
+                clients = db._watchers.pop(key, None)
+                if clients:
+                    for client in clients:
+                        client.flag |= self.DIRTY_CAS
 
     def _generic_event(self, db, key, command):
         if command.write:
-            self._modified_key(key)
+            self._modified_key(db, key)
 
     _string_event = _generic_event
     _set_event = _generic_event
     _hash_event = _generic_event
     _zset_event = _generic_event
 
+    def _stream_event(self, db, key, command):
+        if command.write:
+            self._modified_key(db, key)
+        # serve clients blocked on key which have new entries to read
+        clients = db._blocking_keys.get(key)
+        value = db._data.get(key)
+        if clients and value.__class__ is Stream:
+            for client in tuple(clients):
+                blocked = client.blocked
+                if blocked is None:
+                    # served by the event of a read of another client
+                    continue
+                read = blocked.dest
+                if blocked.command == 'xread':
+                    ready = value.last_id > read.ids[key]
+                elif blocked.command == 'xreadgroup':
+                    group = value.groups.get(read.group)
+                    ready = group is not None and value.last_id > group.last_id
+                else:
+                    ready = False
+                if ready:
+                    blocked.unblock(client, key, value)
+
     def _list_event(self, db, key, command):
         if command.write:
-            self._modified_key(key)
+            self._modified_key(db, key)
         # the key is blocking clients
         if key in db._blocking_keys:
-            if key in db._data:
-                value = db._data[key]
-            elif key in self._expires:
-                value = db._expires[key]
-            else:
-                value = None
+            value = db._data.get(key)
             for client in db._blocking_keys.pop(key):
                 client.blocked.unblock(client, key, value)
 
     def _remove_connection(self, client, _, **kw):
         # Remove a client from the server
         self._monitors.discard(client)
-        self._watching.discard(client)
-        for channel, clients in list(self._channels.items()):
-            clients.discard(client)
-            if not clients:
-                self._channels.pop(channel)
-        for pattern, p in list(self._patterns.items()):
-            p.clients.discard(client)
-            if not p.clients:
-                self._patterns.pop(pattern)
+        self._unwatch(client)
+        self._pending_output.discard(client)
+        if client.flag & self.REPLICA and self._replication:
+            self._replication.remove(client)
+        for channel in client.channels:
+            clients = self._channels.get(channel)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    self._channels.pop(channel)
+        for pattern in client.patterns:
+            p = self._patterns.get(pattern)
+            if p is not None:
+                p.clients.discard(client)
+                if not p.clients:
+                    self._patterns.pop(pattern)
+                    self._pattern_index.remove(pattern)
 
     def _write_to_monitors(self, client, request):
         # addr = '%s:%s' % self._transport.get_extra_info('addr')
@@ -2498,7 +4424,7 @@ class Storage(object):
         remove = set()
         for m in self._monitors:
             try:
-                m._transport.write(message)
+                m.write_message(message)
             except Exception:
                 remove.add(m)
         if remove:
@@ -2507,13 +4433,28 @@ class Storage(object):
 
 class Db(object):
     '''A database.
+
+    Values are stored in the ``_data`` dictionary while the deadlines of
+    volatile keys are kept in the ``_expires`` :class:`.TimerWheel`.
+    Keys are expired lazily when accessed and actively, within a time
+    budget, by the :meth:`active_expire` cycle.
+
+    When the store has a memory limit, the estimated size and the access
+    metadata of keys are kept in the ``_meta`` dictionary and their total
+    in ``_memory``.
     '''
     def __init__(self, num, store):
         self.store = store
         self._num = num
         self._loop = store._loop
         self._data = {}
-        self._expires = {}
+        self._meta = {} if store._evictor else None
+        self._memory = 0
+        self._expires = TimerWheel(self._loop.time())
+        # keys for the SCAN command
+        self._index = ScanIndex()
+        # clients watching keys in this database
+        self._watchers = {}
         self._events = {}
         self._blocking_keys = {}
 
@@ -2522,104 +4463,194 @@ class Db(object):
     __str__ = __repr__
 
     def __len__(self):
-        return len(self._data) + len(self._expires)
+        return len(self._data)
 
     def __iter__(self):
-        return chain(self._data, self._expires)
+        return iter(self._data)
 
     # #########################################################################
     # #    INTERNALS
-    def flush(self):
+    def flush(self, lazy=False):
+        '''Remove all keys, freed in the background when ``lazy``.'''
         removed = len(self._data)
-        self._data.clear()
-        [handle.cancel() for handle, _ in self._expires.values()]
-        self._expires.clear()
+        if lazy:
+            # the keyspace, the expiry and scan indexes and the metadata
+            # of keys are all as large as the number of keys
+            free = self.store._lazyfree.free
+            free(self._data, self._memory or None)
+            free(self._expires)
+            free(self._expires._slots)
+            free(self._index._buckets)
+            self._data = {}
+            self._expires = TimerWheel(self._loop.time())
+            self._index = ScanIndex()
+        else:
+            self._data.clear()
+            self._expires.clear()
+            self._index.clear()
+        if self._meta is not None:
+            if lazy:
+                free(self._meta)
+                self._meta = {}
+            else:
+                self._meta.clear()
+            self.store._evictor.used_memory -= self._memory
+            self._memory = 0
         self.store._signal(self.store.NOTIFY_GENERIC, self, 'flushdb',
                            dirty=removed)
 
+    def set(self, key, value):
+        '''Set ``value`` at ``key`` and index new keys.'''
+        if key not in self._data:
+            self._index.add(key)
+        self._data[key] = value
+        if self._meta is not None:
+            self.resize(key)
+
     def get(self, key, default=None):
-        if key in self._data:
+        if key in self._data and not (key in self._expires and
+                                      self._expire_if_due(key)):
             self.store._hit_keys += 1
+            if self._meta is not None:
+                meta = self._meta[key]
+                self._meta[key] = ((meta >> ACCESS_BITS << ACCESS_BITS) |
+                                   self.store._evictor.touch(
+                                       meta & ACCESS_MASK))
             return self._data[key]
-        elif key in self._expires:
-            self.store._hit_keys += 1
-            return self._expires[key][1]
         else:
             self.store._missed_keys += 1
             return default
 
     def exists(self, key):
-        return key in self._data or key in self._expires
+        return key in self._data and not (key in self._expires and
+                                          self._expire_if_due(key))
 
     def expire(self, key, timeout):
-        if key in self._expires:
-            handle, value = self._expires.pop(key)
-            handle.cancel()
-        elif key in self._data:
-            value = self._data.pop(key)
-        else:
-            return False
-        self._expires[key] = (self._loop.call_later(
-            timeout, self._do_expire, key), value)
-        return True
+        if self.exists(key):
+            self._expires.add(key, self._loop.time() + timeout)
+            return True
+        return False
 
     def persist(self, key):
-        if key in self._expires:
-            self.store._hit_keys += 1
-            handle, value = self._expires.pop(key)
-            handle.cancel()
-            self._data[key] = value
-            return True
-        elif key in self._data:
+        if self.exists(key):
             self.store._hit_keys += 1
+            return self._expires.remove(key) is not None
         else:
             self.store._missed_keys += 1
         return False
 
     def ttl(self, key, m=1):
-        if key in self._expires:
+        if self.exists(key):
             self.store._hit_keys += 1
-            handle, value = self._expires[key]
-            return max(0, int(m*(handle._when - self._loop.time())))
-        elif key in self._data:
-            self.store._hit_keys += 1
-            return -1
+            deadline = self._expires.get(key)
+            if deadline is None:
+                return -1
+            return max(0, int(m*(deadline - self._loop.time())))
         else:
             self.store._missed_keys += 1
             return -2
 
     def info(self):
-        return {'Keys': len(self._data),
+        info = {'Keys': len(self._data),
                 'expires': len(self._expires)}
+        if self._meta is not None:
+            info['memory'] = self._memory
+        return info
+
+    def resize(self, key):
+        '''Update the estimated size of ``key`` after a change of its value.
+        '''
+        value = self._data.get(key)
+        if value is not None:
+            meta = self._meta.get(key)
+            if meta is None:
+                old, access = 0, self.store._evictor.access()
+            else:
+                old, access = meta >> ACCESS_BITS, meta & ACCESS_MASK
+            size = object_memory(key, value)
+            self._meta[key] = size << ACCESS_BITS | access
+            self._memory += size - old
+            self.store._evictor.used_memory += size - old
 
     def pop(self, key, value=None):
         if not value:
-            if key in self._data:
-                value = self._data.pop(key)
-                return value
-            elif key in self._expires:
-                handle, value = self._expires.pop(key)
-                handle.cancel()
-                return value
+            if key in self._expires:
+                self._expires.remove(key)
+            return self._remove(key)
 
     def rem(self, key):
-        if key in self._data:
+        if self.exists(key):
             self.store._hit_keys += 1
-            self._data.pop(key)
+            self.pop(key)
             self.store._signal(self.store.NOTIFY_GENERIC, self, 'del', key, 1)
             return 1
-        elif key in self._expires:
+        else:
+            self.store._missed_keys += 1
+            return 0
+
+    def unlink(self, key):
+        '''Remove ``key`` as :meth:`rem` and free its value in the
+        background.
+        '''
+        if self.exists(key):
             self.store._hit_keys += 1
-            handle, _ = self._expires.pop(key)
-            handle.cancel()
+            self.store._lazyfree.free(self.pop(key))
             self.store._signal(self.store.NOTIFY_GENERIC, self, 'del', key, 1)
             return 1
         else:
             self.store._missed_keys += 1
             return 0
 
+    def active_expire(self, until):
+        '''Remove volatile keys whose deadline has passed.
+
+        Stop once the loop time reaches ``until`` and return the number
+        of keys removed; the remaining keys are reclaimed by the next
+        cycle or lazily when accessed.
+        '''
+        expired = 0
+        time = self._loop.time
+        for key in self._expires.pop_expired(time()):
+            self._remove(key)
+            self._expired(key)
+            expired += 1
+            if not expired % 32 and time() >= until:
+                break
+        self.store._expired_keys += expired
+        return expired
+
+    def _expire_if_due(self, key):
+        if self._expires[key] <= self._loop.time():
+            self._do_expire(key)
+            return True
+        return False
+
     def _do_expire(self, key):
-        if key in self._expires:
-            handle, value, = self._expires.pop(key)
-            handle.cancel()
+        if self._expires.remove(key) is not None:
+            self._remove(key)
+            self._expired(key)
             self.store._expired_keys += 1
+
+    def _expired(self, key):
+        store = self.store
+        # replicas and the append only file delete the expired key
+        if store._propagation:
+            store._feed(self._num, ('del', key))
+        if store._notify_events & store.NOTIFY_EXPIRED:
+            store._notify(store.NOTIFY_EXPIRED, self, 'expired', key)
+
+    def _evict(self, key):
+        self.pop(key)
+        if self.store._propagation:
+            self.store._feed(self._num, ('del', key))
+        self.store._signal(self.store.NOTIFY_EVICTED, self, 'del', key, 1)
+
+    def _remove(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._index.remove(key)
+            if self._meta is not None:
+                size = self._meta.pop(key) >> ACCESS_BITS
+                self._memory -= size
+                self.store._evictor.used_memory -= size
+        return value
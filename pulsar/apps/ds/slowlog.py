@@ -0,0 +1,125 @@
+'''Latency statistics of pulsar-ds commands.
+
+Every command executed by a client is timed. The duration updates the
+:class:`CommandStats` of the command, reported in the ``commandstats``
+section of ``INFO``, and, when it is over the
+:ref:`key_value_slowlog_log_slower_than
+<setting-key_value_slowlog_log_slower_than>` threshold, the command is
+added to the :class:`SlowLog` returned by ``SLOWLOG GET``.
+
+Latencies are counted in a log-linear histogram: durations below
+``2**SUB_BITS`` microseconds have a bucket each, larger durations are
+grouped in ``2**(SUB_BITS - 1)`` buckets for each power of two, so that
+the percentiles are within 1/8 of the measured durations.
+'''
+import time
+from collections import deque
+from itertools import islice
+
+
+SUB_BITS = 4
+SUB_MASK = (1 << (SUB_BITS - 1)) - 1
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p99.9', 0.999))
+# Arguments and bytes of each argument kept in a slow log entry
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+
+def latency_bucket(usec):
+    '''The histogram bucket of a duration of ``usec`` microseconds.'''
+    shift = usec.bit_length() - SUB_BITS
+    if shift <= 0:
+        return usec
+    return (shift << (SUB_BITS - 1)) + (usec >> shift)
+
+
+def bucket_limit(bucket):
+    '''The largest duration, in microseconds, counted in ``bucket``.'''
+    if bucket < (1 << SUB_BITS):
+        return bucket
+    shift = (bucket >> (SUB_BITS - 1)) - 1
+    top = (bucket & SUB_MASK) | (1 << (SUB_BITS - 1))
+    return ((top + 1) << shift) - 1
+
+
+class CommandStats:
+    '''Number of calls and latency histogram of a command.'''
+    __slots__ = ('calls', 'usec', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.usec = 0
+        self.histogram = {}
+
+    def add(self, usec):
+        self.calls += 1
+        self.usec += usec
+        bucket = latency_bucket(usec)
+        histogram = self.histogram
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        '''Upper limit of the duration of ``fraction`` of the calls.'''
+        rank = fraction*self.calls
+        count = 0
+        bucket = 0
+        for bucket in sorted(self.histogram):
+            count += self.histogram[bucket]
+            if count >= rank:
+                break
+        return bucket_limit(bucket)
+
+    def info(self):
+        info = {'calls': self.calls,
+                'usec': self.usec,
+                'usec_per_call': '%.2f' % (self.usec/max(self.calls, 1))}
+        for name, fraction in PERCENTILES:
+            info[name] = self.percentile(fraction)
+        return info
+
+
+class SlowLog:
+    '''A bounded log of the commands slower than a threshold.
+
+    :param threshold: commands taking at least ``threshold`` microseconds
+        are logged, negative values disable the log
+    :param max_len: the maximum number of entries, older entries are
+        discarded first
+    '''
+    def __init__(self, threshold, max_len):
+        self.threshold = threshold if threshold >= 0 else None
+        self.entries = deque(maxlen=max(max_len, 0))
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, request, usec, address=''):
+        '''Log ``request`` which took ``usec`` microseconds.'''
+        argc = len(request)
+        if argc > SLOWLOG_ENTRY_MAX_ARGC:
+            args = request[:SLOWLOG_ENTRY_MAX_ARGC - 1]
+            more = '... (%d more arguments)' % (argc - len(args))
+            args.append(more.encode('utf-8'))
+        else:
+            args = list(request)
+        for i, arg in enumerate(args):
+            if isinstance(arg, str):
+                args[i] = arg = arg.encode('utf-8')
+            if len(arg) > SLOWLOG_ENTRY_MAX_STRING:
+                more = '... (%d more bytes)' % (len(arg) -
+                                                SLOWLOG_ENTRY_MAX_STRING)
+                args[i] = (arg[:SLOWLOG_ENTRY_MAX_STRING] +
+                           more.encode('utf-8'))
+        self.entries.appendleft((self.next_id, int(time.time()), usec,
+                                 args, address))
+        self.next_id += 1
+
+    def get(self, count=10):
+        '''The ``count`` most recent entries, all of them when negative.'''
+        if count < 0:
+            return list(self.entries)
+        return list(islice(self.entries, count))
+
+    def reset(self):
+        self.entries.clear()
@@ -0,0 +1,415 @@
+'''Snapshot persistence for pulsar-ds.
+
+A snapshot is written by a forked process, which shares the dataset with
+the serving process copy-on-write, and streamed to disk in a compact binary
+format:
+
+* the ``PULSARDS`` magic string followed by the format version
+* a sequence of chunks, each one made of the length of its payload (4 bytes),
+  the payload and the CRC32 checksum of the payload (4 bytes)
+
+Chunk payloads, concatenated, form a stream of records. A record is either
+a ``SELECTDB`` opcode followed by the database number, an ``EXPIRETIME_MS``
+opcode followed by the absolute unix time in milliseconds of the next key,
+a value type followed by a key and its encoded value, or the ``EOF`` opcode
+which terminates the snapshot.
+'''
+import os
+import pickle
+from struct import Struct
+from zlib import crc32
+
+import pulsar
+from pulsar.utils.structures import Dict, Zset, Deque, Quicklist
+
+from .listpack import ListpackHash, ListpackList, ListpackSet, ListpackZset
+from .hyperloglog import HyperLogLog
+from .stream import Stream, ConsumerGroup, SEQ_BITS, SEQ_MASK
+from .utils import string_bytes
+
+
+MAGIC = b'PULSARDS'
+VERSION = 1
+CHUNK_SIZE = 1 << 16
+
+SELECTDB = 0xFE
+EXPIRETIME_MS = 0xFC
+EOF = 0xFF
+
+STRING = 0
+LIST = 1
+SET = 2
+ZSET = 3
+HASH = 4
+STREAM = 5
+
+# lengths below LEN32 are stored in one byte
+LEN32 = 0xFE
+LEN64 = 0xFF
+
+_version = Struct('<H')
+_uint32 = Struct('<I')
+_uint64 = Struct('<Q')
+_int64 = Struct('<q')
+_double = Struct('<d')
+_stream_id = Struct('<QQ')
+
+
+class SnapshotError(pulsar.PulsarException):
+    '''Raised when a snapshot file is corrupted or truncated.'''
+
+
+class SnapshotWriter:
+    '''Stream records into a snapshot ``file`` in chunks.
+
+    :param file: a file opened for writing in binary mode
+    :param chunk_size: approximate size in bytes of chunk payloads
+    '''
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        file.write(MAGIC + _version.pack(VERSION))
+
+    def select(self, num):
+        '''Records which follow belong to database ``num``.'''
+        buffer = self._buffer
+        buffer.append(SELECTDB)
+        _write_length(buffer, num)
+
+    def write(self, key, value, expiretime=None):
+        '''Write a ``key``, ``value`` pair.
+
+        :param expiretime: optional absolute unix time in milliseconds
+            when ``key`` expires.
+        '''
+        buffer = self._buffer
+        if expiretime is not None:
+            buffer.append(EXPIRETIME_MS)
+            buffer.extend(_int64.pack(expiretime))
+        if isinstance(value, (bytes, bytearray, int, HyperLogLog)):
+            buffer.append(STRING)
+            _write_string(buffer, key)
+            _write_string(buffer, string_bytes(value))
+        elif isinstance(value, (set, ListpackSet)):
+            buffer.append(SET)
+            _write_string(buffer, key)
+            self._write_strings(value)
+        elif isinstance(value, (Zset, ListpackZset)):
+            buffer.append(ZSET)
+            _write_string(buffer, key)
+            self._write_zset(value)
+        elif isinstance(value, (Quicklist, Deque, ListpackList)):
+            buffer.append(LIST)
+            _write_string(buffer, key)
+            self._write_strings(value)
+        elif isinstance(value, (dict, ListpackHash)):
+            buffer.append(HASH)
+            _write_string(buffer, key)
+            self._write_hash(value)
+        elif isinstance(value, Stream):
+            buffer.append(STREAM)
+            _write_string(buffer, key)
+            self._write_stream(value)
+        else:
+            raise TypeError('Cannot write value of type %s' %
+                            type(value).__name__)
+        if len(buffer) >= self._chunk_size:
+            self._flush()
+
+    def close(self):
+        '''Terminate the snapshot and flush the last chunk.'''
+        self._buffer.append(EOF)
+        self._flush()
+        self._file.flush()
+
+    #    INTERNALS
+    def _flush(self):
+        payload = bytes(self._buffer)
+        self._buffer.clear()
+        self._file.write(b''.join((_uint32.pack(len(payload)), payload,
+                                   _uint32.pack(crc32(payload) & 0xffffffff))))
+
+    def _write_strings(self, values):
+        buffer = self._buffer
+        chunk_size = self._chunk_size
+        _write_length(buffer, len(values))
+        for value in values:
+            _write_string(buffer, value)
+            if len(buffer) >= chunk_size:
+                self._flush()
+
+    def _write_zset(self, zset):
+        buffer = self._buffer
+        chunk_size = self._chunk_size
+        pack = _double.pack
+        _write_length(buffer, len(zset))
+        for score, member in zset.items():
+            _write_string(buffer, member)
+            buffer.extend(pack(score))
+            if len(buffer) >= chunk_size:
+                self._flush()
+
+    def _write_hash(self, hash):
+        buffer = self._buffer
+        chunk_size = self._chunk_size
+        _write_length(buffer, len(hash))
+        for field, value in hash.items():
+            _write_string(buffer, field)
+            _write_string(buffer, value)
+            if len(buffer) >= chunk_size:
+                self._flush()
+
+    def _write_stream(self, stream):
+        # entries, the last ID and the consumer groups with the pending
+        # entries of each consumer
+        buffer = self._buffer
+        chunk_size = self._chunk_size
+        _write_length(buffer, len(stream))
+        for id, fields in stream.range():
+            _write_id(buffer, id)
+            _write_length(buffer, len(fields))
+            for value in fields:
+                _write_string(buffer, value)
+            if len(buffer) >= chunk_size:
+                self._flush()
+        _write_id(buffer, stream.last_id)
+        _write_length(buffer, len(stream.groups))
+        for name, group in stream.groups.items():
+            _write_string(buffer, name)
+            _write_id(buffer, group.last_id)
+            _write_length(buffer, len(group.consumers))
+            for consumer_name, consumer in group.consumers.items():
+                _write_string(buffer, consumer_name)
+                buffer.extend(_int64.pack(consumer.seen_time))
+                _write_length(buffer, len(consumer.pending))
+                for id in consumer.pending:
+                    _, delivery_time, deliveries = group.pending[id]
+                    _write_id(buffer, id)
+                    buffer.extend(_int64.pack(delivery_time))
+                    _write_length(buffer, deliveries)
+                if len(buffer) >= chunk_size:
+                    self._flush()
+
+
+class SnapshotReader:
+    '''Read records from a snapshot ``file`` one chunk at a time.
+
+    Chunks are verified against their checksum as they are read, so that
+    only one chunk is held in memory and a corrupted file is detected
+    before its records are loaded.
+    '''
+    def __init__(self, file):
+        self._file = file
+        self._chunk = b''
+        self._pos = 0
+        header = file.read(len(MAGIC) + _version.size)
+        if header[:len(MAGIC)] != MAGIC:
+            raise SnapshotError('Not a pulsar-ds snapshot')
+        version = _version.unpack(header[len(MAGIC):])[0]
+        if version > VERSION:
+            raise SnapshotError('Unsupported snapshot version %s' % version)
+
+    def __iter__(self):
+        '''Iterator over ``(db, key, value, expiretime)`` records.'''
+        db = 0
+        expiretime = None
+        read_byte = self._read_byte
+        readers = (self._read_string, self._read_list, self._read_set,
+                   self._read_zset, self._read_hash, self._read_stream)
+        while True:
+            opcode = read_byte()
+            if opcode == EOF:
+                break
+            elif opcode == SELECTDB:
+                db = self._read_length()
+            elif opcode == EXPIRETIME_MS:
+                expiretime = _int64.unpack(self._read(_int64.size))[0]
+            elif opcode < len(readers):
+                key = self._read_string()
+                value = readers[opcode]()
+                yield db, key, value, expiretime
+                expiretime = None
+            else:
+                raise SnapshotError('Unknown opcode %s' % opcode)
+
+    #    INTERNALS
+    def _next_chunk(self):
+        header = self._file.read(_uint32.size)
+        if len(header) < _uint32.size:
+            raise SnapshotError('Truncated snapshot')
+        size = _uint32.unpack(header)[0]
+        payload = self._file.read(size)
+        checksum = self._file.read(_uint32.size)
+        if len(payload) < size or len(checksum) < _uint32.size:
+            raise SnapshotError('Truncated snapshot')
+        if _uint32.unpack(checksum)[0] != crc32(payload) & 0xffffffff:
+            raise SnapshotError('Snapshot checksum mismatch')
+        self._chunk = payload
+        self._pos = 0
+
+    def _read(self, size):
+        pos = self._pos
+        end = pos + size
+        chunk = self._chunk
+        if end <= len(chunk):
+            self._pos = end
+            return chunk[pos:end]
+        parts = [chunk[pos:]]
+        size -= len(parts[0])
+        while size:
+            self._next_chunk()
+            part = self._chunk[:size]
+            parts.append(part)
+            self._pos = len(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    def _read_byte(self):
+        while self._pos >= len(self._chunk):
+            self._next_chunk()
+        self._pos += 1
+        return self._chunk[self._pos - 1]
+
+    def _read_length(self):
+        length = self._read_byte()
+        if length < LEN32:
+            return length
+        elif length == LEN32:
+            return _uint32.unpack(self._read(_uint32.size))[0]
+        else:
+            return _uint64.unpack(self._read(_uint64.size))[0]
+
+    def _read_string(self):
+        chunk = self._chunk
+        pos = self._pos + 1
+        # fast path for short strings within the current chunk
+        if pos < len(chunk):
+            length = chunk[pos - 1]
+            end = pos + length
+            if length < LEN32 and end <= len(chunk):
+                self._pos = end
+                return chunk[pos:end]
+        return self._read(self._read_length())
+
+    def _read_list(self):
+        read = self._read_string
+        return Quicklist((read() for _ in range(self._read_length())))
+
+    def _read_set(self):
+        read = self._read_string
+        return set((read() for _ in range(self._read_length())))
+
+    def _read_zset(self):
+        read = self._read_string
+        read_score = self._read
+        unpack = _double.unpack
+        zset = Zset()
+        add = zset.add
+        for _ in range(self._read_length()):
+            member = read()
+            add(unpack(read_score(_double.size))[0], member)
+        return zset
+
+    def _read_hash(self):
+        read = self._read_string
+        hash = Dict()
+        for _ in range(self._read_length()):
+            field = read()
+            hash[field] = read()
+        return hash
+
+    def _read_id(self):
+        ms, seq = _stream_id.unpack(self._read(_stream_id.size))
+        return ms << SEQ_BITS | seq
+
+    def _read_stream(self):
+        read = self._read_string
+        read_id = self._read_id
+        read_length = self._read_length
+        read_time = self._read
+        stream = Stream()
+        for _ in range(read_length()):
+            id = read_id()
+            stream.add(id, tuple(read() for _ in range(read_length())))
+        stream.last_id = read_id()
+        for _ in range(read_length()):
+            name = read()
+            group = stream.groups[name] = ConsumerGroup(read_id())
+            for _ in range(read_length()):
+                consumer_name = read()
+                group.consumer(consumer_name,
+                               _int64.unpack(read_time(_int64.size))[0])
+                for _ in range(read_length()):
+                    id = read_id()
+                    group.deliver(consumer_name, id,
+                                  _int64.unpack(read_time(_int64.size))[0])
+                    group.pending[id][2] = read_length()
+        return stream
+
+
+def save_snapshot(cfg, filename, dbs, offset):
+    '''Write ``dbs`` into the snapshot ``filename``.
+
+    Executed in a forked process by :meth:`.Storage._save` or, for the
+    ``SAVE`` command, in the serving process.
+
+    :param dbs: an iterable over ``(number, data, expires)`` triplets
+    :param offset: converts loop time deadlines into unix timestamps
+    '''
+    logger = cfg.configured_logger('pulsar.ds')
+    path, name = os.path.split(filename)
+    temp = os.path.join(path, 'temp-%s-%s' % (os.getpid(), name))
+    with open(temp, 'wb') as file:
+        writer = SnapshotWriter(file)
+        for num, data, expires in dbs:
+            writer.select(num)
+            for key, value in data.items():
+                deadline = expires.get(key)
+                if deadline is not None:
+                    deadline = int(1000*(deadline + offset))
+                writer.write(key, value, deadline)
+        writer.close()
+        os.fsync(file.fileno())
+    os.replace(temp, filename)
+    logger.info('wrote data into "%s"', filename)
+
+
+def load_snapshot(filename):
+    '''Generator of ``(db, key, value, expiretime)`` records in ``filename``.
+
+    Snapshots pickled by earlier versions of pulsar-ds are loaded too.
+    '''
+    with open(filename, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            file.seek(0)
+            version, dbs = pickle.load(file)
+            for num, data in dbs:
+                for key, value in data.items():
+                    yield num, key, value, None
+        else:
+            file.seek(0)
+            for record in SnapshotReader(file):
+                yield record
+
+
+def _write_length(buffer, length):
+    if length < LEN32:
+        buffer.append(length)
+    elif length <= 0xffffffff:
+        buffer.append(LEN32)
+        buffer.extend(_uint32.pack(length))
+    else:
+        buffer.append(LEN64)
+        buffer.extend(_uint64.pack(length))
+
+
+def _write_id(buffer, id):
+    buffer.extend(_stream_id.pack(id >> SEQ_BITS, id & SEQ_MASK))
+
+
+def _write_string(buffer, value):
+    if not isinstance(value, (bytes, bytearray)):
+        value = str(value).encode('utf-8')
+    _write_length(buffer, len(value))
+    buffer.extend(value)
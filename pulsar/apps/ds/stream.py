@@ -0,0 +1,277 @@
+'''Streams of pulsar-ds.
+
+A :class:`Stream` is an append only log of entries, each one a flat tuple
+of fields and values identified by a monotonic ID: the unix time in
+milliseconds when the entry was added and a sequence number for entries
+added within the same millisecond. IDs are stored as a single integer,
+``ms << 64 | seq``, so that they are compared and bisected as numbers.
+
+Entries are kept in chunks of at most :data:`CHUNK_ENTRIES` entries, two
+flat lists of IDs and of fields, appended at the end of the stream and
+dropped from its head by ``MAXLEN`` trimming. The first ID of each chunk
+is indexed so that ranges are found with two binary searches rather than
+walking the stream from one end.
+
+A :class:`ConsumerGroup` tracks the last ID delivered to the group and
+the entries delivered to its consumers which are not acknowledged yet,
+the pending entries list, kept sorted by ID.
+'''
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+
+
+SEQ_BITS = 64
+SEQ_MASK = (1 << SEQ_BITS) - 1
+MAX_ID = (1 << 2*SEQ_BITS) - 1
+# Entries of a chunk, as the stream-node-max-entries of redis
+CHUNK_ENTRIES = 100
+
+
+class StreamIdError(ValueError):
+    '''Raised when a stream ID argument is not valid.'''
+
+
+def parse_id(value, seq=0):
+    '''The stream ID of ``value``, ``ms-seq`` or ``ms`` bytes.
+
+    :param seq: the sequence of IDs without one
+    '''
+    ms, sep, sequence = value.partition(b'-')
+    if ms.isdigit() and (sequence.isdigit() or not sep):
+        ms = int(ms)
+        if sep:
+            seq = int(sequence)
+        if ms <= SEQ_MASK and seq <= SEQ_MASK:
+            return ms << SEQ_BITS | seq
+    raise StreamIdError(value)
+
+
+def format_id(id):
+    return ('%d-%d' % (id >> SEQ_BITS, id & SEQ_MASK)).encode('ascii')
+
+
+class Stream:
+    '''An append only log of entries.'''
+    __slots__ = ('_chunks', '_firsts', '_length', 'last_id', 'groups')
+
+    def __init__(self):
+        self._chunks = []
+        self._firsts = []
+        self._length = 0
+        self.last_id = 0
+        self.groups = {}
+
+    def __repr__(self):
+        return '%s(%d)' % (type(self).__name__, self._length)
+
+    def __len__(self):
+        return self._length
+
+    def __eq__(self, other):
+        if isinstance(other, Stream):
+            return (self.last_id == other.last_id and
+                    list(self.range()) == list(other.range()))
+        return False
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def next_id(self, ms, seq=None):
+        '''The ID of a new entry added at ``ms`` milliseconds.
+
+        When ``seq`` is ``None`` the sequence is 0, or the next one after
+        :attr:`last_id` when ``ms`` is its time. Return ``None`` when the
+        ID is not greater than :attr:`last_id`.
+        '''
+        last_id = self.last_id
+        if seq is None:
+            if ms > last_id >> SEQ_BITS:
+                return ms << SEQ_BITS
+            id = last_id + 1 if ms == last_id >> SEQ_BITS else 0
+        else:
+            id = ms << SEQ_BITS | seq
+        return id if last_id < id <= MAX_ID else None
+
+    def add(self, id, fields):
+        '''Append an entry, ``id`` must be greater than :attr:`last_id`.'''
+        chunks = self._chunks
+        if not chunks or len(chunks[-1][0]) >= CHUNK_ENTRIES:
+            chunks.append(([], []))
+            self._firsts.append(id)
+        ids, entries = chunks[-1]
+        ids.append(id)
+        entries.append(fields)
+        self._length += 1
+        self.last_id = id
+
+    def get(self, id):
+        '''The fields of the entry ``id``, ``None`` when not found.'''
+        n = bisect_right(self._firsts, id) - 1
+        if n >= 0:
+            ids, entries = self._chunks[n]
+            i = bisect_left(ids, id)
+            if i < len(ids) and ids[i] == id:
+                return entries[i]
+
+    def range(self, start=0, end=MAX_ID):
+        '''Iterator over ``(id, fields)`` entries from ``start`` to ``end``.
+        '''
+        n = max(bisect_right(self._firsts, start) - 1, 0)
+        for ids, entries in islice(self._chunks, n, None):
+            for i in range(bisect_left(ids, start), len(ids)):
+                if ids[i] > end:
+                    return
+                yield ids[i], entries[i]
+
+    def revrange(self, end=MAX_ID, start=0):
+        '''Iterator over ``(id, fields)`` entries from ``end`` back to
+        ``start``.
+        '''
+        chunks = self._chunks
+        for n in range(bisect_right(self._firsts, end) - 1, -1, -1):
+            ids, entries = chunks[n]
+            for i in range(bisect_right(ids, end) - 1, -1, -1):
+                if ids[i] < start:
+                    return
+                yield ids[i], entries[i]
+
+    def trim(self, maxlen, approximate=False):
+        '''Remove the oldest entries to keep at most ``maxlen`` entries.
+
+        With ``approximate`` only whole chunks are removed, the stream can
+        be left with up to :data:`CHUNK_ENTRIES` extra entries. Return the
+        number of removed entries.
+        '''
+        excess = self._length - maxlen
+        if excess <= 0:
+            return 0
+        chunks = self._chunks
+        n = 0
+        removed = 0
+        while n < len(chunks) and len(chunks[n][0]) <= excess - removed:
+            removed += len(chunks[n][0])
+            n += 1
+        if n:
+            del chunks[:n]
+            del self._firsts[:n]
+        if not approximate and removed < excess:
+            ids, entries = chunks[0]
+            del ids[:excess - removed]
+            del entries[:excess - removed]
+            self._firsts[0] = ids[0]
+            removed = excess
+        self._length -= removed
+        return removed
+
+
+class Consumer:
+    '''A consumer of a :class:`ConsumerGroup`.
+
+    ``pending`` is the sorted list of the IDs delivered to the consumer
+    and not acknowledged.
+    '''
+    __slots__ = ('pending', 'seen_time')
+
+    def __init__(self, seen_time):
+        self.pending = []
+        self.seen_time = seen_time
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class ConsumerGroup:
+    '''A group of consumers of a :class:`Stream`.
+
+    ``pending`` maps the IDs of pending entries into their consumer name,
+    delivery time in milliseconds and delivery count, ``pending_ids`` is
+    the sorted list of their IDs.
+    '''
+    __slots__ = ('last_id', 'pending', 'consumers', 'pending_ids')
+
+    def __init__(self, last_id):
+        self.last_id = last_id
+        self.pending = {}
+        self.consumers = {}
+        self.pending_ids = []
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def consumer(self, name, now):
+        '''The consumer ``name``, created when missing, seen at ``now``.'''
+        consumer = self.consumers.get(name)
+        if consumer is None:
+            self.consumers[name] = consumer = Consumer(now)
+        else:
+            consumer.seen_time = now
+        return consumer
+
+    def deliver(self, name, id, now):
+        '''Add the entry ``id`` delivered to consumer ``name`` to the
+        pending entries.
+        '''
+        nack = self.pending.get(id)
+        if nack is None:
+            insort(self.pending_ids, id)
+        else:
+            _remove(self.consumers[nack[0]].pending, id)
+        self.pending[id] = [name, now, 1]
+        insort(self.consumers[name].pending, id)
+
+    def redeliver(self, id, now):
+        '''Update the delivery time and count of the pending ``id``.'''
+        nack = self.pending[id]
+        nack[1] = now
+        nack[2] += 1
+
+    def ack(self, id):
+        '''Remove ``id`` from the pending entries, return ``True`` when it
+        was pending.
+        '''
+        nack = self.pending.pop(id, None)
+        if nack is None:
+            return False
+        _remove(self.pending_ids, id)
+        _remove(self.consumers[nack[0]].pending, id)
+        return True
+
+    def delete_consumer(self, name):
+        '''Remove consumer ``name`` and its pending entries, return the
+        number of its pending entries.
+        '''
+        consumer = self.consumers.pop(name, None)
+        if consumer is None:
+            return 0
+        for id in consumer.pending:
+            self.pending.pop(id)
+            _remove(self.pending_ids, id)
+        return len(consumer.pending)
+
+    def pending_range(self, start, end, consumer=None):
+        '''Iterator over the pending IDs from ``start`` to ``end``, of
+        ``consumer`` only when given.
+        '''
+        ids = self.pending_ids if consumer is None else consumer.pending
+        for n in range(bisect_left(ids, start), len(ids)):
+            if ids[n] > end:
+                break
+            yield ids[n]
+
+
+def _remove(ids, id):
+    n = bisect_left(ids, id)
+    if n < len(ids) and ids[n] == id:
+        del ids[n]
@@ -1,21 +1,29 @@
-import shutil
-import pickle
+from functools import reduce
+from math import isfinite
+from heapq import nsmallest, nlargest
+from operator import and_, or_, xor
 
+from .hyperloglog import HyperLogLog
 
-def save_data(cfg, filename, data):
-    logger = cfg.configured_logger('pulsar.ds')
-    temp = 'temp_%s' % filename
-    with open(temp, 'wb') as file:
-        pickle.dump(data, file, protocol=2)
-    shutil.move(temp, filename)
-    logger.info('wrote data into "%s"', filename)
 
+# Strings are stored as ints when they are integers of at most 20 characters
+INT_MAX_LENGTH = 20
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+# Number of bits set, and inverted bits, of each byte
+POPCOUNT = bytes(bin(n).count('1') for n in range(256))
+INVERT = bytes(255 - n for n in range(256))
+BITOPS = {b'and': and_, b'or': or_, b'xor': xor}
+BITFIELD_OVERFLOWS = (b'wrap', b'sat', b'fail')
+_bit_count = getattr(int, 'bit_count', None)
+# SORT with LIMIT selects the first elements with a heap, rather than
+# sorting all elements, when they are less than one in this number
+HEAP_SELECT_RATIO = 8
 
-def sort_command(store, client, request, value):
-    sort_type = type(value)
-    right = 0
+
+def sort_command(store, client, request, value, readonly=False):
     desc = False
-    alpha = None
+    alpha = False
     start = None
     end = None
     storekey = None
@@ -38,10 +46,10 @@ def sort_command(store, client, request, value):
                 start = max(0, int(request[j+1]))
                 count = int(request[j+2])
             except Exception:
-                return client.error_reply(store.SYNTAX_ERROR)
+                return client.reply_error(store.SYNTAX_ERROR)
             end = len(value) if count <= 0 else start + count
             j += 2
-        elif val == b'store' and right >= 1:
+        elif val == b'store' and right >= 1 and not readonly:
             storekey = request[j+1]
             j += 1
         elif val == b'by' and right >= 1:
@@ -53,145 +61,362 @@ def sort_command(store, client, request, value):
             getops.append(request[j+1])
             j += 1
         else:
-            return client.error_reply(store.SYNTAX_ERROR)
+            return client.reply_error(store.SYNTAX_ERROR)
         j += 1
 
     db = client.db
-    if sort_type is store.zset_type and dontsort:
+    if isinstance(value, store.zset_types) and dontsort:
         dontsort = False
         alpha = True
         sortby = None
 
-    vector = []
-    sortable = SortableDesc if desc else Sortable
-    #
+    elements = list(value)
     if not dontsort:
-        for val in value:
-            if sortby:
-                byval = lookup(store, db, sortby, val)
-                if byval is None:
-                    vector.append((val, null))
-                    continue
-            else:
-                byval = val
-            if not alpha:
-                try:
-                    byval = sortable(float(byval))
-                except Exception:
-                    byval = null
-            else:
-                byval = sortable(byval)
-            vector.append((val, byval))
-
-        vector = sorted(vector, key=lambda x: x[1])
-        if start is not None:
-            vector = vector[start:end]
-        vector = [val for val, _ in vector]
-    else:
-        vector = list(value)
-        if start is not None:
-            vector = vector[start:end]
+        if sortby:
+            weights = lookup_pattern(store, db, sortby, elements)
+        else:
+            weights = elements
+        elements = sort_elements(elements, weights, alpha, desc, end)
+    if start is not None:
+        elements = elements[start:end]
 
+    if getops:
+        columns = [lookup_pattern(store, db, getv, elements)
+                   for getv in getops]
+        elements = [val for row in zip(*columns) for val in row]
     if storekey is None:
-        if getops:
-            result = []
-            for val in vector:
-                for getv in getops:
-                    gval = lookup(store, db, getv, val)
-                    result.append(gval)
-            vector = result
-        client.reply_multi_bulk(vector)
+        client.reply_multi_bulk(elements)
     else:
-        if getops:
-            vals = store.list_type()
-            empty = b''
-            for val in vector:
-                for getv in getops:
-                    vals.append(lookup(store, db, getv, val) or empty)
-        else:
-            vals = store.list_type(vector)
+        empty = b''
+        vals = store.list_type([empty if val is None else val
+                                for val in elements])
         if db.pop(storekey) is not None:
-            store._signal(store.NOTIFY_GENERIC, db, 'del', storekey)
+            store._signal(store.NOTIFY_GENERIC, db, 'del', storekey, 1)
         result = len(vals)
         if result:
-            db._data[storekey] = vals
+            db.set(storekey, vals)
             store._signal(store.NOTIFY_LIST, db, 'sort', storekey, result)
         client.reply_int(result)
 
 
-def lookup(store, db, pattern, repl):
+def sort_elements(elements, weights, alpha=False, desc=False, end=None):
+    '''Sort the list of ``elements`` by their ``weights``.
+
+    Weights are compared as floats unless ``alpha``, elements with equal
+    weights keep their order. Elements without a weight, or whose weight
+    is not a number, follow the sorted elements in their original order.
+
+    :param end: only the first ``end`` elements of the result are needed,
+        when they are few they are selected with a heap rather than by
+        sorting all the elements
+    '''
+    if not alpha:
+        try:
+            weights = list(map(float, weights))
+        except (TypeError, ValueError):
+            weights = [_float(weight) for weight in weights]
+    # sort the indexes of elements, keyed by their weight
+    if None in weights:
+        indexes = [n for n, weight in enumerate(weights)
+                   if weight is not None]
+        missing = [n for n, weight in enumerate(weights) if weight is None]
+    else:
+        indexes = range(len(weights))
+        missing = ()
+    key = weights.__getitem__
+    if end is not None and end*HEAP_SELECT_RATIO < len(indexes):
+        order = (nlargest if desc else nsmallest)(end, indexes, key=key)
+    else:
+        order = sorted(indexes, key=key, reverse=desc)
+        order.extend(missing)
+    return list(map(elements.__getitem__, order))
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def lookup_pattern(store, db, pattern, elements):
+    '''The values of the ``BY`` or ``GET`` ``pattern`` for ``elements``.
+
+    The first ``*`` of the key is replaced by each element and all keys
+    are fetched in one pass over the keyspace. Values are ``None`` for
+    missing, expired or mismatching keys.
+    '''
     if pattern == b'#':
-        return repl
-    key = pattern.replace(b'*', repl)
-    bits = key.split(b'->', 1)
-    if len(bits) == 1:
-        string = db.get(key)
-        return bytes(string) if isinstance(string, bytearray) else None
+        return elements
+    keypattern, arrow, field = pattern.rpartition(b'->')
+    if not (arrow and field and keypattern):
+        keypattern, field = pattern, None
+    prefix, star, suffix = keypattern.partition(b'*')
+    if star:
+        keys = [prefix + element + suffix for element in elements]
+    else:
+        keys = [keypattern]*len(elements)
+    get = db._data.get
+    expires = db._expires
+    if expires:
+        # expired keys are left to the lazy expiry of the next access
+        now = db._loop.time()
+        values = [None if key in expires and expires[key] <= now
+                  else get(key) for key in keys]
     else:
-        key, field = bits
-        hash = db.get(key)
-        return hash.get(field) if isinstance(hash, store.hash_type) else None
+        values = list(map(get, keys))
+    missed = values.count(None)
+    store._hit_keys += len(values) - missed
+    store._missed_keys += missed
+    if field is None:
+        types = store.string_types
+        return [string_bytes(value) if isinstance(value, types) else None
+                for value in values]
+    types = store.hash_types
+    return [value.get(field) if isinstance(value, types) else None
+            for value in values]
 
 
-class Null:
-    __slots__ = ()
+def set_operation(oper, sets):
+    '''The ``union``, ``intersection`` or ``difference`` of ``sets``.
 
-    def __lt__(self, other):
-        return False
+    Operands are taken by cardinality rather than argument order: the
+    intersection starts from the smallest set, the union from a copy of
+    the largest and the difference removes the largest sets first, and
+    both stop once the result is empty. The result can be one of ``sets``,
+    without a copy, when there is a single operand or an empty first
+    operand of a difference.
+    '''
+    if len(sets) == 1:
+        return sets[0]
+    if oper == 'intersection':
+        sets = sorted(sets, key=len)
+        result = set(sets[0])
+        for other in sets[1:]:
+            if not result:
+                break
+            result.intersection_update(other)
+    elif oper == 'union':
+        sets = sorted(sets, key=len, reverse=True)
+        result = set(sets[0])
+        for other in sets[1:]:
+            result.update(other)
+    else:
+        result = sets[0]
+        if result:
+            others = sorted(sets[1:], key=len, reverse=True)
+            # a single copy, updated in place by the other operands
+            result = result.difference(others[0])
+            for other in others[1:]:
+                if not result:
+                    break
+                result.difference_update(other)
+    return result
 
-null = Null()
 
+def intersection_count(sets, limit=0):
+    '''Number of members in the intersection of ``sets``, up to
+    ``limit`` when positive.
 
-class Sortable:
-    __slots__ = ('value',)
+    Members of the smallest set are probed in the others, from the
+    smallest to the largest, without building the intersection.
+    '''
+    sets = sorted(sets, key=len)
+    others = sets[1:]
+    count = 0
+    if sets[0]:
+        for member in sets[0]:
+            for other in others:
+                if member not in other:
+                    break
+            else:
+                count += 1
+                if count == limit:
+                    break
+    return count
 
-    def __init__(self, value):
-        self.value = value
 
-    def __lt__(self, other):
-        if other is null:
-            return True
-        else:
-            return self.value < other.value
+def count_bytes(array):
+    '''Count the number of bits set in a byte ``array``.
 
+    The whole array is converted into an integer when ``int.bit_count``
+    is available, otherwise each byte is translated into its number of
+    bits, :data:`POPCOUNT`, and the counts are summed.
+    '''
+    if _bit_count:
+        return _bit_count(int.from_bytes(array, 'little'))
+    return sum(array.translate(POPCOUNT))
 
-class SortableDesc:
-    __slots__ = ('value',)
 
-    def __init__(self, value):
-        self.value = value
+def bit_operation(op, strings):
+    '''The result of the ``BITOP`` operation ``op`` on ``strings``.
 
-    def __lt__(self, other):
-        if other is null:
-            return True
-        else:
-            return self.value > other.value
+    Shorter strings are padded with zero bytes. ``and``, ``or`` and
+    ``xor`` operate on the strings converted into big integers.
+    '''
+    if op == b'not':
+        return strings[0].translate(INVERT)
+    size = max(map(len, strings))
+    numbers = (int.from_bytes(s, 'big') << 8*(size - len(s))
+               for s in strings)
+    return reduce(BITOPS[op], numbers).to_bytes(size, 'big')
 
 
-def count_bytes(array):
-    '''Count the number of bits in a byte ``array``.
+def bit_position(string, bit, start=0, end=None):
+    '''Position of the first ``bit`` in the bytes ``string[start:end]``.
 
-    It uses the Hamming weight popcount algorithm
+    Return -1 when there is none, apart from a clear bit searched without
+    an ``end``, which is at the right of the string as for redis.
     '''
-    # this algorithm can be rewritten as
-    # for i in array:
-    #     count += sum(b=='1' for b in bin(i)[2:])
-    # but this version is almost 2 times faster
-    count = 0
-    for i in array:
-        i = i - ((i >> 1) & 0x55555555)
-        i = (i & 0x33333333) + ((i >> 2) & 0x33333333)
-        count += (((i + (i >> 4)) & 0x0F0F0F0F) * 0x01010101) >> 24
-    return count
+    data = string[start:end]
+    if bit:
+        index = len(data) - len(data.lstrip(b'\x00'))
+        if index == len(data):
+            return -1
+        byte = data[index]
+    else:
+        index = len(data) - len(data.lstrip(b'\xff'))
+        if index == len(data):
+            return -1 if end is not None else 8*(start + index)
+        byte = data[index] ^ 255
+    return 8*(start + index) + 8 - byte.bit_length()
+
+
+def bitfield_type(value):
+    '''The ``signed, bits`` pair of a ``BITFIELD`` type such as ``i8``.
+
+    Raise ``ValueError`` for invalid types, ``u64`` is not supported.
+    '''
+    sign = value[:1].lower()
+    bits = int(value[1:])
+    if sign == b'i':
+        if 0 < bits <= 64:
+            return True, bits
+    elif sign == b'u':
+        if 0 < bits < 64:
+            return False, bits
+    raise ValueError(value)
+
+
+def bitfield_limits(signed, bits):
+    '''The minimum and maximum values of a ``BITFIELD`` type.'''
+    if signed:
+        return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    return 0, (1 << bits) - 1
+
+
+def bitfield_overflow(value, signed, bits, overflow):
+    '''Apply the ``overflow`` policy to an integer ``value``.
+
+    Return ``None`` when ``value`` is out of the limits of the type and
+    the policy is ``fail``.
+    '''
+    low, high = bitfield_limits(signed, bits)
+    if low <= value <= high:
+        return value
+    elif overflow == b'wrap':
+        return ((value - low) & ((1 << bits) - 1)) + low
+    elif overflow == b'sat':
+        return high if value > high else low
+
+
+def get_bits(string, offset, signed, bits):
+    '''The integer in the ``bits`` of ``string`` starting at ``offset``.
+
+    Bits beyond the end of ``string`` are zero.
+    '''
+    first = offset >> 3
+    last = (offset + bits + 7) >> 3
+    chunk = string[first:last]
+    number = int.from_bytes(chunk, 'big') << 8*(last - first - len(chunk))
+    value = (number >> (8*last - offset - bits)) & ((1 << bits) - 1)
+    if signed and value >> (bits - 1):
+        value -= 1 << bits
+    return value
 
 
-def and_op(x, y):
-    return x & y
+def set_bits(string, offset, bits, value):
+    '''Write ``value`` in the ``bits`` of the bytearray ``string``.
+
+    ``string`` is padded with zero bytes when needed.
+    '''
+    first = offset >> 3
+    last = (offset + bits + 7) >> 3
+    if len(string) < last:
+        string.extend(bytes(last - len(string)))
+    shift = 8*last - offset - bits
+    mask = ((1 << bits) - 1) << shift
+    number = int.from_bytes(string[first:last], 'big')
+    number = (number & ~mask) | ((value << shift) & mask)
+    string[first:last] = number.to_bytes(last - first, 'big')
+
+
+def encode_string(value):
+    '''The stored encoding of the bytes ``value`` of a string.
+
+    An ``int`` when ``value`` is the canonical decimal representation of a
+    64 bits signed integer, ``value`` itself otherwise.
+    '''
+    if 0 < len(value) <= INT_MAX_LENGTH:
+        digits = value[1:] if value[:1] == b'-' else value
+        # digits after an optional minus sign, without leading zeros
+        if digits.isdigit() and (digits[:1] != b'0' or value == b'0'):
+            number = int(value)
+            if INT64_MIN <= number <= INT64_MAX:
+                return number
+    return value
+
+
+def parse_number(value, type):
+    '''The ``int`` or ``float`` ``type`` number of the string ``value``.
+
+    Raise :class:`ValueError` when ``value`` is not a 64 bits signed
+    integer or a finite float.
+    '''
+    number = type(value)
+    if type is int:
+        if not INT64_MIN <= number <= INT64_MAX:
+            raise ValueError('integer out of range')
+    elif not isfinite(number):
+        raise ValueError('float is not finite')
+    return number
+
+
+def add_numbers(a, b):
+    '''The sum of the numbers ``a`` and ``b`` parsed by
+    :func:`parse_number`.
+
+    Raise :class:`OverflowError` when the sum of two integers is out of the
+    64 bits signed range or the sum of two floats is not finite.
+    '''
+    result = a + b
+    if result.__class__ is int:
+        if not INT64_MIN <= result <= INT64_MAX:
+            raise OverflowError('integer out of range')
+    elif not isfinite(result):
+        raise OverflowError('float is not finite')
+    return result
 
 
-def or_op(x, y):
-    return x | y
+def number_string(number):
+    '''The stored, and replied, encoding of a ``number`` result of
+    an increment.
+
+    Integers are stored as they are, floats as the bytes of their shortest
+    representation without the ``.0`` of integral values.
+    '''
+    if number.__class__ is int:
+        return number
+    value = repr(number).encode('utf-8')
+    return value[:-2] if value.endswith(b'.0') else value
 
 
-def xor_op(x, y):
-    return x ^ y
+def string_bytes(value):
+    '''The bytes of a string stored with any of its encodings.'''
+    if value.__class__ is int:
+        return str(value).encode('ascii')
+    elif value.__class__ is bytearray:
+        return bytes(value)
+    elif value.__class__ is HyperLogLog:
+        return value.to_bytes()
+    return value
@@ -38,6 +38,24 @@ Skiplist
    :member-order: bysource
 
 
+.. module:: pulsar.utils.structures.sortedlist
+
+SortedList
+~~~~~~~~~~~~~~~
+.. autoclass:: SortedList
+   :members:
+   :member-order: bysource
+
+
+.. module:: pulsar.utils.structures.quicklist
+
+Quicklist
+~~~~~~~~~~~~~~~
+.. autoclass:: Quicklist
+   :members:
+   :member-order: bysource
+
+
 .. module:: pulsar.utils.structures.zset
 
 Zset
@@ -49,6 +67,8 @@ Zset
 from collections import *       # noqa
 
 from .skiplist import Skiplist  # noqa
+from .sortedlist import SortedList  # noqa
+from .quicklist import Quicklist  # noqa
 from .zset import Zset          # noqa
 from .misc import (MultiValueDict, AttributeDictionary, FrozenDict,  # noqa
                    Dict, Deque, merge_prefix, recursive_update,  # noqa
@@ -282,6 +282,9 @@ class Deque(collections.deque):
         self.clear()
         self.extend(slice)
 
+    def range(self, start=0, end=None):
+        return list(islice(self, start, end))
+
 
 def merge_prefix(deque, size):
     """Replace the first entries in a deque of bytes with a single
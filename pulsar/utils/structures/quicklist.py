@@ -0,0 +1,334 @@
+'''Chunked list with fast access by position.
+
+A :class:`Quicklist` keeps its elements in a list of chunks, python lists
+of at most ``chunk_size`` elements, as the quicklist of redis keeps them
+in a linked list of listpacks. Pushing and popping at both ends only
+touches the first or the last chunk.
+
+The position of the first element of each chunk is cached in ``_starts``
+so that the chunk of a position is found by bisection rather than by
+walking the list. Positions are virtual: pushing to the head decreases
+the start of the first chunk, rather than increasing the start of all the
+others, so that the cache stays valid. Inserting or removing elements in
+the middle of the list shifts the chunks which follow, their starts are
+recomputed when a position is next looked up.
+'''
+from bisect import bisect_right
+from collections import deque
+from itertools import chain
+
+
+class Quicklist:
+    '''A list of elements stored in chunks, with ``O(1)`` push and pop at
+    both ends and ``O(log n)`` access by position.
+
+    It supports the methods of :class:`.Deque` used by the list commands of
+    pulsar-ds.
+    '''
+    __slots__ = ('_chunks', '_starts', '_valid', '_size', '_chunk_size')
+
+    def __init__(self, iterable=None, chunk_size=256):
+        self._chunk_size = chunk_size
+        self.clear()
+        if iterable is not None:
+            self.extend(iterable)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self))
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def __reversed__(self):
+        for chunk in reversed(self._chunks):
+            yield from reversed(chunk)
+
+    def __eq__(self, other):
+        if isinstance(other, (Quicklist, deque, list)):
+            return len(self) == len(other) and all(
+                (a == b for a, b in zip(self, other)))
+        return NotImplemented
+
+    def __reduce__(self):
+        return type(self), (list(self), self._chunk_size)
+
+    def __getitem__(self, index):
+        k, i = self._locate(index)
+        return self._chunks[k][i]
+
+    def __setitem__(self, index, value):
+        k, i = self._locate(index)
+        self._chunks[k][i] = value
+
+    def clear(self):
+        self._chunks = []
+        self._starts = []
+        self._valid = 0
+        self._size = 0
+
+    def append(self, value):
+        chunks = self._chunks
+        if chunks and len(chunks[-1]) < self._chunk_size:
+            chunks[-1].append(value)
+        else:
+            self._add_chunk([value])
+        self._size += 1
+
+    def appendleft(self, value):
+        chunks = self._chunks
+        if chunks and len(chunks[0]) < self._chunk_size:
+            chunks[0].insert(0, value)
+            self._starts[0] -= 1
+        else:
+            start = self._starts[0] - 1 if chunks else 0
+            chunks.insert(0, [value])
+            self._starts.insert(0, start)
+            self._valid += 1
+        self._size += 1
+
+    def extend(self, values):
+        chunks = self._chunks
+        chunk_size = self._chunk_size
+        values = list(values)
+        n = 0
+        if chunks:
+            n = chunk_size - len(chunks[-1])
+            chunks[-1].extend(values[:n])
+        for n in range(n, len(values), chunk_size):
+            self._add_chunk(values[n:n + chunk_size])
+        self._size += len(values)
+
+    def extendleft(self, values):
+        # as deque.extendleft, the values are added in reverse order
+        for value in values:
+            self.appendleft(value)
+
+    def pop(self):
+        chunks = self._chunks
+        if not chunks:
+            raise IndexError('pop from an empty quicklist')
+        chunk = chunks[-1]
+        value = chunk.pop()
+        if not chunk:
+            self._delete_chunk(len(chunks) - 1)
+        self._size -= 1
+        return value
+
+    def popleft(self):
+        chunks = self._chunks
+        if not chunks:
+            raise IndexError('pop from an empty quicklist')
+        chunk = chunks[0]
+        value = chunk.pop(0)
+        self._starts[0] += 1
+        if not chunk:
+            self._delete_chunk(0)
+        self._size -= 1
+        return value
+
+    def insert(self, index, value):
+        '''Insert ``value`` before position ``index``.'''
+        if index >= self._size:
+            self.append(value)
+        elif index <= 0:
+            self.appendleft(value)
+        else:
+            self._insert(*self._locate(index), value=value)
+
+    def insert_before(self, pivot, value):
+        self._insert_pivot(pivot, value, 0)
+
+    def insert_after(self, pivot, value):
+        self._insert_pivot(pivot, value, 1)
+
+    def index(self, value):
+        '''Position of the first element equal to ``value``.'''
+        k, i = self._find(value)
+        if k is None:
+            raise ValueError('%r is not in quicklist' % (value,))
+        return self._start(k) - self._starts[0] + i
+
+    def range(self, start=0, end=None):
+        '''List of the elements from position ``start`` to ``end``
+        excluded.'''
+        start, end = self._slice(start, end)
+        if start >= end:
+            return []
+        k, i = self._locate(start)
+        chunks = self._chunks
+        result = []
+        left = end - start
+        # chunks are indexed, rather than iterated from the first one
+        while left:
+            values = chunks[k][i:i + left]
+            result.extend(values)
+            left -= len(values)
+            k += 1
+            i = 0
+        return result
+
+    def remove(self, elem, count=1):
+        '''Remove the first ``count`` elements equal to ``elem``, the last
+        ``-count`` when negative or all of them when 0.
+
+        Chunks without ``elem`` are skipped at once, return the number of
+        elements removed.
+        '''
+        chunks = self._chunks
+        removed = 0
+        indexes = range(len(chunks))
+        if count < 0:
+            indexes = reversed(indexes)
+        touched = []
+        for k in indexes:
+            chunk = chunks[k]
+            if elem not in chunk:
+                continue
+            touched.append(k)
+            if count:
+                left = abs(count) - removed
+                if count < 0:
+                    chunk.reverse()
+                while left and elem in chunk:
+                    chunk.remove(elem)
+                    left -= 1
+                if count < 0:
+                    chunk.reverse()
+                removed = abs(count) - left
+                if not left:
+                    break
+            else:
+                size = len(chunk)
+                chunk[:] = [v for v in chunk if v != elem]
+                removed += size - len(chunk)
+        if removed:
+            self._size -= removed
+            self._valid = min(self._valid, min(touched) + 1)
+            for k in sorted(touched, reverse=True):
+                self._join(k)
+        return removed
+
+    def trim(self, start, end):
+        '''Keep the elements from position ``start`` to ``end`` excluded,
+        dropping whole chunks outside the range.'''
+        start, end = self._slice(start, end)
+        if start >= end:
+            return self.clear()
+        chunks = self._chunks
+        k, i = self._locate(end - 1)
+        del chunks[k + 1:]
+        del self._starts[k + 1:]
+        del chunks[k][i + 1:]
+        k, i = self._locate(start)
+        del chunks[:k]
+        del self._starts[:k]
+        del chunks[0][:i]
+        self._starts[0] += i
+        self._valid = len(chunks)
+        self._size = end - start
+
+    #    INTERNALS
+    def _slice(self, start, end):
+        size = self._size
+        start = max(size + start if start < 0 else start, 0)
+        if end is None or end > size:
+            end = size
+        elif end < 0:
+            end = max(size + end, 0)
+        return start, end
+
+    def _locate(self, index):
+        # chunk and position in the chunk of the element at index
+        size = self._size
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('quicklist index out of range')
+        starts = self._starts
+        if self._valid < len(starts):
+            self._refresh()
+        k = bisect_right(starts, starts[0] + index) - 1
+        return k, starts[0] + index - starts[k]
+
+    def _start(self, k):
+        if self._valid <= k:
+            self._refresh()
+        return self._starts[k]
+
+    def _refresh(self):
+        # recompute the starts of the chunks after the valid ones
+        starts = self._starts
+        chunks = self._chunks
+        for k in range(max(self._valid, 1), len(chunks)):
+            starts[k] = starts[k - 1] + len(chunks[k - 1])
+        self._valid = len(chunks)
+
+    def _find(self, value):
+        for k, chunk in enumerate(self._chunks):
+            if value in chunk:
+                return k, chunk.index(value)
+        return None, None
+
+    def _add_chunk(self, chunk):
+        chunks = self._chunks
+        starts = self._starts
+        if not chunks:
+            starts.append(0)
+            self._valid = 1
+        elif self._valid == len(chunks):
+            starts.append(starts[-1] + len(chunks[-1]))
+            self._valid += 1
+        else:
+            starts.append(0)
+        chunks.append(chunk)
+
+    def _delete_chunk(self, k):
+        # remove the empty chunk k, the chunk which follows starts where it
+        # started
+        starts = self._starts
+        start = starts[k]
+        del self._chunks[k]
+        del starts[k]
+        if not starts:
+            self._valid = 0
+        else:
+            if not k:
+                starts[0] = start
+            if k < self._valid:
+                self._valid = max(self._valid - 1, 1)
+
+    def _insert(self, k, i, value):
+        chunk = self._chunks[k]
+        chunk.insert(i, value)
+        self._size += 1
+        self._valid = min(self._valid, k + 1)
+        if len(chunk) > self._chunk_size:
+            half = len(chunk) // 2
+            self._chunks.insert(k + 1, chunk[half:])
+            self._starts.insert(k + 1, 0)
+            del chunk[half:]
+            self._valid = min(self._valid, k + 1)
+
+    def _insert_pivot(self, pivot, value, offset):
+        k, i = self._find(pivot)
+        if k is not None:
+            if k == 0 and i + offset == 0:
+                self.appendleft(value)
+            else:
+                self._insert(k, i + offset, value)
+
+    def _join(self, k):
+        # remove the chunk k when empty or join it with the next chunk
+        # when both fit in one
+        chunks = self._chunks
+        if not chunks[k]:
+            self._delete_chunk(k)
+        elif (k + 1 < len(chunks) and
+                len(chunks[k]) + len(chunks[k + 1]) <= self._chunk_size):
+            chunks[k].extend(chunks[k + 1])
+            del chunks[k + 1]
+            del self._starts[k + 1]
+            self._valid = min(self._valid, k + 1)
@@ -0,0 +1,364 @@
+'''Sorted list of ``score, value`` pairs stored in blocks.
+
+Pairs are kept in a list of sorted blocks of at most ``2*load`` pairs,
+with the last pair of each block in ``_maxes`` so that a pair is found by
+bisecting ``_maxes`` and then its block. Blocks are split when they grow
+over ``2*load`` pairs and joined with a neighbour when they shrink under
+``load/2``.
+
+The rank of a pair is the number of pairs in the blocks before its own,
+kept in a binary indexed (Fenwick) tree over the lengths of the blocks,
+plus its position in the block. The tree is updated in ``O(log n)`` when
+a pair is inserted or removed and rebuilt when blocks are split or joined.
+
+Compared with a linked skiplist, a pair is a single tuple rather than a
+node with a list of links and a list of widths for each of its levels.
+Pairs are ordered by score and then by value, so that a pair with a
+score shared by many others is located with a binary search rather than
+by walking the pairs with the same score.
+'''
+from bisect import bisect_left, insort
+from operator import itemgetter
+
+
+class _Top:
+    '''Greater than any value, the upper bound of the pairs of a score.'''
+    __slots__ = ()
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __repr__(self):
+        return 'TOP'
+
+
+TOP = _Top()
+_value = itemgetter(1)
+
+
+class SortedList:
+    '''Sorted collection of ``score, value`` pairs supporting O(log n)
+    insertion, removal, rank and access by rank.
+
+    Pairs with the same score are sorted by value.
+    '''
+    __slots__ = ('_blocks', '_maxes', '_index', '_size', '_load')
+
+    def __init__(self, data=None, load=1000):
+        self._load = load
+        self.clear()
+        if data is not None:
+            self.update(data)
+
+    def __repr__(self):
+        return list(self).__repr__()
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('sorted list index out of range')
+        pos, index = self._locate(index)
+        return self._blocks[pos][index]
+
+    def clear(self):
+        '''Clear the container from all data.'''
+        self._blocks = []
+        self._maxes = []
+        self._index = None
+        self._size = 0
+
+    def update(self, iterable):
+        '''Insert the ``score, value`` pairs of ``iterable``.'''
+        pairs = [(score, value) for score, value in iterable]
+        if any((score != score for score, _ in pairs)):
+            raise ValueError('Cannot insert score nan')
+        if self._size or len(pairs) < self._load:
+            insert = self.insert
+            for score, value in pairs:
+                insert(score, value)
+        elif pairs:
+            # load sorted blocks at once
+            pairs.sort()
+            load = self._load
+            self._blocks = [pairs[n:n + load]
+                            for n in range(0, len(pairs), load)]
+            self._maxes = [block[-1] for block in self._blocks]
+            self._index = None
+            self._size = len(pairs)
+    extend = update
+
+    def insert(self, score, value):
+        '''Insert the pair ``score``, ``value``.'''
+        if score != score:
+            raise ValueError('Cannot insert score {0}'.format(score))
+        pair = (score, value)
+        maxes = self._maxes
+        if not maxes:
+            self._blocks.append([pair])
+            maxes.append(pair)
+            self._index = None
+            self._size = 1
+            return
+        pos = bisect_left(maxes, pair)
+        if pos == len(maxes):
+            pos -= 1
+            self._blocks[pos].append(pair)
+            maxes[pos] = pair
+        else:
+            insort(self._blocks[pos], pair)
+        self._size += 1
+        self._expand(pos)
+
+    def remove(self, score, value):
+        '''Remove the pair ``score``, ``value``, return ``True`` when found.
+        '''
+        pair = (score, value)
+        pos = bisect_left(self._maxes, pair)
+        if pos == len(self._maxes):
+            return False
+        block = self._blocks[pos]
+        index = bisect_left(block, pair)
+        if block[index] != pair:
+            return False
+        self._delete(pos, index)
+        return True
+
+    def rank(self, score, value):
+        '''The 0-based index of the pair ``score``, ``value``, ``None``
+        when not found.'''
+        pair = (score, value)
+        pos = bisect_left(self._maxes, pair)
+        if pos < len(self._maxes):
+            block = self._blocks[pos]
+            index = bisect_left(block, pair)
+            if block[index] == pair:
+                return self._offset(pos) + index
+
+    def bisect(self, pair):
+        '''The index of the first pair not less than ``pair``.'''
+        pos = bisect_left(self._maxes, pair)
+        if pos == len(self._maxes):
+            return self._size
+        return self._offset(pos) + bisect_left(self._blocks[pos], pair)
+
+    def score_range(self, minval, maxval, include_min=True,
+                    include_max=True):
+        '''The ``start, end`` indexes of the pairs with a score between
+        ``minval`` and ``maxval``.'''
+        start = self.bisect((minval,) if include_min else (minval, TOP))
+        end = self.bisect((maxval, TOP) if include_max else (maxval,))
+        return start, max(start, end)
+
+    def range(self, start=0, end=None, scores=False):
+        '''Iterator over the values, or the pairs when ``scores``, from
+        rank ``start`` to rank ``end`` excluded.'''
+        start, end = self._slice(start, end)
+        pairs = self._pairs(start, end)
+        return pairs if scores else map(_value, pairs)
+
+    def range_by_score(self, minval, maxval, include_min=True,
+                       include_max=True, start=0, num=None, scores=False):
+        first, last = self.score_range(minval, maxval, include_min,
+                                       include_max)
+        if num is not None:
+            last = min(last, first + start + num)
+        first += max(start, 0)
+        pairs = self._pairs(first, last)
+        return pairs if scores else map(_value, pairs)
+
+    def count(self, minval, maxval, include_min=True, include_max=True):
+        '''Returns the number of pairs with a score between ``minval`` and
+        ``maxval``.
+        '''
+        start, end = self.score_range(minval, maxval, include_min,
+                                      include_max)
+        return end - start
+
+    def remove_range(self, start, end, callback=None):
+        '''Remove a range by rank.
+
+        This is equivalent to perform::
+
+            del l[start:end]
+
+        on a python list.
+        It returns the number of element removed.
+        '''
+        start, end = self._slice(start, end)
+        if start >= end:
+            return 0
+        blocks = self._blocks
+        maxes = self._maxes
+        pos, index = self._locate(start)
+        first = pos
+        left = end - start
+        while left:
+            block = blocks[pos]
+            removed = block[index:index + left]
+            if callback:
+                for score, value in removed:
+                    callback(score, value)
+            del block[index:index + left]
+            left -= len(removed)
+            if block:
+                maxes[pos] = block[-1]
+                pos += 1
+            else:
+                del blocks[pos]
+                del maxes[pos]
+            index = 0
+        self._size -= end - start
+        self._index = None
+        if first < len(blocks):
+            self._join(first)
+        return end - start
+
+    def remove_range_by_score(self, minval, maxval, include_min=True,
+                              include_max=True, callback=None):
+        '''Remove a range with scores between ``minval`` and ``maxval``.
+
+        :param minval: the start value of the range to remove
+        :param maxval: the end value of the range to remove
+        :param include_min: whether or not to include ``minval`` in the
+            values to remove
+        :param include_max: whether or not to include ``maxval`` in the
+            scores to to remove
+        :param callback: optional callback function invoked for each
+            score, value pair removed.
+        :return: the number of elements removed.
+        '''
+        start, end = self.score_range(minval, maxval, include_min,
+                                      include_max)
+        return self.remove_range(start, end, callback)
+
+    def flat(self):
+        return tuple((x for pair in self for x in pair))
+
+    #    INTERNALS
+    def _slice(self, start, end):
+        N = self._size
+        if start < 0:
+            start = max(N + start, 0)
+        if end is None:
+            end = N
+        elif end < 0:
+            end = max(N + end, 0)
+        else:
+            end = min(end, N)
+        return start, end
+
+    def _pairs(self, start, end):
+        if start >= end:
+            return
+        blocks = self._blocks
+        pos, index = self._locate(start)
+        left = end - start
+        while left > 0 and pos < len(blocks):
+            pairs = blocks[pos][index:index + left]
+            yield from pairs
+            left -= len(pairs)
+            pos += 1
+            index = 0
+
+    def _expand(self, pos):
+        # split the block at pos when it is too large
+        blocks = self._blocks
+        block = blocks[pos]
+        load = self._load
+        if len(block) > 2*load:
+            half = block[load:]
+            del block[load:]
+            self._maxes[pos] = block[-1]
+            blocks.insert(pos + 1, half)
+            self._maxes.insert(pos + 1, half[-1])
+            self._index = None
+        elif self._index is not None:
+            self._index_add(pos, 1)
+
+    def _delete(self, pos, index):
+        blocks = self._blocks
+        block = blocks[pos]
+        del block[index]
+        self._size -= 1
+        if len(block) > self._load // 2:
+            self._maxes[pos] = block[-1]
+            if self._index is not None:
+                self._index_add(pos, -1)
+        elif block:
+            self._maxes[pos] = block[-1]
+            self._index = None
+            self._join(pos)
+        else:
+            del blocks[pos]
+            del self._maxes[pos]
+            self._index = None
+
+    def _join(self, pos):
+        # join the block at pos with a neighbour when it is too small
+        blocks = self._blocks
+        if len(blocks) > 1 and len(blocks[pos]) <= self._load // 2:
+            if pos == len(blocks) - 1:
+                pos -= 1
+            blocks[pos].extend(blocks[pos + 1])
+            self._maxes[pos] = blocks[pos][-1]
+            del blocks[pos + 1]
+            del self._maxes[pos + 1]
+            self._index = None
+            self._expand(pos)
+
+    def _build_index(self):
+        tree = [0]
+        tree.extend((len(block) for block in self._blocks))
+        size = len(tree)
+        for i in range(1, size):
+            j = i + (i & -i)
+            if j < size:
+                tree[j] += tree[i]
+        self._index = tree
+        return tree
+
+    def _index_add(self, pos, delta):
+        tree = self._index
+        size = len(tree)
+        i = pos + 1
+        while i < size:
+            tree[i] += delta
+            i += i & -i
+
+    def _offset(self, pos):
+        # number of pairs in the blocks before pos
+        tree = self._index
+        if tree is None:
+            tree = self._build_index()
+        total = 0
+        while pos:
+            total += tree[pos]
+            pos &= pos - 1
+        return total
+
+    def _locate(self, index):
+        # block and position in the block of the pair at index
+        tree = self._index
+        if tree is None:
+            tree = self._build_index()
+        size = len(tree)
+        pos = 0
+        bit = 1 << (size - 1).bit_length()
+        while bit:
+            next = pos + bit
+            if next < size and tree[next] <= index:
+                index -= tree[next]
+                pos = next
+            bit >>= 1
+        return pos, index
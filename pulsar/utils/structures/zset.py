@@ -1,11 +1,14 @@
-from .skiplist import Skiplist
+from .sortedlist import SortedList
 
 
 class Zset(object):
     '''Ordered-set equivalent of redis zset.
+
+    Members are sorted by score, members with the same score are sorted
+    by value.
     '''
     def __init__(self, data=None):
-        self._sl = Skiplist()
+        self._sl = SortedList()
         self._dict = {}
         if data:
             self.update(data)
@@ -17,6 +20,9 @@ class Zset(object):
     def __len__(self):
         return len(self._dict)
 
+    def __contains__(self, member):
+        return member in self._dict
+
     def __iter__(self):
         for _, value in self._sl:
             yield value
@@ -26,8 +32,8 @@ class Zset(object):
 
     def __setstate__(self, state):
         self._dict = state
-        self._sl = Skiplist(((score, member) for member, score
-                             in state.items()))
+        self._sl = SortedList(((score, member) for member, score
+                               in state.items()))
 
     def __eq__(self, other):
         if isinstance(other, Zset):
@@ -62,7 +68,7 @@ class Zset(object):
             sc = self._dict[val]
             if sc == score:
                 return 0
-            self.remove(val)
+            self._sl.remove(sc, val)
             r = 0
         self._dict[val] = score
         self._sl.insert(score, val)
@@ -71,9 +77,14 @@ class Zset(object):
     def update(self, score_vals):
         '''Update the :class:`zset` with an iterable over pairs of
 scores and values.'''
-        add = self.add
-        for score, value in score_vals:
-            add(score, value)
+        if not self._dict:
+            # sort once when empty
+            self._set_scores(dict(((value, score) for score, value
+                                   in score_vals)))
+        else:
+            add = self.add
+            for score, value in score_vals:
+                add(score, value)
 
     def remove_items(self, items):
         removed = 0
@@ -89,13 +100,8 @@ scores and values.'''
         '''
         score = self._dict.pop(item, None)
         if score is not None:
-            index = self._sl.rank(score)
-            assert index >= 0, 'could not find start range'
-            for i, v in enumerate(self._sl.range(index)):
-                if v == item:
-                    assert self._sl.remove_range(index + i, index+i + 1) == 1
-                    return score
-            assert False, 'could not find element'
+            self._sl.remove(score, item)
+            return score
 
     def remove_range(self, start, end):
         '''Remove a range by score.
@@ -113,56 +119,120 @@ scores and values.'''
 
     def clear(self):
         '''Clear this :class:`zset`.'''
-        self._sl = Skiplist()
+        self._sl = SortedList()
         self._dict.clear()
 
     def rank(self, item):
         '''Return the rank (index) of ``item`` in this :class:`zset`.'''
         score = self._dict.get(item)
         if score is not None:
-            return self._sl.rank(score)
+            return self._sl.rank(score, item)
 
     def flat(self):
         return self._sl.flat()
 
     @classmethod
     def union(cls, zsets, weights, oper):
-        result = None
+        '''The union of ``zsets`` with scores multiplied by ``weights``.
+
+        The scores of a member in more than one sorted set are aggregated
+        by ``oper``, the ``sum``, ``min`` or ``max`` builtins or a function
+        of an iterable over scores. Scores are accumulated in a dictionary
+        and the result is sorted once.
+        '''
+        scores = {}
         for zset, weight in zip(zsets, weights):
-            if result is None:
-                result = cls()
-                sl = result._sl
-                for score, value in zset._sl:
-                    result.add(score*weight, value)
+            items = _weighted(zset.items(), weight)
+            if not scores:
+                scores.update(((member, score) for score, member in items))
             else:
-                for score, value in zset._sl:
-                    score *= weight
-                    existing = sl.score(value)
-                    if existing is not None:
-                        score = oper(score, existing)
-                    result.add(score, value)
-        return result
+                _aggregate(scores, items, oper)
+        return cls._from_scores(scores)
 
     @classmethod
     def inter(cls, zsets, weights, oper):
-        result = None
-        values = None
-        for zset, _ in zip(zsets, weights):
-            if values is None:
-                values = set(zset)
-            else:
-                values.intersection_update(zset)
-        #
-        for zset, weight in zip(zsets, weights):
-            if result is None:
-                result = cls()
-                for score, value in zset._sl:
-                    if value in values:
-                        result.add(score*weight, value)
-            else:
-                for score, value in zset._sl:
-                    if value in values:
-                        existing = result.score(value)
-                        score = oper((score*weight, existing))
-                        result.add(score, value)
+        '''The intersection of ``zsets`` with scores multiplied by
+        ``weights`` and aggregated by ``oper`` as in :meth:`union`.
+
+        Members of the smallest sorted set are probed in the others, from
+        the smallest to the largest, until none is left.
+        '''
+        inputs = sorted(zip(zsets, weights), key=lambda zw: len(zw[0]))
+        if not inputs:
+            return cls()
+        zset, weight = inputs[0]
+        scores = dict(((member, score) for score, member
+                       in _weighted(zset.items(), weight)))
+        for zset, weight in inputs[1:]:
+            if not scores:
+                break
+            others = _scores(zset)
+            items = [(others[member], member) for member in scores
+                     if member in others]
+            scores = dict(((member, scores[member]) for _, member in items))
+            _aggregate(scores, _weighted(items, weight), oper)
+        return cls._from_scores(scores)
+
+    @classmethod
+    def diff(cls, zsets):
+        '''The members of the first of ``zsets`` which are not in the
+        others, with their scores.'''
+        if not zsets:
+            return cls()
+        others = [_scores(zset) for zset in zsets[1:] if zset]
+        scores = dict(((member, score) for score, member in zsets[0].items()
+                       if not any((member in other for other in others))))
+        return cls._from_scores(scores)
+
+    @classmethod
+    def _from_scores(cls, scores):
+        result = cls()
+        result._set_scores(scores)
         return result
+
+    def _set_scores(self, scores):
+        # set the members of an empty zset from a dictionary of scores
+        self._sl.update(((score, member) for member, score
+                         in scores.items()))
+        self._dict = scores
+
+
+def _scores(zset):
+    # dictionary of the member scores of zset
+    if isinstance(zset, Zset):
+        return zset._dict
+    return dict(((member, score) for score, member in zset.items()))
+
+
+def _weighted(items, weight):
+    # score, member pairs of items with scores multiplied by weight
+    if weight == 1:
+        return items
+    return ((_nan_to_zero(score*weight), member) for score, member in items)
+
+
+def _nan_to_zero(score):
+    # 0 times infinity is 0, as in redis
+    return 0.0 if score != score else score
+
+
+def _aggregate(scores, items, oper):
+    get = scores.get
+    if oper is sum:
+        for score, member in items:
+            scores[member] = _nan_to_zero(get(member, 0.0) + score)
+    elif oper is min:
+        for score, member in items:
+            existing = get(member)
+            if existing is None or score < existing:
+                scores[member] = score
+    elif oper is max:
+        for score, member in items:
+            existing = get(member)
+            if existing is None or score > existing:
+                scores[member] = score
+    else:
+        for score, member in items:
+            existing = get(member)
+            scores[member] = (score if existing is None else
+                              oper((existing, score)))
@@ -0,0 +1,57 @@
+'''Write throughput of the pulsar-ds append only file for each fsync policy::
+
+    python runtests.py bench.aof --benchmark
+
+Each run feeds a batch of ``SET`` commands, as received by the storage in
+one event loop iteration, and runs the iteration which writes them.
+'''
+import os
+import asyncio
+import tempfile
+import unittest
+
+from pulsar import new_event_loop
+from pulsar.apps.ds import redis_parser
+from pulsar.apps.ds.aof import AppendOnlyFile
+
+
+class AofEverysec(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1000
+    fsync = 'everysec'
+    _sizes = {'tiny': 10,
+              'small': 50,
+              'normal': 100,
+              'big': 500,
+              'huge': 1000}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = new_event_loop()
+        cls.filename = tempfile.mktemp()
+        cls.aof = AppendOnlyFile(cls.filename, cls.loop, redis_parser()(),
+                                 cls.fsync)
+        cls.batch = cls._sizes[cls.cfg.size]
+        cls.value = os.urandom(64)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.aof.close()
+        cls.loop.close()
+        os.remove(cls.filename)
+
+    def test_set(self):
+        aof = self.aof
+        value = self.value
+        for n in range(self.batch):
+            aof.feed(0, ('set', b'key', value))
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        aof.cron()
+
+
+class AofAlways(AofEverysec):
+    fsync = 'always'
+
+
+class AofNo(AofEverysec):
+    fsync = 'no'
@@ -0,0 +1,85 @@
+'''Cost of the pulsar-ds bit commands on large bitmaps.
+
+Compare the byte by byte loops pulsar-ds used to run for ``BITCOUNT`` and
+``BITOP`` with the whole buffer operations of :mod:`pulsar.apps.ds.utils`::
+
+    python runtests.py bench.bitmaps --benchmark
+
+Bitmaps are random, the ``normal`` size is a 1MB bitmap, one bit for each
+of 8 million users.
+'''
+import os
+import unittest
+from functools import reduce
+from itertools import zip_longest
+
+from pulsar.apps.ds.utils import count_bytes, bit_operation, bit_position
+
+
+def count_loop(array):
+    count = 0
+    for i in array:
+        i = i - ((i >> 1) & 0x55555555)
+        i = (i & 0x33333333) + ((i >> 2) & 0x33333333)
+        count += (((i + (i >> 4)) & 0x0F0F0F0F) * 0x01010101) >> 24
+    return count
+
+
+def and_loop(strings):
+    result = bytearray()
+    for values in zip_longest(*strings, fillvalue=0):
+        result.append(reduce(lambda x, y: x & y, values))
+    return result
+
+
+def not_loop(string):
+    result = bytearray()
+    for value in string:
+        result.append(~value & 255)
+    return result
+
+
+class BitmapLoop(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1
+    _sizes = {'tiny': 1 << 10,
+              'small': 1 << 17,
+              'normal': 1 << 20,
+              'big': 1 << 23,
+              'huge': 1 << 26}
+
+    @classmethod
+    def setUpClass(cls):
+        size = cls._sizes[cls.cfg.size]
+        cls.bitmaps = [os.urandom(size), os.urandom(size)]
+
+    def test_bitcount(self):
+        count_loop(self.bitmaps[0])
+
+    def test_bitop_and(self):
+        and_loop(self.bitmaps)
+
+    def test_bitop_not(self):
+        not_loop(self.bitmaps[0])
+
+
+class BitmapBuffer(BitmapLoop):
+    __number__ = 10
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # the first set bit is in the last byte
+        cls.sparse = bytes(len(cls.bitmaps[0]) - 1) + b'\x01'
+
+    def test_bitcount(self):
+        count_bytes(self.bitmaps[0])
+
+    def test_bitop_and(self):
+        bit_operation(b'and', self.bitmaps)
+
+    def test_bitop_not(self):
+        bit_operation(b'not', self.bitmaps[:1])
+
+    def test_bitpos(self):
+        bit_position(self.sparse, 1)
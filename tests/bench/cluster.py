@@ -0,0 +1,81 @@
+'''Write throughput of a sharded pulsar-ds application::
+
+    python runtests.py bench.cluster --benchmark
+
+Each run sends a batch of ``SET`` commands, pipelined over one connection
+for each shard, to all shards at once. Shards are worker processes, so the
+time of a run decreases almost linearly with the number of shards while
+there are free cores. The ``normal`` size sends 10k commands.
+'''
+import socket
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import pulsar
+from pulsar.apps.ds import PulsarDS, redis_parser
+from pulsar.apps.ds.cluster import key_slot, slot_ranges
+
+
+OK = b'+OK\r\n'
+
+
+class ClusterOneShard(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 10
+    _sizes = {'tiny': 100,
+              'small': 1000,
+              'normal': 10000,
+              'big': 100000,
+              'huge': 1000000}
+    shards = 1
+    app_cfg = None
+
+    @classmethod
+    def setUpClass(cls):
+        server = PulsarDS(name=cls.__name__.lower(),
+                          bind='127.0.0.1:0',
+                          workers=cls.shards,
+                          key_value_cluster=True,
+                          key_value_save=[],
+                          concurrency='process')
+        cls.app_cfg = yield from pulsar.send('arbiter', 'run', server)
+        cls.connections = [socket.create_connection(address)
+                           for address in cls.app_cfg.addresses]
+        # the pipelined commands and the size of their replies by shard
+        parser = redis_parser()()
+        ranges = slot_ranges(cls.shards)
+        requests = [[] for _ in ranges]
+        for n in range(cls._sizes[cls.cfg.size]):
+            key = ('key:%s' % n).encode('utf-8')
+            slot = key_slot(key)
+            shard = next(s for s, (first, last) in enumerate(ranges)
+                         if first <= slot <= last)
+            requests[shard].append(parser.pack_command((b'set', key, key)))
+        cls.requests = [(b''.join(r), len(r)*len(OK)) for r in requests]
+        cls.executor = ThreadPoolExecutor(cls.shards)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+        for connection in cls.connections:
+            connection.close()
+        if cls.app_cfg is not None:
+            yield from pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    def _send(self, shard):
+        connection = self.connections[shard]
+        data, size = self.requests[shard]
+        connection.sendall(data)
+        while size:
+            size -= len(connection.recv(65536))
+
+    def test_set(self):
+        list(self.executor.map(self._send, range(self.shards)))
+
+
+class ClusterTwoShards(ClusterOneShard):
+    shards = 2
+
+
+class ClusterFourShards(ClusterOneShard):
+    shards = 4
@@ -0,0 +1,76 @@
+'''Event loop latency with a large number of volatile keys.
+
+Compare one ``loop.call_later`` handle per volatile key with the
+:class:`.TimerWheel` expiry index used by pulsar-ds databases::
+
+    python runtests.py bench.expiry --benchmark --size big
+
+The ``normal``, ``big`` and ``huge`` sizes load 1M, 5M and 10M keys.
+'''
+import asyncio
+import unittest
+from random import randint
+
+from pulsar import new_event_loop
+from pulsar.apps.ds.expiry import TimerWheel
+
+
+def noop():
+    pass
+
+
+class TimerHandles(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1000
+    _sizes = {'tiny': 10000,
+              'small': 100000,
+              'normal': 1000000,
+              'big': 5000000,
+              'huge': 10000000}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = new_event_loop()
+        cls.size = cls._sizes[cls.cfg.size]
+        cls.populate(cls.loop.time() + 3600)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.close()
+
+    @classmethod
+    def populate(cls, deadline):
+        call_at = cls.loop.call_at
+        cls.handles = [call_at(deadline + n % 3600, noop)
+                       for n in range(cls.size)]
+
+    def test_loop_latency(self):
+        loop = self.loop
+        future = asyncio.Future(loop=loop)
+        loop.call_later(0, future.set_result, None)
+        loop.run_until_complete(future)
+
+    def test_renew_ttl(self):
+        index = randint(0, self.size - 1)
+        self.handles[index].cancel()
+        self.handles[index] = self.loop.call_later(3600, noop)
+
+
+class TimerWheelIndex(TimerHandles):
+
+    @classmethod
+    def populate(cls, deadline):
+        cls.wheel = wheel = TimerWheel(cls.loop.time())
+        for n in range(cls.size):
+            wheel.add(n, deadline + n % 3600)
+
+    def test_renew_ttl(self):
+        key = randint(0, self.size - 1)
+        self.wheel.add(key, self.loop.time() + 3600)
+
+    def test_expire_cycle(self):
+        # a cycle with nothing to reclaim, as run by the storage cron
+        until = self.loop.time() + 0.025
+        for key in self.wheel.pop_expired(self.loop.time()):
+            if self.loop.time() >= until:
+                break
@@ -0,0 +1,77 @@
+'''Cost of positional operations on the middle of a deep pulsar-ds list.
+
+Compare the :class:`.Deque` pulsar-ds used for lists with the chunked
+:class:`.Quicklist`::
+
+    python runtests.py bench.lists --benchmark
+
+The ``normal`` size has 1M elements and the ``big`` size 10M, which takes
+about 10 minutes since the deque needs 40 seconds for each ``lrange``
+run::
+
+    python runtests.py bench.lists --benchmark --size big
+
+``lindex``, ``lset`` and ``lrange`` tests access 1000 positions around the
+middle, ``linsert`` inserts before the middle element and removes the
+inserted element as ``LREM`` does and ``ltrim`` removes one element at each
+end.
+'''
+import unittest
+
+from pulsar.utils.structures import Deque, Quicklist
+
+
+class DequeList(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1
+    list_type = Deque
+    _sizes = {'tiny': 1 << 10,
+              'small': 1 << 14,
+              'normal': 1 << 20,
+              'big': 10*(1 << 20),
+              'huge': 1 << 25}
+
+    @classmethod
+    def setUpClass(cls):
+        size = cls._sizes[cls.cfg.size]
+        cls.value = cls.list_type((str(n).encode('utf-8')
+                                   for n in range(size)))
+        middle = size // 2
+        cls.positions = range(middle - 500, middle + 500)
+        cls.pivot = cls.value[middle]
+
+    def test_push_pop(self):
+        value = self.value
+        for _ in range(1000):
+            value.appendleft(b'x')
+            value.append(b'y')
+        for _ in range(1000):
+            value.popleft()
+            value.pop()
+
+    def test_lindex(self):
+        value = self.value
+        for index in self.positions:
+            value[index]
+
+    def test_lset(self):
+        value = self.value
+        for index in self.positions:
+            value[index] = value[index]
+
+    def test_lrange(self):
+        value = self.value
+        for index in self.positions:
+            value.range(index, index + 10)
+
+    def test_linsert_lrem(self):
+        self.value.insert_before(self.pivot, b'x')
+        self.value.remove(b'x', 1)
+
+    def test_ltrim(self):
+        self.value.trim(1, len(self.value) - 1)
+
+
+class QuicklistList(DequeList):
+    __number__ = 10
+    list_type = Quicklist
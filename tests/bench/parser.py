@@ -0,0 +1,64 @@
+'''Cost of parsing pipelined commands and large bulk strings with the
+python redis parser::
+
+    python runtests.py bench.parser --benchmark
+
+Data is fed to the parser in chunks of 64KB, as read from a socket. The
+``normal`` size is a pipeline of 10k ``SET`` commands, about 400KB, and a
+bulk string of 10MB.
+'''
+import unittest
+
+from pulsar.apps.ds import redis_parser
+
+
+CHUNK = 65536
+
+
+class TestPyParser(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 10
+    _sizes = {'tiny': 100,
+              'small': 1000,
+              'normal': 10000,
+              'big': 100000,
+              'huge': 1000000}
+
+    @classmethod
+    def setUpClass(cls):
+        size = cls._sizes[cls.cfg.size]
+        parser = cls.parser()
+        cls.pipeline = cls.chunks(b''.join(
+            (parser.pack_command(('set', 'key:%d' % n, 'value:%d' % n))
+             for n in range(size))))
+        cls.bulk = cls.chunks(parser.bulk(b'x' * (size << 10)))
+
+    @classmethod
+    def parser(cls):
+        return redis_parser(True)()
+
+    @classmethod
+    def chunks(cls, data):
+        return [data[n:n+CHUNK] for n in range(0, len(data), CHUNK)]
+
+    def parse(self, chunks):
+        parser = self.parser()
+        messages = []
+        for chunk in chunks:
+            parser.feed(chunk)
+            messages.extend(parser.get_all())
+        return messages
+
+    def test_pipeline(self):
+        self.assertEqual(len(self.parse(self.pipeline)),
+                         self._sizes[self.cfg.size])
+
+    def test_large_bulk(self):
+        self.assertEqual(len(self.parse(self.bulk)), 1)
+
+
+class TestParser(TestPyParser):
+
+    @classmethod
+    def parser(cls):
+        return redis_parser()()
@@ -0,0 +1,78 @@
+'''Cost of finding the pattern subscriptions matching a published channel.
+
+Compare matching every pattern regular expression, as pulsar-ds used to
+do, with the :class:`.PatternIndex` dispatch index::
+
+    python runtests.py bench.pubsub --benchmark
+
+Patterns are one per tenant, ``tenant:<n>:*``, and the ``normal`` size
+loads 10k of them. Each run dispatches a batch of 1000 messages, enough
+for 100k messages per second when a run takes less than 10ms.
+'''
+import re
+import unittest
+from collections import namedtuple
+from random import randint
+
+from pulsar.apps.ds import redis_to_py_pattern
+from pulsar.apps.ds.pubsub import PatternIndex
+
+
+pubsub_patterns = namedtuple('pubsub_patterns', 're clients')
+
+BATCH = 1000
+
+
+class PatternScan(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 10
+    _sizes = {'tiny': 100,
+              'small': 1000,
+              'normal': 10000,
+              'big': 50000,
+              'huge': 100000}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.size = size = cls._sizes[cls.cfg.size]
+        cls.patterns = {}
+        for n in range(size):
+            pattern = ('tenant:%s:*' % n).encode('utf-8')
+            regex = re.compile(redis_to_py_pattern(pattern.decode('utf-8')))
+            cls.patterns[pattern] = pubsub_patterns(regex, set())
+        cls.setUpIndex()
+        # channels published in the same run are mostly distinct
+        cls.channels = [('tenant:%s:events' % randint(0, size - 1)
+                         ).encode('utf-8') for _ in range(BATCH)]
+
+    @classmethod
+    def setUpIndex(cls):
+        pass
+
+    def match(self, channel):
+        ch = channel.decode('utf-8')
+        return [p for p in self.patterns.values() if p.re.match(ch)]
+
+    def test_publish(self):
+        match = self.match
+        for channel in self.channels:
+            match(channel)
+
+
+class PatternTrie(PatternScan):
+    __number__ = 1000
+
+    @classmethod
+    def setUpIndex(cls):
+        cls.index = PatternIndex()
+        for pattern, value in cls.patterns.items():
+            cls.index.add(pattern, value)
+
+    def match(self, channel):
+        return self.index.match(channel)
+
+    def test_publish_uncached(self):
+        index = self.index
+        index._cache.clear()
+        for channel in self.channels:
+            index.match(channel)
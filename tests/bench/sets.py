@@ -0,0 +1,62 @@
+'''Cost of the pulsar-ds ``SINTER``, ``SUNION`` and ``SINTERCARD`` set
+algebra.
+
+Compare the chain of set operations in argument order pulsar-ds used with
+:func:`pulsar.apps.ds.utils.set_operation`, which takes operands by
+cardinality, and :func:`pulsar.apps.ds.utils.intersection_count`::
+
+    python runtests.py bench.sets --benchmark
+
+Operands are two large sets followed by a set of 10 members, the
+``normal`` size has 1M members in each large set.
+'''
+import random
+import unittest
+
+from pulsar.apps.ds.utils import set_operation, intersection_count
+
+
+def chain_operation(oper, sets):
+    result = None
+    for value in sets:
+        if result is None:
+            result = value
+        else:
+            result = getattr(result, oper)(value)
+    return result
+
+
+class ChainOperation(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1
+    operation = staticmethod(chain_operation)
+    _sizes = {'tiny': 1 << 10,
+              'small': 1 << 14,
+              'normal': 1 << 20,
+              'big': 1 << 22,
+              'huge': 1 << 24}
+
+    @classmethod
+    def setUpClass(cls):
+        size = cls._sizes[cls.cfg.size]
+        members = [b'member:%d' % n for n in range(2*size)]
+        cls.sets = [set(random.sample(members, size)),
+                    set(random.sample(members, size)),
+                    set(random.sample(members, 10))]
+
+    def test_intersection(self):
+        self.operation('intersection', self.sets)
+
+    def test_union(self):
+        self.operation('union', self.sets)
+
+    def test_intersection_count(self):
+        len(self.operation('intersection', self.sets))
+
+
+class SetOperation(ChainOperation):
+    __number__ = 10
+    operation = staticmethod(set_operation)
+
+    def test_intersection_count(self):
+        intersection_count(self.sets)
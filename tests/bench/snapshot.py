@@ -0,0 +1,73 @@
+'''Save and load time of pulsar-ds snapshots::
+
+    python runtests.py bench.snapshot --benchmark --size big
+
+The dataset mixes strings, volatile strings, lists, sets, sorted sets and
+hashes. The ``big`` and ``huge`` sizes produce multi-GB datasets.
+'''
+import os
+import tempfile
+import unittest
+
+from pulsar.utils.structures import Zset, Deque, Dict
+from pulsar.apps.ds.snapshot import SnapshotWriter, load_snapshot
+
+
+def dataset(size):
+    value = bytearray(os.urandom(100))
+    members = [('member%s' % n).encode('utf-8') for n in range(100)]
+    data = {}
+    expires = {}
+    for n in range(size):
+        key = ('key:%s' % n).encode('utf-8')
+        kind = n % 10
+        if kind < 6:
+            data[key] = bytearray(value)
+            if kind == 5:
+                expires[key] = 10000000000000
+        elif kind == 6:
+            data[key] = Deque(members)
+        elif kind == 7:
+            data[key] = set(members)
+        elif kind == 8:
+            data[key] = Zset(enumerate(members))
+        else:
+            data[key] = Dict(zip(members, members))
+    return data, expires
+
+
+class SnapshotBench(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1
+    _sizes = {'tiny': 10000,
+              'small': 100000,
+              'normal': 1000000,
+              'big': 5000000,
+              'huge': 20000000}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data, cls.expires = dataset(cls._sizes[cls.cfg.size])
+        cls.filename = tempfile.mktemp()
+        cls.save(cls.filename)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.filename)
+
+    @classmethod
+    def save(cls, filename):
+        expires = cls.expires
+        with open(filename, 'wb') as file:
+            writer = SnapshotWriter(file)
+            writer.select(0)
+            for key, value in cls.data.items():
+                writer.write(key, value, expires.get(key))
+            writer.close()
+
+    def test_save(self):
+        self.save(self.filename)
+
+    def test_load(self):
+        for record in load_snapshot(self.filename):
+            pass
@@ -0,0 +1,83 @@
+'''Cost of sorting the elements of a pulsar-ds list, set or sorted set.
+
+Compare the ``Sortable`` wrapper objects pulsar-ds used to sort with for
+``SORT`` with the decorated tuples and heap selection of
+:func:`pulsar.apps.ds.utils.sort_elements`::
+
+    python runtests.py bench.sort --benchmark
+
+Elements are random integers, the ``normal`` size sorts 1M of them.
+``LIMIT`` tests select the first 10 elements.
+'''
+import random
+import unittest
+
+from pulsar.apps.ds.utils import sort_elements
+
+
+class Null:
+    __slots__ = ()
+
+    def __lt__(self, other):
+        return False
+
+null = Null()
+
+
+class Sortable:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        if other is null:
+            return True
+        else:
+            return self.value < other.value
+
+
+def sort_wrappers(elements, start=None, end=None):
+    vector = []
+    for val in elements:
+        try:
+            byval = Sortable(float(val))
+        except Exception:
+            byval = null
+        vector.append((val, byval))
+    vector = sorted(vector, key=lambda x: x[1])
+    if start is not None:
+        vector = vector[start:end]
+    return [val for val, _ in vector]
+
+
+class SortWrappers(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1
+    _sizes = {'tiny': 1 << 10,
+              'small': 1 << 14,
+              'normal': 1 << 20,
+              'big': 1 << 22,
+              'huge': 1 << 24}
+
+    @classmethod
+    def setUpClass(cls):
+        size = cls._sizes[cls.cfg.size]
+        cls.elements = [str(random.randint(0, size)).encode('utf-8')
+                        for _ in range(size)]
+
+    def test_sort(self):
+        sort_wrappers(self.elements)
+
+    def test_sort_limit(self):
+        sort_wrappers(self.elements, 0, 10)
+
+
+class SortElements(SortWrappers):
+    __number__ = 5
+
+    def test_sort(self):
+        sort_elements(self.elements, self.elements)
+
+    def test_sort_limit(self):
+        sort_elements(self.elements, self.elements, end=10)
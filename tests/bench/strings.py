@@ -0,0 +1,88 @@
+'''Throughput of the string commands of pulsar-ds::
+
+    python runtests.py bench.strings --benchmark
+
+Each run sends ``SET``, ``GET`` or ``INCR`` commands over one connection,
+pipelined in batches of 1000. Half of the values are integers, stored as
+python ints, and half are short strings, stored as immutable bytes. The
+``normal`` size sends 10k commands.
+'''
+import socket
+import unittest
+
+import pulsar
+from pulsar.apps.ds import PulsarDS, redis_parser
+from pulsar.apps.data import create_store
+
+
+BATCH = 1000
+
+
+class StringsBench(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 10
+    _sizes = {'tiny': 100,
+              'small': 1000,
+              'normal': 10000,
+              'big': 100000,
+              'huge': 1000000}
+    app_cfg = None
+
+    @classmethod
+    def setUpClass(cls):
+        server = PulsarDS(name=cls.__name__.lower(),
+                          bind='127.0.0.1:0',
+                          workers=1,
+                          key_value_save=[],
+                          concurrency='process')
+        cls.app_cfg = yield from pulsar.send('arbiter', 'run', server)
+        address = cls.app_cfg.addresses[0]
+        # the worker serves requests once it replies, the benchmark can
+        # then block the event loop of the arbiter
+        store = create_store('pulsar://%s:%s' % address)
+        yield from store.client().ping()
+        cls.connection = socket.create_connection(address)
+        cls.parser = redis_parser()()
+        size = cls._sizes[cls.cfg.size]
+        keys = [('key:%s' % n).encode('utf-8') for n in range(size)]
+        values = [(('%s' if n % 2 else 'value:%s') % n).encode('utf-8')
+                  for n in range(size)]
+        cls.requests = {
+            'set': cls.pack([(b'set', k, v) for k, v in zip(keys, values)]),
+            'get': cls.pack([(b'get', k) for k in keys]),
+            'incr': cls.pack([(b'incr', k) for k in keys[1::2]])}
+        cls.execute('set')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.close()
+        if cls.app_cfg is not None:
+            yield from pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    @classmethod
+    def pack(cls, commands):
+        '''Pipelined batches of ``commands`` and their number of replies.'''
+        pack = cls.parser.pack_command
+        return [(b''.join(map(pack, commands[n:n + BATCH])),
+                 len(commands[n:n + BATCH]))
+                for n in range(0, len(commands), BATCH)]
+
+    @classmethod
+    def execute(cls, name):
+        connection = cls.connection
+        parser = cls.parser
+        for data, replies in cls.requests[name]:
+            connection.sendall(data)
+            while replies:
+                parser.feed(connection.recv(65536))
+                while replies and parser.get() is not False:
+                    replies -= 1
+
+    def test_set(self):
+        self.execute('set')
+
+    def test_get(self):
+        self.execute('get')
+
+    def test_incr(self):
+        self.execute('incr')
@@ -0,0 +1,72 @@
+'''Cost of write commands while many clients are watching keys::
+
+    python runtests.py bench.watch --benchmark
+
+Each watcher watches its own key, as clients doing optimistic locking
+with ``WATCH``/``MULTI``/``EXEC`` do, and the ``normal`` size has 1k
+watchers. Writes only touch the clients watching the written key.
+'''
+import os
+import tempfile
+import unittest
+
+from pulsar import new_event_loop
+from pulsar.apps.ds import PulsarDS
+from pulsar.apps.ds.server import TcpServer
+from pulsar.apps.ds.client import ReplayClient
+
+
+BATCH = 1000
+
+
+class WatchBench(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 100
+    _sizes = {'tiny': 10,
+              'small': 100,
+              'normal': 1000,
+              'big': 10000,
+              'huge': 100000}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = new_event_loop()
+        cfg = PulsarDS.cfg.copy()
+        cfg.set('key_value_filename', tempfile.mktemp())
+        cfg.set('key_value_save', [])
+        cls.store = TcpServer(cfg, None, cls.loop)._key_value_store
+        cls.size = cls._sizes[cls.cfg.size]
+        cls.watchers = []
+        for n in range(cls.size):
+            client = ReplayClient(cls.store)
+            client.execute([b'watch', cls.key(n)])
+            cls.watchers.append(client)
+        cls.writer = ReplayClient(cls.store)
+        cls.value = os.urandom(64)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.close()
+
+    @classmethod
+    def key(cls, n):
+        return ('watched:%s' % n).encode('utf-8')
+
+    def test_set(self):
+        execute = self.writer.execute
+        value = self.value
+        for n in range(BATCH):
+            execute([b'set', b'notwatched', value])
+
+    def test_set_watched(self):
+        execute = self.writer.execute
+        value = self.value
+        watchers = self.watchers
+        for n in range(BATCH):
+            n = n % self.size
+            key = self.key(n)
+            execute([b'set', key, value])
+            # watch again the key
+            client = watchers[n]
+            client.execute([b'unwatch'])
+            client.execute([b'watch', key])
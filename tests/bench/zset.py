@@ -0,0 +1,92 @@
+'''Cost of sorted set updates when many members share a score.
+
+Compare the linked :class:`.Skiplist` pulsar-ds used to keep the members
+of a sorted set in, where removing a member walks all the members with its
+score, with the blocked :class:`.SortedList` of :class:`.Zset`::
+
+    python runtests.py bench.zset --benchmark
+
+Members are spread over 10 scores, the ``normal`` size adds 100K of them.
+``remove`` tests remove and add back a sample of 200 members.
+'''
+import random
+import unittest
+
+from pulsar.utils.structures import Skiplist, Zset
+
+
+class SkiplistZset:
+    '''The skiplist sorted set, kept for comparison.'''
+    def __init__(self):
+        self._sl = Skiplist()
+        self._dict = {}
+
+    def add(self, score, val):
+        r = 1
+        if val in self._dict:
+            if self._dict[val] == score:
+                return 0
+            self.remove(val)
+            r = 0
+        self._dict[val] = score
+        self._sl.insert(score, val)
+        return r
+
+    def remove(self, item):
+        score = self._dict.pop(item, None)
+        if score is not None:
+            index = self._sl.rank(score)
+            for i, v in enumerate(self._sl.range(index)):
+                if v == item:
+                    self._sl.remove_range(index + i, index + i + 1)
+                    return score
+
+    def rank(self, item):
+        score = self._dict.get(item)
+        if score is not None:
+            index = self._sl.rank(score)
+            for i, v in enumerate(self._sl.range(index)):
+                if v == item:
+                    return index + i
+
+
+class SkiplistUpdates(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1
+    zset_type = SkiplistZset
+    _sizes = {'tiny': 1 << 10,
+              'small': 1 << 13,
+              'normal': 100000,
+              'big': 1 << 18,
+              'huge': 1 << 20}
+
+    @classmethod
+    def setUpClass(cls):
+        size = cls._sizes[cls.cfg.size]
+        cls.members = [b'member:%d' % n for n in range(size)]
+        cls.scores = [float(random.randint(0, 9)) for _ in range(size)]
+        cls.sample = random.sample(cls.members, min(size, 200))
+
+    def setUp(self):
+        self.zset = self.zset_type()
+        for score, member in zip(self.scores, self.members):
+            self.zset.add(score, member)
+
+    def test_add(self):
+        zset = self.zset_type()
+        for score, member in zip(self.scores, self.members):
+            zset.add(score, member)
+
+    def test_rank(self):
+        rank = self.zset.rank
+        for member in self.sample:
+            rank(member)
+
+    def test_remove(self):
+        zset = self.zset
+        for member in self.sample:
+            zset.add(zset.remove(member), member)
+
+
+class SortedListUpdates(SkiplistUpdates):
+    zset_type = Zset
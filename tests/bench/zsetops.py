@@ -0,0 +1,96 @@
+'''Cost of the pulsar-ds ``ZUNIONSTORE`` and ``ZINTERSTORE`` operations.
+
+Compare the aggregation pulsar-ds used, which added the members of each
+input one at a time to the destination sorted set, with
+:meth:`.Zset.union` and :meth:`.Zset.inter`, which accumulate scores in a
+dictionary and sort the destination once::
+
+    python runtests.py bench.zsetops --benchmark
+
+The inputs are 10 sorted sets, the ``normal`` size has 100K members in
+each of them drawn from 200K members, so that about half of the members of
+an input are in any other input.
+'''
+import random
+import unittest
+
+from pulsar.utils.structures import Zset
+
+
+def union_adds(zsets, weights, oper):
+    result = None
+    for zset, weight in zip(zsets, weights):
+        if result is None:
+            result = Zset()
+            for score, value in zset.items():
+                result.add(score*weight, value)
+        else:
+            for score, value in zset.items():
+                score *= weight
+                existing = result.score(value)
+                if existing is not None:
+                    score = oper((score, existing))
+                result.add(score, value)
+    return result
+
+
+def inter_adds(zsets, weights, oper):
+    result = None
+    values = None
+    for zset in zsets:
+        if values is None:
+            values = set(zset)
+        else:
+            values.intersection_update(zset)
+    for zset, weight in zip(zsets, weights):
+        if result is None:
+            result = Zset()
+            for score, value in zset.items():
+                if value in values:
+                    result.add(score*weight, value)
+        else:
+            for score, value in zset.items():
+                if value in values:
+                    existing = result.score(value)
+                    result.add(oper((score*weight, existing)), value)
+    return result
+
+
+class ZsetAdds(unittest.TestCase):
+    __benchmark__ = True
+    __number__ = 1
+    union = staticmethod(union_adds)
+    inter = staticmethod(inter_adds)
+    _sizes = {'tiny': 1 << 10,
+              'small': 1 << 13,
+              'normal': 100000,
+              'big': 1 << 18,
+              'huge': 1 << 20}
+
+    @classmethod
+    def setUpClass(cls):
+        size = cls._sizes[cls.cfg.size]
+        members = [b'member:%d' % n for n in range(2*size)]
+        cls.zsets = [Zset(((random.random(), member) for member
+                           in random.sample(members, size)))
+                     for _ in range(10)]
+        cls.weights = [1]*10
+        cls.int_weights = list(range(1, 11))
+
+    def test_union_sum(self):
+        self.union(self.zsets, self.weights, sum)
+
+    def test_union_weights_max(self):
+        self.union(self.zsets, self.int_weights, max)
+
+    def test_inter_sum(self):
+        self.inter(self.zsets, self.weights, sum)
+
+    def test_inter_weights_min(self):
+        self.inter(self.zsets, self.int_weights, min)
+
+
+class ZsetAggregate(ZsetAdds):
+    __number__ = 5
+    union = Zset.union
+    inter = Zset.inter
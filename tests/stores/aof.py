@@ -0,0 +1,241 @@
+import os
+import pickle
+import asyncio
+import tempfile
+import unittest
+
+import pulsar
+from pulsar import get_event_loop
+from pulsar.utils.structures import Zset, Deque, Dict
+from pulsar.apps.ds import PulsarDS, ResponseError, redis_parser
+from pulsar.apps.ds.aof import AppendOnlyFile, read_commands, rebuild_commands
+from pulsar.apps.ds.scripting import lupa
+from pulsar.apps.ds.stream import Stream, ConsumerGroup
+
+from .pulsards import StoreMixin
+
+
+class TestAppendOnlyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = get_event_loop()
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    def aof(self, fsync):
+        return AppendOnlyFile(self.filename, self.loop, redis_parser()(),
+                              fsync)
+
+    def commands(self):
+        return list(read_commands(self.filename, redis_parser()()))
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, self.aof, 'never')
+
+    def test_batched_writes(self):
+        aof = self.aof('everysec')
+        aof.feed(0, ('set', b'a', b'1'))
+        aof.feed(0, ('incr', b'b'))
+        aof.feed(2, ('del', b'a'))
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        yield from asyncio.sleep(0)
+        self.assertEqual(self.commands(), [[b'select', b'0'],
+                                           [b'set', b'a', b'1'],
+                                           [b'incr', b'b'],
+                                           [b'select', b'2'],
+                                           [b'del', b'a']])
+        self.assertEqual(aof.size, os.path.getsize(self.filename))
+        aof.close()
+
+    def test_always(self):
+        aof = self.aof('always')
+        aof.feed(3, ('set', b'a', b'1'))
+        aof.feed(3, ('incr', b'b'))
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        yield from asyncio.sleep(0)
+        self.assertEqual(self.commands(), [[b'select', b'3'],
+                                           [b'set', b'a', b'1'],
+                                           [b'incr', b'b']])
+        aof.close()
+
+    def test_restart(self):
+        aof = self.aof('no')
+        aof.feed(0, ('set', b'a', b'1'))
+        aof.flush()
+        aof.feed(0, ('set', b'b', b'2'))
+        aof.restart([(1, {b'c': bytearray(b'3')}, {})])
+        self.assertEqual(self.commands(), [])
+        aof.feed(1, ('incr', b'c'))
+        while aof.rewriting:
+            yield from asyncio.sleep(0.05)
+            aof.cron()
+        aof.flush()
+        self.assertEqual(self.commands(), [[b'select', b'1'],
+                                           [b'set', b'c', b'3'],
+                                           [b'select', b'1'],
+                                           [b'incr', b'c']])
+        aof.close()
+
+    def test_truncated_file(self):
+        parser = redis_parser()()
+        with open(self.filename, 'wb') as file:
+            file.write(parser.pack_command(('set', 'a', 'foo')))
+            file.write(parser.pack_command(('set', 'b', 'bla'))[:-4])
+        self.assertEqual(self.commands(), [[b'set', b'a', b'foo']])
+
+    def test_rebuild_commands(self):
+        zset = Zset()
+        zset.add(1.5, b'a')
+        hash = Dict()
+        hash[b'f'] = b'v'
+        self.assertEqual(list(rebuild_commands(b'k', bytearray(b'x'))),
+                         [('set', b'k', b'x')])
+        self.assertEqual(list(rebuild_commands(b'k', Deque((b'1', b'2')))),
+                         [('rpush', b'k', b'1', b'2')])
+        self.assertEqual(list(rebuild_commands(b'k', {b'1'})),
+                         [('sadd', b'k', b'1')])
+        self.assertEqual(list(rebuild_commands(b'k', zset)),
+                         [('zadd', b'k', 1.5, b'a')])
+        self.assertEqual(list(rebuild_commands(b'k', hash)),
+                         [('hmset', b'k', b'f', b'v')])
+
+    def test_rebuild_commands_stream(self):
+        stream = Stream()
+        stream.add(1, (b'f', b'v'))
+        stream.groups[b'g'] = ConsumerGroup(1)
+        (command,) = rebuild_commands(b'k', stream)
+        self.assertEqual(command[:3], ('restore', b'k', 0))
+        restored = pickle.loads(command[3])
+        self.assertEqual(restored, stream)
+        self.assertEqual(restored.groups[b'g'].last_id, 1)
+
+    def test_rebuild_commands_batches(self):
+        commands = list(rebuild_commands(b'k', set(range(150))))
+        self.assertEqual(len(commands), 3)
+        self.assertEqual(sum((len(c) - 2 for c in commands)), 150)
+
+
+class TestPulsarStoreAof(StoreMixin, unittest.TestCase):
+    app_cfg = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp()
+        # replayed at startup
+        parser = redis_parser()()
+        with open(cls.filename, 'wb') as file:
+            file.write(parser.pack_command(('select', 9)))
+            file.write(parser.pack_command(('set', 'replayed', 'foo')))
+            file.write(parser.pack_command(('rpush', 'replayed:list', 'a',
+                                            'b')))
+            file.write(parser.pack_command(('del', 'replayed:list')))
+            file.write(parser.pack_command(('sadd', 'replayed:set', 'a')))
+            file.write(parser.pack_command(('multi',)))
+            file.write(parser.pack_command(('set', 'replayed:multi', 'a')))
+            file.write(parser.pack_command(('append', 'replayed:multi', 'b')))
+            file.write(parser.pack_command(('exec',)))
+        server = PulsarDS(name=cls.__name__.lower(),
+                          bind='127.0.0.1:0',
+                          concurrency=cls.cfg.concurrency,
+                          key_value_appendonly=True,
+                          key_value_appendfilename=cls.filename,
+                          key_value_appendfsync='always')
+        cls.app_cfg = yield from pulsar.send('arbiter', 'run', server)
+        cls.pulsards_uri = 'pulsar://%s:%s' % cls.app_cfg.addresses[0]
+        cls.store = cls.create_store('%s/9' % cls.pulsards_uri)
+        cls.client = cls.store.client()
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.isfile(cls.filename):
+            os.remove(cls.filename)
+        if cls.app_cfg is not None:
+            return pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    def commands(self, key=None):
+        commands = read_commands(self.filename, redis_parser()())
+        if key is not None:
+            # tests run concurrently, keep the commands on key
+            key = key.encode('utf-8')
+            commands = (c for c in commands
+                        if len(c) > 1 and c[1].endswith(key))
+        return list(commands)
+
+    def transaction(self, key):
+        '''Names of the commands logged in the transaction on ``key``.'''
+        commands = list(read_commands(self.filename, redis_parser()()))
+        key = key.encode('utf-8')
+        start = [i for i, c in enumerate(commands)
+                 if len(c) > 1 and c[1].endswith(key)][0] - 1
+        end = commands.index([b'exec'], start)
+        return [c[0] for c in commands[start:end+1]]
+
+    def test_info(self):
+        info = yield from self.client.info()
+        self.assertEqual(info['aof_enabled'], 1)
+        self.assertEqual(info['aof_fsync'], 'always')
+
+    def test_replay(self):
+        c = self.client
+        yield from self.async.assertEqual(c.get('replayed'), b'foo')
+        yield from self.async.assertEqual(c.exists('replayed:list'), False)
+        yield from self.async.assertEqual(c.smembers('replayed:set'),
+                                          {b'a'})
+        yield from self.async.assertEqual(c.get('replayed:multi'), b'ab')
+
+    def test_unchanged_data_not_logged(self):
+        key = self.randomkey()
+        c = self.client
+        yield from c.set(key, 'foo')
+        yield from c.set(key, 'bla', nx=True)
+        yield from self.async.assertRaises(ResponseError, c.sadd, key, 'a')
+        yield from self.async.assertRaises(ResponseError, c.lpush, key, 'a')
+        yield from self.async.assertRaises(ResponseError, c.hset, key, 'a',
+                                           'b')
+        yield from self.async.assertRaises(ResponseError, c.incr, key)
+        yield from c.delete(key + 'x')
+        yield from c.persist(key)
+        yield from c.delete(key)
+        yield from c.delete(key)
+        commands = self.commands(key)
+        self.assertEqual([c[0] for c in commands], [b'set', b'del'])
+        self.assertEqual(self.commands(key + 'x'), [])
+
+    def test_log_write_commands(self):
+        key = self.randomkey()
+        c = self.client
+        yield from c.set(key, 'foo')
+        yield from c.get(key)
+        yield from c.expire(key, 100)
+        set, pexpireat = self.commands(key)
+        self.assertEqual(set[0], b'set')
+        self.assertEqual(set[2], b'foo')
+        self.assertEqual(pexpireat[0], b'pexpireat')
+        self.assertEqual(pexpireat[1], set[1])
+
+    def test_multi_exec_logged(self):
+        key = self.randomkey()
+        pipe = self.client.pipeline()
+        pipe.set(key, 'foo')
+        pipe.get(key)
+        pipe.append(key, 'bla')
+        yield from pipe.commit()
+        self.assertEqual(self.transaction(key),
+                         [b'multi', b'set', b'append', b'exec'])
+
+    @unittest.skipIf(lupa is None, 'Requires lupa')
+    def test_script_writes_logged(self):
+        key = self.randomkey()
+        yield from self.client.eval("redis.call('set', KEYS[1], 'a'); "
+                                    "redis.call('get', KEYS[1]); "
+                                    "redis.call('append', KEYS[1], 'b')",
+                                    (key,))
+        self.assertEqual(self.transaction(key),
+                         [b'multi', b'set', b'append', b'exec'])
+
+    def test_bgrewriteaof(self):
+        result = yield from self.client.bgrewriteaof()
+        self.assertTrue(result)
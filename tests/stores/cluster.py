@@ -0,0 +1,223 @@
+import os
+import glob
+import tempfile
+import unittest
+
+import pulsar
+from pulsar.apps.ds import (PulsarDS, ResponseError, MovedError,
+                             COMMANDS_INFO)
+from pulsar.apps.ds.cluster import (SLOTS, key_slot, command_keys,
+                                    slot_ranges, shard_filename)
+
+from .pulsards import StoreMixin
+
+
+class TestHashSlots(unittest.TestCase):
+
+    def test_key_slot(self):
+        # values from the redis cluster specification
+        self.assertEqual(key_slot(b'123456789'), 12739)
+        self.assertEqual(key_slot(b'foo'), 12182)
+        self.assertEqual(key_slot('foo'), 12182)
+
+    def test_hash_tag(self):
+        slot = key_slot(b'user1000')
+        self.assertEqual(key_slot(b'{user1000}.following'), slot)
+        self.assertEqual(key_slot(b'{user1000}.followers'), slot)
+        # empty hash tags are ignored
+        self.assertEqual(key_slot(b'foo{}'), 5542)
+        self.assertEqual(key_slot(b'foo{{bar}}zap'), key_slot(b'{bar'))
+
+    def test_shard_filename(self):
+        self.assertEqual(shard_filename('pulsards.rdb', 0), 'pulsards.0.rdb')
+        self.assertEqual(shard_filename('/tmp/data', 1), '/tmp/data.1')
+
+    def test_slot_ranges(self):
+        ranges = slot_ranges(3)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], SLOTS - 1)
+        for (_, last), (first, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(first, last + 1)
+
+    def test_command_keys(self):
+        def keys(*request):
+            request = [r.encode('utf-8') for r in request]
+            return list(command_keys(COMMANDS_INFO[request[0].decode()],
+                                     request))
+        self.assertEqual(keys('get', 'a'), [b'a'])
+        self.assertEqual(keys('mget', 'a', 'b'), [b'a', b'b'])
+        self.assertEqual(keys('mset', 'a', '1', 'b', '2'), [b'a', b'b'])
+        self.assertEqual(keys('blpop', 'a', 'b', '0'), [b'a', b'b'])
+        self.assertEqual(keys('bitop', 'and', 'a', 'b'), [b'a', b'b'])
+        self.assertEqual(keys('zunionstore', 'd', '2', 'a', 'b',
+                              'weights', '1', '2'), [b'd', b'a', b'b'])
+        self.assertEqual(keys('zdiff', '2', 'a', 'b', 'withscores'),
+                         [b'a', b'b'])
+        self.assertEqual(keys('zrangestore', 'd', 'a', '0', '-1'),
+                         [b'd', b'a'])
+        self.assertEqual(keys('xread', 'count', '1', 'streams', 'a', 'b',
+                              '0', '0'), [b'a', b'b'])
+        self.assertEqual(keys('xgroup', 'create', 'a', 'g', '$'), [b'a'])
+        self.assertEqual(list(command_keys(COMMANDS_INFO['xread'],
+                                           ['xread', 'STREAMS', 'a', '0'])),
+                         ['a'])
+        self.assertEqual(keys('keys', '*'), [])
+        self.assertEqual(keys('ping'), [])
+
+
+class TestPulsarStoreCluster(StoreMixin, unittest.TestCase):
+    app_cfg = None
+
+    @classmethod
+    def setUpClass(cls):
+        server = PulsarDS(name=cls.__name__.lower(),
+                          bind='127.0.0.1:0',
+                          workers=2,
+                          key_value_cluster=True,
+                          concurrency=cls.cfg.concurrency)
+        cls.app_cfg = yield from pulsar.send('arbiter', 'run', server)
+        cls.addresses = cls.app_cfg.addresses
+        cls.store = cls.create_store('pulsar://%s:%s/9?cluster=1' %
+                                     cls.addresses[0])
+        cls.client = cls.store.client()
+        cls.shard = cls.create_store('pulsar://%s:%s/9' % cls.addresses[0])
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.app_cfg is not None:
+            yield from pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    def keys(self, shard):
+        '''Keys in the slots of the ``shard``
+        '''
+        first, last = slot_ranges(len(self.addresses))[shard]
+        while True:
+            key = self.randomkey()
+            if first <= key_slot(key) <= last:
+                yield key
+
+    def test_cluster_slots(self):
+        slots = yield from self.shard.client().execute('cluster', 'slots')
+        self.assertEqual(len(slots), 2)
+        for (first, last, address), (f, l) in zip(slots, slot_ranges(2)):
+            self.assertEqual((first, last), (f, l))
+        self.assertEqual(slots[1][2][1], self.addresses[1][1])
+        slot = yield from self.shard.client().execute('cluster', 'keyslot',
+                                                      'foo')
+        self.assertEqual(slot, 12182)
+
+    def test_moved(self):
+        key = next(self.keys(1))
+        try:
+            yield from self.shard.client().set(key, 'foo')
+        except MovedError as exc:
+            address = '%s:%d' % self.addresses[1]
+            self.assertEqual(str(exc), '%d %s' % (key_slot(key), address))
+        else:
+            self.fail('MOVED error not raised')
+
+    def test_crossslot(self):
+        key0, key1 = next(self.keys(0)), next(self.keys(1))
+        client = self.shard.client()
+        yield from self.async.assertRaises(ResponseError, client.mget,
+                                           key0, key1)
+        # keys in different slots of the same shard
+        result = yield from client.mget(key0, next(self.keys(0)))
+        self.assertEqual(result, [None, None])
+
+    def test_routing(self):
+        key0, key1 = next(self.keys(0)), next(self.keys(1))
+        c = self.client
+        yield from c.set(key0, 'foo')
+        yield from c.set(key1, 'bla')
+        value = yield from c.get(key1)
+        self.assertEqual(value, b'bla')
+        # the key is stored in the first shard
+        value = yield from self.shard.client().exists(key0)
+        self.assertTrue(value)
+
+    def test_xread_routing(self):
+        key = next(self.keys(1))
+        c = self.client
+        sid = yield from c.execute('xadd', key, '*', 'field', 'value')
+        result = yield from c.execute('xread', 'COUNT', 1, 'STREAMS', key,
+                                      '0')
+        self.assertEqual(result, [[key.encode('utf-8'),
+                                   [[sid, [b'field', b'value']]]]])
+
+    def test_split_multi_keys(self):
+        keys = [next(self.keys(n % 2)) for n in range(6)]
+        c = self.client
+        result = yield from c.mset(*[v for k in keys for v in (k, k)])
+        self.assertTrue(result)
+        values = yield from c.mget(*keys)
+        self.assertEqual(values, [k.encode('utf-8') for k in keys])
+        result = yield from c.delete(*keys)
+        self.assertEqual(result, 6)
+
+    def test_pipeline(self):
+        key0, key1 = next(self.keys(0)), next(self.keys(1))
+        pipe = self.client.pipeline()
+        pipe.set(key0, 'a')
+        pipe.set(key1, 'b')
+        pipe.get(key0)
+        pipe.get(key1)
+        result = yield from pipe.commit()
+        self.assertEqual(result, [True, True, b'a', b'b'])
+
+    def test_info(self):
+        info = yield from self.shard.client().info()
+        self.assertEqual(info['cluster_enabled'], 1)
+        self.assertEqual(info['cluster_known_nodes'], 2)
+
+
+class TestClusterPersistence(StoreMixin, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp()
+        cls.app_cfg = None
+
+    @classmethod
+    def tearDownClass(cls):
+        for filename in glob.glob(cls.filename + '*'):
+            os.remove(filename)
+        if cls.app_cfg is not None:
+            yield from pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    def start(self, name):
+        if self.app_cfg is not None:
+            yield from pulsar.send('arbiter', 'kill_actor', self.app_cfg.name)
+        server = PulsarDS(name=name,
+                          bind='127.0.0.1:0',
+                          workers=2,
+                          key_value_cluster=True,
+                          key_value_filename=self.filename + '.rdb',
+                          key_value_appendonly=True,
+                          key_value_appendfilename=self.filename + '.aof',
+                          concurrency=self.cfg.concurrency)
+        self.__class__.app_cfg = app_cfg = yield from pulsar.send(
+            'arbiter', 'run', server)
+        return [self.create_store('pulsar://%s:%s/9' % address).client()
+                for address in app_cfg.addresses]
+
+    def test_restart(self):
+        shards = yield from self.start('clusterpersistence')
+        keys = []
+        for first, last in slot_ranges(2):
+            key = self.randomkey()
+            while not first <= key_slot(key) <= last:
+                key = self.randomkey()
+            keys.append(key)
+        for shard, key in zip(shards, keys):
+            yield from shard.set(key, key)
+            yield from shard.execute('save')
+        for n in range(2):
+            self.assertTrue(os.path.isfile('%s.%d.rdb' % (self.filename, n)))
+            self.assertTrue(os.path.isfile('%s.%d.aof' % (self.filename, n)))
+        shards = yield from self.start('clusterpersistence2')
+        for shard, key in zip(shards, keys):
+            size = yield from shard.dbsize()
+            self.assertEqual(size, 1)
+            value = yield from shard.get(key)
+            self.assertEqual(value, key.encode('utf-8'))
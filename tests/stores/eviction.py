@@ -0,0 +1,136 @@
+import unittest
+
+import pulsar
+from pulsar.apps.ds import PulsarDS, ResponseError
+from pulsar.apps.test import sequential
+
+from .pulsards import StoreMixin
+
+
+class EvictionMixin(StoreMixin):
+    '''Tests of a class share the memory of a server and run sequentially.
+    '''
+    app_cfg = None
+    maxmemory = 59800
+    policy = 'noeviction'
+    value = 1000*'x'
+
+    @classmethod
+    def setUpClass(cls):
+        server = PulsarDS(name=cls.__name__.lower(),
+                          bind='127.0.0.1:0',
+                          concurrency=cls.cfg.concurrency,
+                          key_value_maxmemory=cls.maxmemory,
+                          key_value_maxmemory_policy=cls.policy,
+                          key_value_maxmemory_samples=10)
+        cls.app_cfg = yield from pulsar.send('arbiter', 'run', server)
+        cls.pulsards_uri = 'pulsar://%s:%s' % cls.app_cfg.addresses[0]
+        cls.store = cls.create_store('%s/9' % cls.pulsards_uri)
+        cls.client = cls.store.client()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.app_cfg is not None:
+            return pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    def setUp(self):
+        return self.client.flushdb()
+
+    def fill(self, prefix, n, **kw):
+        keys = ['%s%s' % (prefix, i) for i in range(n)]
+        for key in keys:
+            yield from self.client.set(key, self.value, **kw)
+        return keys
+
+    def survivors(self, keys):
+        values = yield from self.client.mget(*keys)
+        return sum((1 for value in values if value is not None))
+
+
+@sequential
+class TestNoEviction(EvictionMixin, unittest.TestCase):
+
+    def test_info(self):
+        yield from self.fill('a', 10)
+        info = yield from self.client.info()
+        self.assertEqual(info['maxmemory'], self.maxmemory)
+        self.assertEqual(info['maxmemory_policy'], 'noeviction')
+        self.assertTrue(info['used_memory'] > 10*len(self.value))
+        self.assertEqual(info['db9']['memory'], info['used_memory'])
+
+    def test_out_of_memory(self):
+        keys = yield from self.fill('a', 50)
+        yield from self.async.assertRaises(ResponseError, self.client.set,
+                                           'b', self.value)
+        info = yield from self.client.info()
+        self.assertEqual(info['evicted_keys'], 0)
+        # read commands are allowed
+        result = yield from self.client.ttl(keys[0])
+        self.assertEqual(result, -1)
+        result = yield from self.client.type(keys[0])
+        self.assertEqual(result, 'string')
+        result = yield from self.client.lrange('c', 0, -1)
+        self.assertEqual(result, [])
+        # commands freeing memory are allowed
+        result = yield from self.client.delete(*keys[:10])
+        self.assertEqual(result, 10)
+        result = yield from self.client.set('b', self.value)
+        self.assertTrue(result)
+
+
+@sequential
+class TestAllKeysLru(EvictionMixin, unittest.TestCase):
+    policy = 'allkeys-lru'
+
+    def test_evict_least_recently_used(self):
+        keys = yield from self.fill('a', 30)
+        yield from pulsar.asyncio.sleep(0.05)
+        used = keys[:10]
+        yield from self.client.mget(*used)
+        yield from pulsar.asyncio.sleep(0.05)
+        # about 10 keys are evicted
+        yield from self.fill('b', 30)
+        info = yield from self.client.info()
+        # keys are evicted before writing the last key
+        self.assertTrue(info['used_memory'] <= self.maxmemory +
+                        2*len(self.value))
+        self.assertTrue(info['evicted_keys'] > 0)
+        survived = yield from self.survivors(used)
+        self.assertTrue(survived >= 8)
+        survived = yield from self.survivors(keys[10:])
+        self.assertTrue(survived <= 12)
+
+
+@sequential
+class TestAllKeysLfu(EvictionMixin, unittest.TestCase):
+    policy = 'allkeys-lfu'
+
+    def test_evict_least_frequently_used(self):
+        keys = yield from self.fill('a', 30)
+        used = keys[:10]
+        for _ in range(20):
+            yield from self.client.mget(*used)
+        yield from self.fill('b', 30)
+        survived = yield from self.survivors(used)
+        self.assertTrue(survived >= 8)
+
+
+@sequential
+class TestVolatileTtl(EvictionMixin, unittest.TestCase):
+    policy = 'volatile-ttl'
+
+    def test_evict_nearest_expiry(self):
+        persistent = yield from self.fill('p', 20)
+        late = yield from self.fill('l', 10, ex=1000)
+        yield from self.fill('s', 30, ex=100)
+        survived = yield from self.survivors(persistent)
+        self.assertEqual(survived, 20)
+        survived = yield from self.survivors(late)
+        self.assertTrue(survived >= 8)
+        info = yield from self.client.info()
+        self.assertTrue(info['evicted_keys'] > 0)
+
+    def test_no_volatile_keys(self):
+        yield from self.fill('p', 50)
+        yield from self.async.assertRaises(ResponseError, self.client.set,
+                                           'b', self.value)
@@ -0,0 +1,80 @@
+import unittest
+
+import pulsar
+from pulsar.apps.ds import PulsarDS, ResponseError
+from pulsar.apps.test import sequential
+
+from .pulsards import StoreMixin
+
+
+@sequential
+class TestPulsarStoreOutputBuffer(StoreMixin, unittest.TestCase):
+    app_cfg = None
+
+    @classmethod
+    def setUpClass(cls):
+        limits = [('pubsub', 10000, 0, 0)]
+        server = PulsarDS(name=cls.__name__.lower(),
+                          bind='127.0.0.1:0',
+                          concurrency=cls.cfg.concurrency,
+                          key_value_client_output_buffer_limit=limits)
+        cls.app_cfg = yield from pulsar.send('arbiter', 'run', server)
+        cls.pulsards_uri = 'pulsar://%s:%s' % cls.app_cfg.addresses[0]
+        cls.store = cls.create_store('%s/9' % cls.pulsards_uri)
+        cls.client = cls.store.client()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.app_cfg is not None:
+            return pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    def test_client_list(self):
+        clients = yield from self.client.execute('client', 'list')
+        self.assertTrue(clients)
+        for client in clients.decode('utf-8').splitlines():
+            self.assertTrue(' omem=' in client)
+            self.assertTrue(' drop=' in client)
+
+    def test_client_kill(self):
+        c = self.client
+        pubsub = self.client.pubsub()
+        yield from pubsub.subscribe(self.randomkey())
+        killed = yield from c.execute('client', 'kill', 'type', 'pubsub')
+        self.assertTrue(killed >= 1)
+        yield from self.async.assertEqual(
+            c.execute('client', 'kill', 'type', 'pubsub'), 0)
+        yield from self.async.assertRaises(
+            ResponseError, c.execute, 'client', 'kill', '127.0.0.1:1')
+        yield from self.async.assertRaises(
+            ResponseError, c.execute, 'client', 'kill', 'type', 'foo')
+        yield from self.async.assertRaises(
+            ResponseError, c.execute, 'client', 'kill', 'id', '1')
+
+    def test_hard_limit(self):
+        channel = self.randomkey()
+        pubsub = self.client.pubsub()
+        yield from pubsub.subscribe(channel)
+        info = yield from self.client.info()
+        disconnections = info['client_output_buffer_disconnections']
+        dropped = info['dropped_messages']
+        # a message over the hard limit disconnects the subscriber as soon
+        # as it is queued, whatever the number of messages in the loop
+        # iteration, and is not delivered
+        count = yield from self.client.publish(channel, 20000*'x')
+        self.assertEqual(count, 0)
+        info = yield from self.client.info()
+        self.assertEqual(info['client_output_buffer_disconnections'],
+                         disconnections + 1)
+        self.assertEqual(info['dropped_messages'], dropped + 1)
+
+    def test_within_limits(self):
+        channel = self.randomkey()
+        pubsub = self.client.pubsub()
+        yield from pubsub.subscribe(channel)
+        info = yield from self.client.info()
+        disconnections = info['client_output_buffer_disconnections']
+        count = yield from self.client.publish(channel, 'hello')
+        self.assertEqual(count, 1)
+        info = yield from self.client.info()
+        self.assertEqual(info['client_output_buffer_disconnections'],
+                         disconnections)
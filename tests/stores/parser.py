@@ -134,6 +134,40 @@ class TestParser(unittest.TestCase):
         self.assertEqual(res2[0], b'100')
         self.assertEqual(res2[1], result[1])
 
+    def test_get_all(self):
+        p = self.parser()
+        commands = [(b'set', b'key%d' % n, b'value') for n in range(100)]
+        data = b''.join((p.pack_command(c) for c in commands))
+        self.assertEqual(p.get_all(), [])
+        p.feed(data[:1000])
+        first = p.get_all()
+        self.assertTrue(first)
+        self.assertEqual(p.get(), False)
+        p.feed(data[1000:] + b':5\r\n')
+        result = first + p.get_all()
+        self.assertEqual(result, [list(c) for c in commands] + [5])
+        self.assertEqual(p.buffer(), b'')
+
+    def test_get_all_malformed(self):
+        p = self.parser()
+        p.feed(p.pack_command(('set', 'a', '1')) + b':3\r\npxxxx\r\n:4\r\n')
+        self.assertEqual(p.get_all(), [[b'set', b'a', b'1'], 3])
+        self.assertRaises(InvalidResponse, p.get_all)
+        p.feed(b'pxxxx\r\n')
+        self.assertRaises(InvalidResponse, p.get_all)
+
+    def test_large_bulk(self):
+        p = self.parser()
+        value = b'x\r\n' * 100000
+        data = p.multi_bulk([value, b'foo']) + b'+OK\r\n'
+        for n in range(0, len(data) - 1000, 1000):
+            p.feed(data[n:n+1000])
+            self.assertEqual(p.get(), False)
+        p.feed(data[n+1000:])
+        self.assertEqual(p.get(), [value, b'foo'])
+        self.assertEqual(p.get(), b'OK')
+        self.assertEqual(p.get(), False)
+
     # CLIENT ENCODERS
     def test_encode_commands(self):
         p = self.parser()
@@ -1,13 +1,16 @@
 import binascii
+import hashlib
 import time
 import unittest
 import asyncio
 import datetime
 
 import pulsar
+from pulsar import async
 from pulsar.utils.string import random_string
 from pulsar.utils.structures import Zset
 from pulsar.apps.ds import PulsarDS, redis_parser, ResponseError
+from pulsar.apps.ds.scripting import lupa
 from pulsar.apps.data import create_store
 
 
@@ -91,6 +94,18 @@ class RedisCommands(StoreMixin):
         yield from eq(c.exists(key), True)
         yield from eq(c.delete(key), 1)
 
+    def test_unlink(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.unlink(key), 0)
+        yield from eq(c.sadd(key, *range(1000)), 1000)
+        yield from eq(c.set(key + 'x', 'hello'), True)
+        yield from eq(c.unlink(key, key + 'x', key + 'y'), 2)
+        yield from eq(c.exists(key), False)
+        yield from eq(c.sadd(key, 1), 1)
+        yield from eq(c.scard(key), 1)
+
     def test_expire_persist_ttl(self):
         key = self.randomkey()
         c = self.client
@@ -122,6 +137,21 @@ class RedisCommands(StoreMixin):
         yield from eq(c.ttl(key), -1)
         yield from eq(c.persist(key), False)
 
+    def test_expire_volatile_keys(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.set(key, 'hello', px=1500), True)
+        yield from eq(c.set(key+'2', 'hello', px=1500), True)
+        yield from eq(c.set(key+'3', 'hello', ex=100), True)
+        yield from eq(c.exists(key), True)
+        yield from asyncio.sleep(2)
+        yield from eq(c.get(key), None)
+        yield from eq(c.exists(key), False)
+        yield from eq(c.ttl(key+'2'), -2)
+        ttl = yield from c.ttl(key+'3')
+        self.assertTrue(ttl > 0 and ttl <= 100)
+
     def test_keys(self):
         key = self.randomkey()
         keya = '%s_a' % key
@@ -179,6 +209,37 @@ class RedisCommands(StoreMixin):
         yield from eq(c.renamenx(key, des+'a'), True)
         yield from eq(c.exists(key), False)
 
+    def test_scan(self):
+        prefix = self.randomkey()
+        keys = set(('%s:%s' % (prefix, n)).encode('utf-8')
+                   for n in range(50))
+        c = self.client
+        for key in keys:
+            yield from c.set(key, 1)
+        found = set()
+        cursor = 0
+        while True:
+            cursor, result = yield from c.scan(cursor, 'match', prefix + ':*',
+                                               'count', 7)
+            found.update(result)
+            cursor = int(cursor)
+            if not cursor:
+                break
+        self.assertEqual(found, keys)
+
+    def test_scan_iter(self):
+        prefix = self.randomkey()
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.set(prefix + ':a', 1), True)
+        yield from eq(c.sadd(prefix + ':b', 1), 1)
+        it = c.scan_iter(match=prefix + ':*', type='set')
+        yield from eq(it.next(), (prefix + ':b').encode('utf-8'))
+        yield from eq(it.next(), None)
+        yield from self.async.assertRaises(ResponseError, c.scan, 'foo')
+        yield from self.async.assertRaises(ResponseError, c.scan, 0,
+                                           'count', 0)
+
     ###########################################################################
     #    BAD REQUESTS
     # def test_no_command(self):
@@ -289,6 +350,81 @@ class RedisCommands(StoreMixin):
         self.assertEqual(int(binascii.hexlify(res2), 16), 0x0102FFFF)
         self.assertEqual(int(binascii.hexlify(res3), 16), 0x000000FF)
 
+    def test_bitpos(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.bitpos(key, 1), -1)
+        yield from eq(c.bitpos(key, 0), 0)
+        yield from eq(c.set(key, b'\xff\xf0\x00'), True)
+        yield from eq(c.bitpos(key, 0), 12)
+        yield from eq(c.bitpos(key, 1, 1), 8)
+        yield from eq(c.bitpos(key, 1, 2), -1)
+        yield from eq(c.bitpos(key, 0, -1), 16)
+        yield from eq(c.set(key, b'\xff\xff'), True)
+        yield from eq(c.bitpos(key, 0), 16)
+        yield from eq(c.bitpos(key, 0, 0, -1), -1)
+        yield from eq(c.bitpos(key, 1, 3, 1), -1)
+        yield from self.async.assertRaises(ResponseError, c.bitpos, key, 2)
+        yield from self._remove_and_push(key)
+        yield from self.async.assertRaises(ResponseError, c.bitpos, key, 1)
+
+    def test_bitfield(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.bitfield(key, 'get', 'u8', 0), [0])
+        yield from eq(c.exists(key), False)
+        yield from eq(c.bitfield(key, 'set', 'u8', 0, 255, 'get', 'u4', 4,
+                                 'get', 'i8', 0), [0, 15, -1])
+        yield from eq(c.get(key), b'\xff')
+        yield from eq(c.bitfield(key, 'set', 'i16', '#1', -2), [0])
+        yield from eq(c.get(key), b'\xff\x00\xff\xfe')
+        yield from eq(c.bitfield(key, 'incrby', 'u2', 100, 1,
+                                 'incrby', 'i5', 3, -3), [1, -4])
+        value = yield from c.get(key)
+        self.assertEqual(value, b'\xfc\x00\xff\xfe' + 8*b'\x00' + b'\x04')
+        yield from eq(c.bitcount(key), 22)
+        yield from self.async.assertRaises(ResponseError, c.bitfield, key,
+                                           'get', 'u64', 0)
+        yield from self.async.assertRaises(ResponseError, c.bitfield, key,
+                                           'set', 'i8', -1, 0)
+        yield from self.async.assertRaises(ResponseError, c.bitfield, key,
+                                           'overflow', 'foo')
+        yield from self.async.assertRaises(ResponseError, c.bitfield, key,
+                                           'incrby', 'i8', 0)
+        yield from self._remove_and_push(key)
+        yield from self.async.assertRaises(ResponseError, c.bitfield, key,
+                                           'get', 'u8', 0)
+
+    def test_bitfield_limit(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        # the last byte of the largest string, as for SETBIT
+        yield from eq(c.bitfield(key, 'get', 'u8', 2**32 - 8,
+                                 'get', 'u8', '#%d' % (2**29 - 1)), [0, 0])
+        yield from self.async.assertRaises(ResponseError, c.bitfield, key,
+                                           'get', 'u8', 2**32 - 7)
+        yield from self.async.assertRaises(ResponseError, c.bitfield, key,
+                                           'get', 'u8', '#%d' % 2**29)
+        yield from self.async.assertRaises(ResponseError, c.setbit, key,
+                                           2**32, 1)
+        yield from eq(c.exists(key), False)
+
+    def test_bitfield_overflow(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.bitfield(key, 'incrby', 'u2', 0, 5,
+                                 'overflow', 'sat', 'incrby', 'u2', 2, 5,
+                                 'incrby', 'i4', 4, -20,
+                                 'overflow', 'fail', 'incrby', 'u2', 0, 3,
+                                 'set', 'i4', 4, 8, 'get', 'i4', 4),
+                      [1, 3, -8, None, None, -8])
+        yield from eq(c.bitfield(key, 'overflow', 'wrap', 'set', 'i4', 4, 8,
+                                 'get', 'u8', 0), [-8, 0x78])
+
     def test_decr(self):
         key = self.randomkey()
         c = self.client
@@ -366,6 +502,22 @@ class RedisCommands(StoreMixin):
         yield from eq(c.incr(key, 5), 7)
         yield from eq(c.get(key), b'7')
 
+    def test_incr_overflow(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.set(key, 9223372036854775807)
+        yield from self.async.assertRaises(ResponseError, c.incr, key)
+        yield from eq(c.get(key), b'9223372036854775807')
+        yield from eq(c.decr(key), 9223372036854775806)
+        yield from c.set(key, -9223372036854775808)
+        yield from self.async.assertRaises(ResponseError, c.decr, key)
+        yield from self.async.assertRaises(ResponseError, c.incrby, key,
+                                           9223372036854775808)
+        yield from c.set(key, 9223372036854775808)
+        yield from self.async.assertRaises(ResponseError, c.incr, key)
+        yield from eq(c.incr(key + 'x'), 1)
+
     def test_incrby(self):
         key = self.randomkey()
         c = self.client
@@ -382,6 +534,14 @@ class RedisCommands(StoreMixin):
         yield from eq(c.get(key), b'1')
         yield from eq(c.incrbyfloat(key, 1.1), 2.1)
         yield from eq(c.get(key), b'2.1')
+        yield from c.set(key, 1.5)
+        yield from eq(c.incrbyfloat(key, 1.5), 3.0)
+        yield from eq(c.get(key), b'3')
+        yield from eq(c.incr(key), 4)
+        yield from c.set(key, 1.7e308)
+        yield from self.async.assertRaises(ResponseError, c.incrbyfloat,
+                                           key, 1.7e308)
+        yield from eq(c.get(key), b'1.7e+308')
 
     def test_mget(self):
         key1 = self.randomkey()
@@ -557,6 +717,12 @@ class RedisCommands(StoreMixin):
         yield from eq(c.hincrbyfloat(key, 'foo', 1), 1.0)
         yield from eq(c.hincrbyfloat(key, 'foo', 2.5), 3.5)
         yield from eq(c.hincrbyfloat(key, 'foo', -1.1), 2.4)
+        yield from eq(c.hincrbyfloat(key, 'foo', 0.6), 3.0)
+        yield from eq(c.hget(key, 'foo'), b'3')
+        yield from eq(c.hincrby(key, 'foo', 1), 4)
+        yield from c.hset(key, 'bar', 9223372036854775807)
+        yield from self.async.assertRaises(ResponseError, c.hincrby, key,
+                                           'bar', 1)
         yield from self._remove_and_push(key)
 
     def test_hkeys_hvals_hlen_hmget(self):
@@ -594,6 +760,29 @@ class RedisCommands(StoreMixin):
         yield from self.async.assertRaises(ResponseError, c.hsetnx, key,
                                            'a', 'jk')
 
+    def test_hscan(self):
+        key = self.randomkey()
+        eq = self.async.assertEqual
+        c = self.client
+        fields = dict((('f%s' % n, n) for n in range(200)))
+        yield from eq(c.hmset(key, fields), True)
+        it = c.hscan_iter(key, count=20)
+        found = {}
+        while True:
+            pair = yield from it.next()
+            if pair is None:
+                break
+            found[pair[0].decode('utf-8')] = int(pair[1])
+        self.assertEqual(found, fields)
+        it = c.hscan_iter(key, match='f1?')
+        found = set()
+        while True:
+            pair = yield from it.next()
+            if pair is None:
+                break
+            found.add(pair[0])
+        self.assertEqual(len(found), 10)
+
     ###########################################################################
     #    LISTS
     def test_blpop(self):
@@ -831,6 +1020,58 @@ class RedisCommands(StoreMixin):
         yield from eq(c.sort(key2, get=('%s:*' % key, '#'), groups=True),
                       [(b'u1', b'1'), (b'u2', b'2'), (b'u3', b'3')])
 
+    def test_sort_desc_alpha(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.rpush(key, 'b', '10', 'a', '9')
+        yield from eq(c.sort(key, alpha=True), [b'10', b'9', b'a', b'b'])
+        yield from eq(c.sort(key, desc=True, alpha=True),
+                      [b'b', b'a', b'9', b'10'])
+        # elements which are not numbers follow the sorted elements
+        yield from eq(c.sort(key), [b'9', b'10', b'b', b'a'])
+        yield from eq(c.sort(key, desc=True), [b'10', b'9', b'b', b'a'])
+
+    def test_sort_limit_large(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.sadd(key, *range(1000))
+        yield from eq(c.sort(key, start=10, num=3), [b'10', b'11', b'12'])
+        yield from eq(c.sort(key, start=10, num=3, desc=True),
+                      [b'989', b'988', b'987'])
+        yield from eq(c.sort(key, start=998, num=5), [b'998', b'999'])
+
+    def test_sort_by_hash_store(self):
+        key = self.randomkey()
+        key2 = self.randomkey()
+        dest = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.hmset('%s:1' % key, {'w': 3, 'name': 'one'})
+        yield from c.hmset('%s:2' % key, {'w': 1, 'name': 'two'})
+        yield from c.hmset('%s:3' % key, {'w': 2})
+        yield from c.rpush(key2, '1', '2', '3')
+        yield from eq(c.sort(key2, by='%s:*->w' % key,
+                             get=('#', '%s:*->name' % key)),
+                      [b'2', b'two', b'3', None, b'1', b'one'])
+        yield from eq(c.sort(key2, by='%s:*->w' % key,
+                             get='%s:*->name' % key, store=dest), 3)
+        yield from eq(c.lrange(dest, 0, -1), [b'two', b'', b'one'])
+
+    def test_sort_ro(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.rpush(key, '3', '1', '2')
+        yield from eq(c.sort_ro(key, 'desc'), [b'3', b'2', b'1'])
+        yield from eq(c.sort_ro(key, 'limit', 0, 1), [b'1'])
+        yield from self.async.assertRaises(ResponseError, c.sort_ro, key,
+                                           'store', key + 'x')
+        yield from c.set(key + 'x', 'foo')
+        yield from self.async.assertRaises(ResponseError, c.sort_ro,
+                                           key + 'x')
+
     ###########################################################################
     #    SETS
     def test_sadd_scard(self):
@@ -888,6 +1129,42 @@ class RedisCommands(StoreMixin):
         yield from eq(c.sinterstore(des, key, key2), 2)
         yield from eq(c.smembers(des), set([b'2', b'3']))
 
+    def test_sinter_smallest_first(self):
+        key = self.randomkey()
+        key2 = key + '2'
+        key3 = key + '3'
+        des = key + 'd'
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.sadd(key, *range(300)), 300)
+        yield from eq(c.sadd(key2, 5, 7, 1000), 3)
+        yield from eq(c.sinter(key, key2), set([b'5', b'7']))
+        yield from eq(c.sinter(key, key2, key3), set())
+        yield from eq(c.sdiff(key2, key), set([b'1000']))
+        yield from eq(c.sunionstore(des, key), 300)
+        yield from eq(c.srem(des, 5), 1)
+        yield from eq(c.sismember(key, 5), True)
+        yield from c.set(key3, 'x')
+        yield from self.async.assertRaises(ResponseError, c.sinter,
+                                           key2, key3)
+
+    def test_sintercard(self):
+        key = self.randomkey()
+        key2 = key + '2'
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.sadd(key, 1, 2, 3, 4), 4)
+        yield from eq(c.sadd(key2, 2, 3, 4, 5), 4)
+        yield from eq(c.sintercard(2, key, key2), 3)
+        yield from eq(c.sintercard(2, key, key2, 'LIMIT', 2), 2)
+        yield from eq(c.sintercard(2, key, key2, 'limit', 0), 3)
+        yield from eq(c.sintercard(1, key), 4)
+        yield from eq(c.sintercard(2, key, key + '3'), 0)
+        yield from self.async.assertRaises(ResponseError, c.sintercard,
+                                           0, key)
+        yield from self.async.assertRaises(ResponseError, c.sintercard,
+                                           2, key, key2, 'LIMIT', -1)
+
     def test_sismember(self):
         key = self.randomkey()
         eq = self.async.assertEqual
@@ -898,6 +1175,17 @@ class RedisCommands(StoreMixin):
         yield from eq(c.sismember(key, 3), True)
         yield from eq(c.sismember(key, 4), False)
 
+    def test_smismember(self):
+        key = self.randomkey()
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.sadd(key, 1, 2, 3), 3)
+        yield from eq(c.smismember(key, 1, 4, 3), [1, 0, 1])
+        yield from eq(c.smismember(key + '2', 1), [0])
+        yield from c.set(key + '3', 'x')
+        yield from self.async.assertRaises(ResponseError, c.smismember,
+                                           key + '3', 1)
+
     def test_smove(self):
         key = self.randomkey()
         key2 = key + '2'
@@ -971,6 +1259,50 @@ class RedisCommands(StoreMixin):
         yield from eq(c.sunionstore(des, key, key2), 4)
         yield from eq(c.smembers(des), set([b'1', b'2', b'3', b'4']))
 
+    def test_sscan(self):
+        key = self.randomkey()
+        eq = self.async.assertEqual
+        c = self.client
+        members = set((str(n).encode('utf-8') for n in range(300)))
+        yield from eq(c.sadd(key, *members), 300)
+        it = c.sscan_iter(key, count=30)
+        found = set()
+        while True:
+            member = yield from it.next()
+            if member is None:
+                break
+            found.add(member)
+        self.assertEqual(found, members)
+        yield from self._remove_and_push(key)
+        yield from self.async.assertRaises(ResponseError, c.sscan, key, 0)
+
+    def test_sscan_during_writes(self):
+        key = self.randomkey()
+        eq = self.async.assertEqual
+        c = self.client
+        members = set((str(n).encode('utf-8') for n in range(1000)))
+        yield from eq(c.sadd(key, *members), 1000)
+        cursor, found = yield from c.execute('sscan', key, 0, 'count', 10)
+        cursor, found = int(cursor), set(found)
+        n = 1000
+        while cursor:
+            yield from c.sadd(key, n, n + 1)
+            yield from c.srem(key, n - 900)
+            n += 2
+            cursor, result = yield from c.execute('sscan', key, cursor,
+                                                  'count', 10)
+            cursor = int(cursor)
+            found.update(result)
+        members = yield from c.smembers(key)
+        kept = set((str(n).encode('utf-8') for n in range(1000)))
+        self.assertTrue(members & kept <= found)
+        # stored results are indexed too
+        dest = self.randomkey()
+        yield from eq(c.sunionstore(dest, key), len(members))
+        cursor, result = yield from c.execute('sscan', dest, 0, 'count', 10)
+        self.assertNotEqual(int(cursor), 0)
+        self.assertTrue(len(result) < len(members))
+
     ###########################################################################
     #    SORTED SETS
     def test_zadd_zcard(self):
@@ -1002,6 +1334,25 @@ class RedisCommands(StoreMixin):
         yield from eq(c.zscore(key, 'a3'), 8.0)
         yield from eq(c.zscore(key, 'blaaa'), None)
 
+    def test_zdiff(self):
+        key1 = self.randomkey()
+        key2 = key1 + '2'
+        des = key1 + 'd'
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.zadd(key1, a1=1, a2=2, a3=3), 3)
+        yield from eq(c.zadd(key2, a2=5, a4=4), 2)
+        yield from eq(c.zdiff((key1, key2)), [b'a1', b'a3'])
+        yield from eq(c.zdiff((key1, key2), withscores=True),
+                      Zset(((1.0, b'a1'), (3.0, b'a3'))))
+        yield from eq(c.zdiffstore(des, (key1, key2)), 2)
+        yield from eq(c.zrange(des, 0, -1), [b'a1', b'a3'])
+        yield from eq(c.zdiffstore(des, (key2, key2)), 0)
+        yield from eq(c.exists(des), False)
+        yield from c.set(key2, 'x')
+        yield from self.async.assertRaises(ResponseError, c.zdiff,
+                                           (key1, key2))
+
     def test_zinterstore_sum(self):
         des = self.randomkey()
         key1 = des + '1'
@@ -1073,6 +1424,45 @@ class RedisCommands(StoreMixin):
         yield from eq(c.zrange(key, 1, 2, withscores=True),
                       Zset([(2, b'a2'), (3, b'a3')]))
 
+    def test_zrangestore(self):
+        key = self.randomkey()
+        des = key + 'd'
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.zadd(key, a1=1, a2=2, a3=3, a4=4, a5=5), 5)
+        yield from eq(c.zrangestore(des, key, 1, -2), 3)
+        yield from eq(c.zrange(des, 0, -1), [b'a2', b'a3', b'a4'])
+        yield from eq(c.zrangestore(des, key, 0, 1, rev=True), 2)
+        yield from eq(c.zrange(des, 0, -1), [b'a4', b'a5'])
+        yield from eq(c.zrangestore(des, key, '(1', 4, byscore=True,
+                                    offset=1, count=5), 2)
+        yield from eq(c.zrange(des, 0, -1, withscores=True),
+                      Zset([(3, b'a3'), (4, b'a4')]))
+        yield from eq(c.zrangestore(des, key, 5, 2, byscore=True, rev=True,
+                                    offset=0, count=2), 2)
+        yield from eq(c.zrange(des, 0, -1), [b'a4', b'a5'])
+        yield from eq(c.zrangestore(des, key, 10, 20), 0)
+        yield from eq(c.exists(des), False)
+        yield from self.async.assertRaises(ResponseError, c.zrangestore,
+                                           des, key, 0, 1, offset=0,
+                                           count=1)
+
+    def test_zunionstore(self):
+        des = self.randomkey()
+        key1 = des + '1'
+        key2 = des + '2'
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.zadd(key1, a1=1, a2=2), 2)
+        yield from eq(c.zadd(key2, a2=3, a3=4), 2)
+        yield from eq(c.zunionstore(des, (key1, key2), weights=(2, 1)), 3)
+        yield from eq(c.zrange(des, 0, -1, withscores=True),
+                      Zset(((2.0, b'a1'), (4.0, b'a3'), (7.0, b'a2'))))
+        yield from eq(c.zunionstore(des, (key1, key2), aggregate='MAX'), 3)
+        yield from eq(c.zscore(des, 'a2'), 3.0)
+        yield from eq(c.zinterstore(des, (key1, des + 'x')), 0)
+        yield from eq(c.exists(des), False)
+
     def test_zrangebyscore(self):
         key = self.randomkey()
         eq = self.async.assertEqual
@@ -1127,6 +1517,160 @@ class RedisCommands(StoreMixin):
         yield from eq(c.zremrangebyscore(key, 2, 4), 0)
         yield from eq(c.zrange(key, 0, -1), [b'a1', b'a5'])
 
+    def test_zscan(self):
+        key = self.randomkey()
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.zadd(key, a1=1, a2=2, a3=3.5), 3)
+        it = c.zscan_iter(key)
+        found = []
+        while True:
+            pair = yield from it.next()
+            if pair is None:
+                break
+            found.append(pair)
+        self.assertEqual(sorted(found), [(b'a1', 1), (b'a2', 2),
+                                         (b'a3', 3.5)])
+
+    ###########################################################################
+    #    HYPERLOGLOG
+    def test_pfadd_pfcount(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.pfcount(key), 0)
+        yield from eq(c.pfadd(key, 'a', 'b', 'c'), 1)
+        yield from eq(c.pfadd(key, 'a', 'b'), 0)
+        yield from eq(c.pfcount(key), 3)
+        yield from eq(c.pfadd(key, *range(1000)), 1)
+        count = yield from c.pfcount(key)
+        self.assertTrue(990 < count < 1020)
+        key2 = self.randomkey()
+        yield from eq(c.pfadd(key2), 1)
+        yield from eq(c.pfadd(key2), 0)
+        yield from eq(c.pfcount(key2), 0)
+        yield from eq(c.type(key2), 'string')
+
+    def test_pfmerge(self):
+        key1 = self.randomkey()
+        key2 = self.randomkey()
+        dest = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.pfadd(key1, 'a', 'b', 'c'), 1)
+        yield from eq(c.pfadd(key2, 'c', 'd'), 1)
+        yield from eq(c.pfcount(key1, key2, dest), 4)
+        yield from eq(c.pfmerge(dest, key1, key2), True)
+        yield from eq(c.pfcount(dest), 4)
+        yield from eq(c.pfmerge(dest, key1), True)
+        yield from eq(c.pfcount(dest), 4)
+        # a counter read and written as a string
+        value = yield from c.get(dest)
+        yield from eq(c.set(key1, value), True)
+        yield from eq(c.pfcount(key1), 4)
+
+    def test_pf_wrongtype(self):
+        key = self.randomkey()
+        c = self.client
+        yield from c.set(key, 'foo')
+        yield from self.async.assertRaises(ResponseError, c.pfadd, key, 'a')
+        yield from self.async.assertRaises(ResponseError, c.pfcount, key)
+        key2 = self.randomkey()
+        yield from c.lpush(key2, 'a')
+        yield from self.async.assertRaises(ResponseError, c.pfmerge, key2,
+                                           key)
+
+    ###########################################################################
+    #    STREAMS
+    def test_xadd_xrange(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.xadd(key, 'nomkstream', '*', 'a', 1), None)
+        yield from eq(c.exists(key), False)
+        yield from eq(c.xadd(key, '1-1', 'a', 1), b'1-1')
+        yield from eq(c.xadd(key, '1-*', 'b', 2), b'1-2')
+        yield from eq(c.xadd(key, '2', 'c', 3, 'd', 4), b'2-0')
+        yield from self.async.assertRaises(ResponseError, c.xadd, key, '1-5',
+                                           'e', 5)
+        yield from self.async.assertRaises(ResponseError, c.xadd, key, '*')
+        yield from eq(c.xlen(key), 3)
+        yield from eq(c.type(key), 'stream')
+        yield from eq(c.xrange(key, '-', '+'),
+                      [[b'1-1', [b'a', b'1']], [b'1-2', [b'b', b'2']],
+                       [b'2-0', [b'c', b'3', b'd', b'4']]])
+        yield from eq(c.xrange(key, '(1-1', '2', 'count', 1),
+                      [[b'1-2', [b'b', b'2']]])
+        yield from eq(c.xrevrange(key, '+', '1-2'),
+                      [[b'2-0', [b'c', b'3', b'd', b'4']],
+                       [b'1-2', [b'b', b'2']]])
+        yield from eq(c.xadd(key, 'maxlen', 2, '3-0', 'e', 5), b'3-0')
+        yield from eq(c.xlen(key), 2)
+        yield from eq(c.xrange(key, '-', '1-2'), [])
+        id = yield from c.xadd(key, '*', 'f', 6)
+        self.assertTrue(int(id.split(b'-')[0]) > 3)
+
+    def test_xreadgroup(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from self.async.assertRaises(ResponseError, c.xgroup, 'create',
+                                           key, 'g', '$')
+        yield from eq(c.xgroup('create', key, 'g', '$', 'mkstream'), b'OK')
+        yield from self.async.assertRaises(ResponseError, c.xgroup, 'create',
+                                           key, 'g', '$')
+        for n in range(1, 4):
+            yield from c.xadd(key, '1-%s' % n, 'n', n)
+        yield from eq(c.xreadgroup('group', 'g', 'alice', 'count', 2,
+                                   'streams', key, '>'),
+                      [[key.encode('utf-8'), [[b'1-1', [b'n', b'1']],
+                                              [b'1-2', [b'n', b'2']]]]])
+        yield from eq(c.xreadgroup('group', 'g', 'bob', 'streams', key, '>'),
+                      [[key.encode('utf-8'), [[b'1-3', [b'n', b'3']]]]])
+        yield from eq(c.xreadgroup('group', 'g', 'bob', 'streams', key, '>'),
+                      None)
+        yield from eq(c.xpending(key, 'g'),
+                      [3, b'1-1', b'1-3', [[b'alice', b'2'], [b'bob', b'1']]])
+        # the history of a consumer is its pending entries
+        yield from eq(c.xreadgroup('group', 'g', 'alice', 'streams', key, 0),
+                      [[key.encode('utf-8'), [[b'1-1', [b'n', b'1']],
+                                              [b'1-2', [b'n', b'2']]]]])
+        yield from eq(c.xack(key, 'g', '1-1', '1-3', '1-3'), 2)
+        pending = yield from c.xpending(key, 'g', '-', '+', 10)
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0][:2], [b'1-2', b'alice'])
+        self.assertEqual(pending[0][3], 2)
+        yield from eq(c.xgroup('delconsumer', key, 'g', 'alice'), 1)
+        yield from eq(c.xpending(key, 'g'), [0, None, None, None])
+        yield from eq(c.xgroup('destroy', key, 'g'), 1)
+        yield from self.async.assertRaises(ResponseError, c.xreadgroup,
+                                           'group', 'g', 'bob', 'streams',
+                                           key, '>')
+
+    def test_xread_block(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.xread('block', 100, 'streams', key, '$'), None)
+        read = async(c.xread('block', 0, 'streams', key, '0-0'))
+        yield from asyncio.sleep(0.1)
+        yield from c.xadd(key, '1-1', 'a', 1)
+        yield from eq(read, [[key.encode('utf-8'),
+                              [[b'1-1', [b'a', b'1']]]]])
+        yield from eq(c.xread('streams', key, '0-0'),
+                      [[key.encode('utf-8'), [[b'1-1', [b'a', b'1']]]]])
+
+    def test_stream_wrongtype(self):
+        key = self.randomkey()
+        c = self.client
+        yield from c.lpush(key, 'a')
+        yield from self.async.assertRaises(ResponseError, c.xadd, key, '*',
+                                           'a', 1)
+        yield from self.async.assertRaises(ResponseError, c.xrange, key,
+                                           '-', '+')
+        yield from self.async.assertRaises(ResponseError, c.xread, 'streams',
+                                           key, 0)
+
     ###########################################################################
     #    CONNECTION
     def test_ping(self):
@@ -1230,6 +1774,55 @@ class RedisCommands(StoreMixin):
         result = yield from self.client.watch(key1)
         self.assertEqual(result, 1)
 
+    ###########################################################################
+    #    SCRIPTING
+    @unittest.skipIf(lupa is None, 'Requires lupa')
+    def test_eval(self):
+        key = self.randomkey()
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.eval("return redis.call('set', KEYS[1], ARGV[1])",
+                             (key,), ('foo',)), b'OK')
+        yield from eq(c.eval("return {redis.call('get', KEYS[1]), 1}",
+                             (key,)), [b'foo', 1])
+        yield from self.async.assertRaises(
+            ResponseError, c.eval, "return redis.call('lpush', KEYS[1], 1)",
+            (key,))
+        yield from eq(c.eval("return redis.pcall('lpush', KEYS[1], 1).err",
+                             (key,)), b'WRONGTYPE Operation against a key '
+                                      b'holding the wrong kind of value')
+        yield from self.async.assertRaises(
+            ResponseError, c.eval, "return redis.call('multi')")
+        yield from self.async.assertRaises(ResponseError, c.eval, "return (")
+
+    @unittest.skipIf(lupa is None, 'Requires lupa')
+    def test_eval_sandbox(self):
+        c = self.client
+        raises = self.async.assertRaises
+        for script in ("return redis.call.__self__",
+                       "return redis.call['__globals__']",
+                       "return redis.pcall.__closure__",
+                       "return redis.sha1hex.__globals__",
+                       "return python.eval('1')",
+                       "return io.open('/etc/passwd')",
+                       "return os.execute('id')"):
+            yield from raises(ResponseError, c.eval, script)
+        yield from self.async.assertEqual(
+            c.eval("return redis.sha1hex('')"),
+            b'da39a3ee5e6b4b0d3255bfef95601890afd80709')
+
+    @unittest.skipIf(lupa is None, 'Requires lupa')
+    def test_evalsha(self):
+        script = "return ARGV[1] .. KEYS[1]"
+        sha = binascii.hexlify(hashlib.sha1(script.encode('utf-8')).digest())
+        eq = self.async.assertEqual
+        c = self.client
+        yield from eq(c.execute('script', 'load', script), sha)
+        yield from eq(c.evalsha(sha, ('a',), ('b',)), b'ba')
+        yield from eq(c.execute('script', 'exists', sha, 'ff'), [1, 0])
+        yield from eq(c.execute('script', 'flush'), b'OK')
+        yield from self.async.assertRaises(ResponseError, c.evalsha, sha)
+
 
 class TestPulsarStore(RedisCommands, unittest.TestCase):
     app_cfg = None
@@ -1259,6 +1852,199 @@ class TestPulsarStore(RedisCommands, unittest.TestCase):
         self.assertEqual(store.encoding, 'utf-8')
         self.assertTrue(repr(store))
 
+    def encoding(self, key):
+        return self.client.execute('object', 'encoding', key)
+
+    def test_listpack_hash(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(self.encoding(key), None)
+        yield from c.hmset(key, {'a': '1', 'b': '2'})
+        yield from eq(self.encoding(key), b'listpack')
+        yield from c.hmset(key, dict(((n, n) for n in range(126))))
+        yield from eq(self.encoding(key), b'listpack')
+        yield from c.hset(key, 'c', '3')
+        yield from eq(self.encoding(key), b'hashtable')
+        yield from eq(c.hlen(key), 129)
+        yield from eq(c.hget(key, 'b'), b'2')
+        key = self.randomkey()
+        yield from c.hset(key, 'a', 65*'x')
+        yield from eq(self.encoding(key), b'hashtable')
+
+    def test_listpack_list(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.rpush(key, *range(128))
+        yield from eq(self.encoding(key), b'listpack')
+        yield from c.lpush(key, 'a')
+        yield from eq(self.encoding(key), b'quicklist')
+        yield from eq(c.lrange(key, 0, 2), [b'a', b'0', b'1'])
+
+    def test_listpack_set(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.sadd(key, 'a', 'b')
+        yield from eq(self.encoding(key), b'listpack')
+        yield from c.sadd(key, 65*'x')
+        yield from eq(self.encoding(key), b'hashtable')
+        yield from eq(c.scard(key), 3)
+
+    def test_listpack_zset(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.zadd(key, 2, 'b', 1, 'a')
+        yield from eq(self.encoding(key), b'listpack')
+        yield from c.zadd(key, *[v for n in range(200) for v in (n, n)])
+        yield from eq(self.encoding(key), b'skiplist')
+        yield from eq(c.zcard(key), 202)
+        # the union of small zsets is a listpack
+        dest = self.randomkey()
+        key2 = self.randomkey()
+        yield from c.zadd(key2, 1, 'a')
+        yield from c.zunionstore(dest, (key2,))
+        yield from eq(self.encoding(dest), b'listpack')
+
+    def test_listpack_large_write(self):
+        # a write well above the listpack limits converts the key first
+        c = self.client
+        eq = self.async.assertEqual
+        members = [str(n) for n in range(5000)]
+        key = self.randomkey()
+        yield from eq(c.sadd(key, *members), 5000)
+        yield from eq(self.encoding(key), b'hashtable')
+        yield from eq(c.scard(key), 5000)
+        key = self.randomkey()
+        yield from c.hset(key, 'a', '1')
+        yield from c.hmset(key, dict(((m, m) for m in members)))
+        yield from eq(self.encoding(key), b'hashtable')
+        yield from eq(c.hlen(key), 5001)
+        key = self.randomkey()
+        yield from eq(c.zadd(key, *[v for m in members for v in (m, m)]),
+                      5000)
+        yield from eq(self.encoding(key), b'skiplist')
+        yield from eq(c.zrange(key, 0, 1), [b'0', b'1'])
+        key = self.randomkey()
+        yield from eq(c.rpush(key, *members), 5000)
+        yield from eq(self.encoding(key), b'quicklist')
+
+    def test_string_encodings(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.set(key, 10)
+        yield from eq(self.encoding(key), b'int')
+        yield from eq(c.incrby(key, 5), 15)
+        yield from eq(self.encoding(key), b'int')
+        yield from eq(c.get(key), b'15')
+        yield from eq(c.strlen(key), 2)
+        yield from c.set(key, '015')
+        yield from eq(self.encoding(key), b'embstr')
+        yield from eq(c.incr(key), 16)
+        yield from eq(self.encoding(key), b'int')
+        yield from c.set(key, 'foo')
+        yield from eq(self.encoding(key), b'embstr')
+        yield from eq(c.append(key, 'bar'), 6)
+        yield from eq(self.encoding(key), b'raw')
+        yield from eq(c.get(key), b'foobar')
+        yield from eq(c.incrbyfloat(key + '2', 0.5), 0.5)
+        yield from eq(self.encoding(key + '2'), b'embstr')
+        yield from c.set(key, 0)
+        yield from eq(c.setbit(key, 7, 1), 0)
+        yield from eq(self.encoding(key), b'raw')
+        yield from eq(c.get(key), b'1')
+
+    def test_hyperloglog_encodings(self):
+        key = self.randomkey()
+        c = self.client
+        eq = self.async.assertEqual
+        yield from c.pfadd(key, *range(100))
+        yield from eq(self.encoding(key), b'raw')
+        value = yield from c.get(key)
+        self.assertEqual(value[:5], b'HYLL\x01')
+        yield from c.pfadd(key, *range(100, 2000))
+        value = yield from c.get(key)
+        self.assertEqual(value[:5], b'HYLL\x00')
+        self.assertEqual(len(value), 5 + 16384)
+        yield from eq(c.strlen(key), 5 + 16384)
+        # serialized in dumps
+        dump = yield from c.dump(key)
+        key2 = self.randomkey()
+        yield from eq(c.restore(key2, 0, dump), True)
+        count = yield from c.pfcount(key)
+        yield from eq(c.pfcount(key2), count)
+
+    def test_flushdb_async(self):
+        client = self.create_store('%s/7' % self.pulsards_uri).client()
+        eq = self.async.assertEqual
+        yield from client.rpush('list', *range(5000))
+        for n in range(100):
+            yield from client.set('key%s' % n, n)
+        yield from client.setex('volatile', 100, 'hello')
+        yield from self.async.assertRaises(ResponseError, client.flushdb,
+                                           'later')
+        yield from eq(client.flushdb('async'), True)
+        yield from eq(client.dbsize(), 0)
+        yield from eq(client.llen('list'), 0)
+        yield from eq(client.ttl('volatile'), -2)
+        yield from eq(client.set('string', 'hello'), True)
+        yield from eq(client.scan(0), [b'0', [b'string']])
+        info = yield from client.info()
+        self.assertTrue(info['lazyfreed_objects'] > 0)
+        self.assertIn('lazyfree_pending_memory', info)
+        yield from eq(client.flushdb('sync'), True)
+
+    def test_keyspace_notifications(self):
+        key = self.randomkey()
+        bkey = key.encode('utf-8')
+        c = self.client
+        eq = self.async.assertEqual
+        yield from eq(c.execute('config', 'get', 'notify-keyspace-events'),
+                      [b'notify-keyspace-events', b''])
+        yield from self.async.assertRaises(ResponseError, c.execute, 'config',
+                                           'set', 'notify-keyspace-events',
+                                           'KQ')
+        pubsub = self.client.pubsub()
+        listener = Listener()
+        pubsub.add_client(listener)
+        yield from pubsub.subscribe('__keyspace@9__:%s' % key,
+                                    '__keyevent@9__:expired')
+        # no published events
+        yield from c.set(key, 1)
+        yield from eq(c.execute('config', 'set', 'notify-keyspace-events',
+                                'K$x'), b'OK')
+        yield from eq(c.execute('config', 'get', 'notify-keyspace-events'),
+                      [b'notify-keyspace-events', b'$xK'])
+        try:
+            yield from c.lpush(key + 'x', 1)
+            yield from c.incr(key)
+            channel, message = yield from listener.get()
+            self.assertEqual(channel, '__keyspace@9__:%s' % key)
+            self.assertEqual(message, b'incr')
+            yield from eq(c.execute('config', 'set',
+                                    'notify-keyspace-events', 'AE'), b'OK')
+            yield from eq(c.execute('config', 'get',
+                                    'notify-keyspace-events'),
+                          [b'notify-keyspace-events', b'AE'])
+            yield from c.pexpire(key, 1)
+            yield from asyncio.sleep(0.05)
+            yield from eq(c.get(key), None)
+            # keys of other tests expire too
+            message = None
+            while message != bkey:
+                channel, message = yield from listener.get()
+                self.assertEqual(channel, '__keyevent@9__:expired')
+        finally:
+            yield from c.execute('config', 'set', 'notify-keyspace-events',
+                                 '')
+
+    def test_object_errors(self):
+        yield from self.async.assertRaises(ResponseError, self.client.execute,
+                                           'object', 'foo', 'bla')
+
 
 @unittest.skipUnless(pulsar.HAS_C_EXTENSIONS, 'Requires cython extensions')
 class TestPulsarStorePyParser(TestPulsarStore):
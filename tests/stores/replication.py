@@ -0,0 +1,208 @@
+import os
+import asyncio
+import tempfile
+import unittest
+
+import pulsar
+from pulsar.apps.test import sequential
+from pulsar.apps.ds import PulsarDS, redis_parser, ResponseError
+from pulsar.apps.ds.aof import read_commands
+from pulsar.apps.ds.replication import ReplicationBacklog, command_size
+
+from .pulsards import StoreMixin
+
+
+class TestReplicationBacklog(unittest.TestCase):
+
+    def test_command_size(self):
+        parser = redis_parser()()
+        for request in ((b'set', b'a', b'foo'),
+                        (b'select', b'10'),
+                        (b'rpush', b'list', 100*b'x', b'')):
+            self.assertEqual(command_size(request),
+                             len(parser.pack_command(request)))
+
+    def test_read(self):
+        backlog = ReplicationBacklog(10)
+        self.assertEqual(backlog.read(0), b'')
+        backlog.append(b'abcd')
+        backlog.append(b'efgh')
+        self.assertEqual(backlog.offset, 8)
+        self.assertEqual(backlog.first_byte_offset, 1)
+        self.assertEqual(backlog.read(0), b'abcdefgh')
+        self.assertEqual(backlog.read(5), b'fgh')
+        self.assertEqual(backlog.read(8), b'')
+        self.assertEqual(backlog.read(9), None)
+
+    def test_trim(self):
+        backlog = ReplicationBacklog(10)
+        for chunk in (b'abcd', b'efgh', b'ijkl', b'mnop'):
+            backlog.append(chunk)
+        self.assertEqual(backlog.offset, 16)
+        self.assertEqual(len(backlog), 12)
+        self.assertEqual(backlog.first_byte_offset, 5)
+        self.assertEqual(backlog.read(3), None)
+        self.assertEqual(backlog.read(4), b'efghijklmnop')
+        self.assertEqual(backlog.read(10), b'klmnop')
+
+
+class ReplicaMixin(StoreMixin):
+    master_cfg = None
+    replica_cfg = None
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.isfile(cls.filename):
+            os.remove(cls.filename)
+        if cls.replica_cfg is not None:
+            yield from pulsar.send('arbiter', 'kill_actor',
+                                   cls.replica_cfg.name)
+        if cls.master_cfg is not None:
+            yield from pulsar.send('arbiter', 'kill_actor',
+                                   cls.master_cfg.name)
+
+    def wait_for(self, key, value):
+        for n in range(50):
+            result = yield from self.replica.get(key)
+            if result == value:
+                break
+            yield from asyncio.sleep(0.1)
+        return result
+
+
+class TestPulsarStoreReplication(ReplicaMixin, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp()
+        name = cls.__name__.lower()
+        master = PulsarDS(name='%s_master' % name,
+                          bind='127.0.0.1:0',
+                          concurrency=cls.cfg.concurrency)
+        cls.master_cfg = yield from pulsar.send('arbiter', 'run', master)
+        address = cls.master_cfg.addresses[0]
+        namespace = cls.randomkey(6).lower()
+        cls.store = cls.create_store('pulsar://%s:%s/9' % address,
+                                     namespace=namespace)
+        cls.client = cls.store.client()
+        # written before the replica connects
+        yield from cls.client.set('initial', 'foo')
+        replica = PulsarDS(name='%s_replica' % name,
+                           bind='127.0.0.1:0',
+                           concurrency=cls.cfg.concurrency,
+                           key_value_filename=cls.filename,
+                           key_value_slaveof='%s:%s' % address)
+        cls.replica_cfg = yield from pulsar.send('arbiter', 'run', replica)
+        cls.replica_store = cls.create_store(
+            'pulsar://%s:%s/9' % cls.replica_cfg.addresses[0],
+            namespace=namespace)
+        cls.replica = cls.replica_store.client()
+
+    def test_full_sync(self):
+        result = yield from self.wait_for('initial', b'foo')
+        self.assertEqual(result, b'foo')
+
+    def test_propagate_writes(self):
+        key = self.randomkey()
+        c = self.client
+        yield from c.set(key, 'bla')
+        yield from c.append(key, 'foo')
+        result = yield from self.wait_for(key, b'blafoo')
+        self.assertEqual(result, b'blafoo')
+        yield from c.hmset(key+'h', {'a': 1, 'b': 2})
+        yield from c.delete(key)
+        yield from self.wait_for(key, None)
+        result = yield from self.replica.hgetall(key+'h')
+        self.assertEqual(result, {b'a': b'1', b'b': b'2'})
+
+    def test_read_only(self):
+        yield from self.async.assertRaises(ResponseError, self.replica.set,
+                                           self.randomkey(), 'foo')
+
+    def test_info(self):
+        # the key must be streamed rather than included in the snapshot
+        yield from self.wait_for('initial', b'foo')
+        key = self.randomkey()
+        yield from self.client.set(key, 'foo')
+        yield from self.wait_for(key, b'foo')
+        info = yield from self.replica.info()
+        self.assertEqual(info['role'], 'slave')
+        self.assertEqual(info['master_link_status'], 'up')
+        offset = info['slave_repl_offset']
+        self.assertTrue(offset > 0)
+        # other tests may write to the master in the meantime
+        info = yield from self.client.info()
+        self.assertEqual(info['role'], 'master')
+        self.assertEqual(info['connected_slaves'], 1)
+        self.assertTrue(info['master_repl_offset'] >= offset)
+
+
+@sequential
+class TestReplicaResync(ReplicaMixin, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp()
+        # replayed by the replica before its first synchronization
+        parser = redis_parser()()
+        with open(cls.filename, 'wb') as file:
+            file.write(parser.pack_command(('select', 9)))
+            file.write(parser.pack_command(('set', 'stale', 'foo')))
+        name = cls.__name__.lower()
+        master = PulsarDS(name='%s_master' % name,
+                          bind='127.0.0.1:0',
+                          concurrency=cls.cfg.concurrency)
+        cls.master_cfg = yield from pulsar.send('arbiter', 'run', master)
+        address = cls.master_cfg.addresses[0]
+        cls.store = cls.create_store('pulsar://%s:%s/9' % address)
+        cls.client = cls.store.client()
+        yield from cls.client.set('initial', 'foo')
+        replica = PulsarDS(name='%s_replica' % name,
+                           bind='127.0.0.1:0',
+                           concurrency=cls.cfg.concurrency,
+                           key_value_appendonly=True,
+                           key_value_appendfilename=cls.filename,
+                           key_value_slaveof='%s:%s' % address)
+        cls.replica_cfg = yield from pulsar.send('arbiter', 'run', replica)
+        cls.replica_store = cls.create_store(
+            'pulsar://%s:%s/9' % cls.replica_cfg.addresses[0])
+        cls.replica = cls.replica_store.client()
+
+    def test_aof_rewritten(self):
+        yield from self.wait_for('initial', b'foo')
+        yield from self.async.assertEqual(self.replica.get('stale'), None)
+        for n in range(50):
+            info = yield from self.replica.info()
+            if not info['aof_rewrite_in_progress']:
+                break
+            yield from asyncio.sleep(0.1)
+        keys = [c[1] for c in read_commands(self.filename,
+                                            redis_parser()())
+                if c[0] == b'set']
+        self.assertTrue(b'initial' in keys)
+        self.assertFalse(b'stale' in keys)
+
+    def test_partial_resync(self):
+        yield from self.wait_for('initial', b'foo')
+        c = self.client
+        info = yield from c.info()
+        full = info['sync_full']
+        partial = info['sync_partial_ok']
+        killed = yield from c.execute('client', 'kill', 'type', 'replica')
+        self.assertEqual(killed, 1)
+        # written while the replica is disconnected
+        key = self.randomkey()
+        yield from c.set(key, 'foo')
+        yield from c.rpush(key + 'l', 'a', 'b')
+        result = yield from self.wait_for(key, b'foo')
+        self.assertEqual(result, b'foo')
+        yield from self.async.assertEqual(
+            self.replica.lrange(key + 'l', 0, -1), [b'a', b'b'])
+        # the replica continued the replication stream
+        info = yield from c.info()
+        self.assertEqual(info['sync_full'], full)
+        self.assertEqual(info['sync_partial_ok'], partial + 1)
+        replica_info = yield from self.replica.info()
+        self.assertEqual(replica_info['master_link_status'], 'up')
+        yield from self.async.assertEqual(self.replica.dbsize(),
+                                          c.dbsize())
@@ -0,0 +1,99 @@
+import unittest
+from unittest import mock
+
+import pulsar
+from pulsar.apps.ds import PulsarDS, ResponseError
+from pulsar.apps.ds.client import PulsarStoreClient
+from pulsar.apps.test import sequential
+
+from .pulsards import StoreMixin
+
+
+@sequential
+class TestSlowLog(StoreMixin, unittest.TestCase):
+    '''Every command is logged, tests share the slow log of a server.
+    '''
+    app_cfg = None
+
+    @classmethod
+    def setUpClass(cls):
+        server = PulsarDS(name=cls.__name__.lower(),
+                          bind='127.0.0.1:0',
+                          concurrency=cls.cfg.concurrency,
+                          key_value_slowlog_log_slower_than=0,
+                          key_value_slowlog_max_len=5)
+        cls.app_cfg = yield from pulsar.send('arbiter', 'run', server)
+        cls.pulsards_uri = 'pulsar://%s:%s' % cls.app_cfg.addresses[0]
+        cls.store = cls.create_store('%s/9' % cls.pulsards_uri)
+        cls.client = cls.store.client()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.app_cfg is not None:
+            return pulsar.send('arbiter', 'kill_actor', cls.app_cfg.name)
+
+    def setUp(self):
+        return self.client.execute('slowlog', 'reset')
+
+    def test_get(self):
+        yield from self.client.set('a', 'foo')
+        entries = yield from self.client.execute('slowlog', 'get', 1)
+        self.assertEqual(len(entries), 1)
+        id, timestamp, usec, args, address, name = entries[0]
+        self.assertEqual(args, [b'set', b'a', b'foo'])
+        self.assertTrue(usec >= 0)
+        self.assertTrue(address)
+        # the slow log is bounded
+        for n in range(10):
+            yield from self.client.get('a')
+        entries = yield from self.client.execute('slowlog', 'get', -1)
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(entries[0][0] - entries[-1][0], 4)
+
+    def test_failed_command(self):
+        yield from self.async.assertRaises(ResponseError,
+                                           self.client.execute,
+                                           'get', 'a', 'b')
+        entries = yield from self.client.execute('slowlog', 'get', 1)
+        self.assertEqual(entries[0][3], [b'get', b'a', b'b'])
+
+    def test_len_reset(self):
+        yield from self.client.get('a')
+        result = yield from self.client.execute('slowlog', 'len')
+        # slowlog reset and get are logged too
+        self.assertEqual(result, 2)
+        result = yield from self.client.execute('slowlog', 'reset')
+        self.assertTrue(result)
+        result = yield from self.client.execute('slowlog', 'get')
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][3], [b'slowlog', b'reset'])
+
+    def test_commandstats(self):
+        for n in range(10):
+            yield from self.client.incr('counter')
+        info = yield from self.client.info()
+        stats = info['cmdstat_incr']
+        self.assertTrue(stats['calls'] >= 10)
+        self.assertTrue(stats['usec'] >= 0)
+        self.assertTrue(stats['p50'] <= stats['p99'] <= stats['p99.9'])
+        yield from self.client.execute('config', 'resetstat')
+        info = yield from self.client.info()
+        self.assertFalse('cmdstat_incr' in info)
+        self.assertEqual(info['cmdstat_config']['calls'], 1)
+
+
+class TestClientAddress(unittest.TestCase):
+
+    def address(self, peername):
+        client = mock.Mock()
+        client._transport.get_extra_info.return_value = peername
+        return PulsarStoreClient.address.fget(client)
+
+    def test_address(self):
+        self.assertEqual(self.address(('127.0.0.1', 6379)), '127.0.0.1:6379')
+        self.assertEqual(self.address(('::1', 6379, 0, 0)), '::1:6379')
+
+    def test_unknown(self):
+        # once the connection is lost, or for unix sockets
+        self.assertEqual(self.address(None), '')
+        self.assertEqual(self.address(''), '')
@@ -0,0 +1,113 @@
+import io
+import os
+import pickle
+import tempfile
+import unittest
+
+from pulsar.utils.structures import Zset, Quicklist, Dict
+from pulsar.apps.ds.snapshot import (SnapshotWriter, SnapshotReader,
+                                     SnapshotError, load_snapshot)
+from pulsar.apps.ds.stream import Stream, ConsumerGroup
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def dataset(self):
+        hash = Dict()
+        hash[b'f'] = b'v'
+        hash[b'n'] = 5
+        zset = Zset(((1.5, b'a'), (-2, b'b'), (float('inf'), b'c')))
+        return {b'string': b'foo',
+                b'empty': b'',
+                b'list': Quicklist((b'1', b'2', b'3')),
+                b'set': {b'a', b'b'},
+                b'zset': zset,
+                b'hash': hash}
+
+    def write(self, records, chunk_size=1 << 16):
+        file = io.BytesIO()
+        writer = SnapshotWriter(file, chunk_size)
+        num = None
+        for db, key, value, expiretime in records:
+            if db != num:
+                num = db
+                writer.select(db)
+            writer.write(key, value, expiretime)
+        writer.close()
+        return file.getvalue()
+
+    def read(self, data):
+        return list(SnapshotReader(io.BytesIO(data)))
+
+    def test_types(self):
+        data = self.dataset()
+        records = self.read(self.write(((3, k, v, None)
+                                        for k, v in data.items())))
+        self.assertEqual(len(records), len(data))
+        for db, key, value, expiretime in records:
+            self.assertEqual(db, 3)
+            self.assertEqual(type(value), type(data[key]))
+            self.assertEqual(expiretime, None)
+        values = dict(((r[1], r[2]) for r in records))
+        self.assertEqual(values[b'string'], b'foo')
+        self.assertEqual(values[b'empty'], b'')
+        self.assertEqual(values[b'list'], data[b'list'])
+        self.assertEqual(values[b'set'], data[b'set'])
+        self.assertEqual(values[b'zset'], data[b'zset'])
+        self.assertEqual(values[b'hash'], {b'f': b'v', b'n': b'5'})
+
+    def test_expiretime(self):
+        records = [(0, b'a', bytearray(b'1'), 1500000000123),
+                   (0, b'b', bytearray(b'2'), None),
+                   (1, b'a', {b'x'}, 1600000000000)]
+        self.assertEqual(self.read(self.write(records)), records)
+
+    def test_chunks(self):
+        members = set((str(n).encode('utf-8') for n in range(10000)))
+        records = [(0, ('key%s' % n).encode('utf-8'), members, None)
+                   for n in range(3)]
+        data = self.write(records, chunk_size=100)
+        self.assertEqual(self.read(data), records)
+
+    def test_stream(self):
+        stream = Stream()
+        for n in range(1, 251):
+            stream.add(n << 64 | 1, (b'n', str(n).encode('utf-8')))
+        stream.trim(200)
+        group = stream.groups[b'g'] = ConsumerGroup(3 << 64)
+        group.consumer(b'alice', 1000)
+        group.deliver(b'alice', 51 << 64 | 1, 1200)
+        group.deliver(b'alice', 53 << 64 | 1, 1300)
+        group.redeliver(53 << 64 | 1, 1400)
+        group.consumer(b'bob', 1100)
+        ((_, _, value, _),) = self.read(self.write(((0, b's', stream, None),),
+                                                   chunk_size=100))
+        self.assertEqual(value, stream)
+        self.assertEqual(len(value), 200)
+        group = value.groups[b'g']
+        self.assertEqual(group.last_id, 3 << 64)
+        self.assertEqual(group.pending_ids, [51 << 64 | 1, 53 << 64 | 1])
+        self.assertEqual(group.pending[53 << 64 | 1], [b'alice', 1400, 2])
+        self.assertEqual(group.consumers[b'bob'].seen_time, 1100)
+
+    def test_checksum(self):
+        data = bytearray(self.write(((0, b'a', bytearray(b'foo'), None),)))
+        data[-6] ^= 1
+        self.assertRaises(SnapshotError, self.read, bytes(data))
+
+    def test_truncated(self):
+        data = self.write(((0, b'a', bytearray(b'foo'), None),))
+        self.assertRaises(SnapshotError, self.read, data[:-3])
+
+    def test_not_a_snapshot(self):
+        self.assertRaises(SnapshotError, self.read, b'REDIS0006')
+
+    def test_load_legacy_pickle(self):
+        filename = tempfile.mktemp()
+        with open(filename, 'wb') as file:
+            pickle.dump((1, [(2, {b'a': bytearray(b'foo')})]), file)
+        try:
+            self.assertEqual(list(load_snapshot(filename)),
+                             [(2, b'a', bytearray(b'foo'), None)])
+        finally:
+            os.remove(filename)
@@ -1,7 +1,31 @@
 import re
+import pickle
 import unittest
+from collections import namedtuple
 
+from pulsar.utils.structures import Dict, Deque, Quicklist, Zset
 from pulsar.apps.ds import redis_to_py_pattern
+from pulsar.apps.ds.eviction import object_memory
+from pulsar.apps.ds.listpack import (ListpackHash, ListpackList, ListpackSet,
+                                     ListpackZset)
+from pulsar.apps.ds.expiry import TimerWheel
+from pulsar.apps.ds.hyperloglog import HyperLogLog, REGISTERS
+from pulsar.apps.ds.lazyfree import LazyFree, FREE_CHUNK
+from pulsar.apps.ds.stream import (Stream, ConsumerGroup, StreamIdError,
+                                   parse_id, format_id, CHUNK_ENTRIES)
+from pulsar.apps.ds.scan import (ScanIndex, IndexedDict, IndexedSet,
+                                  IndexedZset, next_cursor)
+from pulsar.apps.ds.pubsub import PatternIndex, literal_prefix
+from pulsar.apps.ds.slowlog import (CommandStats, SlowLog, latency_bucket,
+                                    bucket_limit)
+from pulsar.apps.ds.utils import (encode_string, string_bytes, count_bytes,
+                                  bit_operation, bit_position,
+                                  bitfield_overflow, get_bits, set_bits,
+                                  sort_elements, set_operation,
+                                  intersection_count, HEAP_SELECT_RATIO)
+
+
+pubsub_patterns = namedtuple('pubsub_patterns', 're clients')
 
 
 class TestUtils(unittest.TestCase):
@@ -33,3 +57,707 @@ class TestUtils(unittest.TestCase):
         self.match(c, 'hello')
         self.match(c, 'hallo')
         self.not_match(c, 'hollo')
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_add_remove(self):
+        wheel = TimerWheel(0)
+        wheel.add(b'a', 5)
+        wheel.add(b'b', 5.05)
+        self.assertEqual(len(wheel), 2)
+        self.assertEqual(wheel.get(b'a'), 5)
+        self.assertEqual(len(wheel._slots), 1)
+        self.assertEqual(wheel.remove(b'a'), 5)
+        self.assertEqual(wheel.remove(b'a'), None)
+        self.assertFalse(b'a' in wheel)
+        wheel.remove(b'b')
+        self.assertFalse(wheel._slots)
+
+    def test_move_deadline(self):
+        wheel = TimerWheel(0)
+        wheel.add(b'a', 5)
+        wheel.add(b'a', 50)
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(len(wheel._slots), 1)
+        self.assertEqual(list(wheel.pop_expired(10)), [])
+        self.assertEqual(list(wheel.pop_expired(51)), [b'a'])
+
+    def test_pop_expired(self):
+        wheel = TimerWheel(0)
+        for n in range(100):
+            wheel.add(n, 0.5*n)
+        expired = list(wheel.pop_expired(10))
+        self.assertEqual(sorted(expired), list(range(20)))
+        self.assertEqual(len(wheel), 80)
+        self.assertEqual(min(wheel.values()), 10)
+
+    def test_pop_expired_resume(self):
+        wheel = TimerWheel(0)
+        for n in range(10):
+            wheel.add(n, 1)
+        expired = []
+        for key in wheel.pop_expired(2):
+            expired.append(key)
+            if len(expired) == 4:
+                break
+        self.assertEqual(len(wheel), 6)
+        expired.extend(wheel.pop_expired(2))
+        self.assertEqual(sorted(expired), list(range(10)))
+        self.assertFalse(wheel)
+        self.assertFalse(wheel._slots)
+
+    def test_deadline_in_the_past(self):
+        wheel = TimerWheel(0)
+        wheel.add(b'a', 2)
+        list(wheel.pop_expired(10))
+        wheel.add(b'b', 1)
+        self.assertEqual(list(wheel.pop_expired(10.2)), [b'b'])
+
+
+class TestScanIndex(unittest.TestCase):
+
+    def scan(self, index, count=10):
+        cursor, found = index.scan(0, count)
+        while cursor:
+            cursor, result = index.scan(cursor, count)
+            found.extend(result)
+        return found
+
+    def test_next_cursor(self):
+        cursors = [0]
+        while True:
+            cursor = next_cursor(cursors[-1], 7)
+            if not cursor:
+                break
+            cursors.append(cursor)
+        self.assertEqual(cursors, [0, 4, 2, 6, 1, 5, 3, 7])
+
+    def test_scan(self):
+        index = ScanIndex(range(1000))
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(sorted(self.scan(index)), list(range(1000)))
+
+    def test_grow_during_scan(self):
+        index = ScanIndex(range(100))
+        cursor, found = index.scan(0, 10)
+        n = 100
+        while cursor:
+            for _ in range(50):
+                index.add(n)
+                n += 1
+            cursor, result = index.scan(cursor, 10)
+            found.extend(result)
+        self.assertTrue(set(range(100)) <= set(found))
+
+    def test_shrink_during_scan(self):
+        index = ScanIndex(range(2000))
+        cursor, found = index.scan(0, 10)
+        n = 1999
+        while cursor:
+            for _ in range(20):
+                if n >= 1000:
+                    index.remove(n)
+                    n -= 1
+            cursor, result = index.scan(cursor, 10)
+            found.extend(result)
+        self.assertTrue(set(range(1000)) <= set(found))
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(sorted(self.scan(index)), list(range(1000)))
+
+    def test_update(self):
+        index = ScanIndex(range(10))
+        index.update(range(10, 20))
+        index.update(range(20, 1000))
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(sorted(self.scan(index)), list(range(1000)))
+
+    def test_remove_all(self):
+        index = ScanIndex()
+        for n in range(500):
+            index.add(n)
+        for n in range(500):
+            index.remove(n)
+        self.assertEqual(self.scan(index), [])
+        self.assertEqual(index._mask, 3)
+
+    def test_sample(self):
+        index = ScanIndex(range(1000))
+        sample = index.sample(5)
+        self.assertEqual(len(sample), 5)
+        self.assertTrue(set(sample) <= set(range(1000)))
+        sample = index.sample(5, lambda n: n % 100 == 0)
+        self.assertTrue(sample)
+        self.assertTrue(all(n % 100 == 0 for n in sample))
+        self.assertEqual(ScanIndex().sample(5), [])
+
+
+
+class TestIndexedContainers(unittest.TestCase):
+
+    def indexed(self, value):
+        index = value.scan_index
+        self.assertEqual(len(index), len(value))
+        cursor, found = index.scan(0, 10)
+        while cursor:
+            cursor, result = index.scan(cursor, 10)
+            found.extend(result)
+        self.assertEqual(sorted(found), sorted(value))
+
+    def test_set(self):
+        value = IndexedSet(range(100))
+        self.indexed(value)
+        value.add(100)
+        value.update(range(50, 150), [200])
+        value.discard(0)
+        value.remove(1)
+        value.pop()
+        value.difference_update(range(10))
+        self.indexed(value)
+        value.intersection_update(range(100, 300))
+        value.symmetric_difference_update(range(140, 160))
+        value |= set(range(5))
+        value -= set(range(3))
+        self.assertTrue(isinstance(value, IndexedSet))
+        self.indexed(value)
+        self.assertEqual(type(value.union([1])), set)
+        self.assertEqual(pickle.loads(pickle.dumps(value)), set(value))
+        value.clear()
+        self.indexed(value)
+
+    def test_dict(self):
+        value = IndexedDict(((n, n) for n in range(100)))
+        self.indexed(value)
+        value[100] = 100
+        value[0] = 1
+        value.update(((n, n) for n in range(50, 150)))
+        value.update({200: 200})
+        del value[1]
+        value.pop(2)
+        value.pop(2, None)
+        value.popitem()
+        value.setdefault(300, 300)
+        self.indexed(value)
+        self.assertEqual(type(pickle.loads(pickle.dumps(value))), Dict)
+        value.clear()
+        self.indexed(value)
+
+    def test_zset(self):
+        value = IndexedZset(((n, n) for n in range(100)))
+        self.indexed(value)
+        self.assertEqual(value.add(1, 100), 1)
+        self.assertEqual(value.add(2, 1), 0)
+        value.update(((n, n) for n in range(50, 150)))
+        value.remove(3)
+        value.remove_items([4, 5, 1000])
+        value.remove_range(0, 5)
+        value.remove_range_by_score(20, 30)
+        self.indexed(value)
+        self.assertEqual(type(pickle.loads(pickle.dumps(value))), Zset)
+        value.clear()
+        self.indexed(value)
+
+    def test_scan_during_writes(self):
+        value = IndexedSet(range(1000))
+        cursor, found = value.scan_index.scan(0, 10)
+        n = 1000
+        while cursor:
+            for _ in range(20):
+                value.add(n)
+                value.discard(n - 500)
+                n += 1
+            cursor, result = value.scan_index.scan(cursor, 10)
+            found.extend(result)
+        self.assertTrue(set(value) & set(range(1000)) <= set(found))
+
+
+class TestObjectMemory(unittest.TestCase):
+
+    def test_string(self):
+        small = object_memory(b'key', bytearray(10))
+        large = object_memory(b'key', bytearray(10000))
+        self.assertEqual(large - small, 9990)
+
+    def test_containers(self):
+        for value in (set(range(1000)), Deque(range(1000)),
+                      Dict(((n, n) for n in range(1000))),
+                      Zset(((n, n) for n in range(1000)))):
+            small = object_memory(b'key', type(value)())
+            self.assertTrue(object_memory(b'key', value) > small + 1000*24)
+
+
+class TestStringEncoding(unittest.TestCase):
+
+    def test_encode_string(self):
+        self.assertEqual(encode_string(b'0'), 0)
+        self.assertEqual(encode_string(b'-42'), -42)
+        self.assertEqual(encode_string(b'9223372036854775807'), 2**63 - 1)
+        for value in (b'', b'-', b'-0', b'007', b'1.5', b' 1', b'1 ', b'1_0',
+                      b'9223372036854775808', b'foo'):
+            encoded = encode_string(value)
+            self.assertEqual(type(encoded), bytes)
+            self.assertEqual(encoded, value)
+
+    def test_string_bytes(self):
+        self.assertEqual(string_bytes(-42), b'-42')
+        self.assertEqual(string_bytes(b'foo'), b'foo')
+        value = string_bytes(bytearray(b'foo'))
+        self.assertEqual(type(value), bytes)
+        self.assertEqual(value, b'foo')
+
+
+class TestBits(unittest.TestCase):
+
+    def test_count_bytes(self):
+        self.assertEqual(count_bytes(b''), 0)
+        self.assertEqual(count_bytes(bytes(range(256))), 1024)
+        self.assertEqual(count_bytes(bytearray(b'\xff\x01')), 9)
+
+    def test_bit_operation(self):
+        self.assertEqual(bit_operation(b'not', [b'\x0f\xff']), b'\xf0\x00')
+        strings = [b'\x0f\x01', b'\x3c']
+        self.assertEqual(bit_operation(b'and', strings), b'\x0c\x00')
+        self.assertEqual(bit_operation(b'or', strings), b'\x3f\x01')
+        self.assertEqual(bit_operation(b'xor', strings), b'\x33\x01')
+
+    def test_bit_position(self):
+        self.assertEqual(bit_position(b'\x00\x20', 1), 10)
+        self.assertEqual(bit_position(b'\xff\xfe', 0), 15)
+        self.assertEqual(bit_position(b'\xff', 0), 8)
+        self.assertEqual(bit_position(b'\xff', 0, 0, 1), -1)
+        self.assertEqual(bit_position(b'\x80\x00', 1, 1), -1)
+
+    def test_get_set_bits(self):
+        string = bytearray()
+        set_bits(string, 5, 7, 0x7f)
+        self.assertEqual(string, b'\x07\xf0')
+        self.assertEqual(get_bits(string, 5, False, 7), 0x7f)
+        self.assertEqual(get_bits(string, 5, True, 7), -1)
+        self.assertEqual(get_bits(string, 12, False, 8), 0)
+        set_bits(string, 4, 4, -2)
+        self.assertEqual(string, b'\x0e\xf0')
+
+    def test_bitfield_overflow(self):
+        self.assertEqual(bitfield_overflow(300, False, 8, b'wrap'), 44)
+        self.assertEqual(bitfield_overflow(128, True, 8, b'wrap'), -128)
+        self.assertEqual(bitfield_overflow(-129, True, 8, b'sat'), -128)
+        self.assertEqual(bitfield_overflow(-1, False, 8, b'sat'), 0)
+        self.assertEqual(bitfield_overflow(256, False, 8, b'fail'), None)
+        self.assertEqual(bitfield_overflow(255, False, 8, b'fail'), 255)
+
+
+class TestSortElements(unittest.TestCase):
+
+    def test_sort(self):
+        elements = [b'3', b'x', b'1', b'2', b'y', b'1']
+        self.assertEqual(sort_elements(elements, elements),
+                         [b'1', b'1', b'2', b'3', b'x', b'y'])
+        self.assertEqual(sort_elements(elements, elements, desc=True),
+                         [b'3', b'2', b'1', b'1', b'x', b'y'])
+        self.assertEqual(sort_elements(elements, elements, alpha=True,
+                                       desc=True),
+                         [b'y', b'x', b'3', b'2', b'1', b'1'])
+
+    def test_weights(self):
+        elements = [b'a', b'b', b'c', b'd']
+        weights = [b'2', None, b'1', b'1']
+        self.assertEqual(sort_elements(elements, weights),
+                         [b'c', b'd', b'a', b'b'])
+        self.assertEqual(sort_elements(elements, weights, desc=True),
+                         [b'a', b'c', b'd', b'b'])
+
+    def test_heap_select(self):
+        size = 100*HEAP_SELECT_RATIO
+        elements = [str(n).encode('utf-8') for n in range(size, 0, -1)]
+        elements.append(b'nan?')
+        result = sort_elements(elements, elements, end=10)
+        self.assertEqual(result, [str(n).encode('utf-8')
+                                  for n in range(1, 11)])
+        result = sort_elements(elements, elements, desc=True, end=10)
+        self.assertEqual(result, [str(n).encode('utf-8')
+                                  for n in range(size, size - 10, -1)])
+        result = sort_elements(elements, elements, end=size)
+        self.assertEqual(len(result), size + 1)
+        self.assertEqual(result[-1], b'nan?')
+
+
+def members(*args):
+    return [str(n).encode('utf-8') for n in range(*args)]
+
+
+class TestSetOperation(unittest.TestCase):
+
+    def test_operations(self):
+        a = set(members(10))
+        b = ListpackSet(members(5, 15))
+        c = set(members(8, 30))
+        self.assertEqual(set_operation('intersection', [a, b, c]),
+                         set(members(8, 10)))
+        self.assertEqual(set_operation('union', [a, b, c]),
+                         set(members(30)))
+        self.assertEqual(set_operation('difference', [a, b]),
+                         set(members(5)))
+        self.assertEqual(set_operation('difference', [c, b, a]),
+                         set(members(15, 30)))
+        self.assertEqual(a, set(members(10)))
+        self.assertEqual(list(b), members(5, 15))
+
+    def test_single_operand(self):
+        a = set(members(10))
+        for oper in ('intersection', 'union', 'difference'):
+            self.assertIs(set_operation(oper, [a]), a)
+
+    def test_empty(self):
+        a = set(members(10))
+        self.assertEqual(set_operation('intersection', [a, set(), a]), set())
+        self.assertEqual(set_operation('difference', [a, a, set()]), set())
+        empty = set()
+        self.assertIs(set_operation('difference', [empty, a]), empty)
+
+    def test_intersection_count(self):
+        a = set(members(100))
+        b = ListpackSet(members(50, 60))
+        self.assertEqual(intersection_count([a, b]), 10)
+        self.assertEqual(intersection_count([a, b], 3), 3)
+        self.assertEqual(intersection_count([a, b, set()]), 0)
+        self.assertEqual(intersection_count([a]), 100)
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def counter(self, start, stop):
+        hll = HyperLogLog()
+        hll.update(('%s' % n).encode('utf-8') for n in range(start, stop))
+        return hll
+
+    def test_count(self):
+        hll = HyperLogLog()
+        self.assertEqual(hll.count(), 0)
+        self.assertTrue(hll.add(b'a'))
+        self.assertFalse(hll.add(b'a'))
+        self.assertEqual(hll.count(), 1)
+        hll = self.counter(0, 100000)
+        self.assertEqual(hll.encoding, 'sparse')
+        self.assertAlmostEqual(hll.count()/100000, 1, delta=0.03)
+        hll.to_dense()
+        self.assertEqual(hll.encoding, 'dense')
+        self.assertAlmostEqual(hll.count()/100000, 1, delta=0.03)
+
+    def test_serialization(self):
+        hll = self.counter(0, 100)
+        data = hll.to_bytes()
+        self.assertEqual(len(data), 5 + hll.sparse_size())
+        other = HyperLogLog.from_bytes(data)
+        self.assertEqual(other.encoding, 'sparse')
+        self.assertEqual(other.count(), hll.count())
+        hll.to_dense()
+        data = hll.to_bytes()
+        self.assertEqual(len(data), 5 + REGISTERS)
+        self.assertEqual(HyperLogLog.from_bytes(data).count(), hll.count())
+        for data in (b'', b'HYLL', b'HYLL\x02', b'HYLL\x01\x00',
+                     b'HYLL\x01\xff\xff\x01', b'HYLL\x00\x00',
+                     b'HYLL\x01\x00\x00\x40'):
+            self.assertRaises(ValueError, HyperLogLog.from_bytes, data)
+
+    def test_merge(self):
+        hll = self.counter(0, 1000)
+        dense = self.counter(500, 3000)
+        dense.to_dense()
+        sparse = self.counter(2000, 4000)
+        self.assertTrue(hll.merge(dense, sparse))
+        self.assertEqual(hll.encoding, 'dense')
+        self.assertAlmostEqual(hll.count()/4000, 1, delta=0.03)
+        self.assertFalse(hll.merge(dense, sparse))
+
+
+class TestStream(unittest.TestCase):
+
+    def stream(self, size):
+        stream = Stream()
+        for n in range(1, size + 1):
+            stream.add(n << 64, (b'n', n))
+        return stream
+
+    def test_ids(self):
+        self.assertEqual(parse_id(b'5'), 5 << 64)
+        self.assertEqual(parse_id(b'5', 7), 5 << 64 | 7)
+        self.assertEqual(parse_id(b'5-3'), 5 << 64 | 3)
+        self.assertEqual(format_id(5 << 64 | 3), b'5-3')
+        for value in (b'', b'-1', b'5-', b'a-1', b'1-2-3', b'+1',
+                      b'%d' % 2**64):
+            self.assertRaises(StreamIdError, parse_id, value)
+        stream = Stream()
+        self.assertEqual(stream.next_id(0), 1)
+        stream.add(5 << 64 | 3, ())
+        self.assertEqual(stream.next_id(5), 5 << 64 | 4)
+        self.assertEqual(stream.next_id(6), 6 << 64)
+        self.assertEqual(stream.next_id(4), None)
+        self.assertEqual(stream.next_id(5, 3), None)
+        self.assertEqual(stream.next_id(5, 9), 5 << 64 | 9)
+
+    def test_range(self):
+        stream = self.stream(3*CHUNK_ENTRIES)
+        ids = [n for n, _ in stream.range(150 << 64, 260 << 64)]
+        self.assertEqual(ids, [n << 64 for n in range(150, 261)])
+        ids = [n for n, _ in stream.revrange(260 << 64, 150 << 64)]
+        self.assertEqual(ids, [n << 64 for n in range(260, 149, -1)])
+        self.assertEqual(len(list(stream.range())), 3*CHUNK_ENTRIES)
+        self.assertEqual(len(list(stream.revrange())), 3*CHUNK_ENTRIES)
+        self.assertEqual(list(stream.range(1000 << 64)), [])
+        self.assertEqual(list(stream.revrange(0)), [])
+        self.assertEqual(stream.get(120 << 64), (b'n', 120))
+        self.assertEqual(stream.get(120 << 64 | 1), None)
+
+    def test_trim(self):
+        stream = self.stream(3*CHUNK_ENTRIES)
+        self.assertEqual(stream.trim(250, True), 0)
+        self.assertEqual(stream.trim(150, True), CHUNK_ENTRIES)
+        self.assertEqual(stream.trim(150), CHUNK_ENTRIES//2)
+        self.assertEqual(len(stream), 150)
+        ids = [n for n, _ in stream.range()]
+        self.assertEqual(ids, [n << 64 for n in range(151, 301)])
+        self.assertEqual(stream.trim(0), 150)
+        self.assertEqual(list(stream.range()), [])
+        self.assertEqual(stream.last_id, 300 << 64)
+
+    def test_consumer_group(self):
+        group = ConsumerGroup(0)
+        group.consumer(b'a', 1)
+        group.consumer(b'b', 1)
+        for id in (3, 1, 2):
+            group.deliver(b'a', id, 10)
+        group.deliver(b'b', 2, 20)
+        self.assertEqual(group.pending_ids, [1, 2, 3])
+        self.assertEqual(group.consumers[b'a'].pending, [1, 3])
+        self.assertEqual(list(group.pending_range(2, 3)), [2, 3])
+        consumer = group.consumers[b'b']
+        self.assertEqual(list(group.pending_range(0, 9, consumer)), [2])
+        self.assertTrue(group.ack(1))
+        self.assertFalse(group.ack(1))
+        self.assertEqual(group.delete_consumer(b'a'), 1)
+        self.assertEqual(group.pending_ids, [2])
+
+
+class Loop:
+
+    def __init__(self):
+        self.callbacks = []
+
+    def call_soon(self, callback):
+        self.callbacks.append(callback)
+
+    def run(self):
+        iterations = 0
+        while self.callbacks:
+            self.callbacks.pop(0)()
+            iterations += 1
+        return iterations
+
+
+class TestLazyFree(unittest.TestCase):
+
+    def test_small_values(self):
+        lazyfree = LazyFree(Loop())
+        self.assertFalse(lazyfree.free(set(range(10))))
+        self.assertFalse(lazyfree.free(b'x'*100000))
+        self.assertEqual(len(lazyfree), 0)
+
+    def test_free(self):
+        loop = Loop()
+        lazyfree = LazyFree(loop)
+        zset = Zset()
+        zset.update(((n, n) for n in range(3*FREE_CHUNK)))
+        stream = Stream()
+        for n in range(1, FREE_CHUNK + 1):
+            stream.add(n, ())
+        values = [set(range(2*FREE_CHUNK)), Deque(range(FREE_CHUNK)),
+                  zset, stream]
+        for value in values:
+            self.assertTrue(lazyfree.free(value))
+        self.assertEqual(lazyfree.pending_objects(), 7*FREE_CHUNK)
+        self.assertTrue(lazyfree.pending_memory() > 0)
+        self.assertEqual(len(loop.callbacks), 1)
+        self.assertEqual(loop.run(), 7)
+        self.assertEqual([len(value) for value in values], [0, 0, 0, 0])
+        self.assertEqual(lazyfree.pending_objects(), 0)
+        self.assertEqual(lazyfree.pending_memory(), 0)
+        self.assertEqual(lazyfree.freed_objects, 7*FREE_CHUNK)
+
+    def test_free_keyspace(self):
+        loop = Loop()
+        lazyfree = LazyFree(loop)
+        large = set(range(FREE_CHUNK))
+        data = {b'a': large, b'b': b'x'}
+        data.update(((n, n) for n in range(100)))
+        self.assertTrue(lazyfree.free(data))
+        loop.run()
+        self.assertEqual(len(data), 0)
+        self.assertEqual(len(large), 0)
+        self.assertEqual(lazyfree.freed_objects, 102 + FREE_CHUNK)
+
+
+class TestListpack(unittest.TestCase):
+
+    def test_hash(self):
+        hash = ListpackHash(((b'a', b'1'), (b'b', b'2')))
+        hash[b'a'] = b'3'
+        self.assertEqual(hash.flat(), [b'a', b'3', b'b', b'2'])
+        self.assertEqual(hash.pop(b'a'), b'3')
+        self.assertEqual(hash.pop(b'a'), None)
+        self.assertRaises(KeyError, lambda: hash[b'a'])
+        hash[b'c'] = 12
+        self.assertEqual(hash.convert(), {b'b': b'2', b'c': 12})
+        self.assertTrue(hash.fits(2, 1))
+        hash[b'd'] = b'xx'
+        self.assertFalse(hash.fits(3, 1))
+        self.assertFalse(hash.fits(2, 2))
+
+    def test_list(self):
+        full = Deque()
+        chunked = Quicklist(chunk_size=2)
+        compact = ListpackList()
+        for value in (full, chunked, compact):
+            value.extend((b'a', b'b', b'a'))
+            value.extendleft((b'c', b'a'))
+            value.appendleft(b'd')
+            value.insert_after(b'c', b'e')
+            value.insert_before(b'x', b'y')
+            self.assertEqual(value.remove(b'a', -1), 1)
+        self.assertEqual(list(compact), list(full))
+        self.assertEqual(list(chunked), list(full))
+        self.assertEqual(compact.range(1, 3), chunked.range(1, 3))
+        self.assertEqual(compact.remove(b'a', 0), 2)
+        compact.trim(1, 3)
+        self.assertEqual(list(compact), [b'c', b'e'])
+        self.assertEqual(compact.popleft(), b'c')
+        self.assertEqual(type(compact.convert()), Quicklist)
+
+    def test_set(self):
+        value = ListpackSet((b'a', b'b', b'a'))
+        self.assertEqual(len(value), 2)
+        self.assertEqual(value.union((b'c',)), {b'a', b'b', b'c'})
+        self.assertEqual(value.intersection({b'b'}), {b'b'})
+        self.assertEqual(value.difference([b'b']), {b'a'})
+        self.assertRaises(KeyError, value.remove, b'c')
+        self.assertTrue(value.pop() in (b'a', b'b'))
+        self.assertEqual(len(value), 1)
+
+    def test_zset(self):
+        pairs = [(3, b'c'), (1, b'b'), (2, b'x'), (1, b'a'), (5, b'e')]
+        compact = ListpackZset(pairs)
+        full = Zset(pairs)
+        self.assertEqual(list(compact), [b'a', b'b', b'x', b'c', b'e'])
+        self.assertEqual(compact, full)
+        self.assertEqual(compact.add(4, b'x'), 0)
+        self.assertEqual(compact.add(4, b'x'), 0)
+        self.assertEqual(compact.rank(b'x'), 3)
+        self.assertEqual(compact.score(b'x'), 4)
+        self.assertEqual(compact.count(1, 4), 4)
+        self.assertEqual(compact.count(1, 4, False, False), 1)
+        self.assertEqual(list(compact.range(1, 3, True)),
+                         [(1, b'b'), (3, b'c')])
+        self.assertEqual(list(compact.range_by_score(1, 5, start=1, num=2)),
+                         [b'b', b'c'])
+        self.assertEqual(compact.remove_range_by_score(1, 3, False), 1)
+        self.assertEqual(compact.remove_range(0, -1), 3)
+        self.assertEqual(compact.flat(), (5, b'e'))
+        self.assertEqual(compact.convert(), Zset([(5, b'e')]))
+        self.assertRaises(ValueError, compact.add, float('nan'), b'a')
+
+
+class TestCommandStats(unittest.TestCase):
+
+    def test_buckets(self):
+        for usec in (0, 1, 15, 16, 17, 100, 1000, 123456789):
+            bucket = latency_bucket(usec)
+            self.assertTrue(bucket_limit(bucket - 1) < usec <=
+                            bucket_limit(bucket) <= 1.125*usec + 1)
+
+    def test_percentiles(self):
+        stats = CommandStats()
+        for usec in range(1, 1001):
+            stats.add(usec)
+        info = stats.info()
+        self.assertEqual(info['calls'], 1000)
+        self.assertEqual(info['usec'], 500500)
+        self.assertEqual(info['usec_per_call'], '500.50')
+        self.assertTrue(500 <= info['p50'] <= 500*1.125)
+        self.assertTrue(990 <= info['p99'] <= 1000*1.125)
+        self.assertTrue(info['p99'] <= info['p99.9'])
+
+
+class TestSlowLog(unittest.TestCase):
+
+    def test_bounded(self):
+        log = SlowLog(0, 3)
+        for n in range(5):
+            log.add(['get', str(n).encode('utf-8')], n)
+        self.assertEqual(len(log), 3)
+        entries = log.get()
+        self.assertEqual([e[0] for e in entries], [4, 3, 2])
+        self.assertEqual(entries[0][3], [b'get', b'4'])
+        self.assertEqual(len(log.get(1)), 1)
+        log.reset()
+        self.assertEqual(log.get(), [])
+        self.assertEqual(SlowLog(-1, 3).threshold, None)
+
+    def test_truncated_arguments(self):
+        log = SlowLog(0, 3)
+        log.add(['sadd'] + [b'x'*200]*40, 1)
+        args = log.get()[0][3]
+        self.assertEqual(len(args), 32)
+        self.assertEqual(args[1], b'x'*128 + b'... (72 more bytes)')
+        self.assertEqual(args[-1], b'... (10 more arguments)')
+
+
+class TestPatternIndex(unittest.TestCase):
+
+    def index(self, *patterns):
+        index = PatternIndex()
+        for pattern in patterns:
+            value = pubsub_patterns(
+                re.compile(redis_to_py_pattern(pattern.decode('utf-8'))),
+                pattern)
+            index.add(pattern, value)
+        return index
+
+    def match(self, index, channel):
+        return sorted((p.clients for p in index.match(channel)))
+
+    def test_literal_prefix(self):
+        self.assertEqual(literal_prefix(b'foo.*'), b'foo.')
+        self.assertEqual(literal_prefix(b'f?o'), b'f')
+        self.assertEqual(literal_prefix(b'[ab]c'), b'')
+        self.assertEqual(literal_prefix(b'foo'), b'foo')
+
+    def test_match(self):
+        index = self.index(b'*', b'news.*', b'news.?t', b'news.art',
+                           b'sport.*', b'n[ae]ws.*')
+        self.assertEqual(len(index), 6)
+        self.assertEqual(self.match(index, b'news.art'),
+                         [b'*', b'n[ae]ws.*', b'news.*', b'news.art'])
+        self.assertEqual(self.match(index, b'news.it'),
+                         [b'*', b'n[ae]ws.*', b'news.*', b'news.?t'])
+        self.assertEqual(self.match(index, b'naws.it'),
+                         [b'*', b'n[ae]ws.*'])
+        self.assertEqual(self.match(index, b'sport'), [b'*'])
+
+    def test_cache_invalidation(self):
+        index = self.index(b'news.*')
+        self.assertEqual(self.match(index, b'news.art'), [b'news.*'])
+        value = pubsub_patterns(re.compile(r'news\.a.*'), b'news.a*')
+        index.add(b'news.a*', value)
+        self.assertEqual(self.match(index, b'news.art'),
+                         [b'news.*', b'news.a*'])
+        index.remove(b'news.*')
+        self.assertEqual(self.match(index, b'news.art'), [b'news.a*'])
+        index.remove(b'news.a*')
+        self.assertEqual(self.match(index, b'news.art'), [])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index._root, [{}, {}])
+
+    def test_cache_size(self):
+        index = PatternIndex(cache_size=10)
+        for n in range(25):
+            index.match(str(n).encode('utf-8'))
+        self.assertTrue(len(index._cache) <= 10)
@@ -0,0 +1,157 @@
+import pickle
+import unittest
+from random import randint, choice
+
+from pulsar.utils.structures import Quicklist
+
+
+class TestQuicklist(unittest.TestCase):
+
+    def check(self, ql, items):
+        self.assertEqual(len(ql), len(items))
+        self.assertEqual(list(ql), items)
+        self.assertEqual(list(reversed(ql)), items[::-1])
+        for index in range(0, len(items), 7):
+            self.assertEqual(ql[index], items[index])
+        for chunk in ql._chunks:
+            self.assertTrue(0 < len(chunk) <= ql._chunk_size)
+
+    def test_push_pop(self):
+        ql = Quicklist(chunk_size=4)
+        items = []
+        for n in range(200):
+            if n % 3:
+                ql.append(n)
+                items.append(n)
+            else:
+                ql.appendleft(n)
+                items.insert(0, n)
+        self.check(ql, items)
+        ql.extend(range(10))
+        ql.extendleft(range(10))
+        items = list(range(9, -1, -1)) + items + list(range(10))
+        self.check(ql, items)
+        while items:
+            if len(items) % 2:
+                self.assertEqual(ql.pop(), items.pop())
+            else:
+                self.assertEqual(ql.popleft(), items.pop(0))
+            if not len(items) % 20:
+                self.check(ql, items)
+        self.assertRaises(IndexError, ql.pop)
+        self.assertRaises(IndexError, ql.popleft)
+
+    def test_getitem_setitem(self):
+        ql = Quicklist(range(100), chunk_size=8)
+        for _ in range(30):
+            ql.appendleft(-1)
+            ql.popleft()
+            ql.popleft()
+        items = list(range(30, 100))
+        self.check(ql, items)
+        self.assertEqual(ql[-1], 99)
+        ql[10] = 'x'
+        items[10] = 'x'
+        self.check(ql, items)
+        self.assertRaises(IndexError, lambda: ql[70])
+        self.assertRaises(IndexError, lambda: ql[-71])
+
+    def test_insert(self):
+        ql = Quicklist(range(50), chunk_size=4)
+        items = list(range(50))
+        for _ in range(200):
+            index = randint(-2, len(items) + 2)
+            ql.insert(index, 'v')
+            items.insert(max(index, 0), 'v')
+        self.check(ql, items)
+        ql.insert_before(30, 'before')
+        items.insert(items.index(30), 'before')
+        ql.insert_after(30, 'after')
+        items.insert(items.index(30) + 1, 'after')
+        ql.insert_before('missing', 'x')
+        self.check(ql, items)
+        self.assertEqual(ql.index(30), items.index(30))
+        self.assertRaises(ValueError, ql.index, 'missing')
+
+    def test_range(self):
+        ql = Quicklist(range(100), chunk_size=8)
+        items = list(range(100))
+        for start, end in ((0, None), (5, 17), (-20, -3), (90, 200),
+                           (40, 30), (-200, 3)):
+            self.assertEqual(ql.range(start, end),
+                             items[max(start, -100):end])
+
+    def test_remove(self):
+        for count in (0, 3, -3, 100, -100):
+            items = [choice('abc') for _ in range(300)]
+            ql = Quicklist(items, chunk_size=8)
+            removed = ql.remove('a', count)
+            expected = items.count('a')
+            if count:
+                expected = min(abs(count), expected)
+            self.assertEqual(removed, expected)
+            if count < 0:
+                items.reverse()
+            for _ in range(expected):
+                items.remove('a')
+            if count < 0:
+                items.reverse()
+            self.check(ql, items)
+        self.assertEqual(ql.remove('x', 0), 0)
+
+    def test_trim(self):
+        for start, end in ((0, 100), (10, 60), (33, 34), (-20, 200),
+                           (50, 10)):
+            ql = Quicklist(range(100), chunk_size=8)
+            ql.trim(start, end)
+            self.check(ql, list(range(100))[start:end])
+            ql.appendleft('x')
+            ql.append('y')
+            self.check(ql, ['x'] + list(range(100))[start:end] + ['y'])
+
+    def test_random_operations(self):
+        ql = Quicklist(chunk_size=4)
+        items = []
+        for _ in range(2000):
+            op = randint(0, 7)
+            if op == 0:
+                ql.append(len(items))
+                items.append(len(items))
+            elif op == 1:
+                ql.appendleft(len(items))
+                items.insert(0, len(items))
+            elif op == 2 and items:
+                self.assertEqual(ql.pop(), items.pop())
+            elif op == 3 and items:
+                self.assertEqual(ql.popleft(), items.pop(0))
+            elif op == 4:
+                index = randint(0, len(items))
+                ql.insert(index, 'i')
+                items.insert(index, 'i')
+            elif op == 5 and items:
+                index = randint(0, len(items) - 1)
+                self.assertEqual(ql[index], items[index])
+            elif op == 6:
+                count = randint(-2, 2)
+                removed = ql.remove('i', count)
+                if count < 0:
+                    items.reverse()
+                for _ in range(removed):
+                    items.remove('i')
+                if count < 0:
+                    items.reverse()
+                if not count:
+                    self.assertNotIn('i', items)
+            elif op == 7 and len(items) > 20:
+                start = randint(0, 5)
+                end = len(items) - randint(0, 5)
+                ql.trim(start, end)
+                items = items[start:end]
+        self.check(ql, items)
+
+    def test_pickle(self):
+        ql = Quicklist(range(1000))
+        ql.popleft()
+        self.assertEqual(pickle.loads(pickle.dumps(ql)), ql)
+        self.assertEqual(ql, list(range(1, 1000)))
+        self.assertNotEqual(ql, list(range(1000)))
@@ -0,0 +1,126 @@
+import unittest
+from random import randint, random
+
+from pulsar.utils.structures import SortedList, Zset
+
+
+class TestSortedList(unittest.TestCase):
+
+    def random(self, size=500, scores=10, load=4):
+        # few scores shared by many values, small blocks
+        pairs = [(randint(0, scores), 'v%d' % n) for n in range(size)]
+        return SortedList(pairs, load=load), sorted(pairs)
+
+    def check(self, sl, pairs):
+        self.assertEqual(len(sl), len(pairs))
+        self.assertEqual(list(sl), pairs)
+        load = sl._load
+        for block in sl._blocks[:-1]:
+            self.assertTrue(0 < len(block) <= 2*load)
+        self.assertEqual(sl._maxes, [block[-1] for block in sl._blocks])
+
+    def test_insert_remove(self):
+        sl = SortedList(load=4)
+        pairs = []
+        for n in range(300):
+            pair = (randint(0, 5), 'v%d' % n)
+            sl.insert(*pair)
+            pairs.append(pair)
+        pairs.sort()
+        self.check(sl, pairs)
+        while pairs:
+            pair = pairs.pop(randint(0, len(pairs) - 1))
+            self.assertTrue(sl.remove(*pair))
+            self.assertFalse(sl.remove(*pair))
+            if not len(pairs) % 50:
+                self.check(sl, pairs)
+        self.check(sl, [])
+        self.assertRaises(ValueError, sl.insert, float('nan'), 'a')
+
+    def test_bulk_load(self):
+        sl, pairs = self.random(load=4)
+        self.assertEqual(len(sl._blocks), 125)
+        self.check(sl, pairs)
+        sl.insert(3, 'x')
+        pairs = sorted(pairs + [(3, 'x')])
+        self.check(sl, pairs)
+
+    def test_rank(self):
+        sl, pairs = self.random()
+        for index, pair in enumerate(pairs):
+            self.assertEqual(sl.rank(*pair), index)
+            self.assertEqual(sl[index], pair)
+        self.assertEqual(sl[-1], pairs[-1])
+        self.assertEqual(sl.rank(3, 'missing'), None)
+        self.assertEqual(sl.rank(100, 'missing'), None)
+        self.assertRaises(IndexError, lambda: sl[len(pairs)])
+
+    def test_range(self):
+        sl, pairs = self.random()
+        for start, end in ((0, None), (3, 40), (17, -5), (-30, -2),
+                           (490, 600), (40, 3)):
+            self.assertEqual(list(sl.range(start, end, True)),
+                             pairs[start:end])
+            self.assertEqual(list(sl.range(start, end)),
+                             [v for _, v in pairs[start:end]])
+
+    def test_range_by_score(self):
+        sl, pairs = self.random(scores=100)
+        for minval, maxval in ((-1, 200), (10, 20), (10.5, 20), (20, 10),
+                               (30, 30)):
+            for include_min in (True, False):
+                for include_max in (True, False):
+                    expected = [(s, v) for s, v in pairs
+                                if (minval <= s if include_min
+                                    else minval < s) and
+                                (s <= maxval if include_max else s < maxval)]
+                    result = list(sl.range_by_score(
+                        minval, maxval, include_min, include_max,
+                        scores=True))
+                    self.assertEqual(result, expected)
+                    self.assertEqual(
+                        sl.count(minval, maxval, include_min, include_max),
+                        len(expected))
+                    result = list(sl.range_by_score(
+                        minval, maxval, include_min, include_max,
+                        start=2, num=3, scores=True))
+                    self.assertEqual(result, expected[2:5])
+
+    def test_remove_range(self):
+        sl, pairs = self.random()
+        removed = []
+        self.assertEqual(sl.remove_range(100, 350,
+                                         lambda s, v: removed.append((s, v))),
+                         250)
+        self.assertEqual(removed, pairs[100:350])
+        del pairs[100:350]
+        self.check(sl, pairs)
+        self.assertEqual(sl.remove_range(-10, None), 10)
+        del pairs[-10:]
+        self.check(sl, pairs)
+        self.assertEqual(sl.remove_range_by_score(2, 4), len(
+            [s for s, _ in pairs if 2 <= s <= 4]))
+        pairs = [(s, v) for s, v in pairs if not 2 <= s <= 4]
+        self.check(sl, pairs)
+        while sl:
+            index = randint(0, len(sl) - 1)
+            self.assertEqual(sl.remove_range(index, index + 1), 1)
+            del pairs[index]
+        self.check(sl, [])
+
+
+class TestZsetSameScore(unittest.TestCase):
+
+    def test_rank_and_remove(self):
+        zset = Zset(((1.5, 'm%04d' % n) for n in range(2000)))
+        zset.add(0.5, 'first')
+        self.assertEqual(zset.rank('first'), 0)
+        self.assertEqual(zset.rank('m0000'), 1)
+        self.assertEqual(zset.rank('m1999'), 2000)
+        self.assertEqual(zset.remove('m1000'), 1.5)
+        self.assertEqual(zset.rank('m1999'), 1999)
+        self.assertEqual(zset.add(random() - 1, 'm1999'), 0)
+        self.assertEqual(zset.rank('m1999'), 0)
+        self.assertTrue('m0001' in zset)
+        self.assertFalse('m1000' in zset)
+        self.assertEqual(len(zset), 2000)
@@ -93,3 +93,37 @@ class TestZset(unittest.TestCase):
                        (4, 'b'), (5, 'c')])
         self.assertEqual(s.remove_range(1, 4), 3)
         self.assertEqual(s, self.zset([(1.2, 'bla'), (5, 'c')]))
+
+    def test_union(self):
+        a = self.zset([(1, 'a'), (2, 'b'), (3, 'c')])
+        b = self.zset([(4, 'b'), (5, 'd')])
+        s = Zset.union((a, b), (1, 2), sum)
+        self.assertEqual(s, self.zset([(1, 'a'), (10, 'b'), (3, 'c'),
+                                       (10, 'd')]))
+        self.assertEqual(list(s), ['a', 'c', 'b', 'd'])
+        s = Zset.union((a, b), (1, 1), min)
+        self.assertEqual(s.score('b'), 2)
+        s = Zset.union((a, b), (1, 1), max)
+        self.assertEqual(s.score('b'), 4)
+        s = Zset.union((a, b), (0, float('inf')), sum)
+        self.assertEqual(s.score('a'), 0)
+        self.assertEqual(s.score('b'), float('inf'))
+
+    def test_inter(self):
+        a = self.zset([(1, 'a'), (2, 'b'), (3, 'c')])
+        b = self.zset([(4, 'b'), (5, 'c'), (6, 'd')])
+        c = self.zset([(7, 'c'), (8, 'b')])
+        s = Zset.inter((a, b, c), (1, 1, 2), sum)
+        self.assertEqual(s, self.zset([(22, 'b'), (22, 'c')]))
+        self.assertEqual(list(s), ['b', 'c'])
+        s = Zset.inter((a, b, c), (1, 1, 1), max)
+        self.assertEqual(s, self.zset([(8, 'b'), (7, 'c')]))
+        s = Zset.inter((a, b, c, self.zset()), (1, 1, 1, 1), min)
+        self.assertFalse(s)
+
+    def test_diff(self):
+        a = self.zset([(1, 'a'), (2, 'b'), (3, 'c')])
+        b = self.zset([(4, 'b')])
+        s = Zset.diff((a, b, self.zset()))
+        self.assertEqual(s, self.zset([(1, 'a'), (3, 'c')]))
+        self.assertFalse(Zset.diff((b, a)))